@@ -10,11 +10,13 @@
 # pylint: disable=wrong-import-order, global-statement, too-many-arguments
 # pylint: disable=too-many-positional-arguments
 
+import asyncio
 import fastapi
 import logging
+import math
 import time
 import uvicorn
-from typing import Any, Awaitable, Callable, Dict, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
 
 
 import afc_server_compute
@@ -25,6 +27,7 @@ import afc_traffic_metrics
 import appcfg
 from log_utils import dp, get_module_logger, set_dp_printer, set_parent_logger
 import prometheus_utils
+import stack_sampler
 
 __all__ = ["app"]
 
@@ -32,6 +35,14 @@ settings = afc_server_models.AfcServerSettings()
 g_message_processor: \
     Optional[afc_server_msg_proc.AfcServerMessageProcessor] = None
 
+# On-demand profiler (None if not enabled)
+g_profiler: Optional[stack_sampler.WorkerProfiler] = \
+    stack_sampler.WorkerProfiler(
+        directory=settings.profiler_dir,
+        min_start_interval_sec=settings.profiler_min_interval,
+        max_duration_sec=settings.profiler_max_duration) \
+    if settings.profiler_dir else None
+
 PARENT_LOGGER = "uvicorn.error"
 set_parent_logger(PARENT_LOGGER)
 LOGGER = get_module_logger()
@@ -58,7 +69,9 @@ async def get_message_processor() \
                 rmq_password_file=settings.rmq_password_file,
                 engine_request_type=settings.engine_request_type,
                 worker_mnt_root=settings.static_data_root or
-                appcfg.NFS_MOUNT_PATH)
+                appcfg.NFS_MOUNT_PATH,
+                coalesce=settings.rmq_coalesce,
+                worker_stage_timing=settings.worker_stage_timing)
         g_message_processor = \
             afc_server_msg_proc.AfcServerMessageProcessor(
                 db=db, compute=compute,
@@ -80,6 +93,8 @@ async def startup() -> None:
     set_dp_printer(fastapi.logger.logger.error)
     if settings.log_level is not None:
         logging.getLogger(PARENT_LOGGER).setLevel(settings.log_level.upper())
+    if g_profiler is not None:
+        g_profiler.start()
 
 
 @app.on_event("shutdown")
@@ -152,6 +167,46 @@ async def available_spectrum_inquiry_internal(
             internal=True)
 
 
+@app.get("/profile/workers",
+         summary="PIDs of workers that may be profiled (if profiler enabled)")
+async def profile_workers() -> List[int]:
+    """ List of profileable worker PIDs """
+    if g_profiler is None:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_404_NOT_FOUND,
+            detail="Profiler not enabled")
+    return g_profiler.workers()
+
+
+@app.get("/profile", response_class=fastapi.responses.PlainTextResponse,
+         summary="Sample stacks of worker for given time, return folded "
+         "stacks (if profiler enabled)")
+async def profile(
+        duration: float = fastapi.Query(
+            5., title="Profiling duration in seconds"),
+        interval: float = fastapi.Query(
+            stack_sampler.DEFAULT_INTERVAL_SEC,
+            title="Sampling interval in seconds"),
+        pid: Optional[int] = fastapi.Query(
+            None, title="PID of worker to profile. Default is the worker "
+            "that received the request")) -> str:
+    """ On-demand sampling profiling """
+    if g_profiler is None:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_404_NOT_FOUND,
+            detail="Profiler not enabled")
+    try:
+        return \
+            await asyncio.to_thread(
+                g_profiler.profile, duration_sec=duration,
+                interval_sec=interval, pid=pid)
+    except stack_sampler.ProfilerError as ex:
+        raise fastapi.HTTPException(
+            status_code=ex.status, detail=str(ex),
+            headers=None if ex.retry_after is None
+            else {"Retry-After": str(math.ceil(ex.retry_after))})
+
+
 # Exposing Promtheus metrics
 app.mount("/metrics", prometheus_utils.multiprocess_fastapi_metrics())
 
@@ -10,6 +10,7 @@
 # pylint: disable=too-many-instance-attributes
 
 import aio_pika
+import aiormq
 import asyncio
 import os
 import pydantic
@@ -19,7 +20,9 @@ import time
 import traceback
 from typing import Any, Dict, Optional, Set
 
+import afc_traffic_metrics
 import afc_worker
+import defs
 import fst
 from log_utils import dp, error, error_if, get_module_logger
 import rcache_models
@@ -28,6 +31,10 @@ import db_utils
 # Logger for this module
 LOGGER = get_module_logger()
 
+# Runtime options of computations that are never coalesced with other
+# processes (debug computations produce debug files for their own request)
+NON_COALESCED_RUNTIME_OPT = defs.RNTM_OPT_DBG | defs.RNTM_OPT_SLOW_DBG
+
 __all__ = ["AfcServerCompute"]
 
 
@@ -44,15 +51,35 @@ class AfcServerCompute:
     _request_futures     -- Per request hash collection of futures
                             (encapsulated into FutureHolder objects)
     _celery_sender_tasks -- Set of detached tasks, sending requests to celery
+                            (or waiting for identical requests, computed by
+                            other processes) and cleaning up after requests
     _rmq_reader_task     -- Task that reads responses from RMQ queue
     _stopping            -- True if stopping initiated
+    _coalesce            -- True to coalesce identical in-flight computations
+                            with other processes
+    _worker_stage_timing -- True to pass processing stage timing to Worker
+    _rmq_connection      -- RMQ connection. None before reader task creates it
+    _rmq_exchange        -- RMQ exchange. None before reader task creates it
+    _rmq_queue           -- RMQ RX queue. None before reader task creates it
+    _rmq_ready           -- Event, set when RMQ objects are created
+    _marker_channel      -- None or RMQ channel for in-flight markers (it is
+                            closed by RMQ server on failure to claim marker)
+    _subscribed          -- Digests, whose responses are routed to RX queue
+                            regardless of who requested the computation
+    _claimed             -- Digests, whose in-flight markers are held
+    _coalesced           -- Digests of in-flight computations that are
+                            coalesced with other processes
+    _binding_lock        -- Lock serializing subscription changes
     """
     class FutureHolder:
         """ Holder of async.Future that allows it to be put to set
 
         Public attributes:
-        seq    -- Globally unique serial number
-        future -- Future object
+        seq          -- Globally unique serial number
+        future       -- Future object
+        stage_timing -- Processing stage timing (wire form of
+                        afc_traffic_metrics.StageTimer), returned by Worker
+                        along with response. None if not returned
         """
         # Sequential number to use on next creation
         _next_seq = 0
@@ -63,6 +90,7 @@ class AfcServerCompute:
             self.seq = AfcServerCompute.FutureHolder._next_seq
             AfcServerCompute.FutureHolder._next_seq += 1
             self.future: "asyncio.Future[Optional[str]]" = asyncio.Future()
+            self.stage_timing: Optional[str] = None
 
         def __hash__(self) -> int:
             """ Hash value """
@@ -74,7 +102,9 @@ class AfcServerCompute:
                 and (self.seq == other.seq)
 
     def __init__(self, rmq_dsn: str, rmq_password_file: Optional[str],
-                 engine_request_type: str, worker_mnt_root: str) -> None:
+                 engine_request_type: str, worker_mnt_root: str,
+                 coalesce: bool = True,
+                 worker_stage_timing: bool = False) -> None:
         """ Constructor
 
         Arguments:
@@ -82,6 +112,12 @@ class AfcServerCompute:
         rmq_password_file   -- Optional password for AMQP DSN
         engine_request_type -- Value for --request-type AFC Engine parameter
         worker_mnt_root     -- Value for --mnt-path AFC Engine  parameter
+        coalesce            -- True to coalesce identical in-flight
+                               computations with other processes (via
+                               in-flight markers in RabbitMQ)
+        worker_stage_timing -- True to pass processing stage timing to
+                               Worker (Workers that predate it reject such
+                               requests)
         """
         self._rmq_dsn = rmq_dsn
         self._rmq_password_file = rmq_password_file
@@ -95,6 +131,18 @@ class AfcServerCompute:
         self._request_futures: \
             Dict[str, Set["AfcServerCompute.FutureHolder"]] = {}
         self._celery_sender_tasks: Set[asyncio.Task] = set()
+        self._coalesce = coalesce
+        self._worker_stage_timing = worker_stage_timing
+        self._rmq_connection: \
+            Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self._rmq_exchange: Optional[aio_pika.abc.AbstractExchange] = None
+        self._rmq_queue: Optional[aio_pika.abc.AbstractQueue] = None
+        self._rmq_ready = asyncio.Event()
+        self._marker_channel: Optional[aio_pika.abc.AbstractChannel] = None
+        self._subscribed: Set[str] = set()
+        self._claimed: Set[str] = set()
+        self._coalesced: Set[str] = set()
+        self._binding_lock = asyncio.Lock()
         self._rmq_reader_task = \
             asyncio.create_task(self._rmq_reader_worker(), name="RMQ Reader")
         self._stopping = False
@@ -102,7 +150,9 @@ class AfcServerCompute:
     async def process_request(
             self, request_str: str, original_request_str: str, config_str: str,
             req_cfg_digest: str, runtime_opt: int, task_id: str,
-            history_dir: Optional[str], deadline: float) -> Optional[str]:
+            history_dir: Optional[str], deadline: float,
+            stage_timer: Optional[afc_traffic_metrics.StageTimer] = None) \
+            -> Optional[str]:
         """ Process AFC Engine computation request
 
         Arguments:
@@ -115,6 +165,8 @@ class AfcServerCompute:
         task_id              -- Unique request ID
         history_dir          -- None or ObjStore history directory
         deadline             -- Deadline as seconds since Epoch
+        stage_timer          -- Optional timeline of request processing
+                                stages to continue (on Worker and here)
         Returns response (None in case of error) or generates TimeoutError
         """
         timeout = deadline - time.time()
@@ -126,28 +178,40 @@ class AfcServerCompute:
             if future_holders is None:
                 future_holders = {future_holder}
                 self._request_futures[req_cfg_digest] = future_holders
-                celery_sender_task = \
-                    asyncio.create_task(
-                        asyncio.to_thread(
-                            self._send_req_to_celery, request_str=request_str,
-                            original_request_str=original_request_str,
-                            config_str=config_str,
-                            req_cfg_digest=req_cfg_digest,
-                            runtime_opt=runtime_opt, task_id=task_id,
-                            history_dir=history_dir, deadline=deadline),
-                        name=f"Celery sender {future_holder.seq}")
-                self._celery_sender_tasks.add(celery_sender_task)
-                celery_sender_task.add_done_callback(
-                    self._celery_sender_tasks.discard)
+                coalesce = self._coalesce and \
+                    (not (runtime_opt & NON_COALESCED_RUNTIME_OPT))
+                if coalesce:
+                    self._coalesced.add(req_cfg_digest)
+                self._detach(
+                    self._flight(
+                        future_holders=future_holders, coalesce=coalesce,
+                        request_str=request_str,
+                        original_request_str=original_request_str,
+                        config_str=config_str, req_cfg_digest=req_cfg_digest,
+                        runtime_opt=runtime_opt, task_id=task_id,
+                        history_dir=history_dir, deadline=deadline,
+                        stage_timer=stage_timer),
+                    name=f"Celery sender {future_holder.seq}")
             else:
                 future_holders.add(future_holder)
             await asyncio.wait_for(future_holder.future, timeout=timeout)
+            if stage_timer is not None:
+                # Without Worker's timing the whole remote part is attributed
+                # to AFC Engine
+                stage_timer.mark(
+                    "delivery"
+                    if stage_timer.merge_wire(future_holder.stage_timing)
+                    else "engine")
             return future_holder.future.result()
         finally:
             assert future_holders is not None
             future_holders.remove(future_holder)
             if not future_holders:
                 del self._request_futures[req_cfg_digest]
+                if req_cfg_digest in self._coalesced:
+                    self._coalesced.remove(req_cfg_digest)
+                    self._detach(self._unsubscribe(req_cfg_digest),
+                                 name=f"Unsubscriber {future_holder.seq}")
 
     async def close(self) -> None:
         """ Gracefully stops/closes everything """
@@ -177,6 +241,10 @@ class AfcServerCompute:
                     await channel.declare_queue(
                         name=self._rmq_rx_queue_name, exclusive=True)
                 await queue.bind(exchange)
+                self._rmq_connection = connection
+                self._rmq_exchange = exchange
+                self._rmq_queue = queue
+                self._rmq_ready.set()
                 async with queue.iterator(no_ack=True) as queue_iter:
                     async for msg in queue_iter:
                         try:
@@ -186,21 +254,131 @@ class AfcServerCompute:
                             LOGGER.error(f"Decode error on AFC Response Info "
                                          f"arrived from Worker: {ex}")
                             continue
+                        stage_timing = \
+                            (msg.headers or {}).get(
+                                rcache_models.RCACHE_RMQ_STAGE_TIMING_HEADER)
+                        if isinstance(stage_timing, bytes):
+                            stage_timing = stage_timing.decode("utf-8")
                         future_holders = \
                             self._request_futures.get(rrk.req_cfg_digest)
                         for future_holder in (future_holders or set()):
                             if not future_holder.future.done():
+                                future_holder.stage_timing = \
+                                    stage_timing if stage_timing else None
                                 future_holder.future.set_result(rrk.afc_resp)
         except Exception as ex:
             for line in traceback.format_exception(ex):
                 LOGGER.critical(line)
             error(f"Unhandled exception in RMQ reader worker task {ex}")
 
+    def _detach(self, coro: Any, name: str) -> None:
+        """ Runs given coroutine as detached task """
+        task = asyncio.create_task(coro, name=name)
+        self._celery_sender_tasks.add(task)
+        task.add_done_callback(self._celery_sender_tasks.discard)
+
+    async def _flight(
+            self, future_holders: Set["AfcServerCompute.FutureHolder"],
+            coalesce: bool, req_cfg_digest: str, deadline: float,
+            **kwargs: Any) -> None:
+        """ Sends request to Celery, unless identical request is being
+        computed by other process. In latter case waits for response of other
+        process, sending request if that process vanishes
+
+        Arguments:
+        future_holders -- Holders of futures for this request. Waiting stops
+                          when they are no longer waiting for response
+        coalesce       -- True to coalesce computation with other processes
+        req_cfg_digest -- Hash of request and config
+        deadline       -- Deadline as seconds since Epoch
+        kwargs         -- Rest of _send_req_to_celery() arguments
+        """
+        rcache_queue = self._rmq_rx_queue_name
+        if coalesce:
+            try:
+                await asyncio.wait_for(self._rmq_ready.wait(),
+                                       timeout=deadline - time.time())
+                await self._subscribe(req_cfg_digest)
+                while not await self._claim(req_cfg_digest):
+                    # Claim succeeds when other process' marker vanishes
+                    await asyncio.sleep(
+                        rcache_models.RCACHE_RMQ_COALESCE_POLL_SEC)
+                    if (self._request_futures.get(req_cfg_digest) is not
+                            future_holders) or (time.time() >= deadline):
+                        return
+                rcache_queue = \
+                    rcache_models.rmq_digest_routing_key(req_cfg_digest)
+            except (asyncio.TimeoutError, aio_pika.exceptions.AMQPError) \
+                    as ex:
+                LOGGER.warning(f"Request coalescing failed, computing "
+                               f"without it: {ex!r}")
+        await asyncio.to_thread(
+            self._send_req_to_celery, req_cfg_digest=req_cfg_digest,
+            deadline=deadline, rcache_queue=rcache_queue, **kwargs)
+
+    async def _subscribe(self, req_cfg_digest: str) -> None:
+        """ Routes responses for given digest to RX queue """
+        async with self._binding_lock:
+            if req_cfg_digest in self._subscribed:
+                return
+            assert self._rmq_queue is not None
+            await self._rmq_queue.bind(
+                self._rmq_exchange,
+                routing_key=rcache_models.rmq_digest_routing_key(
+                    req_cfg_digest))
+            self._subscribed.add(req_cfg_digest)
+
+    async def _unsubscribe(self, req_cfg_digest: str) -> None:
+        """ Releases in-flight marker and stops routing responses for given
+        digest to RX queue - unless new request for it arrived """
+        try:
+            async with self._binding_lock:
+                if req_cfg_digest in self._request_futures:
+                    return
+                if req_cfg_digest in self._claimed:
+                    self._claimed.remove(req_cfg_digest)
+                    if self._marker_channel is not None:
+                        await self._marker_channel.queue_delete(
+                            rcache_models.rmq_inflight_queue_name(
+                                req_cfg_digest))
+                if req_cfg_digest in self._subscribed:
+                    self._subscribed.remove(req_cfg_digest)
+                    assert self._rmq_queue is not None
+                    await self._rmq_queue.unbind(
+                        self._rmq_exchange,
+                        routing_key=rcache_models.rmq_digest_routing_key(
+                            req_cfg_digest))
+        except aio_pika.exceptions.AMQPError as ex:
+            LOGGER.warning(f"Request coalescing cleanup failed: {ex!r}")
+
+    async def _claim(self, req_cfg_digest: str) -> bool:
+        """ Tries to claim computation of given digest by creating its
+        in-flight marker (exclusive queue). Returns True on success """
+        if req_cfg_digest in self._claimed:
+            return True
+        if (self._marker_channel is None) or self._marker_channel.is_closed:
+            assert self._rmq_connection is not None
+            self._marker_channel = await self._rmq_connection.channel()
+        try:
+            # Marker should not be restored on reconnect
+            await self._marker_channel.declare_queue(
+                name=rcache_models.rmq_inflight_queue_name(req_cfg_digest),
+                exclusive=True, robust=False)
+        except aiormq.exceptions.ChannelLockedResource:
+            # Held by other process
+            self._marker_channel = None
+            return False
+        self._claimed.add(req_cfg_digest)
+        return True
+
     def _send_req_to_celery(
             self, request_str: str, original_request_str: str, config_str: str,
             req_cfg_digest: str, runtime_opt: int, task_id: str,
-            history_dir: Optional[str], deadline: float) -> None:
-        """ Called on separate thread to AFC Engine request via Celery """
+            history_dir: Optional[str], deadline: float,
+            stage_timer: Optional[afc_traffic_metrics.StageTimer],
+            rcache_queue: str) -> None:
+        """ Called on separate thread to AFC Engine request via Celery.
+        Response is sent to 'rcache_queue' RMQ routing key """
         if self._stopping:
             return
         try:
@@ -214,22 +392,28 @@ class AfcServerCompute:
             LOGGER.error(f"Failed to write request to objstore: {ex}")
         try:
             prot, host, port = self._dataif.getProtocol()
-            afc_worker.run.apply_async(
-                kwargs={
-                    "prot": prot,
-                    "host": host,
-                    "port": port,
-                    "request_type": self._engine_request_type,
-                    "task_id": task_id,
-                    "hash_val": req_cfg_digest,
-                    "config_path": None,
-                    "history_dir": history_dir,
-                    "runtime_opts": runtime_opt,
-                    "mntroot": self._worker_mnt_root,
-                    "rcache_queue": self._rmq_rx_queue_name,
-                    "request_str": request_str,
-                    "original_request_str": original_request_str,
-                    "config_str": config_str,
-                    "deadline": deadline})
+            if stage_timer is not None:
+                stage_timer.mark("dispatch")
+            kwargs: Dict[str, Any] = {
+                "prot": prot,
+                "host": host,
+                "port": port,
+                "request_type": self._engine_request_type,
+                "task_id": task_id,
+                "hash_val": req_cfg_digest,
+                "config_path": None,
+                "history_dir": history_dir,
+                "runtime_opts": runtime_opt,
+                "mntroot": self._worker_mnt_root,
+                "rcache_queue": rcache_queue,
+                "request_str": request_str,
+                "original_request_str": original_request_str,
+                "config_str": config_str,
+                "deadline": deadline}
+            if self._worker_stage_timing and (stage_timer is not None):
+                # Passed only if enabled, as Workers that don't know it
+                # reject the task
+                kwargs["stage_timing"] = stage_timer.to_wire()
+            afc_worker.run.apply_async(kwargs=kwargs)
         except Exception as ex:
             error(f"Failed to send request to AFC Engine worker: {ex}")
@@ -66,6 +66,20 @@ class AfcServerSettings(pydantic.BaseSettings):
         pydantic.Field(default=None,
                        title="File with password for RabbitMQ AMQP DSN",
                        env="RCACHE_RMQ_PASSWORD_FILE")
+    rmq_coalesce: bool = \
+        pydantic.Field(
+            default=True,
+            title="Coalesce identical in-flight AFC computations with other "
+            "processes (only one process sends request to Worker, others "
+            "wait for its result)",
+            env="RCACHE_RMQ_COALESCE")
+    worker_stage_timing: bool = \
+        pydantic.Field(
+            default=False,
+            title="Pass processing stage timing to Worker (and get Worker's "
+            "stages back). Workers that predate it reject such requests, so "
+            "it should be enabled only after all Workers are upgraded",
+            env="AFC_WORKER_STAGE_TIMING")
     static_data_root: Optional[str] = \
         pydantic.Field(default=None,
                        title="Worker's mount path of static files",
@@ -101,6 +115,19 @@ class AfcServerSettings(pydantic.BaseSettings):
             default=False,
             title="Bypass actual Rcache lookup (always return same record). "
             "For performance estimation purposes")
+    profiler_dir: Optional[str] = \
+        pydantic.Field(
+            default=None,
+            title="Directory, shared by workers, for on-demand sampling "
+            "profiler. Profiler endpoint is enabled only if specified")
+    profiler_min_interval: float = \
+        pydantic.Field(
+            default=60.,
+            title="Minimum interval between profiling starts (in any worker) "
+            "in seconds")
+    profiler_max_duration: float = \
+        pydantic.Field(default=30.,
+                       title="Maximum profiling duration in seconds")
 
 
 # Supported request versions. Last is default response version
@@ -292,6 +292,8 @@ class AfcServerMessageProcessor:
         Returns AFC Response in dictionary form
         """
         task_id = str(uuid.uuid4())
+        # Timeline of processing stages
+        stage_timer = afc_traffic_metrics.StageTimer(start_time=start_time)
         # Ruleset ID to use in error responses
         err_ruleset_name = "Unknown"
         # Dictionary that, possibly, caused Pydantic validation error
@@ -313,12 +315,14 @@ class AfcServerMessageProcessor:
             validated_dict = req_dict
             req = Rest_AvailableSpectrumInquiryRequest_1_4.validate(req_dict)
             validated_dict = None
+            stage_timer.mark("validation")
 
             # Find allowed certifications
             cert_req = afc_server_db.AfcCertReq(req.deviceDescriptor)
             cert_info = \
                 afc_server_db.AfcCertResp(bypass_checks=cert_req) if internal \
                 else await self._db.get_cert_info(cert_req, deadline=deadline)
+            stage_timer.mark("cert_lookup")
             allowed_certifications = cert_info.allowed_cert_resps()
             if not allowed_certifications:
                 # Bail if none allowed
@@ -344,6 +348,7 @@ class AfcServerMessageProcessor:
                     break
             else:
                 # Bail if no AFC Configs found
+                stage_timer.mark("config_lookup")
                 ret = \
                     self._make_failed_response(
                         request_id=req.requestId, ruleset_id=err_ruleset_name,
@@ -354,6 +359,7 @@ class AfcServerMessageProcessor:
                 return ret
             assert afc_config_dict is not None
             assert cert_resp is not None
+            stage_timer.mark("config_lookup")
 
             # Replace region string in AFC Config if necessary
             try:
@@ -386,6 +392,7 @@ class AfcServerMessageProcessor:
                             dict(exclude_none=True)
                     except pydantic.ValidationError:
                         ret = None
+            stage_timer.mark("rcache_lookup")
 
             # If no results from cache - invoke AFC Engine
             if ret is None:
@@ -434,7 +441,7 @@ class AfcServerMessageProcessor:
                         history_dir=os.path.join(
                             "/history", req.deviceDescriptor.serialNumber,
                             datetime.datetime.now().isoformat()),
-                        deadline=deadline)
+                        deadline=deadline, stage_timer=stage_timer)
                 if not resp_str:
                     # Bail on failure
                     not_computed = True
@@ -469,6 +476,7 @@ class AfcServerMessageProcessor:
                 customer=afc_config_dict["regionStr"],
                 geo_data_version=geo_id, uls_id=uls_id,
                 req_indices=[req_idx])
+            stage_timer.mark("response")
 
             # Return the result
             ret["requestId"] = req.requestId
@@ -484,6 +492,9 @@ class AfcServerMessageProcessor:
             return ret
         finally:
             assert ret is not None
+            stage_timer.observe()
+            LOGGER.debug(f"Request {task_id} stages: "
+                         f"{stage_timer.timeline()}")
             afc_traffic_metrics.request_processed(
                 duration_sec=time.time() - start_time,
                 response="Exception" if exception
@@ -0,0 +1,185 @@
+""" Tests of AFC Server's dispatch of computations: coalescing of identical
+in-flight computations with other processes, sending of requests to Celery
+(RabbitMQ and Celery parts are replaced with mocks)
+
+Run tests:        python -m unittest test_afc_server_compute
+(afc-packages' packages should be in PYTHONPATH)
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+# pylint: disable=protected-access
+
+import asyncio
+import time
+from typing import Any, Dict, List
+import unittest
+from unittest import mock
+
+import afc_server_compute
+from afc_server_compute import AfcServerCompute
+import afc_traffic_metrics
+import afc_worker
+import defs
+import rcache_models
+
+DIGEST = "0123456789abcdef"
+RESPONSE = '{"availableSpectrumInquiryResponses": []}'
+TIMEOUT_SEC = 10.
+
+
+class TestCoalescing(unittest.IsolatedAsyncioTestCase):
+    """ Coalescing of computations with other processes """
+
+    async def asyncSetUp(self) -> None:
+        await unittest.IsolatedAsyncioTestCase.asyncSetUp(self)
+        self._loop = asyncio.get_running_loop()
+        self._sent: List[Dict[str, Any]] = []
+        patches = \
+            [mock.patch.object(afc_server_compute.fst, "DataIf"),
+             mock.patch.object(AfcServerCompute, "_rmq_reader_worker",
+                               self._rmq_reader_worker),
+             mock.patch.object(AfcServerCompute, "_send_req_to_celery",
+                               self._send_req_to_celery),
+             mock.patch.object(AfcServerCompute, "_subscribe",
+                               new_callable=mock.AsyncMock),
+             mock.patch.object(AfcServerCompute, "_claim",
+                               new_callable=mock.AsyncMock,
+                               return_value=True),
+             mock.patch.object(AfcServerCompute, "_unsubscribe",
+                               new_callable=mock.AsyncMock)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self._compute = \
+            AfcServerCompute(rmq_dsn="amqp://rmq:5672",
+                             rmq_password_file=None,
+                             engine_request_type="AP-AFC",
+                             worker_mnt_root="/mnt/nfs")
+
+    async def asyncTearDown(self) -> None:
+        await self._compute.close()
+        await unittest.IsolatedAsyncioTestCase.asyncTearDown(self)
+
+    async def _rmq_reader_worker(self) -> None:
+        """ RMQ reader stand-in: makes RMQ 'ready' """
+        self._compute._rmq_ready.set()
+
+    def _send_req_to_celery(self, **kwargs: Any) -> None:
+        """ Celery sender stand-in: records arguments and responds """
+        self._sent.append(kwargs)
+        self._loop.call_soon_threadsafe(self._respond,
+                                        kwargs["req_cfg_digest"])
+
+    def _respond(self, req_cfg_digest: str) -> None:
+        """ Delivers response to all waiters of given digest """
+        for future_holder in \
+                self._compute._request_futures.get(req_cfg_digest, set()):
+            if not future_holder.future.done():
+                future_holder.future.set_result(RESPONSE)
+
+    async def _process(self, runtime_opt: int) -> None:
+        """ Processes request with given runtime options, waits for detached
+        tasks to complete """
+        self.assertEqual(
+            await self._compute.process_request(
+                request_str="{}", original_request_str="{}", config_str="{}",
+                req_cfg_digest=DIGEST, runtime_opt=runtime_opt,
+                task_id="task", history_dir=None,
+                deadline=time.time() + TIMEOUT_SEC),
+            RESPONSE)
+        await asyncio.gather(*self._compute._celery_sender_tasks)
+        self.assertFalse(self._compute._coalesced)
+
+    async def test_coalesced(self) -> None:
+        """ Regular computation is coalesced """
+        await self._process(defs.RNTM_OPT_NODBG_NOGUI)
+        AfcServerCompute._subscribe.assert_awaited_once_with(DIGEST)
+        AfcServerCompute._claim.assert_awaited_once_with(DIGEST)
+        AfcServerCompute._unsubscribe.assert_awaited_once_with(DIGEST)
+        self.assertEqual(len(self._sent), 1)
+        self.assertEqual(self._sent[0]["rcache_queue"],
+                         rcache_models.rmq_digest_routing_key(DIGEST))
+
+    async def test_debug_not_coalesced(self) -> None:
+        """ Debug computations are not coalesced """
+        for runtime_opt in (defs.RNTM_OPT_DBG, defs.RNTM_OPT_SLOW_DBG,
+                            defs.RNTM_OPT_DBG_GUI):
+            with self.subTest(runtime_opt=runtime_opt):
+                self._sent.clear()
+                await self._process(runtime_opt)
+                AfcServerCompute._subscribe.assert_not_awaited()
+                AfcServerCompute._claim.assert_not_awaited()
+                AfcServerCompute._unsubscribe.assert_not_awaited()
+                self.assertEqual(len(self._sent), 1)
+                self.assertEqual(self._sent[0]["rcache_queue"],
+                                 self._compute._rmq_rx_queue_name)
+                self.assertEqual(self._sent[0]["runtime_opt"], runtime_opt)
+
+
+class TestCelerySender(unittest.IsolatedAsyncioTestCase):
+    """ Sending requests to Celery """
+
+    async def asyncSetUp(self) -> None:
+        await unittest.IsolatedAsyncioTestCase.asyncSetUp(self)
+        patches = \
+            [mock.patch.object(afc_server_compute.fst, "DataIf"),
+             mock.patch.object(afc_server_compute.afc_worker, "run"),
+             mock.patch.object(AfcServerCompute, "_rmq_reader_worker",
+                               new_callable=mock.AsyncMock)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        afc_server_compute.fst.DataIf.return_value.getProtocol.return_value = \
+            ("http", "objst", 5000)
+        self._computes: List[AfcServerCompute] = []
+
+    async def asyncTearDown(self) -> None:
+        for compute in self._computes:
+            await compute.close()
+        await unittest.IsolatedAsyncioTestCase.asyncTearDown(self)
+
+    def _send(self, stage_timer: Any, worker_stage_timing: bool) \
+            -> Dict[str, Any]:
+        """ Sends request, returns arguments of Celery task """
+        compute = \
+            AfcServerCompute(rmq_dsn="amqp://rmq:5672",
+                             rmq_password_file=None,
+                             engine_request_type="AP-AFC",
+                             worker_mnt_root="/mnt/nfs",
+                             worker_stage_timing=worker_stage_timing)
+        self._computes.append(compute)
+        afc_server_compute.afc_worker.run.apply_async.reset_mock()
+        compute._send_req_to_celery(
+            request_str="{}", original_request_str="{}", config_str="{}",
+            req_cfg_digest=DIGEST, runtime_opt=defs.RNTM_OPT_NODBG_NOGUI,
+            task_id="task", history_dir=None,
+            deadline=time.time() + TIMEOUT_SEC, stage_timer=stage_timer,
+            rcache_queue="queue")
+        afc_server_compute.afc_worker.run.apply_async.assert_called_once()
+        return \
+            afc_server_compute.afc_worker.run.apply_async.call_args.\
+            kwargs["kwargs"]
+
+    async def test_stage_timing(self) -> None:
+        """ Stage timing is passed to Worker only if enabled and set """
+        kwargs = self._send(stage_timer=None, worker_stage_timing=True)
+        self.assertEqual(kwargs["hash_val"], DIGEST)
+        self.assertEqual(kwargs["rcache_queue"], "queue")
+        self.assertNotIn("stage_timing", kwargs)
+        kwargs = self._send(stage_timer=afc_traffic_metrics.StageTimer(),
+                            worker_stage_timing=False)
+        self.assertNotIn("stage_timing", kwargs)
+        stage_timer = afc_traffic_metrics.StageTimer()
+        kwargs = self._send(stage_timer=stage_timer,
+                            worker_stage_timing=True)
+        self.assertIsNotNone(
+            afc_worker.stage_timing_mark(kwargs["stage_timing"], "engine"))
+
+
+if __name__ == "__main__":
+    unittest.main()
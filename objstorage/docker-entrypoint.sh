@@ -26,5 +26,9 @@ esac
 
 gunicorn --workers ${AFC_OBJST_WORKERS} --worker-class gevent --bind 0.0.0.0:${AFC_OBJST_PORT} afcobjst:objst_app &
 gunicorn --workers ${AFC_OBJST_HIST_WORKERS} --worker-class gevent --bind 0.0.0.0:${AFC_OBJST_HIST_PORT} afcobjst:hist_app &
+# Retention removes files, hence it only runs if explicitly configured
+if [ -n "${AFC_OBJST_RETENTION}" ]; then
+  python3 -m afcobjst.retention &
+fi
 
 sleep infinity
@@ -0,0 +1,26 @@
+"""index by individual certification IDs
+
+Revision ID: b41e7c2d9a05
+Revises: 7a3aa9894e52
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b41e7c2d9a05'
+down_revision = '7a3aa9894e52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS aps_cert_ids_array_idx "
+        "ON aps USING gin (string_to_array(cert_ids, '|'))")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS aps_cert_ids_array_idx")
@@ -15,9 +15,9 @@ import uvicorn
 from typing import Annotated, Optional
 
 from log_utils import dp, get_module_logger, set_dp_printer, set_parent_logger
-from rcache_models import IfDbExists, RcacheDirectionalInvalidateReq, \
-    RcacheServiceSettings, RcacheUpdateReq, RcacheInvalidateReq, \
-    RcacheSpatialInvalidateReq, RcacheStatus
+from rcache_models import IfDbExists, RcacheCertIdInvalidateReq, \
+    RcacheDirectionalInvalidateReq, RcacheServiceSettings, RcacheUpdateReq, \
+    RcacheInvalidateReq, RcacheSpatialInvalidateReq, RcacheStatus
 from rcache_service import RcacheService
 
 __all__ = ["app"]
@@ -120,6 +120,14 @@ async def spatial_invalidate(
     service.invalidate(directional_invalidate_req)
 
 
+@app.post("/cert_id_invalidate")
+async def cert_id_invalidate(
+        cert_id_invalidate_req: RcacheCertIdInvalidateReq,
+        service: RcacheService = fastapi.Depends(get_service)) -> None:
+    """ Certification ID invalidate request handler """
+    service.invalidate(cert_id_invalidate_req)
+
+
 @app.post("/update")
 async def update(
         update_req: RcacheUpdateReq,
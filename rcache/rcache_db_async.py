@@ -19,7 +19,8 @@ from typing import Any, Dict, List, NamedTuple, Optional
 
 from log_utils import dp, error, error_if, FailOnError
 from rcache_db import RcacheDb
-from rcache_models import ApDbRespState, Beam, FuncSwitch, LatLonRect, ApDbPk
+from rcache_models import ApDbRespState, Beam, CertificationKey, \
+    FuncSwitch, LatLonRect, ApDbPk
 import db_utils
 
 __all__ = ["RcacheDbAsync"]
@@ -221,6 +222,64 @@ class RcacheDbAsync(RcacheDb):
         except sa.exc.SQLAlchemyError as ex:
             error(f"Cache database directional invalidation failed: {ex}")
 
+    async def cert_id_invalidate(
+            self, certifications: List[CertificationKey]) -> int:
+        """ Certification ID invalidation
+
+        Arguments:
+        certifications -- List of changed certifications. Entry is invalidated
+                          if any of its ruleset/certification ID pairs is in
+                          this list
+        Returns number of rows invalidated
+        """
+        assert (self._engine is not None) and (self.ap_table is not None)
+        if not certifications:
+            return 0
+        c = self.ap_table.c
+
+        def text_array(values: List[str]) -> Any:
+            """ Array parameter (with type, explicitly specified for asyncpg)
+            """
+            return sa.cast(values, sa_pg.ARRAY(sa.Text()))
+
+        # Pairs of AP table entry
+        entry_certs = \
+            sa.func.unnest(self.cert_ids_array(c.cert_ids),
+                           self.cert_ids_array(c.rulesets)).\
+            table_valued("cert_id", "ruleset_id").\
+            render_derived(name="entry_certs")
+        # Pairs to invalidate
+        changed_certs = \
+            sa.func.unnest(
+                text_array([cert.cert_id for cert in certifications]),
+                text_array([cert.ruleset_id for cert in certifications])).\
+            table_valued("cert_id", "ruleset_id").\
+            render_derived(name="changed_certs")
+        try:
+            upd = sa.update(self.ap_table).\
+                where(
+                    # Preselection by index on certification IDs
+                    self.cert_ids_array(c.cert_ids).overlap(
+                        text_array(sorted({cert.cert_id
+                                           for cert in certifications}))) &
+                    # Exact ruleset/certification ID match
+                    sa.exists().
+                    select_from(
+                        entry_certs.join(
+                            changed_certs,
+                            (entry_certs.c.cert_id ==
+                             changed_certs.c.cert_id) &
+                            (entry_certs.c.ruleset_id ==
+                             changed_certs.c.ruleset_id)))).\
+                values(state=ApDbRespState.Invalid.name)
+            async with self._engine.begin() as conn:
+                rp = await conn.execute(upd)
+                return rp.rowcount
+        except sa.exc.SQLAlchemyError as ex:
+            error(f"Cache database certification ID invalidation failed: "
+                  f"{ex}")
+        return 0  # Will never happen
+
     async def reset_precomputations(self) -> None:
         """ Mark records in precomputation state as invalid """
         assert self._engine
@@ -21,14 +21,15 @@ import pydantic
 from queue import Queue
 import time
 import traceback
-from typing import Any, Dict, Optional, Set, Tuple, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 import als
 from log_utils import dp, error_if, get_module_logger
 from rcache_db_async import RcacheDbAsync
 from rcache_models import AfcReqRespKey, RcacheUpdateReq, ApDbPk, ApDbRecord, \
-    Beam, FuncSwitch, RatapiAfcConfig, RatapiRulesetIds, \
-    RcacheDirectionalInvalidateReq, RcacheInvalidateReq, \
+    Beam, CertificationKey, FuncSwitch, RatapiAfcConfig, RatapiRulesetIds, \
+    RcacheCertIdInvalidateReq, RcacheDirectionalInvalidateReq, \
+    RcacheInvalidateReq, \
     LatLonRect, RcacheSpatialInvalidateReq, RcacheStatus
 
 __all__ = ["RcacheService"]
@@ -269,7 +270,8 @@ class RcacheService:
             self,
             invalidation_req: Union[RcacheInvalidateReq,
                                     RcacheSpatialInvalidateReq,
-                                    RcacheDirectionalInvalidateReq]) -> None:
+                                    RcacheDirectionalInvalidateReq,
+                                    RcacheCertIdInvalidateReq]) -> None:
         """ Enqueue arrived invalidation requests """
         if isinstance(invalidation_req, RcacheInvalidateReq):
             if invalidation_req.ruleset_ids is None:
@@ -283,6 +285,9 @@ class RcacheService:
         elif isinstance(invalidation_req, RcacheDirectionalInvalidateReq):
             for beam in invalidation_req.beams:
                 self._log_invalidation(invalidate_beam=beam)
+        elif isinstance(invalidation_req, RcacheCertIdInvalidateReq):
+            self._log_invalidation(
+                invalidate_certifications=invalidation_req.certifications)
         self._invalidation_queue.put_nowait(invalidation_req)
 
     async def get_status(self) -> RcacheStatus:
@@ -396,6 +401,11 @@ class RcacheService:
                                 f"<{rect.short_str()}> with clearance of "
                                 f"{max_link_distance_km}km",
                                 invalid_before)
+                elif isinstance(req, RcacheCertIdInvalidateReq):
+                    await self._db.cert_id_invalidate(req.certifications)
+                    await self._report_invalidation(
+                        f"Invalidation for {len(req.certifications)} "
+                        f"certification ID(s)", invalid_before)
                 else:
                     assert isinstance(req, RcacheDirectionalInvalidateReq)
                     for beam in req.beams:
@@ -541,7 +551,9 @@ class RcacheService:
             self, enabled: Optional[bool] = None, invalidate_all: bool = False,
             invalidate_ruleset_id: Optional[str] = None,
             invalidate_tile: Optional[LatLonRect] = None,
-            invalidate_beam: Optional[Beam] = None) -> None:
+            invalidate_beam: Optional[Beam] = None,
+            invalidate_certifications: Optional[List[CertificationKey]] = None
+            ) -> None:
         """ Make ALS log invalidation-related record
 
         Arguments:
@@ -550,6 +562,7 @@ class RcacheService:
         invalidate_ruleset_id -- Ruleset ID ti invalidate or None
         invalidate_tile       -- Tile to invalidate or None
         invalidate_beam       -- Beam to invalidate or None
+        invalidate_certifications -- Certifications to invalidate or None
         """
         als.als_json_log(
             "rcache_invalidation",
@@ -569,7 +582,10 @@ class RcacheService:
                      "tx_lat": invalidate_beam.tx_lat,
                      "tx_lon": invalidate_beam.tx_lon,
                      "azimuth_to_tx": invalidate_beam.azimuth_to_tx}
-                    if invalidate_beam else None})
+                    if invalidate_beam else None,
+                "invalidate_certifications":
+                    [cert.dict() for cert in invalidate_certifications]
+                    if invalidate_certifications else None})
 
     def _log_update(self, enabled: Optional[bool] = None) -> None:
         """ Make ALS log update-related record """
@@ -17,7 +17,7 @@ import jwt
 from appcfg import OIDCConfigurator
 import os
 from sqlalchemy.schema import Sequence
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import JSON, insert
 
 OIDC_LOGIN = OIDCConfigurator().OIDC_LOGIN
 
@@ -101,6 +101,9 @@ class CertId(db.Model):
     ''' entry to designate allowed AP's for the PAWS interface '''
 
     __tablename__ = 'cert_id'
+    __table_args__ = (
+        db.UniqueConstraint('ruleset_id', 'certification_id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     certification_id = db.Column(db.String(64), nullable=False)
     refreshed_at = db.Column(db.DateTime())
@@ -225,6 +228,34 @@ class Ruleset(db.Model):
         self.name = name
 
 
+class CacheGeneration(db.Model):
+    ''' Single-row generation counter of AFCConfig, cert_id and
+    access_point_deny tables. Incremented whenever these tables are modified,
+    so that processes caching their content know when to drop caches '''
+
+    __tablename__ = 'cache_generation'
+    # Always 1
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    generation = db.Column(db.BigInteger, nullable=False)
+
+    @classmethod
+    def bump(cls, session=None):
+        ''' Increments generation (creating row if needed) in given (default
+            - application) session. Should be called in the same transaction
+            as modification of cached tables. Does not commit '''
+        stmt = insert(cls.__table__).values(id=1, generation=1)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.__table__.c.id],
+            set_={"generation": cls.__table__.c.generation + 1})
+        (session or db.session).execute(stmt)
+
+    @classmethod
+    def get(cls, session=None):
+        ''' Current generation (0 if table is empty) '''
+        return (session or db.session).query(cls.generation).\
+            filter(cls.id == 1).scalar() or 0
+
+
 # Local Variables:
 # mode: Python
 # indent-tabs-mode: nil
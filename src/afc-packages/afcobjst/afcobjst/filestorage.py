@@ -15,14 +15,37 @@ import logging
 import shutil
 import socket
 import abc
+import collections
+import datetime
+import tempfile
 import waitress
-from posix_ipc import Semaphore, O_CREAT
-from flask import Flask, request, abort, make_response
+from flask import Flask, Response, request, abort, make_response
 import google.cloud.storage
+from werkzeug.wsgi import wrap_file
+from .histindex import get_index
 from .objstconf import ObjstConfigInternal
 
 NET_TIMEOUT = 600  # The amount of time, in seconds, to wait for the server response
-SEM_TIMEOUT = 60  # Per file semaphore timeout
+# Prefix of names of temporary files, renamed to final names when completely
+# written. Files with this prefix are not for public consumption
+TEMP_FILE_PREFIX = ".objst_tmp."
+# Size of chunks in which GET responses are streamed
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Mode of written files - as open() would create them (tempfile.mkstemp()
+# creates files with 0600 mode). Umask is read once, as setting it is not
+# thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+# Opened object to stream in GET response
+# file          -- Seekable binary file-like object, positioned at start
+# size          -- Object size in bytes
+# etag          -- Object version tag (changes whenever object changes)
+# last_modified -- Object modification time as timezone-aware datetime
+ObjStream = \
+    collections.namedtuple("ObjStream",
+                           ["file", "size", "etag", "last_modified"])
 
 objst_app = Flask(__name__)
 objst_app.config.from_object(ObjstConfigInternal())
@@ -54,6 +77,15 @@ class ObjInt:
     def read(self):
         pass
 
+    @abc.abstractmethod
+    def open_stream(self):
+        """ Opens object for streaming
+
+        Returns ObjStream for existing object, None if object not found.
+        Caller is responsible for closing returned file
+        """
+        pass
+
     @abc.abstractmethod
     def head(self):
         pass
@@ -70,52 +102,95 @@ class ObjInt:
 
 
 class ObjIntLocalFS(ObjInt):
-    def __lock(self, name):
-        sem_name = "/" + name[1:].replace("/", "_")
-        sem = Semaphore(sem_name, O_CREAT, initial_value=1)
-        sem.acquire(timeout=SEM_TIMEOUT)
-        return sem
-
-    def __unlock(self, sem):
-        sem.release()
-        sem.close()
-        try:
-            sem.unlink()
-        except BaseException:
-            pass
+    """ Local filesystem storage. No locks are used: file is written to
+    unique temporary file in the same directory and atomically renamed to
+    its name, so readers see either previous or new complete content, and
+    open file remains readable after it is replaced or deleted """
+
+    def __init__(self, file_name, fsync=None):
+        """ Constructor
+
+        Arguments:
+        file_name -- File name
+        fsync     -- True to fsync written files (and their directories)
+                     before returning from write(), None to take from
+                     AFC_OBJST_FSYNC configuration
+        """
+        super().__init__(file_name)
+        self._fsync = objst_app.config["AFC_OBJST_FSYNC"] if fsync is None \
+            else fsync
 
     def write(self, data):
-        self.__mkdir_local(os.path.dirname(self._file_name))
-        sem = self.__lock(self._file_name)
-        with open(self._file_name, 'wb') as f:
-            f.write(data)
-        self.__unlock(sem)
+        dir_name = os.path.dirname(self._file_name)
+        self.__mkdir_local(dir_name)
+        fd, temp_name = \
+            tempfile.mkstemp(
+                dir=dir_name,
+                prefix=TEMP_FILE_PREFIX + os.path.basename(self._file_name) +
+                ".")
+        try:
+            os.fchmod(fd, FILE_MODE)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_name, self._file_name)
+            temp_name = None
+        finally:
+            if temp_name is not None:
+                try:
+                    os.unlink(temp_name)
+                except OSError:
+                    pass
+        if self._fsync:
+            dir_fd = os.open(dir_name, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
 
     def read(self):
-        if not os.path.isfile(self._file_name):
+        try:
+            with open(self._file_name, "rb") as hfile:
+                return hfile.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+
+    def open_stream(self):
+        """ Opened file keeps its content even if it is replaced or deleted
+        while streamed, so size and ETag are taken from the opened file """
+        try:
+            f = open(self._file_name, "rb")
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
             return None
-        sem = self.__lock(self._file_name)
-        with open(self._file_name, "rb") as hfile:
-            ret = hfile.read()
-        self.__unlock(sem)
-        return ret
+        st = os.fstat(f.fileno())
+        return ObjStream(
+            file=f, size=st.st_size,
+            etag=f"{st.st_size:x}-{st.st_mtime_ns:x}",
+            last_modified=datetime.datetime.fromtimestamp(
+                st.st_mtime, tz=datetime.timezone.utc))
 
     def head(self):
-        sem = self.__lock(self._file_name)
-        ret = os.path.exists(self._file_name)
-        self.__unlock(sem)
-        return ret
+        return os.path.exists(self._file_name)
 
     def delete(self):
-        """ During recursive dir delete only the dir is protected by semaphore from
-        parallel use. Files in the dir arn't protected. """
-        if os.path.exists(self._file_name):
-            sem = self.__lock(self._file_name)
-            if os.path.isdir(self._file_name):
-                shutil.rmtree(self._file_name)
-            else:
-                os.remove(self._file_name)
-            self.__unlock(sem)
+        """ Deletes file or directory (recursively). Readers that already
+        opened files being deleted continue to read them. Files that vanished
+        in the process (deleted concurrently) are ignored """
+        try:
+            os.remove(self._file_name)
+        except FileNotFoundError:
+            pass
+        except (IsADirectoryError, PermissionError):
+            if not os.path.isdir(self._file_name):
+                raise
+
+            def onerror(func, path, exc_info):
+                if not isinstance(exc_info[1], FileNotFoundError):
+                    raise exc_info[1]
+
+            shutil.rmtree(self._file_name, onerror=onerror)
 
     def __mkdir_local(self, path):
         os.makedirs(path, exist_ok=True)
@@ -133,6 +208,18 @@ class ObjIntGoogleCloudBucket(ObjInt):
         return blob.download_as_bytes(raw_download=True,
                                       timeout=NET_TIMEOUT)
 
+    def open_stream(self):
+        """ Reader is pinned to blob generation that was current at open
+        time, so object, replaced while streamed, is not mixed """
+        blob = bucket.get_blob(self._file_name, timeout=NET_TIMEOUT)
+        if blob is None:
+            return None
+        return ObjStream(
+            file=blob.open("rb", chunk_size=STREAM_CHUNK_SIZE,
+                           raw_download=True, timeout=NET_TIMEOUT),
+            size=blob.size, etag=str(blob.generation),
+            last_modified=blob.updated)
+
     def head(self):
         blobs = client.list_blobs(bucket,
                                   prefix=self._file_name,
@@ -166,6 +253,91 @@ def get_local_path(path):
     return path
 
 
+def get_age_index():
+    """ Retention age index or None """
+    # Imported here because retention module depends on this one
+    from .retention import get_age_index as get_retention_index
+    return get_retention_index(objst_app.config)
+
+
+def start_index_update(path, deleting=False):
+    """ Prepares index update before write or delete of given local path.
+    Returns size of existing file (0 if there is no such file). Failure is
+    logged, but does not fail the operation """
+    try:
+        index = get_age_index()
+        if index is None:
+            return 0
+        if not deleting:
+            index.writing(path)
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    except Exception as e:
+        objst_app.logger.error(f"Retention index update failed: {e}")
+        return 0
+
+
+def update_indices(path, deleted, prev_size):
+    """ Reflects write or delete of given local path in history and
+    retention indices. Failure to update index is logged, but does not fail
+    the operation
+
+    Arguments:
+    path      -- Local path
+    deleted   -- True if path was deleted, False if file was written
+    prev_size -- Size of file before operation, as returned by
+                 start_index_update()
+    """
+    try:
+        index = get_index(objst_app.config)
+        if index is not None:
+            if deleted:
+                index.deleted(path)
+            else:
+                index.file_written(path)
+    except Exception as e:
+        objst_app.logger.error(f"History index update failed: {e}")
+    try:
+        age_index = get_age_index()
+        if age_index is not None:
+            if deleted:
+                age_index.deleted(path, prev_size)
+            else:
+                age_index.file_written(
+                    path, os.path.getsize(path) - prev_size)
+    except Exception as e:
+        objst_app.logger.error(f"Retention index update failed: {e}")
+
+
+def stream_response(stream, mimetype="application/octet-stream",
+                    content_encoding=None):
+    """ Streamed GET response for opened object. Range, If-None-Match and
+    If-Modified-Since request headers are honored
+
+    Arguments:
+    stream           -- ObjStream. Its file is closed when response is closed
+    mimetype         -- Response content type
+    content_encoding -- None or Content-Encoding header value
+    """
+    try:
+        resp = Response(
+            wrap_file(request.environ, stream.file,
+                      buffer_size=STREAM_CHUNK_SIZE),
+            mimetype=mimetype, direct_passthrough=True)
+        resp.content_length = stream.size
+        if content_encoding:
+            resp.content_encoding = content_encoding
+        resp.set_etag(stream.etag)
+        resp.last_modified = stream.last_modified
+        # Not all Werkzeug versions set it on non-Range requests
+        resp.accept_ranges = "bytes"
+        # Responds 206 on Range, 304 on matched If-None-Match, etc.
+        return resp.make_conditional(request, accept_ranges=True,
+                                     complete_length=stream.size)
+    except BaseException:
+        stream.file.close()
+        raise
+
+
 @objst_app.route('/' + '<path:path>', methods=['POST'])
 def post(path):
     ''' File upload handler. '''
@@ -187,9 +359,11 @@ def post(path):
         else:
             data = request.get_data()
 
+        prev_size = start_index_update(path)
         objst = Objstorage()
         with objst.open(path) as hobj:
             hobj.write(data)
+        update_indices(path, deleted=False, prev_size=prev_size)
     except Exception as e:
         objst_app.logger.error(e)
         return abort(500)
@@ -204,9 +378,11 @@ def delete(path):
     path = get_local_path(path)
 
     try:
+        prev_size = start_index_update(path, deleting=True)
         objst = Objstorage()
         with objst.open(path) as hobj:
             hobj.delete()
+        update_indices(path, deleted=True, prev_size=prev_size)
     except Exception as e:
         objst_app.logger.error(e)
         return make_response('File not found', 404)
@@ -248,21 +424,22 @@ def healthcheck():
 # handle URL with filename
 @objst_app.route('/' + '<path:path>', methods=['GET'])
 def get(path):
-    ''' File download handler. '''
+    ''' File download handler. Response is streamed, Range, If-None-Match and
+    If-Modified-Since headers are supported '''
     objst_app.logger.debug(f'get {path}')
     path = get_local_path(path)
 
     try:
         objst = Objstorage()
         with objst.open(path) as hobj:
-            data = hobj.read()
-            if data:
-                return data
-            objst_app.logger.error('{}: File not found'.format(path))
-            return make_response('File not found', 404)
+            stream = hobj.open_stream()
     except Exception as e:
         objst_app.logger.error(e)
         return abort(500)
+    if stream is None:
+        objst_app.logger.error('{}: File not found'.format(path))
+        return make_response('File not found', 404)
+    return stream_response(stream)
 
 
 if __name__ == '__main__':
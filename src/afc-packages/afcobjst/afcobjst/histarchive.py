@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+"""
+Compacted history archives.
+
+History directories of a serial number, whose names start with the same date
+(i.e. a day of history) may be compacted into a single '<date>.tar.gz'
+archive. Archive is a gzip-compressed tar file in which every tar entry is
+compressed as a separate gzip member, so it may be extracted with
+'tar xzf', but individual files may also be read without decompressing
+anything else. Offsets of members are stored in hidden JSON index file
+('.<archive name>.idx') next to the archive.
+
+Files inside archive may be addressed explicitly (through archive name:
+'<serial>/<date>.tar.gz/<directory>/<file>') or through their original
+location ('<serial>/<directory>/<file>').
+"""
+
+import collections
+import datetime
+import glob
+import gzip
+import io
+import json
+import os
+import re
+import tarfile
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from .filestorage import TEMP_FILE_PREFIX, ObjStream
+from .histindex import HistEntry
+
+# Archive file name suffix
+ARCHIVE_SUFFIX = ".tar.gz"
+# Index file format version
+INDEX_VERSION = 1
+# Size of chunks in which files are read and compressed
+CHUNK_SIZE = 1024 * 1024
+# Directory names that may be compacted - ones that start with date
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+# Archive member (file)
+# offset      -- Offset of member's gzip stream in archive file
+# length      -- Length of member's gzip stream
+# header_size -- Size of tar header(s) that precede file data in decompressed
+#                member
+# size        -- File size
+# mtime       -- File modification time as seconds since Epoch
+ArchiveMember = \
+    collections.namedtuple("ArchiveMember",
+                           ["offset", "length", "header_size", "size",
+                            "mtime"])
+
+
+def index_file_name(archive_file: str) -> str:
+    """ Name of index file of given archive file """
+    return os.path.join(os.path.dirname(archive_file),
+                        f".{os.path.basename(archive_file)}.idx")
+
+
+def is_archive(name: str) -> bool:
+    """ True if given file name is a name of archive """
+    return name.endswith(ARCHIVE_SUFFIX)
+
+
+def write_archive(archive_file: str, src_dir: str, names: List[str]) -> int:
+    """ Creates archive
+
+    Arguments:
+    archive_file -- Archive file name. Archive and its index are written to
+                    temporary files and renamed when complete
+    src_dir      -- Directory, containing directories to archive
+    names        -- Names of directories (or files) to archive. Member names
+                    are relative to src_dir
+    Returns size of archive and index in bytes
+    """
+    members: Dict[str, List[float]] = {}
+    index_file = index_file_name(archive_file)
+    temp_archive = \
+        os.path.join(src_dir, TEMP_FILE_PREFIX + os.path.basename(
+            archive_file))
+    temp_index = \
+        os.path.join(src_dir, TEMP_FILE_PREFIX + os.path.basename(index_file))
+    try:
+        with open(temp_archive, "wb") as archive:
+            for name in sorted(names):
+                for rel_name, file_name in _files(src_dir, name):
+                    st = os.stat(file_name)
+                    info = tarfile.TarInfo(rel_name)
+                    info.size = st.st_size
+                    info.mtime = int(st.st_mtime)
+                    info.mode = 0o644
+                    header = info.tobuf(format=tarfile.PAX_FORMAT)
+                    offset = archive.tell()
+                    compressor = zlib.compressobj(wbits=31)
+                    archive.write(compressor.compress(header))
+                    with open(file_name, "rb") as f:
+                        while True:
+                            chunk = f.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            archive.write(compressor.compress(chunk))
+                    padding = -st.st_size % tarfile.BLOCKSIZE
+                    archive.write(compressor.compress(b"\0" * padding))
+                    archive.write(compressor.flush())
+                    members[rel_name] = \
+                        [offset, archive.tell() - offset, len(header),
+                         st.st_size, st.st_mtime]
+            # End of archive marker
+            archive.write(gzip.compress(b"\0" * (2 * tarfile.BLOCKSIZE),
+                                        mtime=0))
+        with open(temp_index, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "members": members}, f)
+        if members:
+            mtime = max(m[4] for m in members.values())
+            os.utime(temp_archive, (mtime, mtime))
+        ret = os.path.getsize(temp_archive) + os.path.getsize(temp_index)
+        # Index is renamed first, so that archive is never seen without it
+        os.replace(temp_index, index_file)
+        os.replace(temp_archive, archive_file)
+        return ret
+    finally:
+        for temp_file in (temp_archive, temp_index):
+            try:
+                os.unlink(temp_file)
+            except FileNotFoundError:
+                pass
+
+
+def _files(src_dir: str, name: str) -> List[Tuple[str, str]]:
+    """ List of (member name, file name) for files of given directory (or
+    file) """
+    path = os.path.join(src_dir, name)
+    if not os.path.isdir(path):
+        return [(name, path)]
+    ret: List[Tuple[str, str]] = []
+    for dir_name, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            if file_name.startswith(TEMP_FILE_PREFIX):
+                continue
+            full_name = os.path.join(dir_name, file_name)
+            ret.append(
+                (os.path.relpath(full_name, src_dir).replace(os.sep, "/"),
+                 full_name))
+    return ret
+
+
+def remove_archive(archive_file: str) -> None:
+    """ Removes archive and its index """
+    for file_name in (archive_file, index_file_name(archive_file)):
+        try:
+            os.unlink(file_name)
+        except FileNotFoundError:
+            pass
+
+
+def read_index(archive_file: str) -> Optional[Dict[str, ArchiveMember]]:
+    """ Archive members, indexed by names. None if archive has no index """
+    try:
+        with open(index_file_name(archive_file), encoding="utf-8") as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    if index.get("version") != INDEX_VERSION:
+        raise ValueError(f"Unsupported version of archive index of "
+                         f"'{archive_file}'")
+    return {name: ArchiveMember(*member)
+            for name, member in index["members"].items()}
+
+
+def locate(local_path: str) -> Optional[Tuple[str, str]]:
+    """ Finds archive that contains given file or directory
+
+    Arguments:
+    local_path -- Path to file or directory, either through archive file name
+                  or original one
+    Returns (archive file name, path inside archive) tuple or None
+    """
+    head = local_path.rstrip("/")
+    tail: List[str] = []
+    while not os.path.isdir(head):
+        if is_archive(head) and os.path.isfile(head):
+            return (head, "/".join(reversed(tail)))
+        head, name = os.path.split(head)
+        if not name:
+            return None
+        tail.append(name)
+    if (not tail) or (not DATE_RE.match(tail[-1])):
+        return None
+    inner = "/".join(reversed(tail))
+    for archive_file in \
+            sorted(glob.glob(os.path.join(glob.escape(head),
+                                          tail[-1][: 10] + "*" +
+                                          ARCHIVE_SUFFIX))):
+        members = read_index(archive_file) or {}
+        if (inner in members) or \
+                any(name.startswith(inner + "/") for name in members):
+            return (archive_file, inner)
+    return None
+
+
+def list_members(members: Dict[str, ArchiveMember], inner: str) \
+        -> Optional[List[HistEntry]]:
+    """ Listing of directory inside archive. None if there is no such
+    directory """
+    prefix = (inner.strip("/") + "/") if inner.strip("/") else ""
+    entries: Dict[str, HistEntry] = {}
+    for name, member in members.items():
+        if not name.startswith(prefix):
+            continue
+        child, sep, _ = name[len(prefix):].partition("/")
+        prev = entries.get(child)
+        entries[child] = \
+            HistEntry(name=child, is_dir=bool(sep),
+                      size=0 if sep else member.size,
+                      mtime=max(member.mtime, prev.mtime if prev else 0.))
+    return list(entries.values()) if entries else None
+
+
+class _MemberReader(io.RawIOBase):
+    """ Reader of file data of archive member """
+
+    def __init__(self, f: io.BufferedReader, member: ArchiveMember) -> None:
+        f.seek(member.offset)
+        self._file = f
+        self._gz = gzip.GzipFile(fileobj=f, mode="rb")
+        self._skip = member.header_size
+        self._remaining = member.size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self._skip:
+            skipped = len(self._gz.read(self._skip))
+            if not skipped:
+                raise EOFError("Truncated archive member")
+            self._skip -= skipped
+        data = self._gz.read(min(len(b), self._remaining))
+        if self._remaining and (not data):
+            raise EOFError("Truncated archive member")
+        b[: len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self) -> None:
+        self._gz.close()
+        self._file.close()
+        super().close()
+
+
+def open_member(archive_file: str, member: ArchiveMember) -> ObjStream:
+    """ Opens archive member for streaming """
+    f = open(archive_file, "rb")
+    try:
+        st = os.fstat(f.fileno())
+        return ObjStream(
+            file=_MemberReader(f, member), size=member.size,
+            etag=f"{st.st_size:x}-{st.st_mtime_ns:x}-{member.offset:x}",
+            last_modified=datetime.datetime.fromtimestamp(
+                member.mtime, tz=datetime.timezone.utc))
+    except BaseException:
+        f.close()
+        raise
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+"""
+Persistent index of history directories and paginated history listings.
+
+Index is a SQLite database, stored next to history directory of LocalFS
+object storage. It contains an entry (name, size, modification time) for each
+file and subdirectory of every indexed history directory. Entries are added
+and removed by object storage server as files are written and deleted. Each
+directory is scanned once, when first listed, so existing history trees need
+no migration.
+
+Listings are paginated with opaque cursors (keyset pagination), may be
+sorted by name or by modification time and filtered by name substring (e.g.
+serial number or date) and modification time range.
+"""
+
+import base64
+import collections
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+# Name of index file, created in LocalFS storage directory (next to
+# 'history' directory)
+HIST_INDEX_FILE = ".objst_history_index.sqlite3"
+# Default number of entries per listing page
+DEFAULT_PAGE_SIZE = 1000
+# Maximum number of entries per listing page
+MAX_PAGE_SIZE = 10000
+# Sort keys: 'name' or modification time
+SORT_KEYS = ("name", "mtime")
+# SQLite lock wait timeout in seconds
+DB_TIMEOUT_SEC = 30
+
+# Directory entry
+# name   -- File or subdirectory name
+# is_dir -- True for subdirectory
+# size   -- File size in bytes (0 for directory)
+# mtime  -- Modification time as seconds since Epoch. For directory - latest
+#           modification time of its content
+HistEntry = \
+    collections.namedtuple("HistEntry", ["name", "is_dir", "size", "mtime"])
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ListQuery:
+    """ Listing page parameters: sort, filter, cursor, page size """
+
+    def __init__(self, sort: str = "name", descending: bool = False,
+                 name_filter: Optional[str] = None,
+                 since: Optional[float] = None, until: Optional[float] = None,
+                 cursor: Optional[str] = None,
+                 limit: int = DEFAULT_PAGE_SIZE) -> None:
+        """ Constructor
+
+        Arguments:
+        sort        -- Sort key: 'name' or 'mtime'
+        descending  -- True for descending order
+        name_filter -- None or substring names should contain
+        since       -- None or minimum modification time (seconds since
+                       Epoch)
+        until       -- None or maximum (exclusive) modification time
+        cursor      -- None for first page, next_cursor of previous page for
+                       subsequent pages
+        limit       -- Maximum number of entries per page
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(
+                f"Invalid sort key '{sort}', must be one of "
+                f"{', '.join(SORT_KEYS)}")
+        if not (0 < limit <= MAX_PAGE_SIZE):
+            raise ValueError(
+                f"Page size must be between 1 and {MAX_PAGE_SIZE}")
+        self.sort = sort
+        self.descending = descending
+        self.name_filter = name_filter or None
+        self.since = since
+        self.until = until
+        self.cursor = cursor
+        self.limit = limit
+        self.after: Optional[Tuple[Any, ...]] = None
+        if cursor:
+            try:
+                after = \
+                    json.loads(base64.urlsafe_b64decode(cursor.encode()))
+                assert isinstance(after, list) and \
+                    (len(after) == len(self.key_columns()))
+            except Exception:
+                raise ValueError("Invalid cursor")
+            self.after = tuple(after)
+
+    @classmethod
+    def from_args(cls, args: Mapping[str, str]) -> "ListQuery":
+        """ Creates from request arguments: sort, order ('asc' or 'desc'),
+        filter, since and until (ISO dates or datetimes, UTC by default),
+        cursor, limit. Raises ValueError on invalid arguments """
+        order = args.get("order", "asc")
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Invalid order '{order}'")
+        try:
+            limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise ValueError("Invalid page size")
+        return cls(sort=args.get("sort", "name"), descending=order == "desc",
+                   name_filter=args.get("filter"),
+                   since=cls._parse_time(args.get("since")),
+                   until=cls._parse_time(args.get("until")),
+                   cursor=args.get("cursor"), limit=limit)
+
+    def args(self, **kwargs: Any) -> Dict[str, str]:
+        """ Request arguments (without cursor) that correspond to this query,
+        with some of them replaced by given keyword arguments """
+        ret: Dict[str, Any] = {"sort": self.sort,
+                               "order": "desc" if self.descending else "asc"}
+        if self.name_filter:
+            ret["filter"] = self.name_filter
+        for attr in ("since", "until"):
+            if getattr(self, attr) is not None:
+                ret[attr] = datetime.datetime.fromtimestamp(
+                    getattr(self, attr), tz=datetime.timezone.utc).isoformat()
+        if self.limit != DEFAULT_PAGE_SIZE:
+            ret["limit"] = str(self.limit)
+        ret.update(kwargs)
+        return {k: v for k, v in ret.items() if v is not None}
+
+    def key_columns(self) -> Tuple[str, ...]:
+        """ Entry fields, page is ordered by """
+        return ("name",) if self.sort == "name" else ("mtime", "name")
+
+    def key(self, entry: HistEntry) -> Tuple[Any, ...]:
+        """ Ordering key of given entry """
+        return tuple(getattr(entry, column) for column in self.key_columns())
+
+    def make_cursor(self, entry: HistEntry) -> str:
+        """ Cursor of page that follows given entry """
+        return base64.urlsafe_b64encode(
+            json.dumps(list(self.key(entry))).encode()).decode()
+
+    def matches(self, entry: HistEntry) -> bool:
+        """ True if entry passes filters and follows cursor """
+        if self.name_filter and (self.name_filter not in entry.name):
+            return False
+        if (self.since is not None) and (entry.mtime < self.since):
+            return False
+        if (self.until is not None) and (entry.mtime >= self.until):
+            return False
+        if self.after is not None:
+            key = self.key(entry)
+            return (key < self.after) if self.descending \
+                else (key > self.after)
+        return True
+
+    def paginate(self, entries: List[HistEntry]) \
+            -> Tuple[List[HistEntry], Optional[str]]:
+        """ Page of given (complete, unordered) directory listing.
+        Returns (page entries, next page cursor or None) """
+        page = sorted((e for e in entries if self.matches(e)), key=self.key,
+                      reverse=self.descending)
+        return self.page(page[: self.limit + 1])
+
+    def page(self, entries: List[HistEntry]) \
+            -> Tuple[List[HistEntry], Optional[str]]:
+        """ Page from ordered list of at most limit + 1 entries. Returns
+        (page entries, next page cursor or None) """
+        if len(entries) <= self.limit:
+            return (entries, None)
+        return (entries[: self.limit],
+                self.make_cursor(entries[self.limit - 1]))
+
+    @staticmethod
+    def _parse_time(value: Optional[str]) -> Optional[float]:
+        """ Seconds since Epoch from ISO date/datetime (UTC by default) """
+        if not value:
+            return None
+        try:
+            dt = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid date/time '{value}'")
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt.timestamp()
+
+
+class HistoryIndex:
+    """ SQLite index of history directory tree.
+
+    Private attributes:
+    _root       -- History root directory
+    _index_file -- SQLite database file name
+    _local      -- Thread-local storage of database connections
+    """
+
+    def __init__(self, root: str, index_file: str) -> None:
+        """ Constructor
+
+        Arguments:
+        root       -- History root directory
+        index_file -- SQLite database file name (created if absent)
+        """
+        self._root = os.path.normpath(root)
+        self._index_file = index_file
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "parent TEXT NOT NULL, name TEXT NOT NULL, "
+                "is_dir INTEGER NOT NULL, size INTEGER NOT NULL, "
+                "mtime REAL NOT NULL, PRIMARY KEY (parent, name)) "
+                "WITHOUT ROWID")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_mtime_idx "
+                "ON entries (parent, mtime, name)")
+            # Directories, scanned into index
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS scanned (path TEXT PRIMARY KEY) "
+                "WITHOUT ROWID")
+
+    def relpath(self, local_path: str) -> Optional[str]:
+        """ Path relative to history root ('' for root itself) or None if
+        given storage path is not inside history directory """
+        local_path = os.path.normpath(local_path)
+        if local_path == self._root:
+            return ""
+        if not local_path.startswith(self._root + os.sep):
+            return None
+        return local_path[len(self._root) + 1:].replace(os.sep, "/")
+
+    def file_written(self, local_path: str) -> None:
+        """ Adds (or updates) entry of file, written to storage, and entries
+        of its parent directories. Does nothing for files outside history
+        """
+        rel = self.relpath(local_path)
+        if not rel:
+            return
+        st = os.stat(local_path)
+        parts = rel.split("/")
+        rows = [("/".join(parts[: i]), parts[i], 1, 0, st.st_mtime)
+                for i in range(len(parts) - 1)]
+        rows.append(("/".join(parts[: -1]), parts[-1], 0, st.st_size,
+                     st.st_mtime))
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO entries (parent, name, is_dir, size, mtime) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (parent, name) DO UPDATE "
+                "SET is_dir = excluded.is_dir, size = excluded.size, "
+                "mtime = max(mtime, excluded.mtime)", rows)
+
+    def deleted(self, local_path: str) -> None:
+        """ Removes entries of deleted file or directory tree. Does nothing
+        for paths outside history """
+        rel = self.relpath(local_path)
+        if rel is not None:
+            with self._conn() as conn:
+                self._remove(conn, rel)
+
+    def list(self, rel_dir: str, query: ListQuery) \
+            -> Optional[Tuple[List[HistEntry], Optional[str]]]:
+        """ Page of history directory listing
+
+        Arguments:
+        rel_dir -- Directory path relative to history root
+        query   -- Page parameters
+        Returns None if there is no such directory, otherwise (page entries,
+        next page cursor or None)
+        """
+        rel_dir = "/".join(p for p in rel_dir.split("/") if p)
+        local_dir = os.path.join(self._root, *rel_dir.split("/"))
+        with self._conn() as conn:
+            if not os.path.isdir(local_dir):
+                self._remove(conn, rel_dir)
+                return None
+            if conn.execute("SELECT 1 FROM scanned WHERE path = ?",
+                            (rel_dir,)).fetchone() is None:
+                self._scan(conn, rel_dir, local_dir)
+        where = ["parent = ?"]
+        params: List[Any] = [rel_dir]
+        if query.name_filter:
+            where.append("instr(name, ?) > 0")
+            params.append(query.name_filter)
+        if query.since is not None:
+            where.append("mtime >= ?")
+            params.append(query.since)
+        if query.until is not None:
+            where.append("mtime < ?")
+            params.append(query.until)
+        columns = ", ".join(query.key_columns())
+        if query.after is not None:
+            where.append(
+                f"({columns}) {'<' if query.descending else '>'} "
+                f"({', '.join('?' * len(query.after))})")
+            params += list(query.after)
+        direction = "DESC" if query.descending else "ASC"
+        order = ", ".join(f"{c} {direction}" for c in query.key_columns())
+        entries = \
+            [HistEntry(name=name, is_dir=bool(is_dir), size=size,
+                       mtime=mtime)
+             for name, is_dir, size, mtime in self._conn().execute(
+                 f"SELECT name, is_dir, size, mtime FROM entries "
+                 f"WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?",
+                 params + [query.limit + 1])]
+        page, next_cursor = query.page(entries)
+        # Entries, deleted bypassing object storage, are dropped from index
+        # (cursor is still valid even if it points to dropped entry)
+        stale = [e for e in page
+                 if not os.path.lexists(os.path.join(local_dir, e.name))]
+        if stale:
+            with self._conn() as conn:
+                for entry in stale:
+                    self._remove(
+                        conn,
+                        "/".join(p for p in (rel_dir, entry.name) if p))
+            page = [e for e in page if e not in stale]
+        return (page, next_cursor)
+
+    def _scan(self, conn: sqlite3.Connection, rel_dir: str,
+              local_dir: str) -> None:
+        """ Adds entries of given directory to index """
+        LOGGER.debug(f"Indexing history directory '{local_dir}'")
+        rows = []
+        with os.scandir(local_dir) as it:
+            for de in it:
+                if de.name.startswith("."):
+                    continue
+                try:
+                    st = de.stat()
+                    is_dir = de.is_dir()
+                except FileNotFoundError:
+                    continue
+                rows.append((rel_dir, de.name, int(is_dir),
+                             0 if is_dir else st.st_size, st.st_mtime))
+        conn.executemany(
+            "INSERT INTO entries (parent, name, is_dir, size, mtime) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (parent, name) DO NOTHING",
+            rows)
+        conn.execute("INSERT OR IGNORE INTO scanned (path) VALUES (?)",
+                     (rel_dir,))
+
+    def _remove(self, conn: sqlite3.Connection, rel: str) -> None:
+        """ Removes entries of given path and everything below it """
+        if not rel:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM scanned")
+            return
+        parent, _, name = rel.rpartition("/")
+        # '0' immediately follows '/' in collation order
+        conn.execute(
+            "DELETE FROM entries WHERE (parent = ? AND name = ?) OR "
+            "parent = ? OR (parent >= ? AND parent < ?)",
+            (parent, name, rel, rel + "/", rel + "0"))
+        conn.execute(
+            "DELETE FROM scanned WHERE path = ? OR (path >= ? AND path < ?)",
+            (rel, rel + "/", rel + "0"))
+
+    def _conn(self) -> sqlite3.Connection:
+        """ Database connection of current thread. Used as context manager
+        it wraps transaction """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._index_file, timeout=DB_TIMEOUT_SEC)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+# HistoryIndex objects, indexed by index file name
+_indices: Dict[str, HistoryIndex] = {}
+# Lock for _indices
+_indices_lock = threading.Lock()
+
+
+def get_index(config: Mapping[str, Any]) -> Optional[HistoryIndex]:
+    """ History index for given object storage configuration. None if
+    storage media is not LocalFS or index is disabled """
+    if (config["AFC_OBJST_MEDIA"] != "LocalFS") or \
+            (not config.get("AFC_OBJST_HIST_INDEX")):
+        return None
+    location = config["AFC_OBJST_FILE_LOCATION"]
+    index_file = os.path.join(location, HIST_INDEX_FILE)
+    with _indices_lock:
+        if index_file not in _indices:
+            os.makedirs(location, exist_ok=True)
+            _indices[index_file] = \
+                HistoryIndex(root=os.path.join(location, "history"),
+                             index_file=index_file)
+        return _indices[index_file]
@@ -12,12 +12,19 @@ Provides HTTP server for getting history.
 
 import os
 import logging
-import io
 import abc
+import html
+import datetime
+import mimetypes
+import urllib.parse
 import waitress
-from flask import Flask, request, helpers, abort
+from flask import Flask, request, abort, jsonify, make_response
 import google.cloud.storage
 from .objstconf import ObjstConfigInternal
+from .filestorage import ObjIntLocalFS as ObjStLocalFS, \
+    ObjIntGoogleCloudBucket as ObjStGoogleCloudBucket, stream_response
+from .histindex import get_index, HistEntry, ListQuery
+from . import histarchive
 
 NET_TIMEOUT = 60  # The amount of time, in seconds, to wait for the server response
 
@@ -36,15 +43,18 @@ if hist_app.config["AFC_OBJST_MEDIA"] == "GoogleCloudBucket":
     bucket = client.bucket(hist_app.config["AFC_OBJST_GOOGLE_CLOUD_BUCKET"])
 
 
-def generateHtml(rurl, path, dirs, files):
-    hist_app.logger.debug(f"generateHtml({rurl}, {path}, {dirs}, {files})")
-    dirs.sort()
-    files.sort()
+def generateHtml(rurl, path, entries, query, next_cursor):
+    hist_app.logger.debug(f"generateHtml({rurl}, {path}, {len(entries)})")
     vpath = "history"
     if path is not None and path != "":
         vpath += "/" + path
+    dir_url = "/".join(s for s in (rurl.rstrip("/"), path) if s)
 
-    html = """<!DOCTYPE html>
+    def page_url(**kwargs):
+        return html.escape(
+            dir_url + "?" + urllib.parse.urlencode(query.args(**kwargs)))
+
+    page = """<!DOCTYPE html>
 <html>
 <head>
     <meta content="text/html; charset="utf-8">
@@ -59,34 +69,54 @@ def generateHtml(rurl, path, dirs, files):
     i = 0
     for dir in path_split:
         if i != 0:
-            url += "/" + dir
-        html += " <a href=" + url + ">" + "/" + dir + "</a> "
+            url += "/" + urllib.parse.quote(dir)
+        page += " <a href=" + html.escape(url) + ">" + "/" + \
+            html.escape(dir) + "</a> "
         i = i + 1
 
-    html += """</h1><hr>
+    page += "</h1>\n<form action=" + html.escape(dir_url) + \
+        " method=get>Sort by <a href=" + page_url(sort="name") + \
+        ">name</a> | <a href=" + page_url(sort="mtime") + \
+        ">date</a>, <a href=" + page_url(order="asc") + \
+        ">ascending</a> | <a href=" + page_url(order="desc") + \
+        ">descending</a>. Filter: <input name=filter value=\"" + \
+        html.escape(query.name_filter or "") + "\">"
+    for k, v in query.args(filter=None).items():
+        page += "<input type=hidden name=" + html.escape(k) + \
+            " value=\"" + html.escape(v) + "\">"
+    page += """</form><hr>
 <ul>
 """
 
-    for e in dirs:
-        html += "<li><a href=" + \
-            "/".join(s for s in (rurl.rstrip("/"), path, e) if s) + \
-            "><b>" + e + """/</b></a></li>
-"""
-    for e in files:
-        html += "<li><a href=" + \
-            "/".join(s for s in (rurl.rstrip("/"), path, e) if s) + \
-            ">" + e + """</a></li>
+    for e in entries:
+        page += "<li><a href=" + \
+            html.escape(dir_url + "/" + urllib.parse.quote(e.name)) + ">" + \
+            ("<b>" + html.escape(e.name) + "/</b>" if e.is_dir
+             else html.escape(e.name)) + "</a> " + \
+            datetime.datetime.fromtimestamp(
+                e.mtime, tz=datetime.timezone.utc).strftime(
+                "%Y-%m-%d %H:%M:%S") + \
+            ("" if e.is_dir else " " + str(e.size)) + """</li>
 """
 
-    html += """</ul>
-<hr>
+    page += "</ul>\n"
+    if next_cursor:
+        page += "<a href=" + page_url(cursor=next_cursor) + \
+            ">Next page</a>\n"
+    page += """<hr>
 </body>
 </html>
 """
 
-    hist_app.logger.debug(html)
+    return page.encode()
 
-    return html.encode()
+
+def entry_json(entry):
+    """ JSON dictionary for directory entry """
+    return {"name": entry.name, "type": "dir" if entry.is_dir else "file",
+            "size": entry.size,
+            "mtime": datetime.datetime.fromtimestamp(
+                entry.mtime, tz=datetime.timezone.utc).isoformat()}
 
 
 class ObjInt:
@@ -99,10 +129,12 @@ class ObjInt:
 
     @abc.abstractmethod
     def list(self):
+        """ Complete unordered directory listing as list of HistEntry """
         pass
 
     @abc.abstractmethod
-    def read(self):
+    def open_stream(self):
+        """ ObjStream of file or None if file not found """
         pass
 
     def __enter__(self):
@@ -121,20 +153,27 @@ class ObjIntLocalFS(ObjInt):
 
     def list(self):
         hist_app.logger.debug("ObjIntLocalFS.list")
-        ls = os.listdir(self.__file_name)
-        files = [f for f in ls if os.path.isfile(
-            os.path.join(self.__file_name, f))]
-        dirs = [f for f in ls if os.path.isdir(
-            os.path.join(self.__file_name, f))]
-        return dirs, files
-
-    def read(self):
+        ret = []
+        with os.scandir(self.__file_name) as it:
+            for de in it:
+                # Temporary and archive index files are hidden
+                if de.name.startswith("."):
+                    continue
+                try:
+                    st = de.stat()
+                    is_dir = de.is_dir()
+                except FileNotFoundError:
+                    continue
+                ret.append(
+                    HistEntry(name=de.name, is_dir=is_dir,
+                              size=0 if is_dir else st.st_size,
+                              mtime=st.st_mtime))
+        return ret
+
+    def open_stream(self):
         hist_app.logger.debug(
-            "ObjIntLocalFS.read({})".format(self.__file_name))
-        if os.path.isfile(self.__file_name):
-            with open(self.__file_name, "rb") as hfile:
-                return hfile.read()
-        return None
+            "ObjIntLocalFS.open_stream({})".format(self.__file_name))
+        return ObjStLocalFS(self.__file_name).open_stream()
 
 
 class ObjIntGoogleCloudBucket(ObjInt):
@@ -149,19 +188,21 @@ class ObjIntGoogleCloudBucket(ObjInt):
         hist_app.logger.debug("ObjIntGoogleCloudBucket.list")
         blobs = bucket.list_blobs(prefix=self.__file_name + "/")
         files = []
-        dirs = set()
+        dirs = {}
         for blob in blobs:
             name = blob.name.removeprefix(self.__file_name + "/")
+            mtime = blob.updated.timestamp() if blob.updated else 0.
             if name.count("/"):
-                dirs.add(name.split("/")[0])
+                name = name.split("/")[0]
+                dirs[name] = max(dirs.get(name, 0.), mtime)
             else:
-                files.append(name)
-        return list(dirs), files
+                files.append(HistEntry(name=name, is_dir=False,
+                                       size=blob.size or 0, mtime=mtime))
+        return files + [HistEntry(name=name, is_dir=True, size=0, mtime=mtime)
+                        for name, mtime in dirs.items()]
 
-    def read(self):
-        blob = bucket.blob(self.__file_name)
-        return blob.download_as_bytes(raw_download=True,
-                                      timeout=NET_TIMEOUT)
+    def open_stream(self):
+        return ObjStGoogleCloudBucket(self.__file_name).open_stream()
 
 
 class Objstorage:
@@ -176,34 +217,91 @@ class Objstorage:
                         format(hist_app.config["AFC_OBJST_MEDIA"]))
 
 
+def list_dir(path, lpath, query):
+    """ Page of directory listing: (entries, next page cursor or None).
+    None if path is not a directory """
+    index = get_index(hist_app.config)
+    if index is not None:
+        return index.list(path, query)
+    with Objstorage().open(lpath) as hobj:
+        if not hobj.isdir():
+            return None
+        return query.paginate(hobj.list())
+
+
+def open_archived(lpath, query):
+    """ Looks up compacted history (LocalFS only). Returns (listing page,
+    None) for directory inside archive, (None, ObjStream) for file inside
+    archive, (None, None) if nothing found """
+    located = histarchive.locate(lpath)
+    if located is None:
+        return (None, None)
+    archive_file, inner = located
+    members = histarchive.read_index(archive_file) or {}
+    if inner in members:
+        return (None, histarchive.open_member(archive_file, members[inner]))
+    entries = histarchive.list_members(members, inner)
+    return (None if entries is None else query.paginate(entries), None)
+
+
 @hist_app.route('/', defaults={'path': ""}, methods=['GET'])
 @hist_app.route('/' + '<path:path>', methods=['GET'])
 def get(path):
-    ''' File download handler. '''
+    ''' Directory listing and file download handler.
+
+    Directory listing is paginated (see histindex.ListQuery.from_args() for
+    sort, filter and pagination arguments) and returned as HTML or, if
+    'format=json' argument is given or JSON is preferred by Accept header,
+    as JSON. Files are streamed, Range and conditional requests are supported
+    '''
     # ratapi URL preffix
-    rurl = request.args["url"]
+    rurl = request.args.get("url", request.base_url[: -len(path) or None])
     fwd_proto = request.headers.get('X-Forwarded-Proto')
     if (fwd_proto == 'https') and (request.scheme == "http"):
         rurl = rurl.replace("http:", "https:")
     hist_app.logger.debug(
         f'get method={request.method}, path={path} url={rurl}')
+    try:
+        query = ListQuery.from_args(request.args)
+    except ValueError as e:
+        return make_response(str(e), 400)
     # local path in the storage
     lpath = os.path.join(
         hist_app.config["AFC_OBJST_FILE_LOCATION"], "history", path)
 
+    local = hist_app.config["AFC_OBJST_MEDIA"] == "LocalFS"
     try:
-        objst = Objstorage()
-        with objst.open(lpath) as hobj:
-            if hobj.isdir() is True:
-                dirs, files = hobj.list()
-                return generateHtml(rurl, path, dirs, files)
-            data = hobj.read()
-            return helpers.send_file(
-                io.BytesIO(data),
-                download_name=os.path.basename(path))
+        stream = None
+        listing = list_dir(path, lpath, query)
+        # Archives of compacted history are browsed as directories
+        if (listing is None) and \
+                not (local and histarchive.is_archive(path)):
+            with Objstorage().open(lpath) as hobj:
+                stream = hobj.open_stream()
+        if (listing is None) and (stream is None) and local:
+            listing, stream = open_archived(lpath, query)
     except Exception as e:
         hist_app.logger.error(e)
         return abort(500)
+    if listing is not None:
+        entries, next_cursor = listing
+        if local:
+            entries = [e._replace(is_dir=True)
+                       if (not e.is_dir) and histarchive.is_archive(e.name)
+                       else e for e in entries]
+        if (request.args.get("format") == "json") or \
+                (request.accept_mimetypes.best_match(
+                    ["text/html", "application/json"]) == "application/json"):
+            return jsonify({"path": path,
+                            "entries": [entry_json(e) for e in entries],
+                            "next_cursor": next_cursor})
+        return generateHtml(rurl, path, entries, query, next_cursor)
+    if stream is None:
+        return make_response("File not found", 404)
+    mimetype, encoding = mimetypes.guess_type(os.path.basename(path))
+    return stream_response(stream,
+                           mimetype=mimetype or "application/octet-stream",
+                           content_encoding=encoding)
 
 
 if __name__ == '__main__':
@@ -10,6 +10,7 @@
 Provides env var config for filestorage and history.
 """
 
+import json
 import os
 from appcfg import ObjstConfigBase, InvalidEnvVar
 
@@ -32,6 +33,33 @@ class ObjstConfigInternal(ObjstConfigBase):
             # AFC_OBJST_MEDIA=LocalFS
             self.AFC_OBJST_FILE_LOCATION = os.getenv(
                 "AFC_OBJST_LOCAL_DIR", "/storage")
+            # fsync written files before reporting success
+            self.AFC_OBJST_FSYNC = \
+                os.getenv("AFC_OBJST_FSYNC", "").lower() in \
+                ("1", "yes", "true", "+")
+            # maintain persistent index of history directories
+            self.AFC_OBJST_HIST_INDEX = \
+                os.getenv("AFC_OBJST_HIST_INDEX", "true").lower() in \
+                ("1", "yes", "true", "+")
+            # JSON list of retention policies (see afcobjst.retention).
+            # None or empty list disables retention
+            self.AFC_OBJST_RETENTION = None
+            if os.getenv("AFC_OBJST_RETENTION"):
+                try:
+                    self.AFC_OBJST_RETENTION = \
+                        json.loads(os.getenv("AFC_OBJST_RETENTION"))
+                except json.JSONDecodeError as ex:
+                    raise InvalidEnvVar(
+                        f"Invalid AFC_OBJST_RETENTION env var: {ex}")
+                if not isinstance(self.AFC_OBJST_RETENTION, list):
+                    raise InvalidEnvVar(
+                        "AFC_OBJST_RETENTION env var should be a JSON list")
+            # interval between retention passes
+            self.AFC_OBJST_RETENTION_INTERVAL_SEC = \
+                int(os.getenv("AFC_OBJST_RETENTION_INTERVAL_SEC", "3600"))
+            # port of retention service Prometheus metrics (none if empty)
+            self.AFC_OBJST_RETENTION_METRICS_PORT = \
+                os.getenv("AFC_OBJST_RETENTION_METRICS_PORT")
         else:
             self.AFC_OBJST_GOOGLE_CLOUD_CREDENTIALS_JSON = os.getenv(
                 "AFC_OBJST_GOOGLE_CLOUD_CREDENTIALS_JSON")
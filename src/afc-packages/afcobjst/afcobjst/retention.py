@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+"""
+Retention and compaction of object storage files (LocalFS media).
+
+Retention policies are defined per storage prefix (top level directory, e.g.
+'history' or 'responses'). Policy applies to items - files or directories at
+given depth below the prefix (e.g. for 'history' items are
+'<serial>/<timestamp>' directories, their parents are serial number
+directories). Item may be removed because of its age (time since last write),
+because its parent has too many items or because prefix has too many bytes.
+Items whose names start with date may be compacted into per-day archives (see
+histarchive).
+
+Age index (SQLite database next to storage directories) holds size and
+modification time of every item. It is updated by object storage server on
+every write and delete, so that retention pass only touches items it removes
+(or compacts). Storage directories are scanned only once, to populate the
+index for files written before it was maintained. Directories, written to by
+object storage server, are also recorded in the index, so that temporary
+files, left by writes that crashed midway, may be found without scanning the
+whole storage.
+
+Run retention service:  python -m afcobjst.retention
+"""
+
+import collections
+import datetime
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import prometheus_client
+
+from .filestorage import TEMP_FILE_PREFIX, ObjIntLocalFS, objst_app
+from .histarchive import ARCHIVE_SUFFIX, DATE_RE, index_file_name, \
+    is_archive, remove_archive, write_archive
+from .histindex import HistoryIndex, get_index
+
+# Name of age index file, created in LocalFS storage directory
+RETENTION_INDEX_FILE = ".objst_retention_index.sqlite3"
+# Name of lock file that prevents concurrent retention passes
+RETENTION_LOCK_FILE = ".objst_retention.lock"
+# Temporary files older than this are considered orphaned
+TEMP_FILE_MAX_AGE_SEC = 3600
+# Seconds in day
+DAY_SEC = 24 * 3600
+# SQLite lock wait timeout in seconds
+DB_TIMEOUT_SEC = 30
+
+LOGGER = logging.getLogger(__name__)
+
+# Reasons of removal (metric label values)
+REASON_AGE = "age"
+REASON_COUNT = "count"
+REASON_BYTES = "bytes"
+REASON_COMPACTION = "compaction"
+REASON_TEMP = "temp"
+
+metric_reclaimed_bytes = \
+    prometheus_client.Counter(
+        "objst_retention_reclaimed_bytes",
+        "Bytes reclaimed by object storage retention",
+        ["prefix", "reason"])
+metric_removed_items = \
+    prometheus_client.Counter(
+        "objst_retention_removed_items",
+        "Items (files or directories) removed by object storage retention",
+        ["prefix", "reason"])
+metric_tracked_bytes = \
+    prometheus_client.Gauge(
+        "objst_retention_tracked_bytes",
+        "Bytes in items tracked by object storage retention", ["prefix"])
+metric_pass_duration = \
+    prometheus_client.Gauge(
+        "objst_retention_pass_duration_seconds",
+        "Duration of last object storage retention pass")
+
+# Item, selected for removal
+# path -- Item path relative to storage directory
+# size -- Item size in bytes
+Item = collections.namedtuple("Item", ["path", "size"])
+
+
+class RetentionPolicy:
+    """ Retention policy of storage prefix
+
+    Public attributes:
+    prefix             -- Top level storage directory
+    item_depth         -- Depth of items below prefix directory
+    max_age_days       -- None or maximum item age (since last write) in days
+    max_count          -- None or maximum number of items per parent
+                          directory (compacted archive counts as one item)
+    max_bytes          -- None or maximum total size of items in bytes
+    compact_after_days -- None or age in days after which items of a day are
+                          compacted into archive. Only items whose names
+                          start with date are compacted
+    """
+
+    def __init__(self, prefix: str, item_depth: int = 1,
+                 max_age_days: Optional[float] = None,
+                 max_count: Optional[int] = None,
+                 max_bytes: Optional[int] = None,
+                 compact_after_days: Optional[float] = None) -> None:
+        """ Constructor. Raises ValueError on invalid parameters """
+        self.prefix = prefix.strip("/")
+        if (not self.prefix) or ("/" in self.prefix) or \
+                self.prefix.startswith("."):
+            raise ValueError(f"Invalid retention prefix '{prefix}'")
+        if item_depth < 1:
+            raise ValueError(f"Invalid item depth for prefix '{prefix}'")
+        for name, value in [("max_age_days", max_age_days),
+                            ("max_count", max_count),
+                            ("max_bytes", max_bytes),
+                            ("compact_after_days", compact_after_days)]:
+            if (value is not None) and (value <= 0):
+                raise ValueError(
+                    f"Invalid {name} value for prefix '{prefix}'")
+        self.item_depth = item_depth
+        self.max_age_days = max_age_days
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.compact_after_days = compact_after_days
+
+    @classmethod
+    def from_dict(cls, d: Mapping[str, Any]) -> "RetentionPolicy":
+        """ Creates from JSON dictionary. Raises ValueError on invalid
+        content """
+        try:
+            return cls(**d)
+        except TypeError as ex:
+            raise ValueError(f"Invalid retention policy {d}: {ex}")
+
+
+def policies_from_config(config: Mapping[str, Any]) \
+        -> List[RetentionPolicy]:
+    """ Retention policies from object storage configuration. Empty for
+    media other than LocalFS and if no policies configured (i.e. retention
+    is opt-in) """
+    if config["AFC_OBJST_MEDIA"] != "LocalFS":
+        return []
+    return [RetentionPolicy.from_dict(d)
+            for d in (config.get("AFC_OBJST_RETENTION") or [])]
+
+
+class AgeIndex:
+    """ Age index of retention items.
+
+    Private attributes:
+    _location   -- Storage directory
+    _index_file -- SQLite database file name
+    _policies   -- Retention policies, indexed by prefix
+    _local      -- Thread-local storage of database connections
+    """
+
+    def __init__(self, location: str, policies: List[RetentionPolicy],
+                 index_file: Optional[str] = None) -> None:
+        """ Constructor
+
+        Arguments:
+        location   -- Storage directory
+        policies   -- Retention policies
+        index_file -- None or SQLite database file name (created if absent)
+        """
+        self._location = os.path.normpath(location)
+        self._index_file = \
+            index_file or os.path.join(location, RETENTION_INDEX_FILE)
+        self._policies = {p.prefix: p for p in policies}
+        self._local = threading.local()
+        with self.conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS items (path TEXT PRIMARY KEY, "
+                "prefix TEXT NOT NULL, parent TEXT NOT NULL, "
+                "mtime REAL NOT NULL, size INTEGER NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS items_mtime_idx "
+                         "ON items (prefix, mtime)")
+            conn.execute("CREATE INDEX IF NOT EXISTS items_parent_idx "
+                         "ON items (prefix, parent, mtime)")
+            # Parents to which items were added since last retention pass
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS dirty (prefix TEXT NOT NULL, "
+                "parent TEXT NOT NULL, PRIMARY KEY (prefix, parent)) "
+                "WITHOUT ROWID")
+            # Total item sizes per prefix
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS totals (prefix TEXT PRIMARY KEY, "
+                "size INTEGER NOT NULL) WITHOUT ROWID")
+            # Directories written to, with time of last write start
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, "
+                "written REAL NOT NULL) WITHOUT ROWID")
+            # Prefixes, scanned into index
+            conn.execute("CREATE TABLE IF NOT EXISTS scanned "
+                         "(prefix TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    @property
+    def location(self) -> str:
+        """ Storage directory """
+        return self._location
+
+    @property
+    def policies(self) -> List[RetentionPolicy]:
+        """ Retention policies """
+        return list(self._policies.values())
+
+    def item_of(self, rel: str) \
+            -> Optional[Tuple[RetentionPolicy, str, str, bool]]:
+        """ Retention item, containing given path
+
+        Arguments:
+        rel -- Path relative to storage directory
+        Returns None if path is not inside any item, otherwise (policy, item
+        path, item parent, True if given path is inside item rather than
+        item itself)
+        """
+        parts = rel.split("/")
+        policy = self._policies.get(parts[0])
+        if (policy is None) or (len(parts) <= policy.item_depth) or \
+                any(p.startswith(".") for p in parts[1:]):
+            return None
+        return (policy, "/".join(parts[: policy.item_depth + 1]),
+                "/".join(parts[: policy.item_depth]),
+                len(parts) > (policy.item_depth + 1))
+
+    def relpath(self, local_path: str) -> Optional[str]:
+        """ Path relative to storage directory. None if outside of it """
+        local_path = os.path.normpath(local_path)
+        if not local_path.startswith(self._location + os.sep):
+            return None
+        return local_path[len(self._location) + 1:].replace(os.sep, "/")
+
+    def writing(self, local_path: str) -> None:
+        """ Records start of write of given file """
+        rel = self.relpath(local_path)
+        if rel is None:
+            return
+        with self.conn() as conn:
+            conn.execute(
+                "INSERT INTO dirs (path, written) VALUES (?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET written = excluded.written",
+                (os.path.dirname(rel), time.time()))
+
+    def file_written(self, local_path: str, size_delta: int) -> None:
+        """ Records completed write of given file
+
+        Arguments:
+        local_path -- File name
+        size_delta -- File size change (new size minus previous size)
+        """
+        rel = self.relpath(local_path)
+        item = self.item_of(rel) if rel is not None else None
+        if item is None:
+            return
+        policy, path, parent, _ = item
+        with self.conn() as conn:
+            self.upsert(conn, policy.prefix, path, parent,
+                        os.stat(local_path).st_mtime, size_delta,
+                        add_size=True)
+
+    def deleted(self, local_path: str, size: int) -> None:
+        """ Records deletion of file or directory
+
+        Arguments:
+        local_path -- File or directory name
+        size       -- Size of deleted file (ignored for directories)
+        """
+        rel = self.relpath(local_path)
+        if rel is None:
+            return
+        with self.conn() as conn:
+            item = self.item_of(rel)
+            if (item is not None) and item[3]:
+                # File inside item
+                self.upsert(conn, item[0].prefix, item[1], item[2],
+                            time.time(), -size, add_size=True)
+                return
+            self.remove(conn, rel)
+            conn.execute("DELETE FROM dirs WHERE path = ? OR "
+                         "(path >= ? AND path < ?)",
+                         (rel, rel + "/", rel + "0"))
+
+    def upsert(self, conn: sqlite3.Connection, prefix: str, path: str,
+               parent: str, mtime: float, size: int,
+               add_size: bool) -> None:
+        """ Adds or updates item
+
+        Arguments:
+        conn     -- Database connection
+        prefix   -- Policy prefix
+        path     -- Item path
+        parent   -- Item parent path
+        mtime    -- Item modification time (only increases)
+        size     -- Item size or size change
+        add_size -- True if size is a change, False if it is a new size
+        """
+        old = conn.execute("SELECT size FROM items WHERE path = ?",
+                           (path,)).fetchone()
+        old_size = old[0] if old else 0
+        new_size = max((old_size + size) if add_size else size, 0)
+        conn.execute(
+            "INSERT INTO items (path, prefix, parent, mtime, size) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE "
+            "SET mtime = max(mtime, excluded.mtime), size = excluded.size",
+            (path, prefix, parent, mtime, new_size))
+        conn.execute("INSERT OR IGNORE INTO dirty (prefix, parent) "
+                     "VALUES (?, ?)", (prefix, parent))
+        self._add_total(conn, prefix, new_size - old_size)
+
+    def remove(self, conn: sqlite3.Connection, rel: str) -> None:
+        """ Removes items at or below given path """
+        # '0' immediately follows '/' in collation order
+        cond = "path = ? OR (path >= ? AND path < ?)"
+        params = (rel, rel + "/", rel + "0")
+        for prefix, size in conn.execute(
+                f"SELECT prefix, sum(size) FROM items WHERE {cond} "
+                f"GROUP BY prefix", params).fetchall():
+            self._add_total(conn, prefix, -size)
+        conn.execute(f"DELETE FROM items WHERE {cond}", params)
+
+    def total(self, prefix: str) -> int:
+        """ Total size of items of given prefix """
+        row = self.conn().execute("SELECT size FROM totals WHERE prefix = ?",
+                                  (prefix,)).fetchone()
+        return row[0] if row else 0
+
+    def conn(self) -> sqlite3.Connection:
+        """ Database connection of current thread. Used as context manager
+        it wraps transaction """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._index_file, timeout=DB_TIMEOUT_SEC)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _add_total(self, conn: sqlite3.Connection, prefix: str,
+                   delta: int) -> None:
+        """ Adds given value to total size of prefix """
+        conn.execute(
+            "INSERT INTO totals (prefix, size) VALUES (?, ?) "
+            "ON CONFLICT (prefix) DO UPDATE SET size = max(size + ?, 0)",
+            (prefix, max(delta, 0), delta))
+
+
+# AgeIndex objects, indexed by index file name
+_indices: Dict[str, AgeIndex] = {}
+# Lock for _indices
+_indices_lock = threading.Lock()
+
+
+def get_age_index(config: Mapping[str, Any]) -> Optional[AgeIndex]:
+    """ Age index for given object storage configuration. None if storage
+    media is not LocalFS or there are no retention policies """
+    policies = policies_from_config(config)
+    if not policies:
+        return None
+    location = config["AFC_OBJST_FILE_LOCATION"]
+    index_file = os.path.join(location, RETENTION_INDEX_FILE)
+    with _indices_lock:
+        if index_file not in _indices:
+            os.makedirs(location, exist_ok=True)
+            _indices[index_file] = \
+                AgeIndex(location=location, policies=policies,
+                         index_file=index_file)
+        return _indices[index_file]
+
+
+class Retention:
+    """ Retention pass executor
+
+    Private attributes:
+    _index      -- Age index
+    _hist_index -- None or history index, updated on removals
+    """
+
+    def __init__(self, index: AgeIndex,
+                 hist_index: Optional[HistoryIndex] = None) -> None:
+        """ Constructor
+
+        Arguments:
+        index      -- Age index
+        hist_index -- None or history index to update on removals
+        """
+        self._index = index
+        self._hist_index = hist_index
+
+    def run(self, now: Optional[float] = None) -> Dict[str, int]:
+        """ Makes retention pass
+
+        Arguments:
+        now -- Current time (seconds since Epoch), None for actual time
+        Returns dictionary of bytes reclaimed, indexed by reason. Empty if
+        other pass is in progress
+        """
+        start = time.time()
+        now = start if now is None else now
+        reclaimed: Dict[str, int] = collections.defaultdict(int)
+        with open(os.path.join(self._index.location, RETENTION_LOCK_FILE),
+                  "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                LOGGER.info("Other retention pass is in progress")
+                return {}
+            for policy in self._index.policies:
+                self._scan(policy)
+                if policy.max_age_days is not None:
+                    self._remove(
+                        policy, REASON_AGE, reclaimed,
+                        self._select(
+                            "SELECT path, size FROM items WHERE prefix = ? "
+                            "AND mtime < ? ORDER BY mtime",
+                            policy.prefix,
+                            now - policy.max_age_days * DAY_SEC))
+                self._apply_count(policy, reclaimed)
+                self._apply_bytes(policy, reclaimed)
+                if policy.compact_after_days is not None:
+                    self._compact(policy, now, reclaimed)
+                metric_tracked_bytes.labels(prefix=policy.prefix).set(
+                    self._index.total(policy.prefix))
+            self._sweep_temp_files(now, reclaimed)
+        metric_pass_duration.set(time.time() - start)
+        LOGGER.info(f"Retention pass reclaimed {dict(reclaimed)} bytes")
+        return dict(reclaimed)
+
+    def _select(self, query: str, *params: Any) -> List[Item]:
+        """ Items, returned by given query """
+        return [Item(*row) for row in
+                self._index.conn().execute(query, params).fetchall()]
+
+    def _apply_count(self, policy: RetentionPolicy,
+                     reclaimed: Dict[str, int]) -> None:
+        """ Removes oldest items of parents with too many items """
+        conn = self._index.conn()
+        parents = [row[0] for row in conn.execute(
+            "SELECT parent FROM dirty WHERE prefix = ?", (policy.prefix,))]
+        if policy.max_count is not None:
+            for parent in parents:
+                self._remove(
+                    policy, REASON_COUNT, reclaimed,
+                    self._select(
+                        "SELECT path, size FROM items WHERE prefix = ? AND "
+                        "parent = ? ORDER BY mtime DESC LIMIT -1 OFFSET ?",
+                        policy.prefix, parent, policy.max_count))
+        with conn:
+            conn.executemany(
+                "DELETE FROM dirty WHERE prefix = ? AND parent = ?",
+                [(policy.prefix, parent) for parent in parents])
+
+    def _apply_bytes(self, policy: RetentionPolicy,
+                     reclaimed: Dict[str, int]) -> None:
+        """ Removes oldest items until total size of prefix fits limit """
+        if policy.max_bytes is None:
+            return
+        while self._index.total(policy.prefix) > policy.max_bytes:
+            excess = self._index.total(policy.prefix) - policy.max_bytes
+            items: List[Item] = []
+            for item in self._select(
+                    "SELECT path, size FROM items WHERE prefix = ? "
+                    "ORDER BY mtime LIMIT 1000", policy.prefix):
+                if excess <= 0:
+                    break
+                items.append(item)
+                excess -= item.size
+            if not items:
+                break
+            self._remove(policy, REASON_BYTES, reclaimed, items)
+
+    def _compact(self, policy: RetentionPolicy, now: float,
+                 reclaimed: Dict[str, int]) -> None:
+        """ Compacts days that ended more than compact_after_days ago """
+        assert policy.compact_after_days is not None
+        cutoff_day = datetime.datetime.fromtimestamp(
+            now - policy.compact_after_days * DAY_SEC,
+            tz=datetime.timezone.utc).date()
+        cutoff = datetime.datetime.combine(
+            cutoff_day, datetime.time(),
+            tzinfo=datetime.timezone.utc).timestamp()
+        days: Dict[Tuple[str, str], List[Item]] = \
+            collections.defaultdict(list)
+        for item in self._select(
+                "SELECT path, size FROM items WHERE prefix = ? AND mtime < ? "
+                "ORDER BY mtime", policy.prefix, cutoff):
+            name = item.path.rsplit("/", 1)[-1]
+            if is_archive(name) or (not DATE_RE.match(name)) or \
+                    (name[: 10] >= cutoff_day.isoformat()):
+                continue
+            days[(item.path.rsplit("/", 1)[0], name[: 10])].append(item)
+        for (parent, day), items in sorted(days.items()):
+            local_parent = os.path.join(self._index.location, parent)
+            archive_name = day + ARCHIVE_SUFFIX
+            suffix = 0
+            while os.path.exists(os.path.join(local_parent, archive_name)):
+                suffix += 1
+                archive_name = f"{day}_{suffix}{ARCHIVE_SUFFIX}"
+            archive_file = os.path.join(local_parent, archive_name)
+            try:
+                archive_size = \
+                    write_archive(
+                        archive_file, local_parent,
+                        [item.path.rsplit("/", 1)[-1] for item in items])
+            except OSError as ex:
+                LOGGER.error(f"Compaction of '{parent}/{day}' failed: {ex}")
+                continue
+            with self._index.conn() as conn:
+                self._index.upsert(conn, policy.prefix,
+                                   f"{parent}/{archive_name}", parent,
+                                   os.stat(archive_file).st_mtime,
+                                   archive_size, add_size=False)
+            if self._hist_index is not None:
+                self._hist_index.file_written(archive_file)
+            before = reclaimed[REASON_COMPACTION]
+            self._remove(policy, REASON_COMPACTION, reclaimed, items)
+            reclaimed[REASON_COMPACTION] -= archive_size
+            metric_reclaimed_bytes.labels(
+                prefix=policy.prefix, reason=REASON_COMPACTION).inc(
+                    max(reclaimed[REASON_COMPACTION] - before, 0))
+            LOGGER.info(f"'{parent}/{day}': {len(items)} items compacted "
+                        f"into '{archive_name}'")
+
+    def _remove(self, policy: RetentionPolicy, reason: str,
+                reclaimed: Dict[str, int], items: List[Item]) -> None:
+        """ Removes given items from storage and index """
+        for item in items:
+            local_path = os.path.join(self._index.location, item.path)
+            try:
+                if is_archive(local_path):
+                    remove_archive(local_path)
+                else:
+                    ObjIntLocalFS(local_path).delete()
+            except OSError as ex:
+                LOGGER.error(f"Removal of '{item.path}' failed: {ex}")
+                continue
+            with self._index.conn() as conn:
+                self._index.remove(conn, item.path)
+            if self._hist_index is not None:
+                self._hist_index.deleted(local_path)
+            reclaimed[reason] += item.size
+            if reason != REASON_COMPACTION:
+                metric_reclaimed_bytes.labels(
+                    prefix=policy.prefix, reason=reason).inc(item.size)
+            metric_removed_items.labels(prefix=policy.prefix,
+                                        reason=reason).inc()
+
+    def _scan(self, policy: RetentionPolicy) -> None:
+        """ Populates index with items of given prefix if not yet done """
+        conn = self._index.conn()
+        if conn.execute("SELECT 1 FROM scanned WHERE prefix = ?",
+                        (policy.prefix,)).fetchone():
+            return
+        LOGGER.info(f"Indexing '{policy.prefix}' items")
+        root = os.path.join(self._index.location, policy.prefix)
+        level = [""]
+        for _ in range(policy.item_depth - 1):
+            next_level = []
+            for rel in level:
+                try:
+                    with os.scandir(os.path.join(root, rel)) as it:
+                        next_level += \
+                            [f"{rel}/{de.name}" if rel else de.name
+                             for de in it if de.is_dir() and
+                             (not de.name.startswith("."))]
+                except (FileNotFoundError, NotADirectoryError):
+                    pass
+            level = next_level
+        for rel in level:
+            parent = f"{policy.prefix}/{rel}" if rel else policy.prefix
+            with conn:
+                try:
+                    with os.scandir(os.path.join(root, rel)) as it:
+                        names = [de.name for de in it
+                                 if not de.name.startswith(".")]
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                for name in names:
+                    size, mtime = self._du(os.path.join(root, rel, name))
+                    self._index.upsert(
+                        conn, policy.prefix, f"{parent}/{name}", parent,
+                        mtime, size, add_size=False)
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO scanned (prefix) VALUES (?)",
+                         (policy.prefix,))
+
+    def _du(self, path: str) -> Tuple[int, float]:
+        """ Total size and latest modification time of file or directory
+        (of files in it) """
+        if is_archive(path):
+            size, mtime = self._du_file(path)
+            return (size + self._du_file(index_file_name(path))[0], mtime)
+        if not os.path.isdir(path):
+            return self._du_file(path)
+        size = 0
+        mtime = 0.
+        for dir_name, _, files in os.walk(path):
+            for file_name in files:
+                s, m = self._du_file(os.path.join(dir_name, file_name))
+                size += s
+                mtime = max(mtime, m)
+        # Empty directory is as old as directory itself
+        return (size, mtime or self._du_file(path)[1])
+
+    def _du_file(self, path: str) -> Tuple[int, float]:
+        """ Size and modification time of file (zeros if file vanished) """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return (0, 0.)
+        return (st.st_size, st.st_mtime)
+
+    def _sweep_temp_files(self, now: float,
+                          reclaimed: Dict[str, int]) -> None:
+        """ Removes orphaned temporary files from directories, not written
+        to for TEMP_FILE_MAX_AGE_SEC """
+        cutoff = now - TEMP_FILE_MAX_AGE_SEC
+        conn = self._index.conn()
+        dirs = [row[0] for row in conn.execute(
+            "SELECT path FROM dirs WHERE written < ?", (cutoff,))]
+        for rel in dirs:
+            try:
+                with os.scandir(os.path.join(self._index.location,
+                                             rel)) as it:
+                    for de in it:
+                        if de.name.startswith(TEMP_FILE_PREFIX) and \
+                                (de.stat().st_mtime < cutoff):
+                            size = de.stat().st_size
+                            os.unlink(de.path)
+                            reclaimed[REASON_TEMP] += size
+                            metric_reclaimed_bytes.labels(
+                                prefix=rel.split("/")[0],
+                                reason=REASON_TEMP).inc(size)
+            except FileNotFoundError:
+                pass
+        with conn:
+            conn.executemany("DELETE FROM dirs WHERE path = ? AND written < ?",
+                             [(rel, cutoff) for rel in dirs])
+
+
+def main() -> None:
+    """ Retention service: periodic retention passes """
+    config = objst_app.config
+    index = get_age_index(config)
+    if index is None:
+        LOGGER.info("No retention policies defined")
+        return
+    metrics_port = config.get("AFC_OBJST_RETENTION_METRICS_PORT")
+    if metrics_port:
+        prometheus_client.start_http_server(int(metrics_port))
+    retention = Retention(index, hist_index=get_index(config))
+    while True:
+        try:
+            retention.run()
+        except Exception as ex:
+            LOGGER.error(f"Retention pass failed: {ex}")
+        time.sleep(config["AFC_OBJST_RETENTION_INTERVAL_SEC"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+""" Tests for local filesystem object storage: concurrency stress test, GET
+semantics
+
+Run tests:        python -m unittest test_filestorage
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import multiprocessing
+import os
+import random
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import unittest
+
+from afcobjst.filestorage import ObjIntLocalFS, objst_app, TEMP_FILE_PREFIX
+
+# Number of writer processes
+WRITERS = 4
+# Number of reader processes
+READERS = 4
+# Number of threads in each writer/reader process
+THREADS = 4
+# Duration of stress test in seconds
+DURATION_SEC = 3
+# Number of distinct keys all writers and readers hammer
+KEYS = 3
+# Maximum payload length. Large enough to make writes non-atomic
+MAX_LEN = 1 << 20
+# Payload header: length, fill byte
+HEADER = struct.Struct("<IB")
+
+
+def make_payload(fill: int) -> bytes:
+    """ Payload of random length, made of header and repeated fill byte. Any
+    mixture of two payloads breaks their consistency """
+    length = random.randint(0, MAX_LEN)
+    return HEADER.pack(length, fill) + bytes([fill]) * length
+
+
+def check_payload(data: bytes) -> Optional[str]:
+    """ Returns None if payload is consistent, error message otherwise """
+    if len(data) < HEADER.size:
+        return f"Truncated header: {len(data)} bytes"
+    length, fill = HEADER.unpack_from(data)
+    if len(data) != (HEADER.size + length):
+        return f"Length mismatch: {len(data) - HEADER.size} instead of " \
+            f"{length}"
+    if data.count(fill, HEADER.size) != length:
+        return f"Content of {length} bytes is not filled with {fill}"
+    return None
+
+
+def key_names(directory: str) -> List[str]:
+    """ File names of keys being tested """
+    return [os.path.join(directory, "sub", f"key{i}") for i in range(KEYS)]
+
+
+def stress_worker(directory: str, writer: bool, deadline: float,
+                  errors: "multiprocessing.Queue[str]") -> None:
+    """ Body of writer or reader process
+
+    Arguments:
+    directory -- Storage directory
+    writer    -- True for writer process, False for reader process
+    deadline  -- time.time() at which to stop
+    errors    -- Queue for error messages
+    """
+    names = key_names(directory)
+
+    def thread_body() -> None:
+        try:
+            while time.time() < deadline:
+                obj = ObjIntLocalFS(random.choice(names), fsync=False)
+                if writer:
+                    if random.random() < 0.1:
+                        obj.delete()
+                    else:
+                        obj.write(make_payload(random.randint(0, 255)))
+                    continue
+                data = obj.read()
+                if data is None:
+                    continue
+                msg = check_payload(data)
+                if msg:
+                    errors.put(f"Torn read of '{obj._file_name}': {msg}")
+                    return
+        except Exception as ex:
+            errors.put(f"{ex.__class__.__name__}: {ex}")
+
+    threads = [threading.Thread(target=thread_body) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class TestLocalFSConcurrency(unittest.TestCase):
+    """ Concurrent writes, reads and deletes in local filesystem storage """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._testdir)
+        unittest.TestCase.tearDown(self)
+
+    def test_write_read(self) -> None:
+        """ Simple write, read, head and delete """
+        obj = ObjIntLocalFS(os.path.join(self._testdir, "a", "b"), fsync=True)
+        self.assertFalse(obj.head())
+        self.assertIsNone(obj.read())
+        obj.write(b"abc")
+        self.assertTrue(obj.head())
+        self.assertEqual(obj.read(), b"abc")
+        # Same mode as open() would give
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.join(self._testdir, "a", "b")).
+                         st_mode),
+            0o666 & ~umask)
+        obj.write(b"de")
+        self.assertEqual(obj.read(), b"de")
+        obj.delete()
+        self.assertFalse(obj.head())
+        obj.delete()
+        ObjIntLocalFS(os.path.join(self._testdir, "a")).delete()
+        self.assertFalse(os.path.exists(os.path.join(self._testdir, "a")))
+
+    def test_no_torn_reads(self) -> None:
+        """ Concurrent writers and readers of the same keys. Readers only see
+        complete payloads, no temporary files left behind """
+        ctx = multiprocessing.get_context("fork")
+        errors = ctx.Queue()
+        deadline = time.time() + DURATION_SEC
+        processes = \
+            [ctx.Process(target=stress_worker,
+                         args=(self._testdir, writer, deadline, errors))
+             for writer in [True] * WRITERS + [False] * READERS]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        messages = []
+        while not errors.empty():
+            messages.append(errors.get())
+        self.assertEqual(messages, [])
+        for process in processes:
+            self.assertEqual(process.exitcode, 0)
+        sub_dir = os.path.dirname(key_names(self._testdir)[0])
+        if os.path.isdir(sub_dir):
+            self.assertEqual(
+                [f for f in os.listdir(sub_dir)
+                 if f.startswith(TEMP_FILE_PREFIX)], [])
+
+
+class TestGet(unittest.TestCase):
+    """ Streaming, Range and conditional GET """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+        self._saved_location = objst_app.config["AFC_OBJST_FILE_LOCATION"]
+        objst_app.config["AFC_OBJST_FILE_LOCATION"] = self._testdir
+        self._client = objst_app.test_client()
+        self._data = bytes(range(256)) * 1000
+        self.assertEqual(
+            self._client.post("/a/b", data=self._data).status_code, 200)
+
+    def tearDown(self) -> None:
+        objst_app.config["AFC_OBJST_FILE_LOCATION"] = self._saved_location
+        shutil.rmtree(self._testdir)
+        unittest.TestCase.tearDown(self)
+
+    def _get(self, path: str, headers: Optional[Dict[str, str]] = None) \
+            -> Tuple[int, Dict[str, str], bytes]:
+        """ Makes GET request, returns status code, headers and content """
+        with self._client.get(path, headers=headers) as resp:
+            return (resp.status_code, dict(resp.headers), resp.data)
+
+    def test_full(self) -> None:
+        """ Full GET and 404 """
+        status, headers, data = self._get("/a/b")
+        self.assertEqual(status, 200)
+        self.assertEqual(data, self._data)
+        self.assertEqual(headers["Content-Length"], str(len(self._data)))
+        self.assertEqual(headers["Accept-Ranges"], "bytes")
+        self.assertTrue(headers.get("ETag"))
+        self.assertEqual(self._get("/a/c")[0], 404)
+        self.assertEqual(self._get("/a")[0], 404)
+
+    def test_range(self) -> None:
+        """ Range requests """
+        status, headers, data = \
+            self._get("/a/b", headers={"Range": "bytes=10-19"})
+        self.assertEqual(status, 206)
+        self.assertEqual(data, self._data[10: 20])
+        self.assertEqual(headers["Content-Range"],
+                         f"bytes 10-19/{len(self._data)}")
+        status, _, data = self._get("/a/b", headers={"Range": "bytes=-5"})
+        self.assertEqual(status, 206)
+        self.assertEqual(data, self._data[-5:])
+        self.assertEqual(
+            self._get("/a/b",
+                      headers={"Range": f"bytes={len(self._data)}-"})[0],
+            416)
+
+    def test_conditional(self) -> None:
+        """ 304 for unchanged object, new ETag for changed one """
+        etag = self._get("/a/b")[1]["ETag"]
+        status, _, data = self._get("/a/b", headers={"If-None-Match": etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(data, b"")
+        self._client.post("/a/b", data=b"new")
+        status, headers, data = \
+            self._get("/a/b", headers={"If-None-Match": etag})
+        self.assertEqual(status, 200)
+        self.assertEqual(data, b"new")
+        self.assertNotEqual(headers["ETag"], etag)
+
+
+if __name__ == "__main__":
+    unittest.main()
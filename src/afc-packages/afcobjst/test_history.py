@@ -0,0 +1,187 @@
+""" Tests for history index and history server: pagination, sort, filter,
+index maintenance on write/delete, JSON listing, streamed downloads
+
+Run tests:        python -m unittest test_history
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import datetime
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+import unittest
+
+from afcobjst.filestorage import objst_app
+from afcobjst.history import hist_app
+from afcobjst.histindex import HistoryIndex, ListQuery, HIST_INDEX_FILE
+
+# Serial numbers of test history directories
+SERIALS = ["SN-A", "SN-B", "SN-C", "XN-D", "XN-E"]
+# Timestamp directories of each serial
+DATES = ["2023-01-01T00:00:00", "2023-02-01T00:00:00"]
+
+
+class TestHistory(unittest.TestCase):
+    """ History index and history server """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+        self._saved_config = \
+            [dict(app.config) for app in (objst_app, hist_app)]
+        for app in (objst_app, hist_app):
+            app.config["AFC_OBJST_MEDIA"] = "LocalFS"
+            app.config["AFC_OBJST_FILE_LOCATION"] = self._testdir
+            app.config["AFC_OBJST_HIST_INDEX"] = True
+        self._objst = objst_app.test_client()
+        self._hist = hist_app.test_client()
+        # Serials are written in reverse order of names
+        for idx, serial in reversed(list(enumerate(SERIALS))):
+            for date in DATES:
+                self._write(f"{serial}/{date}/analysisRequest.json",
+                            b"x" * (idx + 1))
+            time.sleep(0.01)
+
+    def tearDown(self) -> None:
+        for app, config in zip((objst_app, hist_app), self._saved_config):
+            app.config.update(config)
+        shutil.rmtree(self._testdir)
+        unittest.TestCase.tearDown(self)
+
+    def _local(self, path: str) -> str:
+        """ Local file name of history path """
+        return os.path.join(self._testdir, "history", path)
+
+    def _write(self, path: str, data: bytes) -> None:
+        """ Writes history file via object storage server """
+        self.assertEqual(
+            self._objst.post(f"/history/{path}", data=data).status_code, 200)
+
+    def _list(self, path: str = "", **args: Any) -> Dict[str, Any]:
+        """ JSON listing of given history directory """
+        resp = self._hist.get(f"/{path}", query_string={"format": "json",
+                                                        **args})
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_json()
+
+    def _names(self, path: str = "", **args: Any) -> List[str]:
+        """ Names in all pages of listing of given history directory """
+        ret: List[str] = []
+        cursor: Optional[str] = None
+        while True:
+            if cursor:
+                args["cursor"] = cursor
+            listing = self._list(path, **args)
+            ret += [e["name"] for e in listing["entries"]]
+            cursor = listing["next_cursor"]
+            if not cursor:
+                return ret
+
+    def test_pagination(self) -> None:
+        """ Page boundaries, sort orders """
+        page = self._list(limit=2)
+        self.assertEqual([e["name"] for e in page["entries"]],
+                         SERIALS[: 2])
+        self.assertEqual(page["entries"][0]["type"], "dir")
+        self.assertEqual(self._names(limit=2), SERIALS)
+        self.assertEqual(self._names(limit=3, order="desc"),
+                         list(reversed(SERIALS)))
+        self.assertEqual(self._names(limit=2, sort="mtime"),
+                         list(reversed(SERIALS)))
+        self.assertEqual(self._names(f"{SERIALS[0]}/{DATES[0]}"),
+                         ["analysisRequest.json"])
+        self.assertEqual(self._hist.get("/", query_string={"limit": 0}).
+                         status_code, 400)
+        self.assertEqual(self._hist.get("/", query_string={"cursor": "x"}).
+                         status_code, 400)
+
+    def test_filter(self) -> None:
+        """ Filter by name and by modification time """
+        self.assertEqual(self._names(filter="XN"), ["XN-D", "XN-E"])
+        self.assertEqual(self._names(SERIALS[0], filter="2023-02"),
+                         [DATES[1]])
+        mtimes = [datetime.datetime.fromisoformat(e["mtime"])
+                  for e in self._list(sort="mtime")["entries"]]
+        since = mtimes[2] - (mtimes[2] - mtimes[1]) / 2
+        self.assertEqual(
+            self._names(sort="mtime", since=since.isoformat()),
+            list(reversed(SERIALS[: 3])))
+
+    def test_index_maintenance(self) -> None:
+        """ Index is updated on write and delete, entries deleted bypassing
+        object storage are dropped, unscanned directory is scanned """
+        self.assertTrue(
+            os.path.isfile(os.path.join(self._testdir, HIST_INDEX_FILE)))
+        self._write("SN-NEW/2023-03-01T00:00:00/response.json", b"{}")
+        self.assertIn("SN-NEW", self._names())
+        self.assertEqual(
+            self._objst.delete("/history/SN-NEW").status_code, 204)
+        self.assertNotIn("SN-NEW", self._names())
+        shutil.rmtree(self._local(SERIALS[-1]))
+        self.assertEqual(self._names(), SERIALS[: -1])
+        self._write("SN-RAW/2023-04-01T00:00:00/a.json", b"{}")
+        with open(self._local("SN-RAW/2023-04-01T00:00:00/b.json"), "wb"):
+            pass
+        self.assertEqual(self._names("SN-RAW/2023-04-01T00:00:00"),
+                         ["a.json", "b.json"])
+        self.assertEqual(self._hist.get("/SN-NONE/").status_code, 404)
+
+    def test_html(self) -> None:
+        """ HTML listing with next page link """
+        resp = self._hist.get("/", query_string={"url": "http://h/history",
+                                                 "limit": 2})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"http://h/history/SN-A", resp.data)
+        self.assertIn(b"Next page", resp.data)
+
+    def test_download(self) -> None:
+        """ Streamed file download with content type and Range support """
+        path = f"/{SERIALS[2]}/{DATES[0]}/analysisRequest.json"
+        resp = self._hist.get(path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"xxx")
+        self.assertEqual(resp.mimetype, "application/json")
+        resp = self._hist.get(path, headers={"Range": "bytes=1-"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, b"xx")
+        self.assertEqual(self._hist.get(path + "x").status_code, 404)
+
+
+class TestListQuery(unittest.TestCase):
+    """ In-memory pagination, used when index is not available """
+
+    def test_paginate(self) -> None:
+        """ In-memory pagination matches index pagination """
+        testdir = tempfile.mkdtemp()
+        try:
+            root = os.path.join(testdir, "history")
+            os.makedirs(root)
+            index = HistoryIndex(root=root,
+                                 index_file=os.path.join(testdir, "idx"))
+            for name in ("b", "a", "d", "c", "e"):
+                with open(os.path.join(root, name), "w") as f:
+                    f.write(name)
+            entries = index.list("", ListQuery(limit=100))[0]
+            for kwargs in ({"limit": 2}, {"sort": "mtime", "limit": 3},
+                           {"descending": True, "limit": 1,
+                            "name_filter": "c"}):
+                query = ListQuery(**kwargs)
+                page, cursor = query.paginate(entries)
+                self.assertEqual(page, index.list("", query)[0])
+                if cursor:
+                    next_page = ListQuery(cursor=cursor, **kwargs).\
+                        paginate(entries)[0]
+                    self.assertTrue(set(next_page).isdisjoint(page))
+        finally:
+            shutil.rmtree(testdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
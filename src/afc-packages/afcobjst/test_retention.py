@@ -0,0 +1,297 @@
+""" Tests for retention and compaction of object storage files: age, count and
+size limits, compaction into archives readable through history server,
+orphaned temporary files sweep, metrics
+
+Run tests:        python -m unittest test_retention
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+import unittest
+
+import prometheus_client
+
+from afcobjst.filestorage import TEMP_FILE_PREFIX, objst_app
+from afcobjst.history import hist_app
+from afcobjst.histarchive import index_file_name
+from afcobjst.histindex import get_index
+from afcobjst.retention import DAY_SEC, Retention, RetentionPolicy, \
+    get_age_index
+
+# Timestamp directories of compacted days
+COMPACTED = ["2023-01-01T00:00:00", "2023-01-01T12:00:00",
+             "2023-01-02T00:00:00"]
+# Files in history directory
+FILES = ["analysisRequest.json", "response.json"]
+
+
+class TestRetention(unittest.TestCase):
+    """ Retention passes on temporary LocalFS storage """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+        self._saved_config = \
+            [dict(app.config) for app in (objst_app, hist_app)]
+        for app in (objst_app, hist_app):
+            app.config["AFC_OBJST_MEDIA"] = "LocalFS"
+            app.config["AFC_OBJST_FILE_LOCATION"] = self._testdir
+            app.config["AFC_OBJST_HIST_INDEX"] = True
+        self._objst = objst_app.test_client()
+        self._hist = hist_app.test_client()
+
+    def tearDown(self) -> None:
+        for app, config in zip((objst_app, hist_app), self._saved_config):
+            app.config.clear()
+            app.config.update(config)
+        shutil.rmtree(self._testdir)
+        unittest.TestCase.tearDown(self)
+
+    def _policies(self, *policies: Dict[str, Any]) -> None:
+        """ Sets retention policies """
+        for app in (objst_app, hist_app):
+            app.config["AFC_OBJST_RETENTION"] = list(policies)
+
+    def _retention(self) -> Retention:
+        """ Retention pass executor for current configuration """
+        index = get_age_index(objst_app.config)
+        assert index is not None
+        return Retention(index, hist_index=get_index(objst_app.config))
+
+    def _local(self, path: str) -> str:
+        """ Local file name of storage path """
+        return os.path.join(self._testdir, path)
+
+    def _write(self, path: str, data: bytes) -> None:
+        """ Writes file via object storage server """
+        self.assertEqual(
+            self._objst.post(f"/{path}", data=data).status_code, 200)
+
+    def _write_raw(self, path: str, data: bytes,
+                   age_days: Optional[float] = None) -> None:
+        """ Writes file bypassing object storage server
+
+        Arguments:
+        path     -- Storage path
+        data     -- File content
+        age_days -- None or file age in days
+        """
+        os.makedirs(os.path.dirname(self._local(path)), exist_ok=True)
+        with open(self._local(path), "wb") as f:
+            f.write(data)
+        if age_days is not None:
+            mtime = time.time() - age_days * DAY_SEC
+            os.utime(self._local(path), (mtime, mtime))
+
+    def _reclaimed(self, prefix: str, reason: str) -> float:
+        """ Value of reclaimed bytes metric """
+        return prometheus_client.REGISTRY.get_sample_value(
+            "objst_retention_reclaimed_bytes_total",
+            {"prefix": prefix, "reason": reason}) or 0.
+
+    def test_age(self) -> None:
+        """ Files written before index existed and files written via object
+        storage server are removed by age """
+        self._policies({"prefix": "history", "item_depth": 2,
+                        "max_age_days": 14},
+                       {"prefix": "responses", "max_age_days": 14})
+        self._write_raw("history/SN-A/2023-01-01T00:00:00/a.json", b"x" * 10,
+                        age_days=20)
+        self._write_raw("history/SN-A/2023-01-20T00:00:00/a.json", b"x",
+                        age_days=1)
+        self._write_raw("responses/old/response.json", b"x" * 5, age_days=20)
+        self._write_raw("other/old.json", b"x", age_days=20)
+        self._write("history/SN-B/2023-02-01T00:00:00/a.json", b"xx")
+        before = self._reclaimed("history", "age")
+        self.assertEqual(self._retention().run(), {"age": 15})
+        self.assertEqual(self._reclaimed("history", "age") - before, 10)
+        self.assertFalse(
+            os.path.exists(self._local("history/SN-A/2023-01-01T00:00:00")))
+        self.assertFalse(os.path.exists(self._local("responses/old")))
+        for path in ("history/SN-A/2023-01-20T00:00:00/a.json",
+                     "history/SN-B/2023-02-01T00:00:00/a.json",
+                     "other/old.json"):
+            self.assertTrue(os.path.isfile(self._local(path)))
+        self.assertEqual(get_age_index(objst_app.config).total("history"), 3)
+        self.assertEqual(self._retention().run(), {})
+        self.assertEqual(
+            self._retention().run(now=time.time() + 15 * DAY_SEC),
+            {"age": 3})
+        self.assertEqual(get_age_index(objst_app.config).total("history"), 0)
+
+    def test_count(self) -> None:
+        """ Oldest items of parents with too many items are removed """
+        self._policies({"prefix": "history", "item_depth": 2,
+                        "max_count": 2})
+        for date in ("2023-01-01", "2023-01-02", "2023-01-03"):
+            self._write(f"history/SN-A/{date}T00:00:00/a.json", b"x")
+            time.sleep(0.01)
+        self._write("history/SN-B/2023-01-01T00:00:00/a.json", b"x")
+        self.assertEqual(self._retention().run(), {"count": 1})
+        self.assertEqual(sorted(os.listdir(self._local("history/SN-A"))),
+                         ["2023-01-02T00:00:00", "2023-01-03T00:00:00"])
+        # Rewrite of existing item makes it the newest
+        self._write("history/SN-A/2023-01-02T00:00:00/b.json", b"x")
+        self._write("history/SN-A/2023-01-04T00:00:00/a.json", b"x")
+        self.assertEqual(self._retention().run(), {"count": 1})
+        self.assertEqual(sorted(os.listdir(self._local("history/SN-A"))),
+                         ["2023-01-02T00:00:00", "2023-01-04T00:00:00"])
+        self.assertTrue(os.path.isdir(self._local("history/SN-B")))
+
+    def test_bytes(self) -> None:
+        """ Oldest items are removed when prefix exceeds size limit, size is
+        tracked on rewrite and delete """
+        self._policies({"prefix": "responses", "max_bytes": 250})
+        for name in ("a", "b", "c"):
+            self._write(f"responses/{name}/response.json", b"x" * 100)
+            time.sleep(0.01)
+        index = get_age_index(objst_app.config)
+        self.assertEqual(index.total("responses"), 300)
+        self.assertEqual(self._retention().run(), {"bytes": 100})
+        self.assertEqual(sorted(os.listdir(self._local("responses"))),
+                         ["b", "c"])
+        self.assertEqual(index.total("responses"), 200)
+        self._write("responses/b/response.json", b"x" * 50)
+        self.assertEqual(index.total("responses"), 150)
+        self.assertEqual(
+            self._objst.delete("/responses/c/response.json").status_code, 204)
+        self.assertEqual(index.total("responses"), 50)
+        self.assertEqual(
+            self._objst.delete("/responses/b").status_code, 204)
+        self.assertEqual(index.total("responses"), 0)
+
+    def _make_compacted(self) -> Dict[str, bytes]:
+        """ Creates and compacts history of SN-A. Returns content of
+        compacted files, indexed by paths relative to SN-A """
+        self._policies({"prefix": "history", "item_depth": 2,
+                        "max_age_days": 100, "compact_after_days": 1})
+        ret: Dict[str, bytes] = {}
+        for idx, timestamp in enumerate(COMPACTED):
+            for file_name in FILES:
+                path = f"{timestamp}/{file_name}"
+                ret[path] = f"{path} {'x' * idx * 1000}".encode()
+                self._write_raw(f"history/SN-A/{path}", ret[path],
+                                age_days=10)
+        self._write_raw("history/SN-A/2023-02-01T00:00:00/a.json", b"x")
+        self.assertEqual(self._names("SN-A"),
+                         COMPACTED + ["2023-02-01T00:00:00"])
+        before = self._reclaimed("history", "compaction")
+        reclaimed = self._retention().run()
+        self.assertGreater(reclaimed["compaction"], 0)
+        self.assertEqual(self._reclaimed("history", "compaction") - before,
+                         reclaimed["compaction"])
+        return ret
+
+    def _names(self, path: str) -> List[str]:
+        """ Names in JSON listing of history directory """
+        resp = self._hist.get(f"/{path}", query_string={"format": "json"})
+        self.assertEqual(resp.status_code, 200)
+        return [e["name"] for e in resp.get_json()["entries"]]
+
+    def test_compaction(self) -> None:
+        """ Compacted history is readable through history server and
+        extractable with tar """
+        contents = self._make_compacted()
+        self.assertEqual(self._names("SN-A"),
+                         ["2023-01-01.tar.gz", "2023-01-02.tar.gz",
+                          "2023-02-01T00:00:00"])
+        listing = self._hist.get("/SN-A", query_string={"format": "json"}).\
+            get_json()["entries"]
+        self.assertEqual(listing[0]["type"], "dir")
+        self.assertEqual(self._names("SN-A/2023-01-01.tar.gz"),
+                         COMPACTED[: 2])
+        self.assertEqual(self._names("SN-A/2023-01-01T12:00:00"), FILES)
+        self.assertEqual(
+            self._names("SN-A/2023-01-01.tar.gz/2023-01-01T12:00:00"), FILES)
+        for path, content in contents.items():
+            day = path[: 10]
+            for url in (f"/SN-A/{path}",
+                        f"/SN-A/{day}.tar.gz/{path}"):
+                resp = self._hist.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.data, content)
+                self.assertEqual(resp.mimetype, "application/json")
+        path = f"{COMPACTED[2]}/{FILES[1]}"
+        resp = self._hist.get(f"/SN-A/{path}",
+                              headers={"Range": "bytes=2000-"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, contents[path][2000:])
+        self.assertEqual(
+            self._hist.get(f"/SN-A/{COMPACTED[0]}/none.json").status_code,
+            404)
+        with tarfile.open(self._local("history/SN-A/2023-01-01.tar.gz")) \
+                as tar:
+            self.assertEqual(
+                {m.name: tar.extractfile(m).read() for m in tar},
+                {k: v for k, v in contents.items()
+                 if k.startswith("2023-01-01")})
+        # Archive is an item, removed (with its index) by age
+        self.assertGreater(
+            self._retention().run(now=time.time() + 150 * DAY_SEC)["age"], 0)
+        archive = self._local("history/SN-A/2023-01-01.tar.gz")
+        self.assertFalse(os.path.exists(archive))
+        self.assertFalse(os.path.exists(index_file_name(archive)))
+        self.assertEqual(self._names("SN-A"), [])
+
+    def test_late_compaction(self) -> None:
+        """ History of already compacted day is compacted into separate
+        archive """
+        self._make_compacted()
+        self._write_raw("history/SN-A/2023-01-01T18:00:00/a.json", b"late",
+                        age_days=10)
+        # Bypassing object storage server requires rescan
+        index = get_age_index(objst_app.config)
+        with index.conn() as conn:
+            conn.execute("DELETE FROM scanned")
+        self._retention().run()
+        self.assertIn("2023-01-01_1.tar.gz", self._names("SN-A"))
+        self.assertEqual(
+            self._hist.get("/SN-A/2023-01-01T18:00:00/a.json").data, b"late")
+
+    def test_temp_files(self) -> None:
+        """ Orphaned temporary files are removed from directories, written to
+        by object storage server """
+        self._policies({"prefix": "history", "item_depth": 2,
+                        "max_count": 10})
+        self._write("history/SN-A/2023-01-01T00:00:00/a.json", b"x")
+        orphan = f"history/SN-A/2023-01-01T00:00:00/{TEMP_FILE_PREFIX}b"
+        self._write_raw(orphan, b"x" * 7, age_days=1)
+        self._write_raw(f"history/SN-B/{TEMP_FILE_PREFIX}c", b"x",
+                        age_days=1)
+        self.assertEqual(self._retention().run(), {})
+        self.assertEqual(self._retention().run(now=time.time() + 7200),
+                         {"temp": 7})
+        self.assertFalse(os.path.exists(self._local(orphan)))
+        self.assertTrue(
+            os.path.exists(self._local(f"history/SN-B/{TEMP_FILE_PREFIX}c")))
+        self.assertTrue(os.path.exists(
+            self._local("history/SN-A/2023-01-01T00:00:00/a.json")))
+
+    def test_policy(self) -> None:
+        """ Invalid policies are rejected, absent or empty policy list
+        disables retention """
+        for d in ({"prefix": ""}, {"prefix": "a/b"},
+                  {"prefix": "history", "max_age_days": 0},
+                  {"prefix": "history", "unknown": 1}):
+            with self.assertRaises(ValueError):
+                RetentionPolicy.from_dict(d)
+        self._policies()
+        self.assertIsNone(get_age_index(objst_app.config))
+        objst_app.config.pop("AFC_OBJST_RETENTION", None)
+        self.assertIsNone(get_age_index(objst_app.config))
+        objst_app.config["AFC_OBJST_RETENTION"] = None
+        self.assertIsNone(get_age_index(objst_app.config))
+
+
+if __name__ == "__main__":
+    unittest.main()
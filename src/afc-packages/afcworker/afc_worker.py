@@ -57,6 +57,33 @@ def get_rcache_client():
     return _rcache_client
 
 
+def stage_timing_mark(stage_timing, stage):
+    """ Marks end of processing stage in stage timing
+
+    Stage timing is the wire form of afc_traffic_metrics.StageTimer (JSON
+    string with time of last mark and list of stages completed here). It is
+    handled here without afc_traffic_metrics, as Prometheus client is not
+    installed on Worker
+
+    Arguments:
+    stage_timing -- None or stage timing in wire form
+    stage        -- Name of stage that ended now
+    Returns updated stage timing. None if None or malformed stage timing
+    passed
+    """
+    if not stage_timing:
+        return None
+    try:
+        timing_dict = json.loads(stage_timing)
+        now = time.time()
+        timing_dict["stages"].append(
+            [stage, max(now - float(timing_dict["last"]), 0.)])
+        timing_dict["last"] = now
+        return json.dumps(timing_dict)
+    except (ValueError, TypeError, LookupError, AttributeError):
+        return None
+
+
 LOGGER.info('Celery Broker: %s', conf.BROKER_URL)
 
 
@@ -74,7 +101,8 @@ client = Celery(
 @client.task(ignore_result=True)
 def run(prot, host, port, request_type, task_id, hash_val,
         config_path, history_dir, runtime_opts, mntroot, rcache_queue,
-        request_str, original_request_str, config_str, deadline):
+        request_str, original_request_str, config_str, deadline,
+        stage_timing=None):
     """ Run AFC Engine
 
         The parameters are all serializable so they can be passed through the message queue.
@@ -102,7 +130,10 @@ def run(prot, host, port, request_type, task_id, hash_val,
         :param config_str None for task-based synchronization, config text for RMQ-based synchronization
 
         :param deadline Processung deadline (when msghnd timeout expires) as seconds since Epoch
+
+        :param stage_timing None or processing stage timing (wire form of afc_traffic_metrics.StageTimer) to update and return along with RMQ response
     """
+    stage_timing = stage_timing_mark(stage_timing, "queue_wait")
     LOGGER.debug(f"run(prot={prot}, host={host}, port={port}, "
                  f"task_id={task_id}, hash={hash_val}, opts={runtime_opts}, "
                  f"mntroot={mntroot}, timeout={deadline-time.time()}, "
@@ -231,7 +262,8 @@ def run(prot, host, port, request_type, task_id, hash_val,
                 if success and response_gz else None
             get_rcache_client().rmq_send_response(
                 queue_name=rcache_queue, req_cfg_digest=hash_val,
-                request=original_request_str, response=response_str)
+                request=original_request_str, response=response_str,
+                stage_timing=stage_timing_mark(stage_timing, "engine"))
 
         if runtime_opts & defs.RNTM_OPT_GUI:
             for fname in ("results.kmz", "mapData.json.gz"):
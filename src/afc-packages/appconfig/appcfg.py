@@ -24,6 +24,21 @@ PROPAGATE_EXCEPTIONS = False
 AFC_RATAPI_LOG_LEVEL = os.getenv("AFC_RATAPI_LOG_LEVEL", "WARNING")
 # Default request timeout in seconds
 AFC_MSGHND_RATAFC_TOUT = 600
+#: Minimum interval in seconds between checks of RatDB cache generation (i.e.
+#: maximum staleness of AFC Config, certification ID and denied AP caches)
+AFC_MSGHND_CACHE_CHECK_INTERVAL = 5
+#: True to pass processing stage timing to Worker (and get Worker's stages
+#: back). Workers that predate it reject such requests, so it should be
+#: enabled only after all Workers are upgraded
+AFC_WORKER_STAGE_TIMING = \
+    os.getenv("AFC_WORKER_STAGE_TIMING", "").lower() == "true"
+#: Directory, shared by msghnd workers, for on-demand sampling profiler.
+#: Profiler endpoint is enabled only if specified
+AFC_PROFILER_DIR = None
+#: Minimum interval between profiling starts (in any worker) in seconds
+AFC_PROFILER_MIN_INTERVAL = 60
+#: Maximum profiling duration in seconds
+AFC_PROFILER_MAX_DURATION = 30
 #: Set of log handlers to use for root logger
 LOG_HANDLERS = [
     logging.StreamHandler(),
@@ -59,6 +74,9 @@ USER_REGISTER_TEMPLATE = 'register.html'
 GOOGLE_APIKEY = None
 #: Dynamic system data (both model data and configuration)
 STATE_ROOT_PATH = '/var/lib/fbrat'
+#: Directory for precompressed variants of static assets (LiDAR/RAS bounds),
+#: may be shared by workers. None means 'static_assets' in STATE_ROOT_PATH
+STATIC_ASSET_CACHE_DIR = None
 #: Mount path
 NFS_MOUNT_PATH = '/mnt/nfs'
 #: Use random PAWS response flag
@@ -11,9 +11,11 @@ Provides wrappers for RATAPI file operations
 """
 
 import abc
+import collections
 import os
 import inspect
 import logging
+import threading
 import requests
 from appcfg import ObjstConfig
 
@@ -21,6 +23,60 @@ app_log = logging.getLogger(__name__)
 conf = ObjstConfig()
 
 
+class _ConditionalCache:
+    """ Process-wide cache of recently read small objects with their ETags.
+    Allows to re-read (poll) unchanged objects with conditional GET, getting
+    304 response without body instead of object content
+
+    Private attributes:
+    _max_entries -- Maximum number of cached objects
+    _max_size    -- Maximum size of cached object
+    _lock        -- Lock for thread-safe access
+    _entries     -- Ordered (oldest first) dictionary of (ETag, content)
+                    tuples, indexed by URL
+    """
+    def __init__(self, max_entries=100, max_size=1024 * 1024):
+        """ Constructor
+
+        Arguments:
+        max_entries -- Maximum number of cached objects
+        max_size    -- Maximum size of cached object
+        """
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, url):
+        """ Returns (ETag, content) tuple for given URL, (None, None) if not
+        cached """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return (None, None)
+            self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url, etag, content):
+        """ Stores or drops (if there is no ETag or content is too big) object
+        content """
+        with self._lock:
+            self._entries.pop(url, None)
+            if (etag is None) or (len(content) > self._max_size):
+                return
+            self._entries[url] = (etag, content)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def drop(self, url):
+        """ Drops object content """
+        with self._lock:
+            self._entries.pop(url, None)
+
+
+_conditional_cache = _ConditionalCache()
+
+
 class DataInt:
     """ Abstract class for data prot operations """
     __metaclass__ = abc.ABCMeta
@@ -57,17 +113,29 @@ class DataIntHttp(DataInt):
     def write(self, data):
         """ write data to prot """
         app_log.debug("DataIntHttp.write({})".format(self._file_name))
+        _conditional_cache.drop(self._file_name)
         r = requests.post(self._file_name, data=data)
         if not r.ok:
             raise Exception("Cant post file")
 
     def read(self):
-        """ read data from prot """
+        """ read data from prot. Conditional GET is used for recently read
+        objects, so unchanged ones are not transferred again """
         app_log.debug("DataIntHttp.read({})".format(self._file_name))
-        r = requests.get(self._file_name, stream=True)
+        etag, content = _conditional_cache.get(self._file_name)
+        r = requests.get(
+            self._file_name, stream=True,
+            headers=None if etag is None else {"If-None-Match": etag})
+        if (r.status_code == 304) and (etag is not None):
+            r.close()
+            return content
         if r.ok:
             r.raw.decode_content = False
-            return r.raw.read()
+            content = r.raw.read()
+            _conditional_cache.put(self._file_name, r.headers.get("ETag"),
+                                   content)
+            return content
+        _conditional_cache.drop(self._file_name)
         raise Exception("Cant get file")
 
     def head(self):
@@ -79,6 +147,7 @@ class DataIntHttp(DataInt):
     def delete(self):
         """ remove data from prot """
         app_log.debug("DataIntHttp.delete({})".format(self._file_name))
+        _conditional_cache.drop(self._file_name)
         requests.delete(self._file_name)
 
 
@@ -6,11 +6,16 @@
 # a copy of which is included with this software program
 #
 
+# pylint: disable=protected-access
+
+import json
 import platform
 import prometheus_client
-from typing import Union
+import time
+from typing import List, Optional, Tuple, Union
 
-__all__ = ["message_processed", "request_processed"]
+__all__ = ["message_processed", "observe_n", "request_processed",
+           "StageTimer", "STAGES"]
 
 # Hostname
 hostname = platform.node()
@@ -18,6 +23,31 @@ hostname = platform.node()
 # Histogram duration buckets in seconds
 DURATION_BUCKETS = (0.05, 0.1, 1., 10., 60., 120.)
 
+# Stage histogram duration buckets in seconds
+STAGE_DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 10., 60.)
+
+# AFC Request processing stages. Stage histogram label values are restricted
+# to these to keep its cardinality bounded
+STAGES = (
+    # Request format validation
+    "validation",
+    # Certification ID lookup (AP authentication)
+    "cert_lookup",
+    # AFC Config retrieval
+    "config_lookup",
+    # Request/config hash computation and Rcache lookup
+    "rcache_lookup",
+    # Sending computation request to AFC Worker (via Celery)
+    "dispatch",
+    # Computation request waiting in Celery queue
+    "queue_wait",
+    # AFC Engine run (including preparation of its files)
+    "engine",
+    # Delivery of AFC Response from AFC Worker (via RabbitMQ)
+    "delivery",
+    # Response postprocessing and ALS logging
+    "response")
+
 # Message processing duration histogram
 message_duration_hist = \
     prometheus_client.Histogram(name="afc_message_duration",
@@ -32,6 +62,17 @@ request_duration_hist = \
                                 labelnames=["host"], buckets=DURATION_BUCKETS)
 request_duration_hist = request_duration_hist.labels(host=hostname)
 
+# AFC Request processing stage duration histogram
+stage_duration_hist = \
+    prometheus_client.Histogram(
+        name="afc_stage_duration",
+        documentation="AFC Request processing stage duration histogram",
+        labelnames=["host", "stage"], buckets=STAGE_DURATION_BUCKETS)
+# Stage histograms, bound to labels, indexed by stage names
+stage_duration_hists = \
+    {stage: stage_duration_hist.labels(host=hostname, stage=stage)
+     for stage in STAGES}
+
 # Message HTTP status codes
 http_status_counter = \
     prometheus_client.Counter(name="afc_http_status",
@@ -46,6 +87,42 @@ afc_response_counter = \
         labelnames=["host", "response"])
 
 
+def observe_n(histogram: prometheus_client.Histogram, value: float,
+              count: int) -> None:
+    """ Observes the same value given number of times
+
+    Equivalent of calling histogram.observe(value) 'count' times, but sum and
+    bucket counter are updated once (i.e. metric lock is taken and, in
+    multiprocess mode, mmapped value files are written once, not 'count'
+    times). Note that sum is incremented by value * count, which may differ
+    from result of repeated additions in last bits of mantissa
+
+    Arguments:
+    histogram -- Histogram (bound to labels if it has them)
+    value     -- Value to observe
+    count     -- Number of observations
+    """
+    if count <= 1:
+        if count == 1:
+            histogram.observe(value)
+        return
+    try:
+        histogram._raise_if_not_observable()
+        sum_value = histogram._sum
+        buckets = histogram._buckets
+        upper_bounds = histogram._upper_bounds
+    except AttributeError:
+        # Unfamiliar prometheus_client internals - doing it the slow way
+        for _ in range(count):
+            histogram.observe(value)
+        return
+    sum_value.inc(value * count)
+    for bucket, bound in zip(buckets, upper_bounds):
+        if value <= bound:
+            bucket.inc(count)
+            break
+
+
 def message_processed(duration_sec: float, status: Union[int, str]) -> None:
     """ Called upon AFC message processing completion
 
@@ -66,6 +143,85 @@ def request_processed(duration_sec: float, response: Union[int, str],
     response     -- AFC response code or string with its moral equivalent
     n            -- Number of responses ended this way
     """
-    for _ in range(n):
-        request_duration_hist.observe(duration_sec)
+    observe_n(request_duration_hist, duration_sec, n)
     afc_response_counter.labels(host=hostname, response=str(response)).inc(n)
+
+
+class StageTimer:
+    """ Timeline of single AFC Request processing stages
+
+    Stage duration is a time between consecutive marks. Part of timeline
+    executed in other process (AFC Worker) is carried there and back in wire
+    form - JSON string with time of last mark and list of stages completed
+    remotely: '{"last": <SECONDS_SINCE_EPOCH>, "stages": [[<STAGE>,
+    <DURATION>], ...]}'. Stage histogram is updated (by observe()) in the
+    process that started the timeline
+
+    Private attributes:
+    _last     -- Time of last mark in seconds since the Epoch
+    _stages   -- List of (stage name, duration in seconds) tuples
+    _observed -- True if stage histogram already updated
+    """
+
+    def __init__(self, start_time: Optional[float] = None) -> None:
+        """ Constructor
+
+        Arguments:
+        start_time -- Start of first stage in seconds since the Epoch. None
+                      for current time
+        """
+        self._last = time.time() if start_time is None else start_time
+        self._stages: List[Tuple[str, float]] = []
+        self._observed = False
+
+    def mark(self, stage: str) -> None:
+        """ Marks end of given stage (that started at previous mark)
+
+        Arguments:
+        stage -- Stage name (one of STAGES)
+        """
+        assert stage in STAGES
+        now = time.time()
+        self._stages.append((stage, max(now - self._last, 0.)))
+        self._last = now
+
+    def to_wire(self) -> str:
+        """ Wire form to send along with computation request to AFC Worker """
+        return json.dumps({"last": self._last, "stages": []})
+
+    def merge_wire(self, wire: Optional[str]) -> bool:
+        """ Merges stages, returned from AFC Worker in wire form
+
+        Arguments:
+        wire -- Wire form, returned from AFC Worker. None if Worker returned
+                nothing
+        Returns True if merge was successful. False if wire form is missing or
+        malformed (then timeline is left intact)
+        """
+        if not wire:
+            return False
+        try:
+            wire_dict = json.loads(wire)
+            stages = [(str(stage), max(float(duration), 0.))
+                      for stage, duration in wire_dict["stages"]
+                      if stage in STAGES]
+            last = float(wire_dict["last"])
+        except (ValueError, TypeError, LookupError):
+            return False
+        self._stages += stages
+        self._last = last
+        return True
+
+    def timeline(self) -> str:
+        """ Timeline in printable form """
+        return " ".join(f"{stage}={duration:.3f}"
+                        for stage, duration in self._stages)
+
+    def observe(self) -> None:
+        """ Updates stage histogram with stages of this timeline (only first
+        call has effect) """
+        if self._observed:
+            return
+        self._observed = True
+        for stage, duration in self._stages:
+            stage_duration_hists[stage].observe(duration)
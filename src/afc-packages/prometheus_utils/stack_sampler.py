@@ -0,0 +1,540 @@
+""" On-demand in-process sampling profiler
+
+This module allows to find out where a running (production) service worker
+spends its time without restarting it with instrumentation. It defines:
+
+- StackSampler - time-boxed stack sampler of current process. Samples are
+  collected either by a separate sampling thread that uses
+  sys._current_frames() (all threads are sampled) or by SIGPROF interval timer
+  (only main thread is sampled, but it works under gevent, where all greenlets
+  run in main thread and no other OS thread gets scheduled while some greenlet
+  burns CPU). No sys.setprofile()/sys.settrace() is used, so overhead is
+  proportional to sampling rate, not to amount of executed code. Result is
+  folded stacks ('frame;frame;...;frame count' lines), consumable by
+  flamegraph.pl, speedscope, etc.
+
+- WorkerProfiler - opt-in profiling service for (gunicorn) worker processes
+  that share a directory. Any worker may be asked to profile any other
+  registered worker (request is passed through the directory and picked up by
+  watcher thread of target worker). Global (per directory) rate limit is
+  enforced.
+
+Example of FastAPI endpoint:
+
+    profiler = stack_sampler.WorkerProfiler(directory=...)
+    profiler.start()
+    ...
+    @app.get("/profile")
+    async def profile(duration: float, pid: Optional[int] = None):
+        try:
+            return fastapi.responses.PlainTextResponse(
+                await asyncio.to_thread(profiler.profile,
+                                        duration_sec=duration, pid=pid))
+        except stack_sampler.ProfilerError as ex:
+            raise fastapi.HTTPException(status_code=ex.status,
+                                        detail=str(ex))
+
+Self-test (profiles busy loop and checks that it is found):
+    python3 stack_sampler.py
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+# pylint: disable=protected-access, too-many-instance-attributes
+# pylint: disable=too-many-arguments
+
+import collections
+import fcntl
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import types
+from typing import Counter, List, Optional
+import uuid
+
+__all__ = ["ProfilerError", "self_test", "StackSampler", "WorkerProfiler"]
+
+# Default sampling interval in seconds
+DEFAULT_INTERVAL_SEC = 0.01
+
+# Minimum sampling interval in seconds
+MIN_INTERVAL_SEC = 0.001
+
+# Default maximum profiling duration in seconds
+DEFAULT_MAX_DURATION_SEC = 30.
+
+# Default minimum interval between profiling starts in seconds
+DEFAULT_MIN_START_INTERVAL_SEC = 60.
+
+# Maximum number of frames in sampled stack
+MAX_STACK_DEPTH = 128
+
+# Interval of polling shared directory for requests/results in seconds
+POLL_INTERVAL_SEC = 0.5
+
+# Time to wait for target worker to pick up profiling request in seconds
+PICKUP_TIMEOUT_SEC = 10.
+
+# Names of files in shared directory
+WORKER_FILE_PREFIX = "worker_"
+REQUEST_FILE_PREFIX = "request_"
+RESULT_FILE_PREFIX = "result_"
+RATE_LIMIT_FILE = "rate_limit"
+
+
+def gevent_patched() -> bool:
+    """ True if threading is monkey-patched by gevent (i.e. 'threads' are
+    greenlets in main OS thread) """
+    if "gevent.monkey" not in sys.modules:
+        return False
+    return bool(sys.modules["gevent.monkey"].is_module_patched("threading"))
+
+
+class ProfilerError(Exception):
+    """ Profiling request failure
+
+    Public attributes:
+    status      -- HTTP status code to report
+    retry_after -- None or number of seconds after which request may succeed
+    """
+
+    def __init__(self, msg: str, status: int = 400,
+                 retry_after: Optional[float] = None) -> None:
+        """ Constructor
+
+        Arguments:
+        msg         -- Error message
+        status      -- HTTP status code to report
+        retry_after -- None or number of seconds after which request may
+                       succeed
+        """
+        super().__init__(msg)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class StackSampler:
+    """ Time-boxed stack sampler of current process
+
+    Samples of profiler's own threads (sampling thread, thread waiting for
+    sampling completion, WorkerProfiler's watcher thread) are not counted
+
+    Private attributes:
+    _interval_sec   -- Sampling interval in seconds
+    _use_signal     -- True to sample by SIGPROF timer, False to sample by
+                       separate thread
+    _counts         -- Sample counts, indexed by folded stacks
+    _num_samples    -- Total number of samples taken (including not counted)
+    _stop_event     -- Event that stops sampling thread
+    _thread         -- Sampling thread or None
+    _prev_handler   -- Previous SIGPROF handler
+    _running        -- True if sampling is in progress
+    """
+
+    def __init__(self, interval_sec: float = DEFAULT_INTERVAL_SEC,
+                 use_signal: Optional[bool] = None) -> None:
+        """ Constructor
+
+        Arguments:
+        interval_sec -- Sampling interval in seconds (for SIGPROF - in
+                        consumed CPU time)
+        use_signal   -- True to sample by SIGPROF timer (main thread only),
+                        False to sample by separate thread (all threads), None
+                        to choose SIGPROF if running under gevent
+        """
+        self._interval_sec = max(interval_sec, MIN_INTERVAL_SEC)
+        self._use_signal = \
+            gevent_patched() if use_signal is None else use_signal
+        self._counts: Counter[str] = collections.Counter()
+        self._num_samples = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._prev_handler: object = None
+        self._running = False
+
+    @property
+    def num_samples(self) -> int:
+        """ Total number of samples taken """
+        return self._num_samples
+
+    def start(self) -> None:
+        """ Starts sampling """
+        if self._running:
+            raise ProfilerError("Sampling already in progress", status=409)
+        if self._use_signal:
+            try:
+                self._prev_handler = \
+                    signal.signal(signal.SIGPROF, self._signal_handler)
+            except ValueError as ex:
+                raise ProfilerError(
+                    f"SIGPROF sampling must be started from main thread: "
+                    f"{ex}", status=500)
+            signal.setitimer(signal.ITIMER_PROF, self._interval_sec,
+                             self._interval_sec)
+        else:
+            self._stop_event.clear()
+            self._thread = \
+                threading.Thread(target=self._sampling_thread,
+                                 name="StackSampler", daemon=True)
+            self._thread.start()
+        self._running = True
+
+    def stop(self) -> None:
+        """ Stops sampling """
+        if not self._running:
+            return
+        self._running = False
+        if self._use_signal:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._prev_handler)
+        else:
+            assert self._thread is not None
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def run(self, duration_sec: float) -> str:
+        """ Samples for given time
+
+        Arguments:
+        duration_sec -- Sampling duration in seconds
+        Returns folded stacks
+        """
+        self.start()
+        try:
+            time.sleep(duration_sec)
+        finally:
+            self.stop()
+        return self.folded()
+
+    def folded(self) -> str:
+        """ Collected samples as folded stacks, most frequent first """
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self._counts.most_common())
+
+    def _sampling_thread(self) -> None:
+        """ Sampling thread function """
+        while not self._stop_event.wait(self._interval_sec):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                self._add_sample(
+                    frame, thread_names.get(thread_id, str(thread_id)))
+
+    def _signal_handler(self, signum: int,
+                        frame: Optional[types.FrameType]) -> None:
+        """ SIGPROF handler """
+        if frame is not None:
+            self._add_sample(frame, "MainThread")
+
+    def _add_sample(self, frame: types.FrameType, thread_name: str) -> None:
+        """ Counts sampled stack
+
+        Arguments:
+        frame       -- Innermost frame of sampled stack
+        thread_name -- Name of sampled thread (becomes root frame)
+        """
+        self._num_samples += 1
+        if frame.f_code in _own_codes:
+            return
+        frames: List[str] = []
+        f: Optional[types.FrameType] = frame
+        while (f is not None) and (len(frames) < MAX_STACK_DEPTH):
+            code = f.f_code
+            frames.append(f"{code.co_name} "
+                          f"({os.path.basename(code.co_filename)}:"
+                          f"{f.f_lineno})")
+            f = f.f_back
+        frames.append(thread_name)
+        self._counts[";".join(reversed(frames))] += 1
+
+
+class WorkerProfiler:
+    """ Opt-in profiling service for worker processes, sharing a directory
+
+    Shared directory contains following files:
+    worker_<PID>               -- Registration of worker that may be profiled
+    request_<PID>_<ID>.json    -- Profiling request to worker with given PID
+    result_<ID>.json           -- Profiling result (folded stacks or error)
+    rate_limit                 -- Time (seconds since the Epoch) before which
+                                  new profiling may not be started. Access
+                                  is serialized by flock()
+
+    Private attributes:
+    _directory              -- Shared directory
+    _min_start_interval_sec -- Minimum interval between profiling starts (in
+                               any worker) in seconds
+    _max_duration_sec       -- Maximum profiling duration in seconds
+    _pid                    -- PID of process watcher thread was started in.
+                               None if not started
+    _lock                   -- Serializes start()
+    """
+
+    def __init__(
+            self, directory: str,
+            min_start_interval_sec: float = DEFAULT_MIN_START_INTERVAL_SEC,
+            max_duration_sec: float = DEFAULT_MAX_DURATION_SEC) -> None:
+        """ Constructor
+
+        Arguments:
+        directory              -- Directory shared by all workers of service
+                                  instance (e.g. container). Created if absent
+        min_start_interval_sec -- Minimum interval between profiling starts
+                                  (in any worker) in seconds
+        max_duration_sec       -- Maximum profiling duration in seconds
+        """
+        self._directory = directory
+        self._min_start_interval_sec = min_start_interval_sec
+        self._max_duration_sec = max_duration_sec
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        os.makedirs(self._directory, exist_ok=True)
+
+    def start(self) -> None:
+        """ Registers current process as profileable and starts watcher
+        thread that executes profiling requests addressed to it. Does nothing
+        if already done in current process (so may be called on every
+        request, e.g. to handle fork after construction) """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            with open(self._path(f"{WORKER_FILE_PREFIX}{self._pid}"), "w",
+                      encoding="ascii"):
+                pass
+            threading.Thread(target=self._watcher_thread,
+                             name="ProfilerWatcher", daemon=True).start()
+
+    def workers(self) -> List[int]:
+        """ Returns sorted list of PIDs of live registered workers (files of
+        dead ones are removed) """
+        ret: List[int] = []
+        for filename in os.listdir(self._directory):
+            if not filename.startswith(WORKER_FILE_PREFIX):
+                continue
+            try:
+                pid = int(filename[len(WORKER_FILE_PREFIX):])
+                os.kill(pid, 0)
+                ret.append(pid)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                try:
+                    os.unlink(self._path(filename))
+                except OSError:
+                    pass
+            except PermissionError:
+                ret.append(pid)
+        return sorted(ret)
+
+    def profile(self, duration_sec: float,
+                interval_sec: float = DEFAULT_INTERVAL_SEC,
+                pid: Optional[int] = None) -> str:
+        """ Profiles given worker (blocks for profiling duration)
+
+        Arguments:
+        duration_sec -- Profiling duration in seconds
+        interval_sec -- Sampling interval in seconds
+        pid          -- PID of worker to profile, None for current process
+        Returns folded stacks. Raises ProfilerError on failure
+        """
+        self.start()
+        if not 0 < duration_sec <= self._max_duration_sec:
+            raise ProfilerError(f"Profiling duration must be positive and "
+                                f"not exceed {self._max_duration_sec}s")
+        if interval_sec < MIN_INTERVAL_SEC:
+            raise ProfilerError(f"Sampling interval may not be less than "
+                                f"{MIN_INTERVAL_SEC}s")
+        if (pid is not None) and (pid != os.getpid()) and \
+                (pid not in self.workers()):
+            raise ProfilerError(
+                f"Worker {pid} not found. Known workers: "
+                f"{', '.join(str(w) for w in self.workers())}",
+                status=404)
+        self._acquire_slot(duration_sec)
+        if (pid is None) or (pid == os.getpid()):
+            return \
+                StackSampler(interval_sec=interval_sec).run(duration_sec)
+        return self._remote_profile(pid=pid, duration_sec=duration_sec,
+                                    interval_sec=interval_sec)
+
+    def _acquire_slot(self, duration_sec: float) -> None:
+        """ Enforces global rate limit. Raises ProfilerError if profiling may
+        not be started now """
+        with open(self._path(RATE_LIMIT_FILE), "a+", encoding="ascii") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read().strip()
+                now = time.time()
+                try:
+                    not_before = float(content) if content else 0.
+                except ValueError:
+                    not_before = 0.
+                if now < not_before:
+                    raise ProfilerError(
+                        f"Profiling rate limit exceeded, retry in "
+                        f"{not_before - now:.0f}s",
+                        status=429, retry_after=not_before - now)
+                f.seek(0)
+                f.truncate()
+                f.write(
+                    str(now +
+                        max(self._min_start_interval_sec, duration_sec)))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _remote_profile(self, pid: int, duration_sec: float,
+                        interval_sec: float) -> str:
+        """ Asks other worker to profile itself and waits for result
+
+        Arguments:
+        pid          -- Worker PID
+        duration_sec -- Profiling duration in seconds
+        interval_sec -- Sampling interval in seconds
+        Returns folded stacks. Raises ProfilerError on failure
+        """
+        req_id = uuid.uuid4().hex
+        request_file = self._path(f"{REQUEST_FILE_PREFIX}{pid}_{req_id}.json")
+        result_file = self._path(f"{RESULT_FILE_PREFIX}{req_id}.json")
+        self._write_atomic(
+            request_file,
+            json.dumps({"id": req_id, "duration": duration_sec,
+                        "interval": interval_sec}))
+        try:
+            deadline = time.time() + PICKUP_TIMEOUT_SEC
+            while os.path.exists(request_file):
+                if time.time() > deadline:
+                    raise ProfilerError(
+                        f"Worker {pid} did not pick up profiling request",
+                        status=504)
+                time.sleep(POLL_INTERVAL_SEC / 5)
+            deadline = time.time() + duration_sec + PICKUP_TIMEOUT_SEC
+            while not os.path.exists(result_file):
+                if time.time() > deadline:
+                    raise ProfilerError(
+                        f"Worker {pid} did not return profiling result",
+                        status=504)
+                time.sleep(POLL_INTERVAL_SEC / 5)
+            with open(result_file, encoding="utf-8") as f:
+                result = json.load(f)
+        finally:
+            for filename in (request_file, result_file):
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+        if "error" in result:
+            raise ProfilerError(f"Worker {pid} failed to profile: "
+                                f"{result['error']}", status=500)
+        return result["folded"]
+
+    def _watcher_thread(self) -> None:
+        """ Watcher thread function. Executes profiling requests addressed to
+        this process """
+        prefix = f"{REQUEST_FILE_PREFIX}{os.getpid()}_"
+        while self._pid == os.getpid():
+            time.sleep(POLL_INTERVAL_SEC)
+            try:
+                filenames = [fn for fn in os.listdir(self._directory)
+                             if fn.startswith(prefix) and fn.endswith(".json")]
+            except OSError:
+                continue
+            for filename in filenames:
+                try:
+                    with open(self._path(filename), encoding="utf-8") as f:
+                        request = json.load(f)
+                    os.unlink(self._path(filename))
+                except (OSError, ValueError):
+                    continue
+                result = {}
+                try:
+                    result["folded"] = \
+                        StackSampler(interval_sec=float(request["interval"])).\
+                        run(float(request["duration"]))
+                except Exception as ex:  # pylint: disable=broad-except
+                    result["error"] = repr(ex)
+                try:
+                    self._write_atomic(
+                        self._path(f"{RESULT_FILE_PREFIX}{request['id']}."
+                                   f"json"),
+                        json.dumps(result))
+                except (OSError, LookupError):
+                    pass
+
+    def _write_atomic(self, filename: str, content: str) -> None:
+        """ Writes file via temporary file and rename """
+        temp = f"{filename}.{os.getpid()}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp, filename)
+
+    def _path(self, filename: str) -> str:
+        """ Full name of file in shared directory """
+        return os.path.join(self._directory, filename)
+
+
+# Code objects of profiler's own idle functions. Samples with these innermost
+# frames are not counted
+_own_codes = {StackSampler.run.__code__,
+              StackSampler._sampling_thread.__code__,
+              WorkerProfiler._watcher_thread.__code__,
+              WorkerProfiler._remote_profile.__code__}
+
+
+def _busy_loop(duration_sec: float) -> int:
+    """ Burns CPU for given time. Self-test's profiling target """
+    ret = 0
+    end = time.time() + duration_sec
+    while time.time() < end:
+        for i in range(1000):
+            ret += i * i
+    return ret
+
+
+def self_test(duration_sec: float = 1.) -> None:
+    """ Profiles busy loop in all sampling modes, raises AssertionError if
+    busy loop was not found to be the hottest stack """
+    # Busy loop in separate thread, sampling by thread
+    busy_thread = \
+        threading.Thread(target=_busy_loop, args=(duration_sec + 1,),
+                         name="BusyLoop")
+    busy_thread.start()
+    try:
+        folded = StackSampler(use_signal=False).run(duration_sec)
+    finally:
+        busy_thread.join()
+    # Busy loop in main thread, sampling by SIGPROF
+    if threading.current_thread() is threading.main_thread():
+        sampler = StackSampler(use_signal=True)
+        sampler.start()
+        try:
+            _busy_loop(duration_sec)
+        finally:
+            sampler.stop()
+        folded += sampler.folded()
+    for mode, lines in \
+            [("thread", [ln for ln in folded.splitlines()
+                         if ln.startswith("BusyLoop;")]),
+             ("signal", [ln for ln in folded.splitlines()
+                         if ln.startswith("MainThread;")])]:
+        if (mode == "signal") and \
+                (threading.current_thread() is not threading.main_thread()):
+            continue
+        samples = sum(int(ln.rsplit(" ", 1)[1]) for ln in lines)
+        busy = sum(int(ln.rsplit(" ", 1)[1]) for ln in lines
+                   if f"{_busy_loop.__name__} (" in ln)
+        assert samples and (busy >= samples * 0.9), \
+            f"Busy loop not found by {mode} sampler ({busy} of {samples} " \
+            f"samples). Folded stacks:\n{folded}"
+
+
+if __name__ == "__main__":
+    self_test()
+    print("Self-test passed")
@@ -0,0 +1,132 @@
+""" Tests and microbenchmark for afc_traffic_metrics.observe_n()
+
+Run tests:        python -m unittest test_afc_traffic_metrics
+Run benchmark:    AFC_BENCHMARK=1 python -m unittest \
+                      test_afc_traffic_metrics.TestBenchmark
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import math
+import os
+import prometheus_client
+import timeit
+from typing import Dict, Tuple
+import unittest
+
+import afc_traffic_metrics
+
+# Values to observe: below first bucket, on bucket boundaries, between
+# buckets, above last bucket
+TEST_VALUES = (0., 0.01, 0.05, 0.07, 0.1, 0.25, 1., 3.5, 10., 60., 100., 120.,
+               1000.)
+
+# Observation counts
+TEST_COUNTS = (0, 1, 2, 7, 1000)
+
+
+def make_histogram(registry: prometheus_client.CollectorRegistry) \
+        -> prometheus_client.Histogram:
+    """ Creates labelled histogram, similar to afc_traffic_metrics' ones, in
+    given registry """
+    return \
+        prometheus_client.Histogram(
+            name="test_duration", documentation="Test duration histogram",
+            labelnames=["host"], buckets=afc_traffic_metrics.DURATION_BUCKETS,
+            registry=registry).labels(host="test")
+
+
+def exported_samples(registry: prometheus_client.CollectorRegistry) \
+        -> Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]:
+    """ Exported sample values (except creation timestamps), indexed by
+    (sample name, sorted labels) """
+    return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+            for metric in registry.collect() for sample in metric.samples
+            if not sample.name.endswith("_created")}
+
+
+class TestObserveN(unittest.TestCase):
+    """ observe_n() vs repeated observe() """
+
+    def _compare(self, value: float, count: int) -> None:
+        """ Checks that exported values are the same for given value and
+        count """
+        registries = [prometheus_client.CollectorRegistry() for _ in range(2)]
+        loop_hist, bulk_hist = [make_histogram(r) for r in registries]
+        for _ in range(count):
+            loop_hist.observe(value)
+        afc_traffic_metrics.observe_n(bulk_hist, value, count)
+        loop_samples, bulk_samples = [exported_samples(r) for r in registries]
+        self.assertEqual(loop_samples.keys(), bulk_samples.keys())
+        for key, loop_value in loop_samples.items():
+            if key[0].endswith("_sum"):
+                # value * count vs repeated additions
+                self.assertTrue(
+                    math.isclose(bulk_samples[key], loop_value,
+                                 rel_tol=1e-12),
+                    f"{key}: {bulk_samples[key]} != {loop_value}")
+            else:
+                self.assertEqual(bulk_samples[key], loop_value, key)
+
+    def test_identical(self) -> None:
+        """ Exported values are identical for all value/count combinations
+        """
+        for value in TEST_VALUES:
+            for count in TEST_COUNTS:
+                with self.subTest(value=value, count=count):
+                    self._compare(value, count)
+
+    def test_exact_sum(self) -> None:
+        """ Sum is bit-exact for values with short binary representation """
+        for value in (0.25, 3.5, 60.):
+            registries = \
+                [prometheus_client.CollectorRegistry() for _ in range(2)]
+            loop_hist, bulk_hist = [make_histogram(r) for r in registries]
+            for _ in range(1000):
+                loop_hist.observe(value)
+            afc_traffic_metrics.observe_n(bulk_hist, value, 1000)
+            self.assertEqual(*[exported_samples(r) for r in registries])
+
+    def test_accumulates(self) -> None:
+        """ Bulk observations add up with prior individual ones """
+        registries = [prometheus_client.CollectorRegistry() for _ in range(2)]
+        loop_hist, bulk_hist = [make_histogram(r) for r in registries]
+        for hist in (loop_hist, bulk_hist):
+            hist.observe(0.5)
+            hist.observe(20.)
+        for _ in range(5):
+            loop_hist.observe(2.)
+        afc_traffic_metrics.observe_n(bulk_hist, 2., 5)
+        self.assertEqual(*[exported_samples(r) for r in registries])
+
+
+@unittest.skipUnless(os.environ.get("AFC_BENCHMARK"),
+                     "Benchmark. Set AFC_BENCHMARK=1 to run")
+class TestBenchmark(unittest.TestCase):
+    """ Microbenchmark of observe_n() """
+
+    def test_observe_n(self) -> None:
+        """ Prints time of observing the same value N times with repeated
+        observe() and with observe_n() """
+        hist = make_histogram(prometheus_client.CollectorRegistry())
+        repeat = 20
+        for count in (1, 10, 100, 1000):
+            loop_sec = \
+                min(timeit.repeat(
+                    lambda: [hist.observe(0.5) for _ in range(count)],
+                    number=100, repeat=repeat)) / 100
+            bulk_sec = \
+                min(timeit.repeat(
+                    lambda: afc_traffic_metrics.observe_n(hist, 0.5, count),
+                    number=100, repeat=repeat)) / 100
+            print(f"N={count:5}: observe() loop {loop_sec * 1e6:9.2f} us, "
+                  f"observe_n() {bulk_sec * 1e6:7.2f} us "
+                  f"({loop_sec / bulk_sec:.1f}x)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+""" Tests for stack_sampler
+
+Run tests:        python -m unittest test_stack_sampler
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import stack_sampler
+
+
+class TestStackSampler(unittest.TestCase):
+    """ Stack sampler and worker profiler """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._testdir)
+        unittest.TestCase.tearDown(self)
+
+    def test_self_test(self) -> None:
+        """ Busy loop is found by both thread and signal samplers """
+        stack_sampler.self_test()
+
+    def test_rate_limit(self) -> None:
+        """ Second profiling within rate limit interval is rejected """
+        profiler = \
+            stack_sampler.WorkerProfiler(directory=self._testdir,
+                                         min_start_interval_sec=60)
+        profiler.profile(duration_sec=0.1)
+        with self.assertRaises(stack_sampler.ProfilerError) as cm:
+            stack_sampler.WorkerProfiler(directory=self._testdir).\
+                profile(duration_sec=0.1)
+        self.assertEqual(cm.exception.status, 429)
+        self.assertGreater(cm.exception.retry_after, 0)
+
+    def test_workers(self) -> None:
+        """ Worker registration and validation of target worker """
+        profiler = stack_sampler.WorkerProfiler(directory=self._testdir)
+        profiler.start()
+        self.assertEqual(profiler.workers(), [os.getpid()])
+        with self.assertRaises(stack_sampler.ProfilerError) as cm:
+            profiler.profile(duration_sec=0.1, pid=os.getpid() + 1000000)
+        self.assertEqual(cm.exception.status, 404)
+        with self.assertRaises(stack_sampler.ProfilerError) as cm:
+            profiler.profile(duration_sec=1000)
+        self.assertEqual(cm.exception.status, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,7 +10,9 @@
 
 import pydantic
 import sys
-from typing import Dict, List, Optional, Set, Union
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, \
+    Union
 
 from log_utils import error, error_if, get_module_logger, \
     include_stack_to_error_log, set_error_exception
@@ -21,8 +23,8 @@ except ImportError:
     pass
 
 try:
-    from rcache_models import AfcReqRespKey, Beam, LatLonRect, \
-        RcacheClientSettings
+    from rcache_models import AfcReqRespKey, Beam, CertificationKey, \
+        LatLonRect, RcacheClientSettings, rmq_digest_routing_key
     from rcache_rcache import RcacheRcache
 except ImportError:
     pass
@@ -58,6 +60,8 @@ class RcacheClient:
     _afc_state_vendor_extensions -- Set of vendor extensions from previously
                                     computed invalidated AFC response to be
                                     sent to AFC Engine
+    _rmq_coalesce                -- True to coalesce identical in-flight
+                                    computations across processes
     """
 
     def __init__(self, client_settings: "RcacheClientSettings",
@@ -98,6 +102,7 @@ class RcacheClient:
             self._rcache_rcache = RcacheRcache(client_settings.service_url)
         self._afc_state_vendor_extensions: Set[str] = \
             set(client_settings.afc_state_vendor_extensions or [])
+        self._rmq_coalesce = client_settings.rmq_coalesce
 
     def lookup_responses(self, req_cfg_digests: List[str]) -> \
             Dict[str, "RcacheLookupResult"]:
@@ -115,8 +120,8 @@ class RcacheClient:
                 return_invalidated=bool(self._afc_state_vendor_extensions))
 
     def rmq_send_response(self, queue_name: str, req_cfg_digest: str,
-                          request: str, response: Optional[str]) \
-            -> None:
+                          request: str, response: Optional[str],
+                          stage_timing: Optional[str] = None) -> None:
         """ Send AFC response to RabbitMQ
 
         Arguments:
@@ -124,12 +129,16 @@ class RcacheClient:
         req_cfg_digest -- Request/Config digest (request identifiers)
         request        -- Request as string
         response       -- Response as string. None on failure
+        stage_timing   -- Optional processing stage timing (wire form of
+                          afc_traffic_metrics.StageTimer) to send along with
+                          response
         """
         assert self._rcache_rmq is not None
         with self._rcache_rmq.create_connection(tx_queue_name=queue_name) \
                 as rmq_conn:
             rmq_conn.send_response(req_cfg_digest=req_cfg_digest,
-                                   response=response)
+                                   response=response,
+                                   stage_timing=stage_timing)
         if response:
             assert self._rcache_rcache is not None
             try:
@@ -149,21 +158,102 @@ class RcacheClient:
         assert self._rcache_rmq is not None
         return self._rcache_rmq.create_connection()
 
-    def rmq_receive_responses(self, rx_connection: "RcacheRmqConnection",
-                              req_cfg_digests: List[str],
-                              timeout_sec: float) -> Dict[str, Optional[str]]:
+    def rmq_compute_responses(
+            self, rx_connection: "RcacheRmqConnection",
+            req_cfg_digests: Iterable[str],
+            dispatch: Callable[[str, str], None], timeout_sec: float,
+            lookup: Optional[Callable[[Set[str]], Dict[str, str]]] = None,
+            coalesce: bool = True,
+            stage_timings: Optional[Dict[str, str]] = None) \
+            -> Dict[str, Optional[str]]:
+        """ Computes AFC responses, coalescing identical in-flight
+        computations with other processes (unless disabled): requests being
+        computed by other processes are not dispatched, their responses are
+        awaited instead. If other process vanishes before response arrives,
+        computation is taken over
+
+        Arguments:
+        rx_connection   -- Previously created RX connection
+        req_cfg_digests -- Request/config digests of requests to compute
+        dispatch        -- Sends request with given digest (first argument)
+                           to Worker, that should send response to given RMQ
+                           queue (second argument)
+        timeout_sec     -- Timeout in seconds
+        lookup          -- Optional cache lookup for requests whose
+                           computation was taken over. Returns found
+                           responses, indexed by digests
+        coalesce        -- False to not coalesce computations (regardless of
+                           Rcache client settings)
+        stage_timings   -- Optional dictionary to put processing stage timings
+                           (wire forms of afc_traffic_metrics.StageTimer),
+                           returned by AFC Worker, to. Indexed by
+                           request/config digests
+        Returns dictionary of responses (as strings), indexed by request/config
+        digests. Failed responses represented by Nones
+        """
+        assert self._rcache_rmq is not None
+        ret: Dict[str, Optional[str]] = {}
+        deadline = time.time() + timeout_sec
+        remaining = set(req_cfg_digests)
+        coalesce = coalesce and self._rmq_coalesce
+        while remaining and (time.time() < deadline):
+            claimed = rx_connection.coalesce(remaining) if coalesce else None
+            for req_cfg_digest in \
+                    sorted(remaining if claimed is None else claimed):
+                dispatch(req_cfg_digest,
+                         rx_connection.rx_queue_name() if claimed is None
+                         else rmq_digest_routing_key(req_cfg_digest))
+            orphaned: Set[str] = set()
+            ret.update(
+                self.rmq_receive_responses(
+                    rx_connection=rx_connection, req_cfg_digests=remaining,
+                    timeout_sec=deadline - time.time(),
+                    stage_timings=stage_timings,
+                    followed=None if claimed is None
+                    else (remaining - claimed),
+                    orphaned=orphaned))
+            # Process that computed orphaned requests vanished. Their
+            # responses might have been cached, otherwise they are computed
+            # by this process
+            remaining = orphaned
+            if remaining and (lookup is not None):
+                found = lookup(remaining)
+                ret.update(found)
+                remaining -= set(found.keys())
+        return ret
+
+    def rmq_receive_responses(
+            self, rx_connection: "RcacheRmqConnection",
+            req_cfg_digests: Iterable[str], timeout_sec: float,
+            stage_timings: Optional[Dict[str, str]] = None,
+            followed: Optional[Set[str]] = None,
+            orphaned: Optional[Set[str]] = None) \
+            -> Dict[str, Optional[str]]:
         """ Receiver ARC responses from RabbitMQ queue
 
         Arguments:
         rx_connection   -- Previously created
         req_cfg_digests -- List of expected request/config digests
         timeout_sec     -- RX timeout in seconds
+        stage_timings   -- Optional dictionary to put processing stage timings
+                           (wire forms of afc_traffic_metrics.StageTimer),
+                           returned by AFC Worker, to. Indexed by
+                           request/config digests
+        followed        -- Optional set of digests, computed by other
+                           processes (not claimed by
+                           RcacheRmqConnection.coalesce())
+        orphaned        -- Optional set to put followed digests to, if
+                           process that computed them vanished. Computation
+                           of these digests is claimed by this process
         Returns dictionary of responses (as strings), indexed by request/config
         digests. Failed responses represented by Nones
         """
         assert self._rcache_rmq is not None
         rrks = rx_connection.receive_responses(req_cfg_digests=req_cfg_digests,
-                                               timeout_sec=timeout_sec)
+                                               timeout_sec=timeout_sec,
+                                               stage_timings=stage_timings,
+                                               followed=followed,
+                                               orphaned=orphaned)
         assert rrks is not None
         return {rrk.req_cfg_digest: rrk.afc_resp for rrk in rrks}
 
@@ -199,6 +289,20 @@ class RcacheClient:
         assert self._rcache_rcache is not None
         self._rcache_rcache.directional_invalidate_cache(beams=beams)
 
+    def rcache_cert_id_invalidate(
+            self, certifications: List[Tuple[str, str]]) -> None:
+        """ Certification ID invalidation
+
+        Arguments:
+        certifications -- List of (ruleset ID, certification ID) pairs of
+                          changed or removed certifications
+        """
+        assert self._rcache_rcache is not None
+        self._rcache_rcache.cert_id_invalidate_cache(
+            certifications=[CertificationKey(ruleset_id=ruleset_id,
+                                             cert_id=cert_id)
+                            for ruleset_id, cert_id in certifications])
+
     def afc_state_vendor_extensions(self) -> Set[str]:
         """ Set of vendor extensions from previously computed invalidated AFC
         response to be sent to AFC Engine """
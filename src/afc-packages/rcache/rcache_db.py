@@ -19,13 +19,14 @@ try:
 except ImportError:
     pass
 import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql as sa_pg
 import sys
 from typing import Any, cast, Dict, List, NamedTuple, Optional, Tuple
 import urllib.parse
 
 import db_utils
 from log_utils import dp, error, error_if, FailOnError, get_module_logger
-from rcache_models import ApDbRespState, ApDbRecord
+from rcache_models import ApDbRespState, ApDbRecord, PK_LIST_SEPARATOR
 
 __all__ = ["RcacheDb", "RcacheLookupResult"]
 
@@ -63,6 +64,9 @@ class RcacheDb:
     # Name of request cache table in database
     AP_TABLE_NAME = "aps"
 
+    # Name of index of AP table by individual certification IDs
+    CERT_IDS_INDEX_NAME = "aps_cert_ids_array_idx"
+
     # Name of enable/disable switches table in database
     SWITCHES_TABLE_NAME = "switches"
 
@@ -80,7 +84,7 @@ class RcacheDb:
         """
         self.metadata = sa.MetaData()
         # This declaration must be kept in sync with rcache_models.ApDbRecord
-        sa.Table(
+        ap_table = sa.Table(
             self.AP_TABLE_NAME,
             self.metadata,
             sa.Column("serial_number", sa.String(), nullable=False,
@@ -103,6 +107,10 @@ class RcacheDb:
             sa.Column("validity_period_sec", sa.Float(), nullable=True),
             sa.Column("request", sa.String(), nullable=False),
             sa.Column("response", sa.String(), nullable=False))
+        # Used by certification ID invalidation
+        sa.Index(self.CERT_IDS_INDEX_NAME,
+                 self.cert_ids_array(ap_table.c.cert_ids),
+                 postgresql_using="gin")
         sa.Table(
             self.SWITCHES_TABLE_NAME,
             self.metadata,
@@ -119,6 +127,14 @@ class RcacheDb:
         self.ap_table: Optional[sa.Table] = None
         self.ap_pk_columns: Optional[Tuple[str, ...]] = None
 
+    @classmethod
+    def cert_ids_array(cls, column: Any) -> Any:
+        """ Expression that splits concatenated IDs of given column to array
+        """
+        return sa.func.string_to_array(
+            column, sa.literal_column(f"'{PK_LIST_SEPARATOR}'"),
+            type_=sa_pg.ARRAY(sa.Text()))
+
     def max_update_records(self) -> int:
         """ Maximum number of records in one update """
         return self._MAX_UPDATE_FIELDS // \
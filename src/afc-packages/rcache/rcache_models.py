@@ -24,17 +24,45 @@ from typing import Any, Dict, List, Optional
 from log_utils import dp
 
 __all__ = ["AfcReqRespKey", "ApDbPk", "ApDbRecord", "ApDbRespState", "Beam",
-           "FuncSwitch", "IfDbExists", "LatLonRect", "RatapiAfcConfig",
-           "RatapiRulesetIds", "RcacheClientSettings",
+           "CertificationKey", "FuncSwitch", "IfDbExists", "LatLonRect",
+           "PK_LIST_SEPARATOR", "RatapiAfcConfig", "RatapiRulesetIds",
+           "RcacheCertIdInvalidateReq", "RcacheClientSettings",
            "RcacheDirectionalInvalidateReq", "RcacheInvalidateReq",
-           "RCACHE_RMQ_EXCHANGE_NAME", "RcacheServiceSettings",
+           "RCACHE_RMQ_COALESCE_POLL_SEC", "RCACHE_RMQ_EXCHANGE_NAME",
+           "RCACHE_RMQ_STAGE_TIMING_HEADER", "RcacheServiceSettings",
            "RcacheSpatialInvalidateReq", "RcacheStatus", "RcacheUpdateReq",
-           "RmqReqRespKey"]
+           "RmqReqRespKey", "rmq_digest_routing_key",
+           "rmq_inflight_queue_name"]
 
 
 # Name of RMQ exchange for delivering AFC Responses from Worker
 RCACHE_RMQ_EXCHANGE_NAME = "RcacheExchange"
 
+# Name of RMQ message header that carries AFC Request processing stage timing
+# (wire form of afc_traffic_metrics.StageTimer)
+RCACHE_RMQ_STAGE_TIMING_HEADER = "afc_stage_timing"
+
+# Interval in seconds between checks that process computing AFC Response,
+# awaited by other processes, is still alive
+RCACHE_RMQ_COALESCE_POLL_SEC = 1.
+
+
+def rmq_digest_routing_key(req_cfg_digest: str) -> str:
+    """ RMQ routing key for delivering AFC Response for given request/config
+    digest to all processes waiting for it (used in request coalescing) """
+    return f"afc_digest_{req_cfg_digest}"
+
+
+def rmq_inflight_queue_name(req_cfg_digest: str) -> str:
+    """ Name of RMQ exclusive queue that marks in-flight computation of AFC
+    Response for given request/config digest. Queue is held by process that
+    initiated computation and disappears when this process closes its RMQ
+    connection (e.g. on process failure) """
+    return f"afc_inflight_{req_cfg_digest}"
+
+
+# Separator of ruleset IDs and of certification IDs in AP table primary key
+PK_LIST_SEPARATOR = "|"
 
 # Format of response expiration time
 RESP_EXPIRATION_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
@@ -164,6 +192,13 @@ class RcacheClientSettings(pydantic.BaseSettings):
             description="List of Set of vendor extensions from previously "
             "computed invalidated AFC response to be sent to AFC Engine",
             env="AFC_STATE_VENDOR_EXTENSIONS")
+    rmq_coalesce: bool = \
+        pydantic.Field(
+            True,
+            description="Coalesce identical in-flight AFC computations "
+            "across processes: only one process sends request for given "
+            "request/config digest to Worker, others wait for its result. "
+            "Default is enabled")
 
     @classmethod
     @pydantic.root_validator(pre=True)
@@ -296,6 +331,20 @@ class RcacheDirectionalInvalidateReq(pydantic.BaseModel):
         pydantic.Field(..., title="List of beam definitions for changed FSs")
 
 
+class CertificationKey(pydantic.BaseModel):
+    """ Certification, used in certification ID invalidation request """
+    ruleset_id: str = pydantic.Field(..., title="Ruleset ID")
+    cert_id: str = pydantic.Field(..., title="Certification ID")
+
+
+class RcacheCertIdInvalidateReq(pydantic.BaseModel):
+    """ Rcache REST API certification ID invalidation request """
+    certifications: List[CertificationKey] = \
+        pydantic.Field(
+            ..., title="List of changed or removed certifications. Entries of "
+            "APs having any of these certifications are invalidated")
+
+
 class AfcReqRespKey(pydantic.BaseModel):
     """ Information about single computed result, used in request cache update
     request """
@@ -524,15 +573,13 @@ class ApDbPk(pydantic.BaseModel):
             req_pydantic = \
                 AfcReqAvailableSpectrumInquiryRequestMessage.parse_raw(req_str)
         first_request = req_pydantic.availableSpectrumInquiryRequests[0]
+        certs = first_request.deviceDescriptor.certificationId
         return \
             ApDbPk(
                 serial_number=first_request.deviceDescriptor.serialNumber,
-                rulesets="|".join(cert.rulesetId for cert in
-                                  first_request.deviceDescriptor.
-                                  certificationId),
-                cert_ids="|".join(cert.id for cert in
-                                  first_request.deviceDescriptor.
-                                  certificationId))
+                rulesets=PK_LIST_SEPARATOR.join(cert.rulesetId
+                                                for cert in certs),
+                cert_ids=PK_LIST_SEPARATOR.join(cert.id for cert in certs))
 
 
 class ApDbRecord(pydantic.BaseModel):
@@ -13,9 +13,9 @@ import requests
 from typing import Any, Dict, List, Optional
 
 from log_utils import dp, error, FailOnError
-from rcache_models import AfcReqRespKey, Beam, LatLonRect, \
-    RcacheDirectionalInvalidateReq, RcacheInvalidateReq, \
-    RcacheSpatialInvalidateReq, RcacheUpdateReq
+from rcache_models import AfcReqRespKey, Beam, CertificationKey, LatLonRect, \
+    RcacheCertIdInvalidateReq, RcacheDirectionalInvalidateReq, \
+    RcacheInvalidateReq, RcacheSpatialInvalidateReq, RcacheUpdateReq
 
 
 class RcacheRcache:
@@ -104,6 +104,26 @@ class RcacheRcache:
             return True
         return False
 
+    def cert_id_invalidate_cache(self, certifications: List[CertificationKey],
+                                 fail_on_error: bool = True) -> bool:
+        """ Certification ID invalidation of request cache
+
+        Arguments:
+        certifications -- List of changed or removed certifications
+        fail_on_error  -- True to fail on error, False to return False
+        Returns True on success, False on known fail if fail_on_error is False
+        """
+        with FailOnError(fail_on_error):
+            try:
+                self._post(
+                    command="cert_id_invalidate",
+                    json=RcacheCertIdInvalidateReq(
+                        certifications=certifications).dict())
+            except pydantic.ValidationError as ex:
+                error(f"Invalid argument format: {ex}")
+            return True
+        return False
+
     def _post(self, command: str, json: Dict[str, Any]) -> None:
         """ Do the POST request to Request cache service
 
@@ -9,7 +9,7 @@
 
 import hashlib
 import json
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 
 class RequestConfigHash:
@@ -21,17 +21,23 @@ class RequestConfigHash:
     cfg_hash     -- Config hash (None if not requested)
     """
     def __init__(self, req_dict: Dict[str, Any],
-                 afc_config_dict: Dict[str, Any],
-                 compute_config_hash: bool = False) -> None:
+                 afc_config_dict: Optional[Dict[str, Any]],
+                 compute_config_hash: bool = False,
+                 cfg_str: Optional[str] = None) -> None:
         """ Constructor
 
         Arguments:
         req_dict            -- Individual AFC Request in dictionary form
-        afc_config_dict     -- AFC Config in dictionary form
+        afc_config_dict     -- AFC Config in dictionary form. May be None if
+                               cfg_str specified
         compute_config_hash -- True to also compute config hash
+        cfg_str             -- Optional precomputed canonical AFC Config
+                               string (json.dumps(afc_config_dict,
+                               sort_keys=True))
         """
         md5 = hashlib.md5()
-        self.cfg_str = json.dumps(afc_config_dict, sort_keys=True)
+        self.cfg_str = cfg_str if cfg_str is not None \
+            else json.dumps(afc_config_dict, sort_keys=True)
         md5.update(self.cfg_str.encode("utf-8"))
         self.cfg_hash = md5.hexdigest() if compute_config_hash else None
         md5.update(
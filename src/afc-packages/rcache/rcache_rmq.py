@@ -14,10 +14,13 @@ import pika
 import pydantic
 import random
 import string
-from typing import cast, List, Optional, Set
+import time
+from typing import cast, Dict, Iterable, List, Optional, Set
 
 from log_utils import error, get_module_logger
-from rcache_models import RCACHE_RMQ_EXCHANGE_NAME, RmqReqRespKey
+from rcache_models import RCACHE_RMQ_COALESCE_POLL_SEC, \
+    RCACHE_RMQ_EXCHANGE_NAME, RCACHE_RMQ_STAGE_TIMING_HEADER, \
+    RmqReqRespKey, rmq_digest_routing_key, rmq_inflight_queue_name
 import db_utils
 
 __all__ = ["RcacheRmq", "RcacheRmqConnection"]
@@ -33,11 +36,18 @@ class RcacheRmqConnection:
     unclear. So single-shot connection and channel are created every time.
 
     Private attributes:
-    _connection -- Pika connection adapter (corresponds to TCP connection to
-                   RMQ server)
-    _channel    -- Pika channel (corresponds to logical data stream)
-    _for_rx     -- True for RX connection, False tot TX connection
-    _queue_name -- Queue name
+    _connection     -- Pika connection adapter (corresponds to TCP
+                       connection to RMQ server)
+    _channel        -- Pika channel (corresponds to logical data stream)
+    _for_rx         -- True for RX connection, False tot TX connection
+    _queue_name     -- Queue name
+    _marker_channel -- None or channel for in-flight markers' handling (it
+                       is closed by RMQ server on failure to claim marker,
+                       hence separate)
+    _subscribed     -- Request/config digests, whose responses are routed to
+                       RX queue regardless of who requested the computation
+    _claimed        -- Request/config digests, whose in-flight markers are
+                       held by this connection
     """
 
     def __init__(self, url_params: pika.URLParameters,
@@ -56,6 +66,10 @@ class RcacheRmqConnection:
         self._channel.exchange_declare(exchange=RCACHE_RMQ_EXCHANGE_NAME,
                                        exchange_type="direct")
         self._for_rx = tx_queue_name is None
+        self._marker_channel: \
+            Optional[pika.adapters.blocking_connection.BlockingChannel] = None
+        self._subscribed: Set[str] = set()
+        self._claimed: Set[str] = set()
         if self._for_rx:
             self._queue_name = \
                 "afc_response_queue_" + \
@@ -72,13 +86,16 @@ class RcacheRmqConnection:
         assert self._for_rx
         return self._queue_name
 
-    def send_response(self, req_cfg_digest: str, response: Optional[str]) \
-            -> None:
+    def send_response(self, req_cfg_digest: str, response: Optional[str],
+                      stage_timing: Optional[str] = None) -> None:
         """ Send computed AFC Response
 
         Arguments:
         req_cfg_digest -- Request/config digest that identifies request
         response       -- Response as a string. None on failure
+        stage_timing   -- Optional processing stage timing (wire form of
+                          afc_traffic_metrics.StageTimer) to send in message
+                          header. Header is not sent if timing is not set
         """
         assert not self._for_rx
         assert self._channel is not None
@@ -91,7 +108,9 @@ class RcacheRmqConnection:
                     afc_resp=response, req_cfg_digest=req_cfg_digest).json(),
                 properties=pika.BasicProperties(
                     content_type="application/json",
-                    delivery_mode=pika.DeliveryMode.Transient),
+                    delivery_mode=pika.DeliveryMode.Transient,
+                    headers=None if not stage_timing
+                    else {RCACHE_RMQ_STAGE_TIMING_HEADER: stage_timing}),
                 mandatory=False)
             self._channel.tx_commit()
         except pydantic.ValidationError as ex:
@@ -99,13 +118,53 @@ class RcacheRmqConnection:
         except pika.exceptions.AMQPError as ex:
             error(f"RabbitMQ send failed: {repr(ex)}")
 
-    def receive_responses(self, req_cfg_digests: List[str],
-                          timeout_sec: float) -> List[RmqReqRespKey]:
+    def coalesce(self, req_cfg_digests: Iterable[str]) -> Set[str]:
+        """ Prepares coalesced computation of AFC Responses.
+
+        Subscribes RX queue to responses for given digests, computed on
+        behalf of any process, and claims computation of those not being
+        computed by other processes. Claimed requests should be sent to Worker
+        with rmq_digest_routing_key() as RMQ queue name
+
+        Arguments:
+        req_cfg_digests -- Request/config digests of requests to compute
+        Returns set of digests, whose computation was claimed
+        """
+        assert self._for_rx
+        assert self._channel is not None
+        ex: Exception
+        try:
+            for req_cfg_digest in req_cfg_digests:
+                if req_cfg_digest in self._subscribed:
+                    continue
+                self._channel.queue_bind(
+                    queue=self._queue_name, exchange=RCACHE_RMQ_EXCHANGE_NAME,
+                    routing_key=rmq_digest_routing_key(req_cfg_digest))
+                self._subscribed.add(req_cfg_digest)
+        except pika.exceptions.AMQPError as ex:
+            error(f"RabbitMQ subscription failed: {repr(ex)}")
+        return self._claim(req_cfg_digests)
+
+    def receive_responses(
+            self, req_cfg_digests: Iterable[str], timeout_sec: float,
+            stage_timings: Optional[Dict[str, str]] = None,
+            followed: Optional[Set[str]] = None,
+            orphaned: Optional[Set[str]] = None) -> List[RmqReqRespKey]:
         """ Receive AFC responses
 
         Arguments:
         req_cfg_digests -- Request/config digests of expected responses
         timeout_sec     -- Timeout in seconds
+        stage_timings   -- Optional dictionary to put processing stage timings
+                           (wire forms of afc_traffic_metrics.StageTimer),
+                           arrived in message headers, to. Indexed by
+                           request/config digests
+        followed        -- Optional set of digests, computed by other
+                           processes (that were not claimed by coalesce()).
+                           If process computing some of them vanished,
+                           waiting for them stops, their computation is
+                           claimed and they are put to 'orphaned'
+        orphaned        -- Set to put orphaned followed digests to
         Returns list of request(optional)/response/digest triplets
         """
         assert self._for_rx
@@ -114,16 +173,32 @@ class RcacheRmqConnection:
         remaining_responses: Set[str] = set(req_cfg_digests)
         ret: List[RmqReqRespKey] = []
         timer_id: Optional[int] = None
+        followed = set(followed or []) & remaining_responses
+        next_poll = time.monotonic() + RCACHE_RMQ_COALESCE_POLL_SEC
         ex: Exception
         try:
             if timeout_sec:
                 timer_id = \
                     self._connection.call_later(timeout_sec,
                                                 self._channel.cancel)
-            body: bytes
-            for _, _, body in \
+            body: Optional[bytes]
+            for _, properties, body in \
                     self._channel.consume(
-                        queue=self._queue_name, auto_ack=True, exclusive=True):
+                        queue=self._queue_name, auto_ack=True, exclusive=True,
+                        inactivity_timeout=RCACHE_RMQ_COALESCE_POLL_SEC
+                        if followed else None):
+                if followed and (time.monotonic() >= next_poll):
+                    # Claim succeeds if other process' marker vanished
+                    for req_cfg_digest in \
+                            self._claim(followed & remaining_responses):
+                        remaining_responses.remove(req_cfg_digest)
+                        if orphaned is not None:
+                            orphaned.add(req_cfg_digest)
+                    next_poll = time.monotonic() + RCACHE_RMQ_COALESCE_POLL_SEC
+                    if not remaining_responses:
+                        self._channel.cancel()
+                if body is None:
+                    continue    # Inactivity timeout
                 try:
                     rrk = RmqReqRespKey.parse_raw(body)
                 except pydantic.ValidationError as ex:
@@ -133,6 +208,15 @@ class RcacheRmqConnection:
                 if rrk.req_cfg_digest in remaining_responses:
                     remaining_responses.remove(rrk.req_cfg_digest)
                     ret.append(rrk)
+                    self._release(rrk.req_cfg_digest)
+                    stage_timing = \
+                        (properties.headers or {}).get(
+                            RCACHE_RMQ_STAGE_TIMING_HEADER)
+                    if (stage_timings is not None) and stage_timing:
+                        stage_timings[rrk.req_cfg_digest] = \
+                            stage_timing.decode("utf-8") \
+                            if isinstance(stage_timing, bytes) \
+                            else str(stage_timing)
                     if not remaining_responses:
                         self._channel.cancel()
             self._connection.remove_timeout(timer_id)
@@ -141,6 +225,48 @@ class RcacheRmqConnection:
             error(f"RabbitMQ receive failed: {repr(ex)}")
         return []  # Will never happen, appeasing pylint
 
+    def _claim(self, req_cfg_digests: Iterable[str]) -> Set[str]:
+        """ Tries to claim computation of given digests by creating their
+        in-flight markers (exclusive queues). Returns set of digests, claimed
+        by this connection (now or before) """
+        assert self._connection is not None
+        ret: Set[str] = set()
+        ex: Exception
+        for req_cfg_digest in req_cfg_digests:
+            if req_cfg_digest not in self._claimed:
+                try:
+                    if self._marker_channel is None:
+                        self._marker_channel = self._connection.channel()
+                    self._marker_channel.queue_declare(
+                        queue=rmq_inflight_queue_name(req_cfg_digest),
+                        exclusive=True)
+                except pika.exceptions.ChannelClosedByBroker as ex:
+                    # Marker is held by other connection
+                    self._marker_channel = None
+                    if ex.reply_code != 405:
+                        error(f"RabbitMQ marker creation failed: {repr(ex)}")
+                    continue
+                except pika.exceptions.AMQPError as ex:
+                    error(f"RabbitMQ marker creation failed: {repr(ex)}")
+                self._claimed.add(req_cfg_digest)
+            ret.add(req_cfg_digest)
+        return ret
+
+    def _release(self, req_cfg_digest: str) -> None:
+        """ Removes in-flight marker of given digest if it is held """
+        if req_cfg_digest not in self._claimed:
+            return
+        self._claimed.remove(req_cfg_digest)
+        assert self._connection is not None
+        try:
+            if self._marker_channel is None:
+                self._marker_channel = self._connection.channel()
+            self._marker_channel.queue_delete(
+                rmq_inflight_queue_name(req_cfg_digest))
+        except pika.exceptions.AMQPError as ex:
+            # Marker will be removed on connection close
+            LOGGER.warning(f"RabbitMQ marker removal failed: {repr(ex)}")
+
     def close(self) -> None:
         """ Closing RabbitMQ connection """
         try:
@@ -153,6 +279,7 @@ class RcacheRmqConnection:
                 self._connection.close()
                 self._connection = None
                 self._channel = None
+                self._marker_channel = None
         except pika.exceptions.AMQPError:
             pass
 
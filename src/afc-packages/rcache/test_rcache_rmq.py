@@ -0,0 +1,363 @@
+""" Tests for coalescing of identical in-flight AFC computations, made by
+several concurrent Rcache clients, over in-memory RabbitMQ broker stand-in
+
+Run tests:        python -m unittest test_rcache_rmq
+(db_utils and pydantic_utils packages should be in PYTHONPATH)
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+# pylint: disable=unused-argument, too-many-arguments
+
+import collections
+import itertools
+import pika
+import queue
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Set, \
+    Tuple
+import unittest
+from unittest import mock
+
+from rcache_client import RcacheClient
+from rcache_models import RcacheClientSettings
+from rcache_rmq import RcacheRmq
+
+RMQ_DSN = "amqp://rmq:5672"
+# Time Worker stand-in spends on computation
+COMPUTE_SEC = 0.5
+# Shortened marker poll interval
+POLL_SEC = 0.1
+TIMEOUT_SEC = 10.
+
+
+class FakeBroker:
+    """ Minimal in-memory stand-in of RabbitMQ server: direct exchange
+    routing, exclusive queues, deleted on owner connection close """
+
+    def __init__(self) -> None:
+        self.cond = threading.Condition()
+        self.queues: Dict[str, Deque[Tuple[Any, Any, bytes]]] = {}
+        self.owners: Dict[str, "FakeConnection"] = {}
+        self.bindings: Dict[str, Set[str]] = collections.defaultdict(set)
+
+    def connect(self, url_params: Any) -> "FakeConnection":
+        """ pika.BlockingConnection() replacement """
+        return FakeConnection(self)
+
+    def delete_queue(self, queue_name: str) -> None:
+        """ Deletes queue (broker condition should be held) """
+        self.queues.pop(queue_name, None)
+        self.owners.pop(queue_name, None)
+        for queues in self.bindings.values():
+            queues.discard(queue_name)
+
+
+class FakeConnection:
+    """ pika.BlockingConnection stand-in """
+
+    def __init__(self, broker: FakeBroker) -> None:
+        self.broker = broker
+        self._timers: Dict[int, Tuple[float, Callable[[], None]]] = {}
+        self._timer_ids = itertools.count()
+
+    def channel(self) -> "FakeChannel":
+        """ Creates channel """
+        return FakeChannel(self)
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> int:
+        """ Schedules callback, called while consuming """
+        timer_id = next(self._timer_ids)
+        self._timers[timer_id] = (time.monotonic() + delay, callback)
+        return timer_id
+
+    def remove_timeout(self, timer_id: Optional[int]) -> None:
+        """ Cancels scheduled callback """
+        self._timers.pop(timer_id, None)  # type: ignore
+
+    def fire_timers(self) -> None:
+        """ Calls due callbacks """
+        for timer_id, (when, callback) in list(self._timers.items()):
+            if when <= time.monotonic():
+                del self._timers[timer_id]
+                callback()
+
+    def close(self) -> None:
+        """ Closes connection, deleting exclusive queues it owns """
+        with self.broker.cond:
+            for queue_name, owner in list(self.broker.owners.items()):
+                if owner is self:
+                    self.broker.delete_queue(queue_name)
+
+
+class FakeChannel:
+    """ pika BlockingChannel stand-in """
+
+    def __init__(self, connection: FakeConnection) -> None:
+        self._connection = connection
+        self._broker = connection.broker
+        self._cancelled = False
+
+    def exchange_declare(self, exchange: str, exchange_type: str) -> None:
+        """ Exchange declaration (only default direct exchange supported) """
+
+    def queue_declare(self, queue: str, exclusive: bool = False) -> None:
+        """ Queue declaration. Fails if exclusive queue is owned by other
+        connection """
+        with self._broker.cond:
+            owner = self._broker.owners.get(queue)
+            if (owner is not None) and (owner is not self._connection):
+                raise pika.exceptions.ChannelClosedByBroker(
+                    405, f"RESOURCE_LOCKED - cannot obtain exclusive access "
+                    f"to locked queue '{queue}'")
+            self._broker.queues.setdefault(queue, collections.deque())
+            if exclusive:
+                self._broker.owners[queue] = self._connection
+
+    def queue_bind(self, queue: str, exchange: str,
+                   routing_key: Optional[str] = None) -> None:
+        """ Binds queue to given (or its own) routing key """
+        with self._broker.cond:
+            self._broker.bindings[routing_key or queue].add(queue)
+
+    def queue_delete(self, queue: str) -> None:
+        """ Deletes queue """
+        with self._broker.cond:
+            self._broker.delete_queue(queue)
+
+    def tx_select(self) -> None:
+        """ Transaction start """
+
+    def tx_commit(self) -> None:
+        """ Transaction commit """
+
+    def basic_publish(self, exchange: str, routing_key: str, body: str,
+                      properties: Any, mandatory: bool) -> None:
+        """ Routes message to all queues bound to routing key """
+        with self._broker.cond:
+            for queue_name in self._broker.bindings.get(routing_key, set()):
+                self._broker.queues[queue_name].append(
+                    (None, properties, body.encode("utf-8")))
+            self._broker.cond.notify_all()
+
+    def cancel(self) -> None:
+        """ Stops consume() generator """
+        self._cancelled = True
+
+    def consume(self, queue: str, auto_ack: bool, exclusive: bool,
+                inactivity_timeout: Optional[float] = None) -> Iterator[Any]:
+        """ Message generator """
+        self._cancelled = False
+        last_activity = time.monotonic()
+        while True:
+            self._connection.fire_timers()
+            if self._cancelled:
+                return
+            with self._broker.cond:
+                messages = self._broker.queues[queue]
+                if not messages:
+                    self._broker.cond.wait(0.02)
+                message = messages.popleft() if messages else None
+            if message is not None:
+                last_activity = time.monotonic()
+                yield message
+            elif (inactivity_timeout is not None) and \
+                    ((time.monotonic() - last_activity) >=
+                     inactivity_timeout):
+                last_activity = time.monotonic()
+                yield (None, None, None)
+
+
+class StubWorker:
+    """ AFC Worker stand-in: computes dispatched requests in background
+    thread, puts responses to cache, then sends them to RabbitMQ
+
+    Public attributes:
+    computations -- Number of computations made for each digest
+    cache        -- Computed responses, indexed by digests
+    stage_timing -- Stage timing to send with responses (None to not send)
+    """
+
+    def __init__(self) -> None:
+        self.computations: Dict[str, int] = collections.defaultdict(int)
+        self.cache: Dict[str, str] = {}
+        self.stage_timing: Optional[str] = None
+        self._lock = threading.Lock()
+        self._tasks: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue()
+        self._rmq = RcacheRmq(RMQ_DSN)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def dispatch(self, req_cfg_digest: str, queue_name: str) -> None:
+        """ Dispatches computation request """
+        self._tasks.put((req_cfg_digest, queue_name))
+
+    def lookup(self, req_cfg_digests: Set[str]) -> Dict[str, str]:
+        """ Cache lookup """
+        with self._lock:
+            return {d: self.cache[d] for d in req_cfg_digests
+                    if d in self.cache}
+
+    def stop(self) -> None:
+        """ Stops worker thread """
+        self._tasks.put(None)
+        self._thread.join()
+
+    def _worker(self) -> None:
+        """ Worker thread function """
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            req_cfg_digest, queue_name = task
+            time.sleep(COMPUTE_SEC)
+            response = f"response_{req_cfg_digest}"
+            with self._lock:
+                self.computations[req_cfg_digest] += 1
+                self.cache[req_cfg_digest] = response
+            with self._rmq.create_connection(tx_queue_name=queue_name) \
+                    as conn:
+                conn.send_response(req_cfg_digest=req_cfg_digest,
+                                   response=response,
+                                   stage_timing=self.stage_timing)
+
+
+class TestRcacheRmqCoalescing(unittest.TestCase):
+    """ Coalescing of identical in-flight computations """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._broker = FakeBroker()
+        self._patchers = \
+            [mock.patch("pika.BlockingConnection", self._broker.connect),
+             mock.patch("rcache_rmq.RCACHE_RMQ_COALESCE_POLL_SEC", POLL_SEC)]
+        for patcher in self._patchers:
+            patcher.start()
+        self._worker = StubWorker()
+
+    def tearDown(self) -> None:
+        self._worker.stop()
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+        unittest.TestCase.tearDown(self)
+
+    def _client(self, coalesce: bool = True) -> RcacheClient:
+        """ Creates Rcache client """
+        return \
+            RcacheClient(
+                RcacheClientSettings(enabled=True, rmq_dsn=RMQ_DSN,
+                                     rmq_coalesce=coalesce),
+                rmq_receiver=True)
+
+    def _compute_concurrently(self, digest_sets: Any, coalesce: bool = True) \
+            -> Dict[int, Dict[str, Optional[str]]]:
+        """ Computes given sets of digests from concurrent clients. Returns
+        results, indexed by client indices """
+        results: Dict[int, Dict[str, Optional[str]]] = {}
+        barrier = threading.Barrier(len(digest_sets))
+
+        def compute(idx: int, digests: Set[str]) -> None:
+            client = self._client(coalesce=coalesce)
+            with client.rmq_create_rx_connection() as rx_connection:
+                barrier.wait()
+                results[idx] = \
+                    client.rmq_compute_responses(
+                        rx_connection=rx_connection, req_cfg_digests=digests,
+                        dispatch=self._worker.dispatch,
+                        lookup=self._worker.lookup, timeout_sec=TIMEOUT_SEC)
+
+        threads = [threading.Thread(target=compute, args=(idx, digests))
+                   for idx, digests in enumerate(digest_sets)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesced(self) -> None:
+        """ Identical concurrent requests are computed once """
+        digest_sets = [{"d1", "d2"}, {"d1"}, {"d2", "d3"}, {"d1", "d2", "d3"}]
+        results = self._compute_concurrently(digest_sets)
+        self.assertEqual(len(results), len(digest_sets))
+        for idx, digests in enumerate(digest_sets):
+            self.assertEqual(results[idx],
+                             {d: f"response_{d}" for d in digests})
+        self.assertEqual(dict(self._worker.computations),
+                         {"d1": 1, "d2": 1, "d3": 1})
+        # Markers and RX queues are gone
+        self.assertEqual(self._broker.queues, {})
+
+    def test_not_coalesced(self) -> None:
+        """ With coalescing disabled every request is computed """
+        results = self._compute_concurrently([{"d1"}, {"d1"}],
+                                             coalesce=False)
+        self.assertEqual(results, {0: {"d1": "response_d1"},
+                                   1: {"d1": "response_d1"}})
+        self.assertEqual(dict(self._worker.computations), {"d1": 2})
+
+    def test_takeover(self) -> None:
+        """ Computation is taken over if claiming process vanished """
+        leader = self._client().rmq_create_rx_connection()
+        self.assertEqual(leader.coalesce(["d1", "d2"]), {"d1", "d2"})
+        # Leader dies before dispatching computation
+        threading.Timer(0.3, leader.close).start()
+        client = self._client()
+        start = time.monotonic()
+        with client.rmq_create_rx_connection() as rx_connection:
+            results = \
+                client.rmq_compute_responses(
+                    rx_connection=rx_connection,
+                    req_cfg_digests=["d1", "d2", "d3"],
+                    dispatch=self._worker.dispatch,
+                    lookup=self._worker.lookup, timeout_sec=TIMEOUT_SEC)
+        self.assertEqual(results, {d: f"response_{d}"
+                                   for d in ("d1", "d2", "d3")})
+        self.assertEqual(dict(self._worker.computations),
+                         {"d1": 1, "d2": 1, "d3": 1})
+        self.assertLess(time.monotonic() - start, TIMEOUT_SEC / 2)
+
+    def test_orphaned_cached(self) -> None:
+        """ Taken over computation is not repeated if response was cached """
+        self._worker.cache["d1"] = "response_d1"
+        leader = self._client().rmq_create_rx_connection()
+        self.assertEqual(leader.coalesce(["d1"]), {"d1"})
+        threading.Timer(0.3, leader.close).start()
+        client = self._client()
+        with client.rmq_create_rx_connection() as rx_connection:
+            results = \
+                client.rmq_compute_responses(
+                    rx_connection=rx_connection, req_cfg_digests=["d1"],
+                    dispatch=self._worker.dispatch,
+                    lookup=self._worker.lookup, timeout_sec=TIMEOUT_SEC)
+        self.assertEqual(results, {"d1": "response_d1"})
+        self.assertEqual(dict(self._worker.computations), {})
+
+    def test_stage_timing(self) -> None:
+        """ Stage timing is optional in responses """
+        client = self._client()
+        for stage_timing in (None, '{"last": 0, "stages": []}'):
+            with self.subTest(stage_timing=stage_timing):
+                self._worker.stage_timing = stage_timing
+                stage_timings: Dict[str, str] = {}
+                with client.rmq_create_rx_connection() as rx_connection:
+                    results = \
+                        client.rmq_compute_responses(
+                            rx_connection=rx_connection,
+                            req_cfg_digests=["d1"],
+                            dispatch=self._worker.dispatch,
+                            lookup=lambda digests: {},
+                            timeout_sec=TIMEOUT_SEC,
+                            stage_timings=stage_timings)
+                self.assertEqual(results, {"d1": "response_d1"})
+                self.assertEqual(
+                    stage_timings,
+                    {} if stage_timing is None else {"d1": stage_timing})
+
+
+if __name__ == "__main__":
+    unittest.main()
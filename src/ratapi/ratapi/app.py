@@ -25,6 +25,8 @@ import als
 import prometheus_utils
 import prometheus_client
 import db_utils
+import math
+import stack_sampler
 
 #: Logger for this module
 LOGGER = logging.getLogger(__name__)
@@ -454,6 +456,47 @@ def create_app(config_override=None):
             prometheus_metric_flask_active_reqs.dec()
             return response
 
+    # On-demand sampling profiler of msghnd workers
+    if ('AFC_MSGHND_WORKERS' in os.environ) and \
+            flaskapp.config['AFC_PROFILER_DIR']:
+        profiler = stack_sampler.WorkerProfiler(
+            directory=flaskapp.config['AFC_PROFILER_DIR'],
+            min_start_interval_sec=float(
+                flaskapp.config['AFC_PROFILER_MIN_INTERVAL']),
+            max_duration_sec=float(
+                flaskapp.config['AFC_PROFILER_MAX_DURATION']))
+        profiler.start()
+
+        def profile_workers():
+            ''' PIDs of workers that may be profiled '''
+            return flask.jsonify(profiler.workers())
+
+        def profile():
+            ''' Samples stacks of worker (given by 'pid' argument, this one
+            by default) for 'duration' seconds, returns folded stacks
+            '''
+            try:
+                pid = flask.request.args.get('pid', type=int)
+                folded = profiler.profile(
+                    duration_sec=flask.request.args.get(
+                        'duration', 5., type=float),
+                    interval_sec=flask.request.args.get(
+                        'interval', stack_sampler.DEFAULT_INTERVAL_SEC,
+                        type=float),
+                    pid=pid)
+            except stack_sampler.ProfilerError as ex:
+                ret = flask.make_response(str(ex), ex.status)
+                if ex.retry_after is not None:
+                    ret.headers['Retry-After'] = \
+                        str(math.ceil(ex.retry_after))
+                return ret
+            ret = flask.make_response(folded)
+            ret.mimetype = 'text/plain'
+            return ret
+
+        flaskapp.add_url_rule('/profile/workers', view_func=profile_workers)
+        flaskapp.add_url_rule('/profile', view_func=profile)
+
     flaskapp.register_blueprint(views.ratapi.module, url_prefix='/ratapi/v1')
     flaskapp.register_blueprint(views.ratafc.module, url_prefix='/ap-afc')
     flaskapp.register_blueprint(views.auth.module, url_prefix='/auth')
@@ -24,12 +24,12 @@ import werkzeug.exceptions
 from . import create_app
 from afcmodels.base import db
 from afcmodels.hardcoded_relations import RulesetVsRegion, \
-    CERT_ID_LOCATION_UNKNOWN, CERT_ID_LOCATION_OUTDOOR, CERT_ID_LOCATION_INDOOR
+    CERT_ID_LOCATION_OUTDOOR, CERT_ID_LOCATION_INDOOR
 from .db.generators import shp_to_spatialite, spatialite_to_raster
 from prettytable import PrettyTable
 from . import cmd_utils
 import als
-from .util import als_log_afc_config_change
+from .util import als_log_afc_config_change, rcache_cert_id_invalidate
 
 LOGGER = logging.getLogger(__name__)
 
@@ -216,67 +216,94 @@ class DbDrop:
             db.drop_all()
 
 
-class DbExport:
-    ''' Export database in db to a file in json. '''
-
-    def __init__(self, *args, **kwargs):
-        LOGGER.debug('DbExport.__init__()')
+# Format name in header of streaming RatDB export
+DB_EXPORT_FORMAT = 'ratdb-export'
+# Version of streaming RatDB export format
+DB_EXPORT_VERSION = 2
+# Default number of rows per export line (and per import transaction)
+DB_EXPORT_BATCH = 1000
 
-    def __call__(self, flaskapp, dst):
-        LOGGER.debug('DbExportPrev.__call__()')
-        from afcmodels.aaa import User, UserRole, Role, Limit
 
-        filename = dst
-
-        with flaskapp.app_context():
-            limit = None
-            user_info = {}
-            user_cfg = {}
-            for user, _, role in db.session.query(
-                    User, UserRole, Role).filter(
-                    User.id == UserRole.user_id).filter(
-                    UserRole.role_id == Role.id).all():  # pylint: disable=no-member
-                key = user.email + ":" + str(user.id)
-                if key in user_cfg:
-                    user_cfg[key]['rolename'].append(role.name)
-                else:
-                    user_cfg[key] = {
-                        'id': user.id,
-                        'email': user.email,
-                        'password': user.password,
-                        'rolename': [role.name],
-                        'ap': []
-                    }
+def db_export_tables(names=None):
+    ''' Exportable RatDB tables in insertion (foreign key dependency) order,
+        indexed by table name.
 
-                    try:
-                        user_cfg[key]['username'] = user.username
-                    except BaseException:
-                        # if old db has no username field, use email field.
-                        user_cfg[key]['username'] = user.email
+        Arguments:
+        names -- Optional collection of names of tables to return, None for
+                 all tables
+        Returns ordered dictionary of sqlalchemy.Table objects
+    '''
+    from afcmodels.aaa import Organization, Ruleset, Role, User, UserRole, \
+        Limit, AFCConfig, MTLS, AccessPointDeny, CertId
+    tables = {model.__tablename__: model.__table__
+              for model in (Organization, Ruleset, Role, User, UserRole,
+                            Limit, AFCConfig, MTLS, AccessPointDeny, CertId)}
+    if names is None:
+        return tables
+    unknown = set(names) - set(tables)
+    if unknown:
+        raise RuntimeError(
+            f'Unknown table(s): {", ".join(sorted(unknown))}. '
+            f'Known tables: {", ".join(tables)}')
+    return {name: table for name, table in tables.items() if name in names}
 
-                    try:
-                        user_cfg[key]['org'] = user.org
-                    except BaseException:
-                        # if old db has no org field, derive from email field.
-                        if '@' in user.email:
-                            user_cfg[key]['org'] = user.email[user.email.index(
-                                '@') + 1:]
-                        else:  # dummy user - dummy org
-                            user_cfg[key]['org'] = ""
 
-            try:
-                limits = db.session.query(Limit).filter(id=0).first()
-                limit = {'min_eirp': float(
-                    limits.min_eirp), 'enforce': bool(limits.enforce)}
+class DbExport:
+    ''' Export database to a JSON-lines file.
+
+        First line is a header with format name, version and list of tables.
+        It is followed by lines with batches of table rows:
+        {"table": <name>, "columns": [<name>...], "rows": [[<value>...]...]}
+        Tables are written in foreign key dependency order, rows of each
+        table are fetched and written in batches, so that whole tables are
+        never held in memory.
+    '''
 
-            except BaseException:
-                LOGGER.debug("Error exporting EIRP Limit")
+    def __init__(self, *args, **kwargs):
+        LOGGER.debug('DbExport.__init__()')
 
-            with open(filename, 'w') as fpout:
-                for k, v in user_cfg.items():
-                    fpout.write("%s\n" % json.dumps({'userConfig': v}))
-                if limit:
-                    fpout.write("%s\n" % json.dumps({'Limit': limit}))
+    @staticmethod
+    def _json_default(value):
+        ''' JSON representation of column values not supported by json '''
+        import datetime
+        import decimal
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        raise TypeError(f'Unsupported value type {type(value).__name__}')
+
+    def __call__(self, flaskapp, dst, tables=None, batch=DB_EXPORT_BATCH):
+        ''' Export given tables (None for all) to dst file.
+            Returns dictionary of exported row counts indexed by table name
+        '''
+        LOGGER.debug('DbExport.__call__() %s', dst)
+        counts = {}
+        with flaskapp.app_context():
+            selected = db_export_tables(tables)
+            engine = db.engine
+            if engine.dialect.name == 'postgresql':
+                # All tables are read from the same snapshot
+                engine = \
+                    engine.execution_options(isolation_level='REPEATABLE READ')
+            with open(dst, 'w') as fpout, engine.begin() as conn:
+                fpout.write('%s\n' % json.dumps(
+                    {'format': DB_EXPORT_FORMAT, 'version': DB_EXPORT_VERSION,
+                     'tables': list(selected)}))
+                for name, table in selected.items():
+                    counts[name] = 0
+                    result = conn.execution_options(stream_results=True).\
+                        execute(table.select().order_by(
+                            *table.primary_key.columns))
+                    columns = list(result.keys())
+                    for rows in result.partitions(batch):
+                        fpout.write('%s\n' % json.dumps(
+                            {'table': name, 'columns': columns,
+                             'rows': [list(row) for row in rows]},
+                            default=self._json_default))
+                        counts[name] += len(rows)
+                    LOGGER.info('%s: %d rows exported', name, counts[name])
+        return counts
 
 
 def setUserIdNextVal():
@@ -292,14 +319,36 @@ def setUserIdNextVal():
 
 
 class DbImport:
-    ''' Import User Database. '''
+    ''' Import User Database.
+
+        Accepts files, written by DbExport, and files in legacy format (one
+        'userConfig' or 'Limit' record per line). Batches of rows of
+        DbExport file are inserted in separate transactions with bulk INSERT
+        statements, rows that conflict with existing ones (same primary or
+        unique key) are skipped, hence import may be safely repeated (e.g.
+        after failure).
+        Rows of tables with natural keys (organizations, rulesets, roles,
+        users) are matched to existing rows by these keys (not by ids, that
+        may differ, e.g. in database made by db-create), foreign keys that
+        refer to them are remapped accordingly. Rows of natural key tables
+        that are in the file, but not selected for import, are used for
+        remapping only. Import fails if referred row can't be found
+    '''
+
+    # Natural key column names, indexed by names of tables that have them
+    NATURAL_KEYS = {'aaa_org': 'name', 'aaa_ruleset': 'name',
+                    'aaa_role': 'name', 'aaa_user': 'username'}
 
     def __init__(self, *args, **kwargs):
         LOGGER.debug('DbImport.__init__()')
 
-    def __call__(self, flaskapp, src):
+    def __call__(self, flaskapp, src, tables=None, dry_run=False):
+        ''' Import given tables (None for all) from src file. In dry run mode
+            file is read and validated, but database is not modified.
+            Returns dictionary of imported (offered for insertion) row
+            counts, indexed by table name. None for legacy format files
+        '''
         LOGGER.debug('DbImport.__call__() %s', src)
-        from afcmodels.aaa import User, Limit
 
         filename = src
         if not os.path.exists(filename):
@@ -307,42 +356,235 @@ class DbImport:
                 '"{}" source file does not exist'.format(filename))
 
         LOGGER.debug('Open admin cfg src file - %s', filename)
+        with open(filename, 'r') as fp_src:
+            first_line = fp_src.readline()
+            header = json.loads(first_line) if first_line.strip() else None
+            if isinstance(header, dict) and \
+                    (header.get('format') == DB_EXPORT_FORMAT):
+                return self._import(flaskapp, fp_src, header, tables,
+                                    dry_run)
+            if tables or dry_run:
+                raise RuntimeError(
+                    'Table selection and dry run are not supported for '
+                    'legacy format files')
+            fp_src.seek(0)
+            self._import_legacy(flaskapp, fp_src)
+        return None
+
+    def _import(self, flaskapp, fp_src, header, tables, dry_run):
+        ''' Import from DbExport file, positioned after header '''
+        from afcmodels.aaa import CacheGeneration, AFCConfig, CertId, \
+            AccessPointDeny
+        if header.get('version') != DB_EXPORT_VERSION:
+            raise RuntimeError(
+                f'Unsupported export file version: {header.get("version")}')
+        file_tables = header.get('tables', [])
+        missing = set(tables or []) - set(file_tables)
+        if missing:
+            raise RuntimeError(
+                f'Table(s) not found in export file: '
+                f'{", ".join(sorted(missing))}')
+        counts = {}
+        # Destination ids by source ids, indexed by natural key table names
+        id_maps = {}
         with flaskapp.app_context():
-            with open(filename, 'r') as fp_src:
-                while True:
-                    dataline = fp_src.readline()
-                    if not dataline:
-                        break
-                    # add user, APs and server configuration
-                    new_rcrd = json.loads(dataline)
-                    user_rcrd = json_lookup('userConfig', new_rcrd, None)
-                    if user_rcrd:
-                        username = json_lookup('username', user_rcrd, None)
-                        try:
-                            UserCreate(flaskapp, user_rcrd[0], True)
-                        except RuntimeError:
-                            LOGGER.debug('User %s already exists', username[0])
+            selected = db_export_tables(tables or file_tables)
+            all_tables = db_export_tables()
+            for lineno, line in enumerate(fp_src, start=2):
+                if not line.strip():
+                    continue
+                batch = json.loads(line)
+                table = all_tables.get(batch['table'])
+                if (table is None) or \
+                        ((table.name not in selected) and
+                         ((table.name not in self.NATURAL_KEYS) or dry_run)):
+                    continue
+                try:
+                    columns = [table.c[name] for name in batch['columns']]
+                except KeyError as ex:
+                    raise RuntimeError(
+                        f'Line {lineno}: table {table.name} has no column '
+                        f'{ex}')
+                rows = [{column.key: self._from_json(column, value)
+                         for column, value in zip(columns, row)}
+                        for row in batch['rows']]
+                if table.name not in selected:
+                    # Natural key table, needed for remapping only
+                    with db.engine.begin() as conn:
+                        self._map_by_natural_key(
+                            conn, table, rows,
+                            id_maps.setdefault(table.name, {}))
+                    continue
+                if rows and (not dry_run):
+                    self._remap_foreign_keys(table, rows, id_maps)
+                    with db.engine.begin() as conn:
+                        if table.name in self.NATURAL_KEYS:
+                            self._insert_by_natural_key(
+                                conn, table, rows,
+                                id_maps.setdefault(table.name, {}))
+                        else:
+                            conn.execute(self._insert(conn, table), rows)
+                counts[table.name] = counts.get(table.name, 0) + len(rows)
+            if not dry_run:
+                with db.engine.begin() as conn:
+                    self._restart_sequences(conn, selected.values())
+                    if {model.__tablename__ for model in
+                            (AFCConfig, CertId, AccessPointDeny)} & \
+                            set(counts):
+                        CacheGeneration.bump(conn)
+        for name in selected:
+            LOGGER.info('%s: %d rows %s', name, counts.setdefault(name, 0),
+                        'validated' if dry_run else 'imported')
+        return counts
+
+    @staticmethod
+    def _from_json(column, value):
+        ''' Column value from its JSON representation '''
+        import datetime
+        import decimal
+        if value is None:
+            return None
+        if isinstance(column.type, sqlalchemy.DateTime):
+            return datetime.datetime.fromisoformat(value)
+        if isinstance(column.type, sqlalchemy.Numeric) and \
+                (not isinstance(column.type, sqlalchemy.Float)):
+            return decimal.Decimal(value)
+        return value
+
+    @staticmethod
+    def _insert(conn, table):
+        ''' Bulk INSERT statement that skips conflicting rows '''
+        if conn.dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif conn.dialect.name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            raise RuntimeError(
+                f'Import to {conn.dialect.name} database is not supported')
+        return insert(table).on_conflict_do_nothing()
+
+    def _remap_foreign_keys(self, table, rows, id_maps):
+        ''' Replaces source ids in foreign key columns that refer to natural
+            key tables with destination ids. Raises RuntimeError if referred
+            row was not found in file or in database '''
+        for column in table.columns:
+            for fk in column.foreign_keys:
+                parent = fk.column.table.name
+                if parent not in self.NATURAL_KEYS:
+                    continue
+                id_map = id_maps.get(parent, {})
+                for row in rows:
+                    src_id = row.get(column.key)
+                    if src_id is None:
+                        continue
+                    if src_id not in id_map:
+                        raise RuntimeError(
+                            f'{table.name}.{column.key}: {parent} row with '
+                            f'id {src_id} not found in export file or in '
+                            f'database')
+                    row[column.key] = id_map[src_id]
+
+    def _insert_by_natural_key(self, conn, table, rows, id_map):
+        ''' Inserts rows of natural key table that are absent in database
+            (source ids of those, that are already taken, are replaced with
+            new ones) and adds source to destination id mapping for all rows
+            to id_map '''
+        key = table.c[self.NATURAL_KEYS[table.name]]
+        pk = table.c.id
+        keys = [row[key.key] for row in rows]
+        existing = {k for k, in conn.execute(
+            sqlalchemy.select([key]).where(key.in_(keys)))}
+        new_rows = [row for row in rows if row[key.key] not in existing]
+        taken_ids = {i for i, in conn.execute(
+            sqlalchemy.select([pk]).where(
+                pk.in_([row[pk.key] for row in new_rows])))} \
+            if new_rows else set()
+        with_ids = [row for row in new_rows if row[pk.key] not in taken_ids]
+        without_ids = [{c: v for c, v in row.items() if c != pk.key}
+                       for row in new_rows if row[pk.key] in taken_ids]
+        if with_ids:
+            conn.execute(self._insert(conn, table), with_ids)
+        if without_ids:
+            # Sequence should be past explicitly inserted ids
+            self._restart_sequences(conn, [table])
+            conn.execute(self._insert(conn, table), without_ids)
+        self._map_by_natural_key(conn, table, rows, id_map)
+
+    def _map_by_natural_key(self, conn, table, rows, id_map):
+        ''' Adds source to destination id mapping of given rows of natural
+            key table to id_map. Rows absent in database are not mapped '''
+        key = table.c[self.NATURAL_KEYS[table.name]]
+        pk = table.c.id
+        keys = [row[key.key] for row in rows]
+        dst_ids = {k: i for k, i in conn.execute(
+            sqlalchemy.select([key, pk]).where(key.in_(keys)))}
+        for row in rows:
+            if row[key.key] in dst_ids:
+                id_map[row[pk.key]] = dst_ids[row[key.key]]
+                if row[pk.key] != dst_ids[row[key.key]]:
+                    LOGGER.debug('%s "%s": id %s mapped to %s', table.name,
+                                 row[key.key], row[pk.key],
+                                 dst_ids[row[key.key]])
+
+    @staticmethod
+    def _restart_sequences(conn, tables):
+        ''' Moves serial primary key sequences past imported values, so that
+            new rows will not reuse them (PostgreSQL only) '''
+        if conn.dialect.name != 'postgresql':
+            return
+        for table in tables:
+            pk = list(table.primary_key.columns)
+            if (len(pk) != 1) or (pk[0].autoincrement is False) or \
+                    (not isinstance(pk[0].type, sqlalchemy.Integer)):
+                continue
+            conn.execute(sqlalchemy.select([sqlalchemy.func.setval(
+                sqlalchemy.func.pg_get_serial_sequence(
+                    conn.dialect.identifier_preparer.format_table(table),
+                    pk[0].name),
+                sqlalchemy.select(
+                    [sqlalchemy.func.coalesce(sqlalchemy.func.max(pk[0]),
+                                              0) + 1]).scalar_subquery(),
+                False)]))
+
+    def _import_legacy(self, flaskapp, fp_src):
+        ''' Import from legacy format file '''
+        from afcmodels.aaa import Limit
 
-                    else:
-                        limit = json_lookup('Limit', new_rcrd, None)
-                        try:
-                            limits = db.session.query(
-                                Limit).filter_by(id=0).first()
-                            # insert case
-                            if limits is None:
-                                limits = Limit(limit[0]['min_eirp'])
-                                db.session.add(limits)
-                            elif (limit[0]['enforce'] == False):
-                                limits.enforce = False
-                            else:
-                                limits.min_eirp = limit[0]['min_eirp']
-                                limits.enforce = True
-                            db.session.commit()
-                        except BaseException:
-                            raise RuntimeError(
-                                "Can't commit DB for EIRP limits")
+        with flaskapp.app_context():
+            while True:
+                dataline = fp_src.readline()
+                if not dataline:
+                    break
+                # add user, APs and server configuration
+                new_rcrd = json.loads(dataline)
+                user_rcrd = json_lookup('userConfig', new_rcrd, None)
+                if user_rcrd:
+                    username = json_lookup('username', user_rcrd, None)
+                    try:
+                        UserCreate(flaskapp, user_rcrd[0], True)
+                    except RuntimeError:
+                        LOGGER.debug('User %s already exists', username[0])
 
-                setUserIdNextVal()
+                else:
+                    limit = json_lookup('Limit', new_rcrd, None)
+                    try:
+                        limits = db.session.query(
+                            Limit).filter_by(id=0).first()
+                        # insert case
+                        if limits is None:
+                            limits = Limit(limit[0]['min_eirp'])
+                            db.session.add(limits)
+                        elif (limit[0]['enforce'] == False):
+                            limits.enforce = False
+                        else:
+                            limits.min_eirp = limit[0]['min_eirp']
+                            limits.enforce = True
+                        db.session.commit()
+                    except BaseException:
+                        raise RuntimeError(
+                            "Can't commit DB for EIRP limits")
+
+            setUserIdNextVal()
 
 
 class DbUpgrade:
@@ -681,7 +923,8 @@ class AccessPointDenyCreate:
     def _create_ap(self, flaskapp, serial, cert_id, ruleset, org):
         from contextlib import closing
         import datetime
-        from afcmodels.aaa import AccessPointDeny, Organization, Ruleset
+        from afcmodels.aaa import AccessPointDeny, Organization, Ruleset, \
+            CacheGeneration
         LOGGER.debug('AccessPointDenyCreate._create_ap() %s %s %s',
                      serial, cert_id, ruleset)
         with flaskapp.app_context():
@@ -710,7 +953,9 @@ class AccessPointDenyCreate:
             organization.aps.append(ap)
             ruleset.aps.append(ap)
             db.session.add(ap)
+            CacheGeneration.bump()
             db.session.commit()
+            rcache_cert_id_invalidate([(ruleset.name, cert_id)])
 
     def __init__(self, flaskapp=None, serial_id=None,
                  cert_id=None, ruleset=None, org=None):
@@ -735,7 +980,7 @@ class AccessPointDenyRemove:
     '''Removes an access point by serial number and or certification id'''
 
     def _remove_ap(self, flaskapp, serial, cert_id):
-        from afcmodels.aaa import AccessPointDeny
+        from afcmodels.aaa import AccessPointDeny, CacheGeneration
         LOGGER.debug('AccessPointDenyRemove._remove_ap() %s', serial)
         with flaskapp.app_context():
             try:
@@ -749,8 +994,11 @@ class AccessPointDenyRemove:
             except BaseException:
                 raise RuntimeError('No access point found')
 
+            certifications = [(ap.ruleset.name, ap.certification_id)]
             db.session.delete(ap)  # pylint: disable=no-member
+            CacheGeneration.bump()
             db.session.commit()  # pylint: disable=no-member
+            rcache_cert_id_invalidate(certifications)
 
     def __init__(self, flaskapp=None, serial=None, cert_id=None):
         if flaskapp:
@@ -822,7 +1070,7 @@ class CertIdRemove:
     '''Removes an Certificate Id by certificate id '''
 
     def _remove_cert_id(self, flaskapp, cert_id):
-        from afcmodels.aaa import CertId
+        from afcmodels.aaa import CertId, CacheGeneration
         LOGGER.debug('CertIdRemove._remove_cert_id() %s', cert_id)
         with flaskapp.app_context():
             try:
@@ -831,8 +1079,11 @@ class CertIdRemove:
             except sqlalchemy.orm.exc.NoResultFound:
                 raise RuntimeError(
                     'No certificate found with id "{0}"'.format(cert_id))
+            certifications = [(cert.ruleset.name, cert_id)]
             db.session.delete(cert)  # pylint: disable=no-member
+            CacheGeneration.bump()
             db.session.commit()  # pylint: disable=no-member
+            rcache_cert_id_invalidate(certifications)
 
     def __init__(self, flaskapp=None, cert_id=None):
         if flaskapp:
@@ -859,7 +1110,8 @@ class CertIdCreate:
     def _create_cert_id(self, flaskapp, cert_id, ruleset_id, location=0):
         from contextlib import closing
         import datetime
-        from afcmodels.aaa import CertId, Ruleset, Organization
+        from afcmodels.aaa import CertId, Ruleset, Organization, \
+            CacheGeneration
         LOGGER.debug('CertIdCreate._create_cert_id() %s %s',
                      cert_id, ruleset_id)
         with flaskapp.app_context():
@@ -881,6 +1133,7 @@ class CertIdCreate:
             ruleset.cert_ids.append(cert)
 
             db.session.add(cert)  # pylint: disable=no-member
+            CacheGeneration.bump()
             db.session.commit()  # pylint: disable=no-member
 
     def __init__(self, flaskapp=None, cert_id=None,
@@ -895,103 +1148,121 @@ class CertIdCreate:
 
 @cert_id_group.command('sweep')
 @click.option('--country', type=str, help='country e.g. US or CA')
+@click.option('--source', type=str, default=None,
+              help='Local file to take certification list from instead of '
+              'downloading it (FCC JSON for US, ISED CSV for CA)')
 @with_appcontext
-def cert_id_sweep(country):
-    CertIdSweep()(flaskapp=flask.current_app, country=country)
+def cert_id_sweep(country, source):
+    CertIdSweep()(flaskapp=flask.current_app, country=country, source=source)
 
 
 class CertIdSweep:
-    '''Lists all access points'''
-
-    def sweep_canada(self, flaskapp):
+    ''' Synchronizes downloaded certification IDs with FCC/ISED lists.
+
+    Certification list is parsed in memory, bulk-loaded into temporary staging
+    table and applied with one upsert and one anti-join delete, all in single
+    transaction. Added, removed and location-changed certification IDs are
+    reported to ALS, Rcache entries of APs with removed and location-changed
+    certifications are invalidated '''
+
+    FCC_URL = 'https://apps.fcc.gov/OETLabServices/getAFCAuthorizations'
+    ISED_URL = 'https://www.ic.gc.ca/engineering/' \
+        'Certified_Standard_Power_Access_Points_6GHz.csv'
+    # Number of FCC download attempts
+    DOWNLOAD_ATTEMPTS = 5
+    # Interval between FCC download attempts in seconds
+    RETRY_INTERVAL_SEC = 5
+
+    @staticmethod
+    def _timeout():
+        ''' Download timeout in seconds (None for no timeout) '''
+        timeout = os.environ.get("REQUEST_TIMEOUT_SEC")
+        return None if timeout is None else float(timeout)
+
+    @staticmethod
+    def parse_ised(csvfile):
+        ''' Parses ISED list of certified standard power APs.
+
+        Arguments:
+        csvfile -- Text file object of CSV list
+        Returns dictionary of CERT_ID_LOCATION_... bitmasks indexed by
+        certification IDs. Entries of certifications with unknown location
+        are None - such certifications are retained, but not added/updated
+        '''
         import csv
-        import requests
-        from afcmodels.aaa import CertId, Ruleset
-        import datetime
-        now = datetime.datetime.now()
+        ret = {}
+        for row in csv.reader(csvfile, delimiter=','):
+            try:
+                cert_id = row[7]
+                code = int(row[6])
+            except (IndexError, ValueError):
+                # ignore header and badly formatted rows
+                continue
+            if code == 103:
+                location = CERT_ID_LOCATION_OUTDOOR
+            elif code == 111:
+                location = CERT_ID_LOCATION_INDOOR | CERT_ID_LOCATION_OUTDOOR
+            else:
+                location = None
+            if (location is not None) or (cert_id not in ret):
+                ret[cert_id] = location
+        return ret
+
+    @staticmethod
+    def parse_fcc(cert_infos):
+        ''' Parses FCC list of AFC authorizations.
+
+        Arguments:
+        cert_infos -- List of authorization dictionaries (parsed JSON)
+        Returns dictionary of CERT_ID_LOCATION_... bitmasks indexed by FCC IDs
+        of standard power (6SD) devices
+        '''
+        ret = {}
+        for cert_info in cert_infos:
+            if cert_info.get('equipmentClass') != '6SD':
+                continue
+            fcc_id = cert_info.get('fccid')
+            if not fcc_id:
+                continue
+            location = CERT_ID_LOCATION_OUTDOOR
+            for spec_info in cert_info.get('lSpecs', {}).get('specs', []):
+                if any(note_info.get('grantNoteId') == 'BX'
+                       for note_info in
+                       spec_info.get('lNotes', {}).get('notes', [])):
+                    location |= CERT_ID_LOCATION_INDOOR
+                    break
+            ret[fcc_id] = location
+        return ret
 
-        with flaskapp.app_context():
-            url = \
-                "https://www.ic.gc.ca/engineering/Certified_Standard_Power_Access_Points_6GHz.csv"
+    def load_canada(self, source=None):
+        ''' Certification locations from ISED list, downloaded or taken from
+        given local CSV file '''
+        import requests
+        if source is None:
             headers = {
                 'accept': 'text/html,application/xhtml+xml,application/xml',
                 'cache-control': 'max-age=0',
                 'content-type': 'application/x-www-form-urlencoded',
                 'user-agent': 'rat_server/1.0'
             }
-            try:
-                timeout = os.environ.get("REQUEST_TIMEOUT_SEC")
-                if timeout is not None:
-                    timeout = float(timeout)
-                with requests.get(url, headers, stream=True, timeout=timeout) as r:
-                    r.raise_for_status()
-
-                    local_filename = "/tmp/SD6_list.csv"
-                    with open(local_filename, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            f.write(chunk)
-
-                with open(local_filename, newline='') as csvfile:
-                    rdr = csv.reader(csvfile, delimiter=',')
-                    cert_ids = []
-                    ruleset_id_str = \
-                        RulesetVsRegion.region_to_ruleset(
-                            "CA", exc=werkzeug.exceptions.NotFound)
-                    for row in rdr:
-                        try:
-                            cert_id = row[7]
-                            code = int(row[6])
-                            if code == 103:
-                                location = CERT_ID_LOCATION_OUTDOOR
-                            elif code == 111:
-                                location = CERT_ID_LOCATION_INDOOR | \
-                                    CERT_ID_LOCATION_OUTDOOR
-                            else:
-                                location = CERT_ID_LOCATION_UNKNOWN
-                            if not location == CERT_ID_LOCATION_UNKNOWN:
-                                cert = CertId.query.filter_by(
-                                    certification_id=cert_id).first()
-                                if cert:
-                                    cert.refreshed_at = now
-                                    cert.location = location
-                                    cert.downloaded = True
-                                else:
-                                    cert = CertId(certification_id=cert_id,
-                                                  location=location,
-                                                  downloaded=True)
-                                    ruleset = Ruleset.query.filter_by(
-                                        name=ruleset_id_str).first()
-                                    ruleset.cert_ids.append(cert)
-                                    db.session.add(cert)
-                            cert_ids.append(cert_id)
-                        except BaseException:
-                            # ignore badly formatted rows
-                            pass
-                    ruleset_id = \
-                        Ruleset.query.filter_by(name=ruleset_id_str).first().id
-                    db.engine.execute(
-                        CertId.__table__.delete().where(
-                            (CertId.downloaded == True) &
-                            (CertId.certification_id.notin_(cert_ids)) &
-                            (CertId.ruleset_id == ruleset_id)))
-
-                    als.als_json_log(
-                        'cert_db', {
-                            'action': 'sweep', 'country': 'CA', 'status': 'success'})
-                    db.session.commit()  # pylint: disable=no-member
-            except BaseException:
-                als.als_json_log(
-                    'cert_db', {
-                        'action': 'sweep', 'country': 'CA', 'status': 'failed download'})
-                self.mailAlert(flaskapp, 'CA', 'none')
-
-    def sweep_fcc(self, flaskapp):
-        from afcmodels.aaa import CertId, Ruleset
+            source = "/tmp/SD6_list.csv"
+            with requests.get(self.ISED_URL, headers, stream=True,
+                              timeout=self._timeout()) as r:
+                r.raise_for_status()
+                with open(source, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=8192):
+                        f.write(chunk)
+        with open(source, newline='') as csvfile:
+            return self.parse_ised(csvfile)
+
+    def load_fcc(self, source=None):
+        ''' Certification locations from FCC list, downloaded (with retries)
+        or taken from given local JSON file '''
         import requests
         import datetime
-
-        now = datetime.datetime.now()
-        url = f'https://apps.fcc.gov/OETLabServices/getAFCAuthorizations'
+        if source is not None:
+            with open(source, encoding='utf-8') as f:
+                return self.parse_fcc(json.load(f))
         headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -999,80 +1270,101 @@ class CertIdSweep:
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.2 Safari/605.1.15',
         }
         params = \
-            {'beginDate': '01-01-2020', 'endDate': now.strftime("%m-%d-%Y")}
-        for _ in range(5):
-            with flaskapp.app_context():
-                try:
-                    timeout = os.environ.get("REQUEST_TIMEOUT_SEC")
-                    if timeout is not None:
-                        timeout = float(timeout)
-                    resp = requests.get(url, headers=headers, params=params,
-                                        timeout=timeout)
-                    if resp.status_code == 200:
-                        cert_ids = []
-                        ruleset_id_str = \
-                            RulesetVsRegion.region_to_ruleset(
-                                "US", exc=werkzeug.exceptions.NotFound)
-                        try:
-                            for cert_info in resp.json():
-                                if cert_info.get('equipmentClass') != '6SD':
-                                    continue
-                                fcc_id = cert_info.get('fccid')
-                                if not fcc_id:
-                                    continue
-                                location = CERT_ID_LOCATION_OUTDOOR
-                                for spec_info in cert_info.get('lSpecs', {}).\
-                                        get('specs', []):
-                                    if any(note_info.get('grantNoteId') == 'BX'
-                                           for note_info in
-                                           spec_info.get('lNotes', {}).
-                                           get('notes', [])):
-                                        location |= CERT_ID_LOCATION_INDOOR
-                                        break
-                                cert = CertId.query.filter_by(
-                                    certification_id=fcc_id).first()
-                                if cert:
-                                    cert.refreshed_at = now
-                                    cert.location = location
-                                    cert.downloaded = True
-                                else:
-                                    cert = CertId(certification_id=fcc_id,
-                                                  location=location,
-                                                  downloaded=True)
-                                    ruleset_id_str = \
-                                        RulesetVsRegion.region_to_ruleset(
-                                            "US",
-                                            exc=werkzeug.exceptions.NotFound)
-                                    ruleset = Ruleset.query.filter_by(
-                                        name=ruleset_id_str).first()
-                                    ruleset.cert_ids.append(cert)
-                                    db.session.add(cert)
-                                cert_ids.append(fcc_id)
-                            ruleset_id = \
-                                Ruleset.query.filter_by(name=ruleset_id_str).\
-                                first().id
-                            db.engine.execute(
-                                CertId.__table__.delete().where(
-                                    (CertId.downloaded == True) &
-                                    (CertId.certification_id.notin_(cert_ids)) &
-                                    (CertId.ruleset_id == ruleset_id)))
-
-                            als.als_json_log(
-                                'cert_db',
-                                {'action': 'sweep', 'country': 'US',
-                                 'status': 'success'})
-                        finally:
-                            db.session.commit()  # pylint: disable=no-member
-                    return
-                except BaseException:
-                    raise
-                    time.sleep(5)
-        als.als_json_log(
-            'cert_db', {
-                'action': 'sweep', 'country': 'US',
-                'status': 'failed download'})
+            {'beginDate': '01-01-2020',
+             'endDate': datetime.datetime.now().strftime("%m-%d-%Y")}
+        for attempt in range(self.DOWNLOAD_ATTEMPTS):
+            if attempt:
+                time.sleep(self.RETRY_INTERVAL_SEC)
+            try:
+                resp = requests.get(self.FCC_URL, headers=headers,
+                                    params=params, timeout=self._timeout())
+                if resp.status_code == 200:
+                    return self.parse_fcc(resp.json())
+                error = f'status code {resp.status_code}'
+            except (requests.RequestException, ValueError) as ex:
+                error = repr(ex)
+            LOGGER.warning(f'FCC download attempt {attempt + 1} failed: '
+                           f'{error}')
+        raise RuntimeError(f'FCC download failed: {error}')
+
+    def apply(self, flaskapp, country, locations):
+        ''' Applies certification list to downloaded certifications of the
+        country's ruleset.
+
+        Arguments:
+        flaskapp  -- Flask application
+        country   -- Country code
+        locations -- Dictionary of CERT_ID_LOCATION_... bitmasks indexed by
+                     certification IDs (as returned by parse_...()), None
+                     for certifications to retain unchanged
+        Returns dictionary with sorted lists of 'added', 'removed' and
+        'location_changed' certification IDs
+        '''
+        import datetime
+        from sqlalchemy.dialects.postgresql import insert
+        from afcmodels.aaa import CertId, Ruleset, CacheGeneration
+
+        if all(location is None for location in locations.values()):
+            # Most likely broken download - better not to delete everything
+            raise RuntimeError('No certifications found in the list')
+        now = datetime.datetime.now()
+        cert = CertId.__table__
+        staging = \
+            sqlalchemy.Table(
+                'cert_id_sweep_staging', sqlalchemy.MetaData(),
+                sqlalchemy.Column('certification_id', sqlalchemy.String(64),
+                                  primary_key=True),
+                sqlalchemy.Column('location', sqlalchemy.Integer),
+                prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
         with flaskapp.app_context():
-            self.mailAlert(flaskapp, 'US', 'none')
+            ruleset_id = \
+                Ruleset.query.filter_by(
+                    name=RulesetVsRegion.region_to_ruleset(
+                        country, exc=werkzeug.exceptions.NotFound)).one().id
+            # Certification IDs are unique within ruleset
+            same_cert = \
+                (cert.c.ruleset_id == ruleset_id) & \
+                (cert.c.certification_id == staging.c.certification_id)
+            in_cert = sqlalchemy.exists().where(same_cert)
+            in_staging = sqlalchemy.exists().where(same_cert)
+            with db.engine.begin() as conn:
+                staging.create(conn, checkfirst=False)
+                conn.execute(
+                    staging.insert(),
+                    [{'certification_id': cert_id, 'location': location}
+                     for cert_id, location in locations.items()])
+                added = conn.execute(
+                    sqlalchemy.select([staging.c.certification_id]).where(
+                        staging.c.location.isnot(None) & ~in_cert)).\
+                    scalars().all()
+                location_changed = conn.execute(
+                    sqlalchemy.select([staging.c.certification_id]).
+                    select_from(staging.join(cert, same_cert)).
+                    where(cert.c.location != staging.c.location)).\
+                    scalars().all()
+                upsert = insert(cert).from_select(
+                    ['certification_id', 'location', 'refreshed_at',
+                     'ruleset_id', 'downloaded'],
+                    sqlalchemy.select(
+                        [staging.c.certification_id, staging.c.location,
+                         sqlalchemy.literal(now, sqlalchemy.DateTime),
+                         sqlalchemy.literal(ruleset_id, sqlalchemy.Integer),
+                         sqlalchemy.true()]).
+                    where(staging.c.location.isnot(None)))
+                conn.execute(upsert.on_conflict_do_update(
+                    index_elements=[cert.c.ruleset_id,
+                                    cert.c.certification_id],
+                    set_={'location': upsert.excluded.location,
+                          'refreshed_at': upsert.excluded.refreshed_at,
+                          'downloaded': True}))
+                removed = conn.execute(
+                    cert.delete().where(
+                        cert.c.downloaded.is_(True) &
+                        (cert.c.ruleset_id == ruleset_id) & ~in_staging).
+                    returning(cert.c.certification_id)).scalars().all()
+                CacheGeneration.bump(conn)
+        return {'added': sorted(added), 'removed': sorted(removed),
+                'location_changed': sorted(location_changed)}
 
     def mailAlert(self, flaskapp, country, other):
         import flask
@@ -1089,15 +1381,44 @@ class CertIdSweep:
             msg.body = f'''Fail to download CertId for country: {country} info {other}'''
             mail.send(msg)
 
-    def __call__(self, flaskapp, country):
+    def __call__(self, flaskapp, country, source=None):
+        ''' Sweeps certifications of given country.
+
+        Arguments:
+        flaskapp -- Flask application
+        country  -- Country code (US or CA)
+        source   -- Local file to take certification list from, None to
+                    download it
+        Returns dictionary of certification ID changes (see apply())
+        '''
+        loaders = {'US': self.load_fcc, 'CA': self.load_canada}
+        if country not in loaders:
+            raise RuntimeError('Unknown country: {0}'.format(country))
         als.als_json_log('cert_db', {'action': 'sweep', 'country': country,
                                      'status': 'starting'})
-        if country == "US":
-            self.sweep_fcc(flaskapp)
-        elif country == "CA":
-            self.sweep_canada(flaskapp)
-        else:
-            raise RuntimeError('Unknown country: {0}'.format(country))
+        status = 'failed download'
+        try:
+            locations = loaders[country](source)
+            status = 'failed update'
+            delta = self.apply(flaskapp, country, locations)
+        except BaseException as ex:
+            als.als_json_log('cert_db', {'action': 'sweep', 'country': country,
+                                         'status': status})
+            self.mailAlert(flaskapp, country, repr(ex))
+            raise
+        LOGGER.info(
+            f'{country} certifications sweep: '
+            f'{len(delta["added"])} added, {len(delta["removed"])} removed, '
+            f'{len(delta["location_changed"])} changed location')
+        als.als_json_log('cert_db', dict(action='sweep', country=country,
+                                         status='success', **delta))
+        ruleset_name = \
+            RulesetVsRegion.region_to_ruleset(
+                country, exc=werkzeug.exceptions.NotFound)
+        rcache_cert_id_invalidate(
+            (ruleset_name, cert_id)
+            for cert_id in delta['removed'] + delta['location_changed'])
+        return delta
 
 
 # 'org' group
@@ -1490,7 +1811,7 @@ class ConfigAdd:
 
     def __call__(self, flaskapp, src):
         LOGGER.debug('ConfigAdd.__call__() %s', src)
-        from afcmodels.aaa import AFCConfig, CertId, User
+        from afcmodels.aaa import AFCConfig, CertId, User, CacheGeneration
         import datetime
 
         split_items = src.split('=', 1)
@@ -1579,6 +1900,7 @@ class ConfigAdd:
                             else:
                                 config.config = all_cfg_rcrds[i]
                                 config.created = datetime.datetime.now()
+                        CacheGeneration.bump()
                         db.session.commit()
 
                 except Exception as e:
@@ -1755,16 +2077,37 @@ def main():
     @cli.command('db-export')
     @click.option('--log-level', help='Console logging lowest level displayed.')
     @click.option('--dst', type=str, required=True, help='export user data file')
+    @click.option('--tables', type=str,
+                  help='Comma-separated list of tables to export (default - '
+                  'all)')
+    @click.option('--batch', type=click.IntRange(min=1),
+                  default=DB_EXPORT_BATCH, show_default=True,
+                  help='Number of rows per export file line')
     @with_appcontext
-    def db_export(log_level, dst):
-        DbExport()(flaskapp=flask.current_app, dst=dst)
+    def db_export(log_level, dst, tables, batch):
+        DbExport()(flaskapp=flask.current_app, dst=dst,
+                   tables=tables.split(',') if tables else None, batch=batch)
 
     @cli.command('db-import')
     @click.option('--log-level', help='Console logging lowest level displayed.')
     @click.option('--src', type=str, required=True, help='configuration source file')
+    @click.option('--tables', type=str,
+                  help='Comma-separated list of tables to import (default - '
+                  'all tables in source file)')
+    @click.option('--dry-run', is_flag=True,
+                  help='Read and validate source file without modifying '
+                  'the database')
     @with_appcontext
-    def db_import(log_level, src):
-        DbImport()(flaskapp=flask.current_app, src=src)
+    def db_import(log_level, src, tables, dry_run):
+        counts = DbImport()(flaskapp=flask.current_app, src=src,
+                            tables=tables.split(',') if tables else None,
+                            dry_run=dry_run)
+        if counts is not None:
+            table = PrettyTable()
+            table.field_names = ["Table", "Rows"]
+            for name, count in counts.items():
+                table.add_row([name, count])
+            print(table)
 
     @cli.command('db-upgrade')
     @click.option('--log-level', help='Console logging lowest level displayed.')
@@ -0,0 +1,27 @@
+"""Cache generation counter for AFCConfig, cert_id and access_point_deny
+
+Revision ID: 5d1b2f63a7c4
+Revises: 9fba1618496f
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d1b2f63a7c4'
+down_revision = '9fba1618496f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'cache_generation',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('generation', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id'))
+    op.execute("INSERT INTO cache_generation (id, generation) VALUES (1, 0)")
+
+
+def downgrade():
+    op.drop_table('cache_generation')
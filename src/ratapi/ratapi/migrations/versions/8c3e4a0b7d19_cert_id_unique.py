@@ -0,0 +1,29 @@
+"""Unique certification ID per ruleset in cert_id
+
+Revision ID: 8c3e4a0b7d19
+Revises: 5d1b2f63a7c4
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c3e4a0b7d19'
+down_revision = '5d1b2f63a7c4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Keeping the oldest of entries, duplicated within ruleset
+    op.execute(
+        "DELETE FROM cert_id a USING cert_id b "
+        "WHERE a.ruleset_id = b.ruleset_id "
+        "AND a.certification_id = b.certification_id AND a.id > b.id")
+    op.create_unique_constraint('cert_id_ruleset_id_certification_id_key',
+                                'cert_id', ['ruleset_id', 'certification_id'])
+
+
+def downgrade():
+    op.drop_constraint('cert_id_ruleset_id_certification_id_key', 'cert_id',
+                       type_='unique')
@@ -0,0 +1,281 @@
+''' Static asset layer for views.
+
+Files (LiDAR/RAS bounds, etc.) are served streamed, with precompressed
+variants, built once per file change, and with ETag/Last-Modified validators
+(so unchanged files are revalidated with 304 responses). Small JSON documents,
+generated by views, are served from in-process LRU cache.
+'''
+
+import collections
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import flask
+import gevent
+import werkzeug.exceptions
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: Logger for this module
+LOGGER = logging.getLogger(__name__)
+
+#: Content encodings in order of preference
+ENCODINGS = ['br', 'gzip', 'identity']
+#: Content smaller than this is not compressed
+MIN_COMPRESS_SIZE = 1024
+#: Chunk size for file copying/compression
+CHUNK_SIZE = 1024 * 1024
+#: Brotli quality (11 is way slower for little gain on big JSON files)
+BROTLI_QUALITY = 9
+
+
+def _offload(func, *args):
+    ''' Runs CPU/IO-heavy function on native thread, so that it does not block
+    other greenlets of the worker (zlib and brotli release GIL)
+    '''
+    return gevent.get_hub().threadpool.apply(func, args)
+
+
+def _choose_encoding(available):
+    ''' Returns most preferred content encoding, accepted by client, out of
+    given available ones. If none is accepted - returns first available one
+    '''
+    accept = flask.request.accept_encodings
+    for encoding in ENCODINGS:
+        if (encoding in available) and \
+                ((encoding == 'identity') or accept[encoding]):
+            return encoding
+    return next(iter(available))
+
+
+def _gunzip(src, dst):
+    ''' Decompresses gzip file to file object '''
+    with gzip.open(src, 'rb') as f:
+        shutil.copyfileobj(f, dst, CHUNK_SIZE)
+
+
+def _gzip(src, dst):
+    ''' Compresses file to gzip file object '''
+    with open(src, 'rb') as f, \
+            gzip.GzipFile(fileobj=dst, mode='wb', mtime=0) as g:
+        shutil.copyfileobj(f, g, CHUNK_SIZE)
+
+
+def _brotli(src, dst):
+    ''' Compresses file to brotli file object '''
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    with open(src, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            dst.write(compressor.process(chunk))
+    dst.write(compressor.finish())
+
+
+class StaticFile:
+    ''' File served with precompressed variants and validators.
+
+    Variants are files in cache directory, named after source path digest and
+    source signature (inode, size, modification time) - hence workers sharing
+    cache directory build them once per source file change.
+
+    Private attributes:
+    _path            -- Source file path
+    _mimetype        -- Content type
+    _source_encoding -- Content encoding of source file ('identity' or
+                        'gzip')
+    _lock            -- Serializes variants' (re)building
+    _signature       -- Source signature variants were built for
+    _variants        -- Variant file paths, indexed by content encodings
+    '''
+
+    def __init__(self, path, mimetype, source_encoding='identity'):
+        self._path = path
+        self._mimetype = mimetype
+        self._source_encoding = source_encoding
+        self._lock = threading.Lock()
+        self._signature = None
+        self._variants = None
+
+    def response(self, cache_dir):
+        ''' Response for current request.
+
+        :param cache_dir: Directory for precompressed variants
+        :return: Streamed response (304 if client's copy is current)
+        '''
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            raise werkzeug.exceptions.NotFound()
+        signature = f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+        variants = self._get_variants(signature, cache_dir)
+        encoding = _choose_encoding(variants)
+        resp = flask.send_file(
+            variants[encoding], mimetype=self._mimetype,
+            etag=f'{signature}-{encoding}', last_modified=st.st_mtime,
+            conditional=True, max_age=None)
+        if encoding != 'identity':
+            resp.content_encoding = encoding
+        resp.vary.add('Accept-Encoding')
+        return resp
+
+    def _get_variants(self, signature, cache_dir):
+        ''' Variants for given source signature, built if necessary '''
+        with self._lock:
+            if signature != self._signature:
+                self._variants = \
+                    _offload(self._build_variants, signature, cache_dir)
+                self._signature = signature
+            return self._variants
+
+    def _build_variants(self, signature, cache_dir):
+        ''' Builds (or finds built by other workers) variants for given source
+        signature. Variants of previous signatures are removed. On failure
+        only source file is served
+        '''
+        variants = {self._source_encoding: self._path}
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            prefix = hashlib.sha1(
+                os.path.abspath(self._path).encode('utf-8')).hexdigest()
+            base = os.path.join(cache_dir, f'{prefix}.{signature}')
+            if 'identity' not in variants:
+                variants['identity'] = \
+                    self._materialize(base + '.identity', _gunzip,
+                                      self._path)
+            if os.path.getsize(variants['identity']) >= MIN_COMPRESS_SIZE:
+                if 'gzip' not in variants:
+                    variants['gzip'] = \
+                        self._materialize(base + '.gz', _gzip,
+                                          variants['identity'])
+                if brotli is not None:
+                    variants['br'] = \
+                        self._materialize(base + '.br', _brotli,
+                                          variants['identity'])
+            for name in os.listdir(cache_dir):
+                if name.startswith(prefix + '.') and \
+                        (not name.startswith(f'{prefix}.{signature}.')):
+                    try:
+                        os.unlink(os.path.join(cache_dir, name))
+                    except OSError:
+                        pass
+        except (OSError, EOFError) as ex:
+            LOGGER.warning('Failed to build variants of "%s": %s',
+                           self._path, ex)
+            return {self._source_encoding: self._path}
+        return variants
+
+    def _materialize(self, path, writer, src):
+        ''' Creates variant file (unless it exists) atomically.
+
+        :param path: Variant file path
+        :param writer: Function that writes variant from source file path to
+            file object
+        :param src: Source file path
+        :return: Variant file path
+        '''
+        if not os.path.exists(path):
+            LOGGER.debug('Building "%s" from "%s"', path, src)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                             prefix='.tmp_')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    writer(src, f)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        return path
+
+
+class JsonCache:
+    ''' Process-wide LRU cache of small generated JSON documents with their
+    gzip variants and ETags.
+
+    Private attributes:
+    _max_entries -- Maximum number of cached documents
+    _max_size    -- Maximum size of cached document
+    _lock        -- Lock for thread-safe access
+    _entries     -- Ordered (oldest first) dictionary of (ETag, body,
+                    gzipped body or None) tuples, indexed by keys
+    '''
+
+    def __init__(self, max_entries=64, max_size=1024 * 1024):
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def response(self, key, generate):
+        ''' Response for current request.
+
+        :param key: Hashable key that identifies document content (i.e.
+            should change when content changes)
+        :param generate: Function that returns JSON-serializable document.
+            Called on cache miss
+        :return: Response (304 if client's copy is current)
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            body = flask.json.dumps(generate()).encode('utf-8')
+            entry = \
+                (hashlib.sha1(body).hexdigest(), body,
+                 gzip.compress(body, mtime=0)
+                 if len(body) >= MIN_COMPRESS_SIZE else None)
+            if len(body) <= self._max_size:
+                with self._lock:
+                    self._entries[key] = entry
+                    while len(self._entries) > self._max_entries:
+                        self._entries.popitem(last=False)
+        etag, body, gzipped = entry
+        resp = flask.make_response()
+        resp.content_type = 'application/json'
+        if (gzipped is not None) and \
+                (_choose_encoding(['gzip', 'identity']) == 'gzip'):
+            resp.data = gzipped
+            resp.content_encoding = 'gzip'
+            etag += '-gzip'
+        else:
+            resp.data = body
+        resp.set_etag(etag)
+        resp.vary.add('Accept-Encoding')
+        return resp.make_conditional(flask.request)
+
+    def clear(self):
+        ''' Drops all cached documents '''
+        with self._lock:
+            self._entries.clear()
+
+
+#: Process-wide JSON document cache
+json_cache = JsonCache()
+
+_static_files_lock = threading.Lock()
+_static_files = {}
+
+
+def serve_file(path, mimetype, source_encoding='identity'):
+    ''' Serves static file with precompressed variants and validators.
+
+    :param path: File path
+    :param mimetype: Content type
+    :param source_encoding: Content encoding of file ('identity' or 'gzip')
+    :return: Streamed response (304 if client's copy is current)
+    '''
+    with _static_files_lock:
+        static_file = _static_files.get(path)
+        if static_file is None:
+            static_file = StaticFile(path, mimetype, source_encoding)
+            _static_files[path] = static_file
+    cache_dir = flask.current_app.config.get('STATIC_ASSET_CACHE_DIR') or \
+        os.path.join(flask.current_app.config['STATE_ROOT_PATH'],
+                     'static_assets')
+    return static_file.response(cache_dir)
@@ -0,0 +1,152 @@
+""" Tests of certification sweep: parsing of FCC/ISED lists from local
+fixture files, sweep flow, ALS reporting and Rcache invalidation.
+
+Applying of the list to RatDB (staging table, upsert, anti-join delete)
+requires PostgreSQL and may be tried on a live database with
+'rat-manage-api cert_id sweep --country US --source <JSON file>'
+
+Run tests:        python -m unittest ratapi.test.test_cert_sweep
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import os
+import unittest
+from unittest import mock
+
+from ..manage import CertIdSweep
+from ..util import rcache_cert_id_invalidate
+from afcmodels.hardcoded_relations import RulesetVsRegion, \
+    CERT_ID_LOCATION_OUTDOOR, CERT_ID_LOCATION_INDOOR
+
+# Directory with fixture files
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+# Fixture FCC list
+FCC_FILE = os.path.join(DATA_DIR, "fcc_authorizations.json")
+# Fixture ISED list
+ISED_FILE = os.path.join(DATA_DIR, "ised_sd6.csv")
+
+BOTH = CERT_ID_LOCATION_INDOOR | CERT_ID_LOCATION_OUTDOOR
+
+
+class TestParse(unittest.TestCase):
+    """ Parsing of certification lists """
+
+    def test_fcc(self) -> None:
+        """ Only standard power devices with FCC ID, BX note means indoor """
+        self.assertEqual(
+            CertIdSweep().load_fcc(FCC_FILE),
+            {"ABCAP1": CERT_ID_LOCATION_OUTDOOR, "ABCAP2": BOTH,
+             "XYZAP1": CERT_ID_LOCATION_OUTDOOR})
+
+    def test_ised(self) -> None:
+        """ Known location codes, unknown ones are retained as None, header
+        and malformed rows skipped """
+        self.assertEqual(
+            CertIdSweep().load_canada(ISED_FILE),
+            {"1234A-AP1": CERT_ID_LOCATION_OUTDOOR, "1234A-AP2": BOTH,
+             "1234A-AP3": None, "5678B-W1": CERT_ID_LOCATION_OUTDOOR})
+
+    def test_ised_duplicates(self) -> None:
+        """ Known location of duplicated certification takes precedence """
+        row = "a,b,c,d,e,f,{code},DUP"
+        self.assertEqual(
+            CertIdSweep.parse_ised(
+                [row.format(code=111), row.format(code=105)]),
+            {"DUP": BOTH})
+
+    def test_empty_list(self) -> None:
+        """ List without known certifications is not applied """
+        with self.assertRaises(RuntimeError):
+            CertIdSweep().apply(None, "CA", {"1234A-AP3": None})
+
+
+class TestSweep(unittest.TestCase):
+    """ Sweep flow with RatDB update and alerts mocked out """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._sweep = CertIdSweep()
+        self._delta = {"added": ["XYZAP1"], "removed": ["OLD"],
+                       "location_changed": ["ABCAP2"]}
+        patchers = [
+            mock.patch.object(self._sweep, "apply",
+                              return_value=self._delta),
+            mock.patch.object(self._sweep, "mailAlert"),
+            mock.patch("als.als_json_log"),
+            mock.patch("ratapi.manage.rcache_cert_id_invalidate")]
+        self._apply, self._mail, self._als, self._invalidate = \
+            [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def test_success(self) -> None:
+        """ Parsed list is applied, delta is reported to ALS """
+        self.assertEqual(self._sweep(None, "US", source=FCC_FILE),
+                         self._delta)
+        self.assertEqual(self._apply.call_args[0][1:],
+                         ("US", CertIdSweep().load_fcc(FCC_FILE)))
+        self._mail.assert_not_called()
+        self.assertEqual(
+            self._als.call_args[0],
+            ("cert_db", {"action": "sweep", "country": "US",
+                         "status": "success", **self._delta}))
+        ruleset_id = RulesetVsRegion.region_to_ruleset("US", exc=KeyError)
+        self.assertEqual(
+            sorted(self._invalidate.call_args[0][0]),
+            [(ruleset_id, "ABCAP2"), (ruleset_id, "OLD")])
+
+    def test_failures(self) -> None:
+        """ Failed download and failed update are reported and raised """
+        with self.assertRaises(FileNotFoundError):
+            self._sweep(None, "CA", source=os.path.join(DATA_DIR, "none"))
+        self.assertEqual(self._als.call_args[0][1]["status"],
+                         "failed download")
+        self._apply.side_effect = RuntimeError("No certifications")
+        with self.assertRaises(RuntimeError):
+            self._sweep(None, "CA", source=ISED_FILE)
+        self.assertEqual(self._als.call_args[0][1]["status"],
+                         "failed update")
+        self.assertEqual(self._mail.call_count, 2)
+        self._invalidate.assert_not_called()
+        with self.assertRaises(RuntimeError):
+            self._sweep(None, "XX")
+
+
+class TestRcacheInvalidation(unittest.TestCase):
+    """ Certification ID invalidation request to Rcache service """
+
+    def _invalidate(self, env):
+        """ Invalidates two certifications with given environment, returns
+        mock of POST request """
+        with mock.patch.dict(os.environ, env), \
+                mock.patch("requests.post") as post:
+            rcache_cert_id_invalidate(
+                [("RS", "CERT_B"), ("RS", "CERT_A"), ("RS", "CERT_B")])
+        return post
+
+    def test_posted(self) -> None:
+        """ Deduplicated certifications are posted to Rcache service """
+        post = self._invalidate({"RCACHE_ENABLED": "True",
+                                 "RCACHE_SERVICE_URL": "http://rcache:8000"})
+        post.assert_called_once()
+        self.assertEqual(post.call_args[0][0],
+                         "http://rcache:8000/cert_id_invalidate")
+        self.assertEqual(
+            post.call_args[1]["json"],
+            {"certifications": [{"ruleset_id": "RS", "cert_id": "CERT_A"},
+                                {"ruleset_id": "RS", "cert_id": "CERT_B"}]})
+
+    def test_disabled(self) -> None:
+        """ Nothing is posted if Rcache is disabled """
+        self._invalidate({"RCACHE_ENABLED": "False",
+                          "RCACHE_SERVICE_URL": "http://rcache:8000"}).\
+            assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
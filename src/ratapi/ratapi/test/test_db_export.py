@@ -0,0 +1,203 @@
+""" Tests of streaming RatDB export/import: round trip through SQLite
+database, idempotency, dry run and table selection
+
+Run tests:        python -m unittest ratapi.test.test_db_export
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import datetime
+import decimal
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import flask
+
+from ..manage import DbExport, DbImport, db_export_tables, \
+    get_or_create, DB_EXPORT_FORMAT, DB_EXPORT_VERSION
+from afcmodels.base import db
+from afcmodels.aaa import User, Role, UserRole, Organization, Ruleset, \
+    AccessPointDeny, CertId, AFCConfig, MTLS, Limit, CacheGeneration
+
+# Number of access point deny list entries in source database
+NUM_APS = 25
+# Batch size used in tests
+BATCH = 10
+
+
+class TestDbExportImport(unittest.TestCase):
+    """ Export from one SQLite database and import to another """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+        self._export_file = os.path.join(self._testdir, "export.jsonl")
+        self._src_app = self._make_app("src")
+        self._dst_app = self._make_app("dst")
+        patcher = mock.patch.object(CacheGeneration, "bump")
+        self._bump = patcher.start()
+        self.addCleanup(patcher.stop)
+        self._populate()
+
+    def tearDown(self) -> None:
+        for app in (self._src_app, self._dst_app):
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+        shutil.rmtree(self._testdir)
+        unittest.TestCase.tearDown(self)
+
+    def _make_app(self, name: str) -> flask.Flask:
+        """ Flask application with empty SQLite RatDB """
+        app = flask.Flask(name)
+        app.config["SQLALCHEMY_DATABASE_URI"] = \
+            "sqlite:///" + os.path.join(self._testdir, f"{name}.sqlite3")
+        app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+        return app
+
+    def _populate(self) -> None:
+        """ Fills source database """
+        with self._src_app.app_context():
+            org = Organization("example.com")
+            ruleset = Ruleset("US_47_CFR_PART_15_SUBPART_E")
+            role = Role(name="Admin")
+            user = User(username="alice", email="alice@example.com",
+                        org="example.com", password="hash", active=True,
+                        email_confirmed_at=datetime.datetime(2023, 1, 2, 3))
+            user.roles.append(role)
+            db.session.add_all([org, ruleset, user])
+            db.session.flush()
+            for i in range(NUM_APS):
+                ap = AccessPointDeny(serial_number=f"SN{i}",
+                                     certification_id=f"CERT{i % 3}")
+                ap.org_id = org.id
+                ap.ruleset_id = ruleset.id
+                db.session.add(ap)
+            cert = CertId("CERT0", location=3, downloaded=True)
+            cert.ruleset_id = ruleset.id
+            db.session.add_all(
+                [cert, AFCConfig({"version": "1.0", "freqBands": []}),
+                 MTLS("-----BEGIN CERTIFICATE-----", "note", "example.com"),
+                 Limit(decimal.Decimal("18.5"), True, False)])
+            db.session.commit()
+
+    def _contents(self, app: flask.Flask):
+        """ Contents of all exportable tables of given database """
+        with app.app_context():
+            return {name: [tuple(row) for row in db.session.execute(
+                        table.select().order_by(*table.primary_key.columns))]
+                    for name, table in db_export_tables().items()}
+
+    def test_round_trip(self) -> None:
+        """ Exported database is imported verbatim, repeated import does not
+        change anything """
+        counts = DbExport()(self._src_app, self._export_file, batch=BATCH)
+        self.assertEqual(counts[AccessPointDeny.__tablename__], NUM_APS)
+        with open(self._export_file, encoding="ascii") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]["format"], DB_EXPORT_FORMAT)
+        self.assertEqual(lines[0]["version"], DB_EXPORT_VERSION)
+        self.assertEqual(
+            [len(line["rows"]) for line in lines[1:]
+             if line["table"] == AccessPointDeny.__tablename__],
+            [BATCH, BATCH, NUM_APS - 2 * BATCH])
+        expected = self._contents(self._src_app)
+        for _ in range(2):
+            self.assertEqual(DbImport()(self._dst_app, self._export_file),
+                             counts)
+            self.assertEqual(self._contents(self._dst_app), expected)
+        self._bump.assert_called()
+
+    def test_import_to_created(self) -> None:
+        """ Import to database, prefilled by db-create with roles and rulesets
+        that have different ids, keeps references by names """
+        with self._src_app.app_context():
+            user = User.query.filter_by(username="alice").one()
+            user.roles.append(Role(name="AP"))
+            db.session.commit()
+        with self._dst_app.app_context():
+            # Same as DbCreate does, in different order
+            for name in ("Super", "Admin", "Analysis", "AP", "Trial"):
+                get_or_create(db.session, Role, name=name)
+            for name in ("CA_RES_DBS-06", "US_47_CFR_PART_15_SUBPART_E"):
+                get_or_create(db.session, Ruleset, name=name)
+        DbExport()(self._src_app, self._export_file, batch=BATCH)
+        # Rulesets are not imported, but used for remapping
+        self.assertEqual(
+            DbImport()(self._dst_app, self._export_file,
+                       tables=[CertId.__tablename__]),
+            {CertId.__tablename__: 1})
+        with self._dst_app.app_context():
+            self.assertEqual(Ruleset.query.count(), 2)
+            self.assertEqual(
+                [cert.ruleset.name for cert in CertId.query.all()],
+                ["US_47_CFR_PART_15_SUBPART_E"])
+        # Organization is neither in destination nor imported
+        with self.assertRaises(RuntimeError):
+            DbImport()(self._dst_app, self._export_file,
+                       tables=[AccessPointDeny.__tablename__])
+        with self._dst_app.app_context():
+            self.assertEqual(AccessPointDeny.query.count(), 0)
+        for _ in range(2):
+            DbImport()(self._dst_app, self._export_file)
+            with self._dst_app.app_context():
+                self.assertEqual(Role.query.count(), 5)
+                self.assertEqual(Ruleset.query.count(), 2)
+                self.assertEqual(
+                    sorted(role.name for role in User.query.filter_by(
+                        username="alice").one().roles),
+                    ["AP", "Admin"])
+                ruleset = Ruleset.query.filter_by(
+                    name="US_47_CFR_PART_15_SUBPART_E").one()
+                org = Organization.query.filter_by(name="example.com").one()
+                self.assertEqual(
+                    [cert.ruleset_id for cert in CertId.query.all()],
+                    [ruleset.id])
+                aps = AccessPointDeny.query.all()
+                self.assertEqual(len(aps), NUM_APS)
+                self.assertTrue(all((ap.ruleset_id == ruleset.id) and
+                                    (ap.org_id == org.id) for ap in aps))
+
+    def test_dry_run(self) -> None:
+        """ Dry run validates file, but does not modify database """
+        counts = DbExport()(self._src_app, self._export_file)
+        self.assertEqual(
+            DbImport()(self._dst_app, self._export_file, dry_run=True),
+            counts)
+        self.assertFalse(any(self._contents(self._dst_app).values()))
+        self._bump.assert_not_called()
+
+    def test_tables(self) -> None:
+        """ Selected tables exported and imported """
+        tables = [Organization.__tablename__, Ruleset.__tablename__,
+                  AccessPointDeny.__tablename__, CertId.__tablename__]
+        DbExport()(self._src_app, self._export_file, tables=tables)
+        self.assertEqual(
+            DbImport()(self._dst_app, self._export_file,
+                       tables=[Organization.__tablename__]),
+            {Organization.__tablename__: 1})
+        contents = self._contents(self._dst_app)
+        self.assertEqual(contents[Organization.__tablename__],
+                         self._contents(self._src_app)[
+                             Organization.__tablename__])
+        self.assertEqual(contents[UserRole.__tablename__], [])
+        with self.assertRaises(RuntimeError):
+            DbImport()(self._dst_app, self._export_file,
+                       tables=[User.__tablename__])
+        with self.assertRaises(RuntimeError):
+            DbExport()(self._src_app, self._export_file, tables=["nothing"])
+
+
+if __name__ == "__main__":
+    unittest.main()
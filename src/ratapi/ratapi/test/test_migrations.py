@@ -0,0 +1,80 @@
+""" Tests of RatDB migrations: SQL, generated by migration scripts for
+PostgreSQL (in Alembic offline mode), and its correspondence to models
+
+Run tests:        python -m unittest ratapi.test.test_migrations
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import importlib.util
+import io
+import os
+import re
+import unittest
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+import sqlalchemy
+
+from afcmodels.aaa import CertId
+
+# Directory with migration scripts
+VERSIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                            "migrations", "versions")
+
+
+def migration_sql(script, upgrade=True):
+    """ SQL statements (with whitespaces normalized), generated by upgrade()
+    or downgrade() of given migration script for PostgreSQL """
+    spec = importlib.util.spec_from_file_location(
+        os.path.splitext(script)[0], os.path.join(VERSIONS_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    buf = io.StringIO()
+    context = MigrationContext.configure(
+        dialect_name="postgresql",
+        opts={"as_sql": True, "output_buffer": buf})
+    with Operations.context(context):
+        (module.upgrade if upgrade else module.downgrade)()
+    return [re.sub(r"\s+", " ", statement).strip()
+            for statement in buf.getvalue().split(";") if statement.strip()]
+
+
+class TestCertIdUnique(unittest.TestCase):
+    """ Certification ID uniqueness within ruleset """
+
+    SCRIPT = "8c3e4a0b7d19_cert_id_unique.py"
+
+    def test_upgrade(self):
+        """ Duplicates within ruleset removed, then constraint added """
+        self.assertEqual(
+            migration_sql(self.SCRIPT),
+            ["DELETE FROM cert_id a USING cert_id b "
+             "WHERE a.ruleset_id = b.ruleset_id "
+             "AND a.certification_id = b.certification_id AND a.id > b.id",
+             "ALTER TABLE cert_id ADD CONSTRAINT "
+             "cert_id_ruleset_id_certification_id_key "
+             "UNIQUE (ruleset_id, certification_id)"])
+
+    def test_downgrade(self):
+        """ Constraint dropped """
+        self.assertEqual(
+            migration_sql(self.SCRIPT, upgrade=False),
+            ["ALTER TABLE cert_id DROP CONSTRAINT "
+             "cert_id_ruleset_id_certification_id_key"])
+
+    def test_model(self):
+        """ Model has the same constraint """
+        unique = [[column.name for column in constraint.columns]
+                  for constraint in CertId.__table__.constraints
+                  if isinstance(constraint, sqlalchemy.UniqueConstraint)]
+        self.assertEqual(unique, [["ruleset_id", "certification_id"]])
+        self.assertFalse(CertId.__table__.c.certification_id.unique)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,329 @@
+""" Tests of RatAfc request preparation: RatDB and Rcache round trips per
+message, arguments of Worker task
+
+Run tests:        python -m unittest ratapi.test.test_ratafc
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import collections
+import datetime
+import json
+import os
+import time
+import unittest
+from unittest import mock
+
+import flask
+
+# Rcache client is not created on ratafc import
+os.environ.setdefault("RCACHE_ENABLED", "False")
+
+from ..views import ratafc  # noqa: E402
+from ..views import ratapi  # noqa: E402
+from afcmodels.hardcoded_relations import RulesetVsRegion, \
+    CERT_ID_LOCATION_INDOOR, CERT_ID_LOCATION_OUTDOOR  # noqa: E402
+
+# Number of requests in test message
+NUM_REQUESTS = 100
+# Certification IDs used in test message
+CERT_IDS = ["CERT_A", "CERT_B", "CERT_C"]
+# Certification ID, unknown to RatDB
+UNKNOWN_CERT_ID = "CERT_UNKNOWN"
+# Serial number, denied for all certification IDs in the first ruleset
+DENIED_SERIAL = "DENIED_SN"
+# Certification ID, that is also in the second ruleset
+SHARED_CERT_ID = CERT_IDS[2]
+# Serial number, denied for shared certification ID in all rulesets
+SHARED_DENIED_SERIAL = "SHARED_DENIED_SN"
+
+
+class CountingRatDbCache(ratafc.RatDbCache):
+    """ RatDB cache with mocked RatDB access, that counts round trips
+
+    Public attributes:
+    round_trips -- Counter of RatDB round trips, indexed by table names
+    generation  -- RatDB cache generation
+    on_load     -- Optional function, called after loading from RatDB
+    """
+    def __init__(self):
+        super().__init__()
+        self.round_trips = collections.Counter()
+        self.generation = 1
+        self.on_load = None
+
+    def _read_generation(self, session):
+        self.round_trips["cache_generation"] += 1
+        return self.generation
+
+    def _load_configs(self, session, regions):
+        self.round_trips["AFCConfig"] += 1
+        self._loaded(session)
+        return {region: self.ConfigInfo(
+                    config={"regionStr": region},
+                    config_str=json.dumps({"regionStr": region}))
+                for region in regions}
+
+    def _load_certs(self, session, cert_ids):
+        self.round_trips["cert_id"] += 1
+        self._loaded(session)
+        ret = {cert_id: {} for cert_id in cert_ids}
+        for cert_id in set(cert_ids) & set(CERT_IDS):
+            ret[cert_id][ratafc.RULESETS[0]] = \
+                self.CertInfo(location=CERT_ID_LOCATION_INDOOR,
+                              refreshed_at=datetime.datetime.now())
+        if SHARED_CERT_ID in cert_ids:
+            ret[SHARED_CERT_ID][ratafc.RULESETS[1]] = \
+                self.CertInfo(location=CERT_ID_LOCATION_OUTDOOR,
+                              refreshed_at=datetime.datetime.now())
+        return ret
+
+    def _load_denials(self, session, cert_ids):
+        self.round_trips["access_point_deny"] += 1
+        self._loaded(session)
+        ret = {cert_id: {ratafc.RULESETS[0]: {DENIED_SERIAL}}
+               for cert_id in cert_ids}
+        if SHARED_CERT_ID in cert_ids:
+            ret[SHARED_CERT_ID][None] = {SHARED_DENIED_SERIAL}
+        return ret
+
+    def _loaded(self, session):
+        """ Calls on_load hook (once) """
+        on_load, self.on_load = self.on_load, None
+        if on_load is not None:
+            on_load(session)
+
+    def bump_generation(self, session=None):
+        """ Increments generation and makes cache notice it (as if it was
+        done by other thread) """
+        self.generation += 1
+        self._check_time = None
+        self._check_generation(session)
+
+
+def make_requests():
+    """ Returns list of single-request messages: mostly valid, but with some
+    invalid, unknown and denied ones """
+    ret = []
+    for idx in range(NUM_REQUESTS):
+        serial = f"SN{idx}"
+        cert_id = CERT_IDS[idx % len(CERT_IDS)]
+        if idx == 10:
+            serial = DENIED_SERIAL
+        elif idx == 20:
+            cert_id = UNKNOWN_CERT_ID
+        request = \
+            {"requestId": str(idx),
+             "deviceDescriptor": {
+                 "serialNumber": serial,
+                 "certificationId": [{"rulesetId": ratafc.RULESETS[0],
+                                      "id": cert_id}]},
+             "location": {"ellipse": {"center": {"latitude": 40 + idx / 100,
+                                                 "longitude": -100}}}}
+        if idx == 30:
+            del request["deviceDescriptor"]["serialNumber"]
+        ret.append({"availableSpectrumInquiryRequests": [request],
+                    "version": ratafc.ALLOWED_VERSIONS[-1]})
+    return ret
+
+
+class TestRequestPreparation(unittest.TestCase):
+    """ Round trips made while preparing multi-request message """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self._app = flask.Flask(__name__)
+        self._app.config["AFC_MSGHND_CACHE_CHECK_INTERVAL"] = 1000
+        self._cache = CountingRatDbCache()
+        self._rcache = mock.Mock()
+        self._rcache.lookup_responses.return_value = {}
+        self._patchers = \
+            [mock.patch.object(ratafc, "rat_db_cache", self._cache),
+             mock.patch.object(ratafc, "rcache", self._rcache),
+             mock.patch.object(ratafc, "db")]
+        for patcher in self._patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+        unittest.TestCase.tearDown(self)
+
+    def _process_message(self):
+        """ Prepares test message and looks it up in Rcache. Returns
+        (req_infos, error_responses) """
+        with self._app.app_context():
+            req_infos, error_responses = \
+                ratafc.RatAfc()._prepare_requests(
+                    requests=make_requests(),
+                    ver=ratafc.ALLOWED_VERSIONS[-1], message_runtime_opts=0,
+                    use_tasks=False, start_time=time.time())
+            ratafc.RatAfc()._cache_lookup(dataif=None, req_infos=req_infos)
+        return (req_infos, error_responses)
+
+    def test_round_trips(self):
+        """ One query per table for cold cache, none for warm one, one
+        Rcache lookup per message """
+        req_infos, error_responses = self._process_message()
+        self.assertEqual(
+            self._cache.round_trips,
+            {"cache_generation": 1, "AFCConfig": 1, "cert_id": 1,
+             "access_point_deny": 1})
+        self.assertEqual(self._rcache.lookup_responses.call_count, 1)
+        self.assertEqual(
+            sorted(self._rcache.lookup_responses.call_args[0][0]),
+            sorted(req_infos.keys()))
+
+        self._process_message()
+        self.assertEqual(sum(self._cache.round_trips.values()), 4)
+        self.assertEqual(self._rcache.lookup_responses.call_count, 2)
+
+    def test_results(self):
+        """ Valid requests prepared, invalid ones reported in order """
+        req_infos, error_responses = self._process_message()
+        self.assertEqual(len(req_infos), NUM_REQUESTS - 3)
+        self.assertEqual(
+            sorted(int(ri.request_id) for ri in req_infos.values()),
+            [idx for idx in range(NUM_REQUESTS) if idx not in (10, 20, 30)])
+        self.assertEqual([r["requestId"] for r in error_responses],
+                         ["10", "20", "30"])
+        self.assertEqual(
+            [r["response"]["responseCode"] for r in error_responses],
+            [ratafc.DeviceUnallowedException("").response_code] * 2 +
+            [ratafc.MissingParamException().response_code])
+        region = RulesetVsRegion.ruleset_to_region(ratafc.RULESETS[0],
+                                                   exc=KeyError)
+        for req_info in req_infos.values():
+            self.assertEqual(req_info.region, region)
+            self.assertTrue(req_info.runtime_opts & ratafc.RNTM_OPT_CERT_ID)
+
+
+class TestRatDbCache(unittest.TestCase):
+    """ RatDB cache lookups concurrent with generation change """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self._app = flask.Flask(__name__)
+        self._app.config["AFC_MSGHND_CACHE_CHECK_INTERVAL"] = 1000
+        self._cache = CountingRatDbCache()
+        patcher = mock.patch.object(ratafc, "db")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_change_during_load(self):
+        """ Generation changed while data being loaded """
+        with self._app.app_context():
+            self._cache.on_load = self._cache.bump_generation
+            self.assertEqual(self._cache.get_config("US").config,
+                             {"regionStr": "US"})
+            self._cache.on_load = self._cache.bump_generation
+            self.assertEqual(
+                self._cache.get_cert(CERT_IDS[0],
+                                     ratafc.RULESETS[0]).location,
+                CERT_ID_LOCATION_INDOOR)
+            self._cache.on_load = self._cache.bump_generation
+            self.assertTrue(self._cache.is_denied(
+                CERT_IDS[1], ratafc.RULESETS[0], DENIED_SERIAL))
+
+    def test_change_after_prefetch(self):
+        """ Generation changed between prefetch and lookups """
+        with self._app.app_context():
+            snapshot = self._cache.prefetch(regions=["US"],
+                                            cert_ids=CERT_IDS)
+            self.assertIn("US", snapshot.configs)
+            self.assertEqual(set(snapshot.certs), set(CERT_IDS))
+            self._cache.bump_generation()
+            self.assertIsNone(self._cache.get_cert(UNKNOWN_CERT_ID,
+                                                   ratafc.RULESETS[0]))
+            self.assertFalse(self._cache.is_denied(
+                CERT_IDS[0], ratafc.RULESETS[0], "SN"))
+            self.assertEqual(self._cache.get_config("US").config,
+                             {"regionStr": "US"})
+            self.assertEqual(self._cache.round_trips["AFCConfig"], 2)
+
+    def test_rulesets(self):
+        """ Certification ID in several rulesets, denials by ruleset """
+        with self._app.app_context():
+            self.assertEqual(
+                self._cache.get_cert(SHARED_CERT_ID,
+                                     ratafc.RULESETS[1]).location,
+                CERT_ID_LOCATION_OUTDOOR)
+            self.assertEqual(
+                self._cache.get_cert(SHARED_CERT_ID,
+                                     ratafc.RULESETS[0]).location,
+                CERT_ID_LOCATION_INDOOR)
+            self.assertIsNone(self._cache.get_cert(CERT_IDS[0],
+                                                   ratafc.RULESETS[1]))
+            self.assertEqual(self._cache.get_cert_rulesets(CERT_IDS[0]),
+                             {ratafc.RULESETS[0]})
+            self.assertEqual(self._cache.get_cert_rulesets(UNKNOWN_CERT_ID),
+                             set())
+            self.assertTrue(self._cache.is_denied(
+                SHARED_CERT_ID, ratafc.RULESETS[0], DENIED_SERIAL))
+            self.assertFalse(self._cache.is_denied(
+                SHARED_CERT_ID, ratafc.RULESETS[1], DENIED_SERIAL))
+            for ruleset in ratafc.RULESETS[:2]:
+                self.assertTrue(self._cache.is_denied(
+                    SHARED_CERT_ID, ruleset, SHARED_DENIED_SERIAL))
+            self.assertEqual(self._cache.round_trips["cert_id"], 3)
+
+    def test_auth(self):
+        """ AP authenticated with certification ID of its ruleset """
+        with self._app.app_context(), \
+                mock.patch.object(ratafc, "rat_db_cache", self._cache):
+            rat_afc = ratafc.RatAfc()
+            self.assertTrue(rat_afc._auth_ap(
+                "SN", ratafc.RULESETS[0], SHARED_CERT_ID, None, None))
+            self.assertFalse(rat_afc._auth_ap(
+                "SN", ratafc.RULESETS[1], SHARED_CERT_ID, None, None))
+            with self.assertRaises(ratafc.InvalidValueException):
+                rat_afc._auth_ap("SN", ratafc.RULESETS[1], CERT_IDS[0],
+                                 None, None)
+            with self.assertRaises(ratafc.DeviceUnallowedException):
+                rat_afc._auth_ap("SN", ratafc.RULESETS[0], UNKNOWN_CERT_ID,
+                                 None, None)
+            with self.assertRaises(ratafc.DeviceUnallowedException):
+                rat_afc._auth_ap(SHARED_DENIED_SERIAL, ratafc.RULESETS[1],
+                                 SHARED_CERT_ID, None, None)
+
+
+class TestBuildTask(unittest.TestCase):
+    """ Worker task arguments """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self._app = flask.Flask(__name__)
+        self._app.config["NFS_MOUNT_PATH"] = "/mnt/nfs"
+        self._dataif = mock.Mock()
+        self._dataif.getProtocol.return_value = ("http", "objst", 5000)
+        patcher = mock.patch.object(ratapi, "run")
+        self._run = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _build_task(self, **kwargs):
+        """ Builds task, returns its arguments """
+        with self._app.app_context():
+            ratapi.build_task(
+                dataif=self._dataif, request_type="AP-AFC", task_id="task",
+                hash_val="digest", config_path=None, history_dir=None,
+                rcache_queue="queue", request_str="{}",
+                original_request_str="{}", config_str="{}", **kwargs)
+        self._run.apply_async.assert_called_once()
+        return self._run.apply_async.call_args.kwargs["kwargs"]
+
+    def test_stage_timing(self):
+        """ Stage timing is passed to Worker only if set """
+        kwargs = self._build_task()
+        self.assertEqual(kwargs["hash_val"], "digest")
+        self.assertNotIn("stage_timing", kwargs)
+        self._run.reset_mock()
+        kwargs = self._build_task(stage_timing='{"last": 0, "stages": []}')
+        self.assertEqual(kwargs["stage_timing"], '{"last": 0, "stages": []}')
+
+
+if __name__ == '__main__':
+    unittest.main()
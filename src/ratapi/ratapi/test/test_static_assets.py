@@ -0,0 +1,227 @@
+""" Tests of static asset layer: precompressed variants, validators,
+JSON document cache
+
+Run tests:        python -m unittest ratapi.test.test_static_assets
+"""
+#
+# Copyright (C) 2023 Broadcom. All rights reserved. The term "Broadcom"
+# refers solely to the Broadcom Inc. corporate affiliate that owns
+# the software below. This work is licensed under the OpenAFC Project License,
+# a copy of which is included with this software program
+#
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import flask
+
+from .. import static_assets
+
+# Test document, big enough to be compressed
+DOCUMENT = {"bounds": [{"idx": idx, "lat": 40. + idx / 1000,
+                        "lon": -100. - idx / 1000} for idx in range(200)]}
+
+
+class TestStaticAssets(unittest.TestCase):
+    """ Static asset layer """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+        self._cache_dir = os.path.join(self._testdir, "cache")
+        self._generated = 0
+        self._app = flask.Flask(__name__)
+        self._app.config["STATE_ROOT_PATH"] = self._testdir
+        self._app.config["STATIC_ASSET_CACHE_DIR"] = self._cache_dir
+
+        @self._app.route("/file/<name>")
+        def get_file(name):
+            return static_assets.serve_file(
+                os.path.join(self._testdir, name), "application/json",
+                source_encoding="gzip" if name.endswith(".gz")
+                else "identity")
+
+        @self._app.route("/doc/<int:generation>")
+        def get_doc(generation):
+            def generate():
+                self._generated += 1
+                return dict(DOCUMENT, generation=generation)
+            return static_assets.json_cache.response(("doc", generation),
+                                                     generate)
+
+        static_assets.json_cache.clear()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._testdir, ignore_errors=True)
+        unittest.TestCase.tearDown(self)
+
+    def _write(self, name: str, content: bytes,
+               mtime_offset: int = 0) -> None:
+        """ Writes test file with given content """
+        path = os.path.join(self._testdir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        if mtime_offset:
+            mtime = time.time() + mtime_offset
+            os.utime(path, (mtime, mtime))
+
+    def _get(self, url: str, **headers: str) -> flask.Response:
+        """ Makes GET request, returns response with content read """
+        with self._app.test_request_context(url, headers=headers):
+            resp = self._app.full_dispatch_request()
+            # What is sent over the wire (e.g. no body for 304)
+            content = b"".join(resp.get_app_iter(flask.request.environ))
+            resp.close()
+            resp.direct_passthrough = False
+            resp.set_data(content)
+            return resp
+
+    def test_gzip_source(self) -> None:
+        """ Precompressed source served as-is or decompressed """
+        content = json.dumps(DOCUMENT).encode("utf-8")
+        self._write("bounds.json.gz", gzip.compress(content))
+        resp = self._get("/file/bounds.json.gz",
+                         **{"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertEqual(gzip.decompress(resp.get_data()), content)
+        self.assertIn("Accept-Encoding", resp.vary)
+        self.assertIsNotNone(resp.get_etag()[0])
+        self.assertIsNotNone(resp.last_modified)
+
+        resp = self._get("/file/bounds.json.gz",
+                         **{"Accept-Encoding": "identity"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(resp.get_data(), content)
+        self.assertEqual(resp.content_length, len(content))
+
+    def test_compressed_variants(self) -> None:
+        """ Plain source served compressed if client accepts it """
+        content = json.dumps(DOCUMENT).encode("utf-8")
+        self._write("bounds.json", content)
+        resp = self._get("/file/bounds.json",
+                         **{"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertLess(len(resp.get_data()), len(content))
+        self.assertEqual(gzip.decompress(resp.get_data()), content)
+        if static_assets.brotli is not None:
+            resp = self._get("/file/bounds.json",
+                             **{"Accept-Encoding": "gzip, br"})
+            self.assertEqual(resp.content_encoding, "br")
+            self.assertEqual(
+                static_assets.brotli.decompress(resp.get_data()), content)
+
+        # Small files are not compressed
+        self._write("small.json", b"{}")
+        resp = self._get("/file/small.json", **{"Accept-Encoding": "gzip"})
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(resp.get_data(), b"{}")
+
+    def test_conditional(self) -> None:
+        """ Unchanged file revalidated with 304, changed one is served """
+        self._write("bounds.json", json.dumps(DOCUMENT).encode("utf-8"),
+                    mtime_offset=-100)
+        headers = {"Accept-Encoding": "gzip"}
+        resp = self._get("/file/bounds.json", **headers)
+        etag = resp.get_etag()[0]
+        resp = self._get("/file/bounds.json", **headers,
+                         **{"If-None-Match": f'"{etag}"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b"")
+        resp = self._get(
+            "/file/bounds.json", **headers,
+            **{"If-Modified-Since": resp.headers["Last-Modified"]})
+        self.assertEqual(resp.status_code, 304)
+        # Variant for other encoding has different ETag
+        resp = self._get("/file/bounds.json",
+                         **{"If-None-Match": f'"{etag}"'})
+        self.assertEqual(resp.status_code, 200)
+
+        variants = set(os.listdir(self._cache_dir))
+        self.assertTrue(variants)
+        new_content = json.dumps(dict(DOCUMENT, changed=True)).\
+            encode("utf-8")
+        self._write("bounds.json", new_content)
+        resp = self._get("/file/bounds.json", **headers,
+                         **{"If-None-Match": f'"{etag}"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.get_etag()[0], etag)
+        self.assertEqual(gzip.decompress(resp.get_data()), new_content)
+        # Variants of previous version removed
+        self.assertFalse(variants & set(os.listdir(self._cache_dir)))
+
+    def test_shared_variants(self) -> None:
+        """ Variants built by other worker are reused """
+        self._write("bounds.json", json.dumps(DOCUMENT).encode("utf-8"))
+        self._get("/file/bounds.json", **{"Accept-Encoding": "gzip"})
+        names = os.listdir(self._cache_dir)
+        self.assertTrue(names)
+        stamps = {name: os.stat(os.path.join(self._cache_dir, name)).
+                  st_mtime_ns for name in names}
+        static_assets._static_files.clear()
+        self._get("/file/bounds.json", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(
+            {name: os.stat(os.path.join(self._cache_dir, name)).st_mtime_ns
+             for name in os.listdir(self._cache_dir)}, stamps)
+
+    def test_unwritable_cache_dir(self) -> None:
+        """ Source is served if variants can't be built """
+        content = json.dumps(DOCUMENT).encode("utf-8")
+        self._write("bounds.json.gz", gzip.compress(content))
+        # Cache directory can't be created over file
+        self._write("cache", b"")
+        resp = self._get("/file/bounds.json.gz",
+                         **{"Accept-Encoding": "identity"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertEqual(gzip.decompress(resp.get_data()), content)
+
+    def test_missing_file(self) -> None:
+        """ Missing file """
+        self.assertEqual(self._get("/file/missing.json").status_code, 404)
+
+    def test_json_cache(self) -> None:
+        """ Generated JSON documents are cached """
+        resp = self._get("/doc/1", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertEqual(json.loads(gzip.decompress(resp.get_data())),
+                         dict(DOCUMENT, generation=1))
+        etag = resp.get_etag()[0]
+        resp = self._get("/doc/1", **{"Accept-Encoding": "gzip",
+                                      "If-None-Match": f'"{etag}"'})
+        self.assertEqual(resp.status_code, 304)
+        resp = self._get("/doc/1")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(json.loads(resp.get_data()),
+                         dict(DOCUMENT, generation=1))
+        self.assertEqual(self._generated, 1)
+        # New key - new document
+        resp = self._get("/doc/2")
+        self.assertEqual(json.loads(resp.get_data())["generation"], 2)
+        self.assertEqual(self._generated, 2)
+
+    def test_json_cache_lru(self) -> None:
+        """ Least recently used documents are evicted """
+        cache = static_assets.JsonCache(max_entries=2)
+        generated = []
+
+        def generate(key):
+            generated.append(key)
+            return {"key": key}
+
+        with self._app.test_request_context("/"):
+            for key in [1, 2, 1, 3, 1, 2]:
+                cache.response(key, lambda: generate(key))
+        self.assertEqual(generated, [1, 2, 3, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,6 +14,8 @@ from werkzeug.http import HTTP_STATUS_CODES
 from werkzeug._internal import _get_environ
 
 import als
+from rcache_client import RcacheClient
+from rcache_models import RcacheClientSettings
 
 #: LOGGER for this module
 LOGGER = logging.getLogger(__name__)
@@ -232,3 +234,29 @@ def als_log_afc_config_change(old_config, new_config, region, user, source):
         if v:
             als_record[k] = v
     als.als_json_log('afc_config', als_record)
+
+
+def rcache_cert_id_invalidate(certifications):
+    ''' Invalidates Rcache entries of APs with given certifications.
+
+    Does nothing if Rcache or its service is not configured. Errors are
+    logged, not raised - RatDB change is already committed by now.
+
+    :param certifications: iterable of (ruleset ID, certification ID) pairs
+        of changed, removed or denied certifications
+    '''
+    certifications = sorted(set(certifications))
+    if (not certifications) or \
+            (os.environ.get('RCACHE_ENABLED', '').lower() in
+             ('0', 'no', 'false', '-')):
+        return
+    try:
+        settings = RcacheClientSettings(postgres_dsn=None, rmq_dsn=None)
+        if not (settings.enabled and settings.service_url):
+            return
+        RcacheClient(settings).rcache_cert_id_invalidate(certifications)
+        LOGGER.info(f'Rcache invalidation requested for '
+                    f'{len(certifications)} certification(s)')
+    except Exception as ex:
+        LOGGER.warning(f'Rcache invalidation for {len(certifications)} '
+                       f'certification(s) failed: {ex}')
@@ -26,6 +26,7 @@ import werkzeug
 import afcmodels.aaa as aaa
 from afcmodels.hardcoded_relations import RulesetVsRegion
 from .auth import auth
+from ..util import rcache_cert_id_invalidate
 from afcmodels.base import db
 import db_creator
 import db_utils
@@ -278,7 +279,9 @@ class AccessPointDeny(MethodView):
         organization.aps.append(ap)
         ruleset.aps.append(ap)
         db.session.add(ap)  # pylint: disable=no-member
+        aaa.CacheGeneration.bump()
         db.session.commit()  # pylint: disable=no-member
+        rcache_cert_id_invalidate([(rulesetId, cert_id)])
 
         return flask.jsonify(id=ap.id)
 
@@ -305,13 +308,17 @@ class AccessPointDeny(MethodView):
         roles = [r.name for r in user.roles]
         if "Super" in roles:
             # delete, replace whole list
-            aaa.AccessPointDeny.query.delete()
+            old_aps = aaa.AccessPointDeny.query
         else:
             # delete, replace list belonging to the admin's org
             organization = aaa.Organization.query.filter_by(
                 name=user_org).first()
-            aaa.AccessPointDeny.query.filter_by(
-                org_id=organization.id).delete()
+            old_aps = aaa.AccessPointDeny.query.filter_by(
+                org_id=organization.id)
+        # Certifications of removed and added entries - to invalidate Rcache
+        certifications = {(ap.ruleset.name, ap.certification_id)
+                          for ap in old_aps if ap.ruleset}
+        old_aps.delete()
 
         payload = content.get("accessPoints")
         rcrd = json.loads(payload)
@@ -371,10 +378,13 @@ class AccessPointDeny(MethodView):
                 organization.aps.append(ap)
                 ruleset.aps.append(ap)
                 db.session.add(ap)  # pylint: disable=no-member
+                certifications.add((ruleset_id, cert_id))
             else:
                 raise exceptions.BadRequest("duplicate entry")
 
+        aaa.CacheGeneration.bump()
         db.session.commit()  # pylint: disable=no-member
+        rcache_cert_id_invalidate(certifications)
         return "Success", 200
 
     def delete(self, id):
@@ -387,8 +397,11 @@ class AccessPointDeny(MethodView):
 
         # check user roles
         auth(roles=["Admin"], org=ap.org.name)
+        certifications = [(ap.ruleset.name, ap.certification_id)]
         db.session.delete(ap)  # pylint: disable=no-member
+        aaa.CacheGeneration.bump()
         db.session.commit()  # pylint: disable=no-member
+        rcache_cert_id_invalidate(certifications)
         return flask.make_response()
 
 
@@ -11,6 +11,7 @@
 '''
 
 import gzip
+import collections
 import contextlib
 import logging
 import os
@@ -40,7 +41,7 @@ from defs import RNTM_OPT_NODBG_NOGUI, RNTM_OPT_DBG, RNTM_OPT_GUI, \
 from afc_worker import run
 from ..util import AFCEngineException, require_default_uls, getQueueDirectory
 from afcmodels.aaa import User, AFCConfig, CertId, Ruleset, \
-    Organization, AccessPointDeny
+    Organization, AccessPointDeny, CacheGeneration
 from afcmodels.hardcoded_relations import RulesetVsRegion, \
     SpecialCertifications, VendorExtensionFilter, CERT_ID_LOCATION_UNKNOWN, \
     CERT_ID_LOCATION_OUTDOOR, CERT_ID_LOCATION_INDOOR
@@ -62,6 +63,7 @@ from rcache_db import RcacheLookupResult
 import prometheus_client
 import prometheus_utils
 import afc_traffic_metrics
+import sqlalchemy.exc
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(AFC_RATAPI_LOG_LEVEL)
@@ -423,23 +425,280 @@ class ReqInfo(NamedTuple):
     # Task ID. Objstore directory name for AFC Engine artifacts
     task_id: str
 
+    # Timeline of request processing stages
+    stage_timer: afc_traffic_metrics.StageTimer
+
+
+class ValidatedReq(NamedTuple):
+    """ Individual AFC Request that passed validation """
+    # 0-based request index within message
+    req_idx: int
+
+    # AFC Request message, containing this request only
+    request: Dict[str, Any]
+
+    # Ruleset ID
+    prefix: str
+
+    # Region identifier
+    region: str
+
+    # Certification ID
+    cert_id: str
+
+    # Serial number
+    serial: str
+
+    # Timeline of request processing stages
+    stage_timer: afc_traffic_metrics.StageTimer
+
+
+class RatDbCache:
+    """ Process-local cache of RatDB data used for AFC Request validation:
+    AFC Configs, certification IDs and denied APs.
+
+    Cached data is dropped when RatDB cache generation (incremented on every
+    modification of these tables) changes. Generation is checked not more
+    often than once per AFC_MSGHND_CACHE_CHECK_INTERVAL seconds, so in steady
+    state no RatDB round trips are made. Data for all requests of a message
+    may be fetched at once with prefetch() - with one query per table.
+    Generation change (possibly made by another thread) replaces cache
+    dictionaries with empty ones, so lookups use dictionaries, returned by
+    prefetch(), rather than current ones
+
+    Private attributes:
+    _generation -- Generation of cached data. None if not known
+    _check_time -- time.monotonic() of last generation check. None if there
+                   was no checks
+    _configs    -- Dictionary of ConfigInfo objects (None for regions without
+                   AFC Config), indexed by region
+    _certs      -- Dictionary of dictionaries of CertInfo objects, indexed
+                   by ruleset names (empty for unknown certification IDs),
+                   indexed by certification IDs (the same certification ID
+                   may be in several rulesets)
+    _denials    -- Dictionary of dictionaries of sets of denied serial numbers
+                   (None in set means that all serial numbers are denied),
+                   indexed by ruleset names (None for denials in all
+                   rulesets), indexed by certification IDs
+    """
+    class ConfigInfo(NamedTuple):
+        """ AFC Config information """
+        # AFC Config dictionary (region overwrite applied)
+        config: Dict[str, Any]
+
+        # Canonical AFC Config string (json.dumps() with sorted keys)
+        config_str: str
+
+    class Snapshot(NamedTuple):
+        """ Cache dictionaries at the moment of prefetch() """
+        # Dictionary of ConfigInfo objects, indexed by region
+        configs: Dict[str, Any]
+
+        # Dictionary of dictionaries of CertInfo objects, indexed by ruleset
+        # names, indexed by certification IDs
+        certs: Dict[str, Dict[str, Any]]
+
+        # Dictionary of dictionaries of sets of denied serial numbers,
+        # indexed by ruleset names, indexed by certification IDs
+        denials: Dict[str, Dict[Optional[str], Any]]
+
+    class CertInfo(NamedTuple):
+        """ Certification ID information (in some ruleset) """
+        # CERT_ID_LOCATION_... flags
+        location: int
+
+        # Last refresh time
+        refreshed_at: Optional[datetime.datetime]
+
+    def __init__(self):
+        """ Constructor """
+        self._generation = None
+        self._check_time = None
+        self._configs = {}
+        self._certs = {}
+        self._denials = {}
+
+    def prefetch(self, regions, cert_ids):
+        """ Fetches data for given regions and certification IDs that is not
+        yet in cache - with at most one query per table
+
+        Arguments:
+        regions  -- Iterable of regions to fetch AFC Configs for
+        cert_ids -- Iterable of certification IDs to fetch certification
+                    information and denied APs for
+        Returns Snapshot object that contains data for given regions and
+        certification IDs
+        """
+        with db.session() as session:
+            self._check_generation(session)
+            ret = self.Snapshot(configs=self._configs, certs=self._certs,
+                                denials=self._denials)
+            for cache, keys, loader in \
+                    [(ret.configs, regions, self._load_configs),
+                     (ret.certs, cert_ids, self._load_certs),
+                     (ret.denials, cert_ids, self._load_denials)]:
+                missing = set(key for key in keys if key not in cache)
+                if missing:
+                    cache.update(loader(session, missing))
+        return ret
+
+    def get_config(self, region):
+        """ Returns ConfigInfo for given region, None if there is no AFC
+        Config for it """
+        configs = self._configs
+        if region not in configs:
+            configs = self.prefetch(regions=[region], cert_ids=[]).configs
+        return configs[region]
+
+    def get_cert(self, cert_id, ruleset):
+        """ Returns CertInfo for given certification ID in given ruleset,
+        None if it is not known there """
+        return self._get_cert_rulesets(cert_id).get(ruleset)
+
+    def get_cert_rulesets(self, cert_id):
+        """ Returns set of names of rulesets, that have given certification
+        ID """
+        return set(self._get_cert_rulesets(cert_id))
+
+    def is_denied(self, cert_id, ruleset, serial):
+        """ True if AP with given certification ID and serial number is
+        denied in given ruleset """
+        denials = self._denials
+        if cert_id not in denials:
+            denials = self.prefetch(regions=[], cert_ids=[cert_id]).denials
+        for r in (ruleset, None):
+            denied_serials = denials[cert_id].get(r, ())
+            if (None in denied_serials) or (serial in denied_serials):
+                return True
+        return False
+
+    def _get_cert_rulesets(self, cert_id):
+        """ Returns dictionary of CertInfo objects for given certification
+        ID, indexed by ruleset names """
+        certs = self._certs
+        if cert_id not in certs:
+            certs = self.prefetch(regions=[], cert_ids=[cert_id]).certs
+        return certs[cert_id]
+
+    def _read_generation(self, session):
+        """ Reads current RatDB cache generation """
+        return CacheGeneration.get(session)
+
+    def _check_generation(self, session):
+        """ Drops cached data if RatDB cache generation changed (or can't be
+        retrieved) since last check. Does nothing if last check was recent
+        """
+        now = time.monotonic()
+        if (self._check_time is not None) and \
+                ((now - self._check_time) <
+                 flask.current_app.config["AFC_MSGHND_CACHE_CHECK_INTERVAL"]):
+            return
+        try:
+            generation = self._read_generation(session)
+        except sqlalchemy.exc.SQLAlchemyError as ex:
+            LOGGER.warning(f"RatDB cache generation retrieval failed: {ex}")
+            session.rollback()
+            generation = None
+        self._check_time = now
+        if (generation is None) or (generation != self._generation):
+            # New dictionaries instead of clearing old ones - not to be
+            # polluted by loads that are in progress in other threads
+            self._configs = {}
+            self._certs = {}
+            self._denials = {}
+            self._generation = generation
+
+    def _load_configs(self, session, regions):
+        """ Retrieves AFC Configs from RatDB
+
+        Arguments:
+        session -- RatDB session
+        regions -- Set of regions
+        Returns dictionary of ConfigInfo objects (None for regions without
+        AFC Config), indexed by regions
+        """
+        ret = dict.fromkeys(regions)
+        for config in session.query(AFCConfig).filter(
+                AFCConfig.config['regionStr'].astext.in_(regions)).\
+                order_by(AFCConfig.id):
+            region = config.config['regionStr']
+            if ret.get(region) is not None:
+                continue
+            afc_config = dict(config.config)
+            try:
+                overwrite_region = \
+                    RulesetVsRegion.overwrite_region(region, exc=KeyError)
+                if overwrite_region:
+                    afc_config['regionStr'] = overwrite_region
+            except KeyError:
+                pass
+            ret[region] = \
+                self.ConfigInfo(
+                    config=afc_config,
+                    config_str=json.dumps(afc_config, sort_keys=True))
+        return ret
+
+    def _load_certs(self, session, cert_ids):
+        """ Retrieves certification information from RatDB
+
+        Arguments:
+        session  -- RatDB session
+        cert_ids -- Set of certification IDs
+        Returns dictionary of dictionaries of CertInfo objects, indexed by
+        ruleset names (empty for unknown certification IDs), indexed by
+        certification IDs
+        """
+        ret = {cert_id: {} for cert_id in cert_ids}
+        for cert_id, ruleset, location, refreshed_at in \
+                session.query(CertId.certification_id, Ruleset.name,
+                              CertId.location, CertId.refreshed_at).\
+                join(Ruleset, CertId.ruleset_id == Ruleset.id).\
+                filter(CertId.certification_id.in_(cert_ids)):
+            ret[cert_id][ruleset] = \
+                self.CertInfo(location=location, refreshed_at=refreshed_at)
+        return ret
+
+    def _load_denials(self, session, cert_ids):
+        """ Retrieves denied APs from RatDB
+
+        Arguments:
+        session  -- RatDB session
+        cert_ids -- Set of certification IDs
+        Returns dictionary of dictionaries of sets of denied serial numbers
+        (None in set means all serial numbers), indexed by ruleset names
+        (None for denials without ruleset), indexed by certification IDs
+        """
+        ret = {cert_id: {} for cert_id in cert_ids}
+        for cert_id, ruleset, serial_number in \
+                session.query(AccessPointDeny.certification_id, Ruleset.name,
+                              AccessPointDeny.serial_number).\
+                outerjoin(Ruleset,
+                          AccessPointDeny.ruleset_id == Ruleset.id).\
+                filter(AccessPointDeny.certification_id.in_(cert_ids)):
+            ret[cert_id].setdefault(ruleset, set()).add(serial_number)
+        return ret
+
+
+# Process-wide RatDB cache
+rat_db_cache = RatDbCache()
+
 
 class RatAfc(MethodView):
     ''' RAT AFC resources
     '''
 
-    def _auth_cert_id(self, cert_id, ruleset, session):
+    def _auth_cert_id(self, cert_id, ruleset):
         ''' Authenticate certification id. Return new indoor value
             for bell application
         '''
         LOGGER.debug("(%d) %s::%s()", threading.get_native_id(),
                      self.__class__, inspect.stack()[0][3])
         indoor_certified = True
-        certId = session.query(CertId).filter_by(certification_id=cert_id).first()
+        certId = rat_db_cache.get_cert(cert_id, ruleset)
         if not certId:
+            if rat_db_cache.get_cert_rulesets(cert_id):
+                raise InvalidValueException(["ruleset", ruleset])
             raise DeviceUnallowedException("")
-        if not certId.ruleset.name == ruleset:
-            raise InvalidValueException(["ruleset", ruleset])
         # add check for certId.valid
 
         now = datetime.datetime.now()
@@ -448,7 +707,7 @@ class RatAfc(MethodView):
             LOGGER.debug("(%d) %s::%s() stale CertId %s",
                          threading.get_native_id(),
                          self.__class__, inspect.stack()[0][3],
-                         certId.certification_id)
+                         cert_id)
 
         if certId.location & CERT_ID_LOCATION_INDOOR:
             indoor_certified = True
@@ -466,30 +725,23 @@ class RatAfc(MethodView):
                      threading.get_native_id(),
                      self.__class__, inspect.stack()[0][3],
                      serial_number, prefix, cert_id, rulesets, version)
-        with db.session() as session:
-            deny_ap = session.query(AccessPointDeny).filter_by(
-                serial_number=serial_number). filter_by(
-                certification_id=cert_id).first()
-            if deny_ap:
-                raise DeviceUnallowedException("")  # InvalidCredentialsException()
-
-            deny_ap = session.query(AccessPointDeny).filter_by(certification_id=cert_id).\
-                filter_by(serial_number=None).first()
-            if deny_ap:
-                # denied all devices matching certification id
-                raise DeviceUnallowedException("")  # InvalidCredentialsException()
-
-            ruleset = prefix
-
-            scp = \
-                SpecialCertifications.get_properties(
-                    cert_id=cert_id, serial_number=serial_number)
-            if scp is not None:
-                return (scp.location_flags & CERT_ID_LOCATION_INDOOR) != 0
-
-            # Assume that once we got here, we already trim the cert_obj list
-            # down to only one entry for the country we're operating in
-            return self._auth_cert_id(cert_id, ruleset, session)
+        ruleset = prefix
+
+        if rat_db_cache.is_denied(cert_id=cert_id, ruleset=ruleset,
+                                  serial=serial_number):
+            # Either this device or all devices matching certification id
+            # denied
+            raise DeviceUnallowedException("")  # InvalidCredentialsException()
+
+        scp = \
+            SpecialCertifications.get_properties(
+                cert_id=cert_id, serial_number=serial_number)
+        if scp is not None:
+            return (scp.location_flags & CERT_ID_LOCATION_INDOOR) != 0
+
+        # Assume that once we got here, we already trim the cert_obj list
+        # down to only one entry for the country we're operating in
+        return self._auth_cert_id(cert_id, ruleset)
 
     def get(self):
         ''' GET method for Analysis Status '''
@@ -549,11 +801,9 @@ class RatAfc(MethodView):
             results["version"] = ver
 
             # split multiple requests into an array of individual requests
-            requests = map(
-                lambda r: {
-                    "availableSpectrumInquiryRequests": [r],
-                    "version": ver},
-                args["availableSpectrumInquiryRequests"])
+            requests = [{"availableSpectrumInquiryRequests": [r],
+                         "version": ver}
+                        for r in args["availableSpectrumInquiryRequests"]]
             request_ids = \
                 set([r["requestId"]
                      for r in args["availableSpectrumInquiryRequests"]])
@@ -561,7 +811,6 @@ class RatAfc(MethodView):
             LOGGER.debug("(%d) %s::%s() Running AFC analysis with params: %s",
                          threading.get_native_id(),
                          self.__class__, inspect.stack()[0][3], args)
-            request_type = 'AP-AFC'
 
             use_tasks = (rcache is None) or \
                 (flask.request.args.get('conn_type') == 'async') or is_gui
@@ -579,135 +828,20 @@ class RatAfc(MethodView):
                                 ap_ip=flask.request.headers.get('X-Real-IP'))
             uls_id = "Unknown"
             geo_id = "Unknown"
-            indoor_certified = True
             req_infos = {}
 
-            # Creating req_infos - list of ReqInfo objects
-            for req_idx, request in enumerate(requests):
-                try:
-                    # authenticate
-                    LOGGER.debug("(%d) %s::%s() Request: %s",
-                                 threading.get_native_id(),
-                                 self.__class__, inspect.stack()[0][3],
-                                 request)
-                    individual_request = \
-                        request["availableSpectrumInquiryRequests"][0]
-                    prefix = None
-                    device_desc = individual_request.get('deviceDescriptor')
-
-                    devices = device_desc.get('certificationId')
-                    if not devices:
-                        raise MissingParamException(
-                            missing_params=['certificationId'])
-
-                    # Pick one ruleset that is being used for the
-                    # deployment of this AFC (RULESETS)
-                    certId = None
-                    region = None
-                    for r in devices:
-                        prefix = r.get('rulesetId')
-                        if not prefix:
-                            # empty/non-exist ruleset
-                            break
-                        if prefix in RULESETS:
-                            region = \
-                                RulesetVsRegion.ruleset_to_region(
-                                    prefix, exc=werkzeug.exceptions.NotFound)
-                            certId = r.get('id')
-                            break
-                        prefix = prefix.strip()
-
-                    if prefix is None:
-                        raise MissingParamException(
-                            missing_params=['rulesetId'])
-                    elif not prefix:
-                        raise InvalidValueException(["rulesetId", prefix])
-
-                    if region:
-                        if certId is None:
-                            # certificationId id field does not exist
-                            raise MissingParamException(
-                                missing_params=['certificationId', 'id'])
-                        elif not certId:
-                            raise InvalidValueException(
-                                ["id", certId])
-                    else:
-                        # ruleset is not in list
-                        raise DeviceUnallowedException("")
-
-                    serial = device_desc.get('serialNumber')
-                    if serial is None:
-                        raise MissingParamException(
-                            missing_params=['serialNumber'])
-                    elif not serial:
-                        raise InvalidValueException(["serialNumber", serial])
-
-                    runtime_opts = message_runtime_opts
-
-                    indoor_certified = \
-                        self._auth_ap(serial, prefix, certId,
-                                      device_desc.get('rulesetIds'), ver)
-                    if indoor_certified:
-                        runtime_opts |= RNTM_OPT_CERT_ID
-                    if use_tasks:
-                        runtime_opts |= RNTM_OPT_AFCENGINE_HTTP_IO
-
-                    LOGGER.debug("(%d) %s::%s() runtime %d",
-                                 threading.get_native_id(),
-                                 self.__class__, inspect.stack()[0][3],
-                                 runtime_opts)
-
-                    # Retrieving config
-                    with db.session() as session:
-                        config = session.query(AFCConfig).filter(
-                            AFCConfig.config['regionStr'].astext == region).first()
-                    if not config:
-                        raise DeviceUnallowedException(
-                            "No AFC configuration for ruleset " + str(region))
-                    afc_config = config.config
-                    try:
-                        overwrite_region = \
-                            RulesetVsRegion.overwrite_region(
-                                region, exc=KeyError)
-                        if overwrite_region:
-                            afc_config = dict(afc_config)
-                            afc_config['regionStr'] = overwrite_region
-                    except KeyError:
-                        pass
-
-                    rcc = RequestConfigHash(req_dict=individual_request,
-                                            afc_config_dict=afc_config,
-                                            compute_config_hash=True)
-                    config_path = \
-                        os.path.join("/afc_config", prefix, rcc.cfg_hash,
-                                     "afc_config.json") if use_tasks else None
-                    history_dir = None
-                    if runtime_opts & (RNTM_OPT_DBG | RNTM_OPT_SLOW_DBG):
-                        history_dir =\
-                            os.path.join(
-                                "/history", str(serial),
-                                str(datetime.datetime.now().isoformat()))
-                    req_infos[rcc.req_cfg_hash] = \
-                        ReqInfo(
-                            req_idx=req_idx, req_cfg_hash=rcc.req_cfg_hash,
-                            request_id=individual_request["requestId"],
-                            request=request, config_str=rcc.cfg_str,
-                            config_path=config_path, region=region,
-                            history_dir=history_dir, request_type=request_type,
-                            runtime_opts=runtime_opts,
-                            task_id=str(uuid.uuid4()))
-                except AP_Exception as e:
-                    response_dict = {"responseCode": e.response_code,
-                                     "shortDescription": e.description}
-                    if e.supplemental_info:
-                        response_dict["supplementalInfo"] = e.supplemental_info
-                    results["availableSpectrumInquiryResponses"].append(
-                        {"requestId": individual_request["requestId"],
-                         "rulesetId": prefix or "Unknown",
-                         "response": response_dict})
-                    afc_traffic_metrics.request_processed(
-                        duration_sec=time.time() - flask.g.afc_start_time,
-                        response="Exception")
+            # Creating req_infos - dictionary of ReqInfo objects
+            req_infos, error_responses = \
+                self._prepare_requests(
+                    requests=requests, ver=ver,
+                    message_runtime_opts=message_runtime_opts,
+                    use_tasks=use_tasks,
+                    start_time=flask.g.afc_start_time)
+            results["availableSpectrumInquiryResponses"] += error_responses
+            if error_responses:
+                afc_traffic_metrics.request_processed(
+                    duration_sec=time.time() - flask.g.afc_start_time,
+                    response="Exception", n=len(error_responses))
 
             # Creating 'responses' - dictionary of responses as JSON strings,
             # indexed by request/config hashes
@@ -721,6 +855,8 @@ class RatAfc(MethodView):
                     req_cfg_hash] = lookup_result.response
             cached_req_hashes = set(responses.keys())
             cached_duration = time.time() - flask.g.afc_start_time
+            for req_info in req_infos.values():
+                req_info.stage_timer.mark("rcache_lookup")
 
             # Computing the responses not found in cache
             # First handling async case
@@ -753,6 +889,9 @@ class RatAfc(MethodView):
                             is_internal_request=is_internal_request))
             computed_duration = time.time() - flask.g.afc_start_time
 
+            # Numbers of processed requests, indexed by (duration, response)
+            # tuples. Reported to metrics in bulk
+            processed_counts = collections.Counter()
             # Preparing responses for requests
             for req_info in req_infos.values():
                 response = responses.get(req_info.req_cfg_hash)
@@ -775,13 +914,20 @@ class RatAfc(MethodView):
                     req_id=als_req_id, config_text=req_info.config_str,
                     customer=req_info.region, geo_data_version=geo_id,
                     uls_id=uls_id, req_indices=[req_info.req_idx])
+                req_info.stage_timer.mark("response")
+                req_info.stage_timer.observe()
+                LOGGER.debug("Request %s stages: %s", req_info.task_id,
+                             req_info.stage_timer.timeline())
+                processed_counts[
+                    (cached_duration
+                     if req_info.req_cfg_hash in cached_req_hashes
+                     else computed_duration,
+                     actualResult[0].get("response", {}).
+                     get("responseCode", "Error") if actualResult
+                     else "NotComputed")] += 1
+            for (duration, response), count in processed_counts.items():
                 afc_traffic_metrics.request_processed(
-                    duration_sec=cached_duration
-                    if req_info.req_cfg_hash in cached_req_hashes
-                    else computed_duration,
-                    response=actualResult[0].get("response", {}).
-                    get("responseCode", "Error") if actualResult
-                    else "NotComputed")
+                    duration_sec=duration, response=response, n=count)
         except Exception as e:
             LOGGER.error(traceback.format_exc())
             lineno = "Unknown"
@@ -798,10 +944,11 @@ class RatAfc(MethodView):
         # Disaster recovery - filling-in unfulfilled stuff
         if "version" not in results:
             results["version"] = ALLOWED_VERSIONS[-1]
-        for missing_id in \
-                request_ids - \
-                set(r["requestId"] for r in
-                    results["availableSpectrumInquiryResponses"]):
+        missing_ids = \
+            request_ids - \
+            set(r["requestId"] for r in
+                results["availableSpectrumInquiryResponses"])
+        for missing_id in missing_ids:
             response_info = {"responseCode": -1}
             req_info_l = [ri for ri in req_infos.values()
                           if ri.request_id == missing_id]
@@ -812,9 +959,10 @@ class RatAfc(MethodView):
                 {"requestId": missing_id,
                  "rulesetId": "Unknown",
                  "response": response_info})
+        if missing_ids:
             afc_traffic_metrics.request_processed(
                 duration_sec=time.time() - flask.g.afc_start_time,
-                response="Exception")
+                response="Exception", n=len(missing_ids))
 
         # Removing internal vendor extensions
         drop_unwanted_extensions(
@@ -838,6 +986,177 @@ class RatAfc(MethodView):
         flask.g.afc_no_exception = True
         return resp
 
+    def _prepare_requests(self, requests, ver, message_runtime_opts,
+                          use_tasks, start_time):
+        """ Validates individual requests of AFC Request message and makes
+        ReqInfo objects for them.
+
+        Done in phases over the whole message: all requests are validated,
+        then RatDB data for all distinct certification IDs and regions is
+        fetched at once, then requests are authenticated and hashed
+
+        Arguments:
+        requests             -- List of AFC Request messages, containing one
+                                individual request each
+        ver                  -- AFC Request version
+        message_runtime_opts -- RNTM_OPT_... runtime options common for all
+                                requests
+        use_tasks            -- True if AFC Engine is invoked via tasks
+        start_time           -- time.time() of message processing start
+        Returns (req_infos, error_responses) tuple. 'req_infos' is dictionary
+        of ReqInfo objects, indexed by request/config hashes. 'error_responses'
+        is list of availableSpectrumInquiryResponses for failed requests
+        """
+        # (req_idx, response) tuples for failed requests
+        errors = []
+        # ValidatedReq objects for requests passed validation
+        validated_reqs = []
+
+        def add_error(req_idx, individual_request, prefix, stage_timer, e):
+            """ Makes error response for request failed with AP_Exception
+            """
+            stage_timer.observe()
+            response_dict = {"responseCode": e.response_code,
+                             "shortDescription": e.description}
+            if e.supplemental_info:
+                response_dict["supplementalInfo"] = e.supplemental_info
+            errors.append(
+                (req_idx,
+                 {"requestId": individual_request["requestId"],
+                  "rulesetId": prefix or "Unknown",
+                  "response": response_dict}))
+
+        # Validation
+        for req_idx, request in enumerate(requests):
+            stage_timer = afc_traffic_metrics.StageTimer(
+                start_time=None if req_idx else start_time)
+            LOGGER.debug("(%d) %s::%s() Request: %s",
+                         threading.get_native_id(),
+                         self.__class__, inspect.stack()[0][3], request)
+            individual_request = \
+                request["availableSpectrumInquiryRequests"][0]
+            prefix = None
+            try:
+                device_desc = individual_request.get('deviceDescriptor')
+
+                devices = device_desc.get('certificationId')
+                if not devices:
+                    raise MissingParamException(
+                        missing_params=['certificationId'])
+
+                # Pick one ruleset that is being used for the
+                # deployment of this AFC (RULESETS)
+                certId = None
+                region = None
+                for r in devices:
+                    prefix = r.get('rulesetId')
+                    if not prefix:
+                        # empty/non-exist ruleset
+                        break
+                    if prefix in RULESETS:
+                        region = \
+                            RulesetVsRegion.ruleset_to_region(
+                                prefix, exc=werkzeug.exceptions.NotFound)
+                        certId = r.get('id')
+                        break
+                    prefix = prefix.strip()
+
+                if prefix is None:
+                    raise MissingParamException(
+                        missing_params=['rulesetId'])
+                elif not prefix:
+                    raise InvalidValueException(["rulesetId", prefix])
+
+                if region:
+                    if certId is None:
+                        # certificationId id field does not exist
+                        raise MissingParamException(
+                            missing_params=['certificationId', 'id'])
+                    elif not certId:
+                        raise InvalidValueException(
+                            ["id", certId])
+                else:
+                    # ruleset is not in list
+                    raise DeviceUnallowedException("")
+
+                serial = device_desc.get('serialNumber')
+                if serial is None:
+                    raise MissingParamException(
+                        missing_params=['serialNumber'])
+                elif not serial:
+                    raise InvalidValueException(["serialNumber", serial])
+                stage_timer.mark("validation")
+                validated_reqs.append(
+                    ValidatedReq(
+                        req_idx=req_idx, request=request, prefix=prefix,
+                        region=region, cert_id=certId, serial=serial,
+                        stage_timer=stage_timer))
+            except AP_Exception as e:
+                add_error(req_idx, individual_request, prefix, stage_timer, e)
+
+        # Fetching RatDB data for all requests at once
+        rat_db_cache.prefetch(
+            regions=set(vr.region for vr in validated_reqs),
+            cert_ids=set(vr.cert_id for vr in validated_reqs))
+
+        # Authentication and hash computation
+        req_infos = {}
+        for vr in validated_reqs:
+            individual_request = \
+                vr.request["availableSpectrumInquiryRequests"][0]
+            try:
+                runtime_opts = message_runtime_opts
+                indoor_certified = \
+                    self._auth_ap(
+                        vr.serial, vr.prefix, vr.cert_id,
+                        individual_request['deviceDescriptor'].
+                        get('rulesetIds'), ver)
+                vr.stage_timer.mark("cert_lookup")
+                if indoor_certified:
+                    runtime_opts |= RNTM_OPT_CERT_ID
+                if use_tasks:
+                    runtime_opts |= RNTM_OPT_AFCENGINE_HTTP_IO
+
+                LOGGER.debug("(%d) %s::%s() runtime %d",
+                             threading.get_native_id(),
+                             self.__class__, inspect.stack()[0][3],
+                             runtime_opts)
+
+                # Retrieving config
+                config_info = rat_db_cache.get_config(vr.region)
+                vr.stage_timer.mark("config_lookup")
+                if not config_info:
+                    raise DeviceUnallowedException(
+                        "No AFC configuration for ruleset " + str(vr.region))
+
+                rcc = RequestConfigHash(req_dict=individual_request,
+                                        afc_config_dict=config_info.config,
+                                        compute_config_hash=True,
+                                        cfg_str=config_info.config_str)
+                config_path = \
+                    os.path.join("/afc_config", vr.prefix, rcc.cfg_hash,
+                                 "afc_config.json") if use_tasks else None
+                history_dir = None
+                if runtime_opts & (RNTM_OPT_DBG | RNTM_OPT_SLOW_DBG):
+                    history_dir =\
+                        os.path.join(
+                            "/history", str(vr.serial),
+                            str(datetime.datetime.now().isoformat()))
+                req_infos[rcc.req_cfg_hash] = \
+                    ReqInfo(
+                        req_idx=vr.req_idx, req_cfg_hash=rcc.req_cfg_hash,
+                        request_id=individual_request["requestId"],
+                        request=vr.request, config_str=rcc.cfg_str,
+                        config_path=config_path, region=vr.region,
+                        history_dir=history_dir, request_type='AP-AFC',
+                        runtime_opts=runtime_opts,
+                        task_id=str(uuid.uuid4()),
+                        stage_timer=vr.stage_timer)
+            except AP_Exception as e:
+                add_error(vr.req_idx, individual_request, vr.prefix,
+                          vr.stage_timer, e)
+        return (req_infos, [response for _, response in sorted(errors)])
+
     def _cache_lookup(self, dataif, req_infos):
         """ Looks up cached results
 
@@ -896,6 +1215,7 @@ class RatAfc(MethodView):
                 with dataif.open(os.path.join(req_info.history_dir, fname)) \
                         as hfile:
                     hfile.write(content.encode("utf-8"))
+        req_info.stage_timer.mark("dispatch")
         build_task(dataif=dataif, request_type=req_info.request_type,
                    task_id=req_info.task_id, hash_val=req_info.req_cfg_hash,
                    config_path=req_info.config_path if use_tasks else None,
@@ -907,7 +1227,11 @@ class RatAfc(MethodView):
                    else original_request_str,
                    config_str=None if use_tasks else req_info.config_str,
                    timeout_sec=flask.current_app.config[
-                        'AFC_MSGHND_RATAFC_TOUT'])
+                        'AFC_MSGHND_RATAFC_TOUT'],
+                   stage_timing=req_info.stage_timer.to_wire()
+                   if (not use_tasks) and
+                   flask.current_app.config['AFC_WORKER_STAGE_TIMING']
+                   else None)
         if use_tasks:
             return afctask.Task(task_id=req_info.task_id, dataif=dataif,
                                 hash_val=req_info.req_cfg_hash,
@@ -960,16 +1284,15 @@ class RatAfc(MethodView):
                             req_info.request[
                                 "availableSpectrumInquiryRequests"][0].\
                                 setdefault("vendorExtensions", []).append(ve)
-            tasks = {}
-            for req_cfg_hash, req_info in req_infos.items():
-                tasks[req_cfg_hash] = \
-                    self._start_processing(
-                        dataif=dataif, req_info=req_info, use_tasks=use_tasks,
-                        is_internal_request=is_internal_request,
-                        rcache_queue=None if use_tasks
-                        else rmq_conn.rx_queue_name(),
-                        original_request=original_requests.get(req_cfg_hash))
             if use_tasks:
+                tasks = {}
+                for req_cfg_hash, req_info in req_infos.items():
+                    tasks[req_cfg_hash] = \
+                        self._start_processing(
+                            dataif=dataif, req_info=req_info, use_tasks=True,
+                            is_internal_request=is_internal_request,
+                            original_request=original_requests.get(
+                                req_cfg_hash))
                 ret = {}
                 for req_cfg_hash, task in tasks.items():
                     task_stat = \
@@ -978,15 +1301,47 @@ class RatAfc(MethodView):
                                 'AFC_MSGHND_RATAFC_TOUT'])
                     ret[req_cfg_hash] = \
                         response_map[task_stat['status']](task).data
+                    req_infos[req_cfg_hash].stage_timer.mark("engine")
                 return ret
+
+            def dispatch(req_cfg_hash, queue_name):
+                self._start_processing(
+                    dataif=dataif, req_info=req_infos[req_cfg_hash],
+                    use_tasks=False, is_internal_request=is_internal_request,
+                    rcache_queue=queue_name,
+                    original_request=original_requests.get(req_cfg_hash))
+
+            def lookup(req_cfg_hashes):
+                return {req_cfg_hash: lookup_result.response
+                        for req_cfg_hash, lookup_result in
+                        self._cache_lookup(
+                            dataif=dataif,
+                            req_infos={k: req_infos[k]
+                                       for k in req_cfg_hashes}).items()
+                        if lookup_result.found}
+
+            stage_timings = {}
+            # Identical requests, being computed by other processes, are not
+            # sent to Worker - their responses are awaited instead. Debug
+            # requests need their own AFC Engine run, though
             ret = \
-                rcache.rmq_receive_responses(
-                    rx_connection=rmq_conn,
-                    req_cfg_digests=req_infos.keys(),
+                rcache.rmq_compute_responses(
+                    rx_connection=rmq_conn, req_cfg_digests=req_infos.keys(),
+                    dispatch=dispatch, lookup=lookup,
+                    coalesce=not any(req_info.runtime_opts &
+                                     (RNTM_OPT_DBG | RNTM_OPT_SLOW_DBG)
+                                     for req_info in req_infos.values()),
                     timeout_sec=flask.current_app.config[
-                        'AFC_MSGHND_RATAFC_TOUT'])
+                        'AFC_MSGHND_RATAFC_TOUT'],
+                    stage_timings=stage_timings)
             for req_cfg_hash, response in ret.items():
                 req_info = req_infos[req_cfg_hash]
+                # Without Worker's timing the whole remote part is attributed
+                # to AFC Engine
+                req_info.stage_timer.mark(
+                    "delivery" if req_info.stage_timer.merge_wire(
+                        stage_timings.get(req_cfg_hash))
+                    else "engine")
                 if (not response) or (not req_info.history_dir):
                     continue
                 with dataif.open(os.path.join(req_info.history_dir,
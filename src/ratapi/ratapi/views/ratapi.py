@@ -34,8 +34,10 @@ from ncli import MsgPublisher
 from hchecks import RmqHealthcheck, ObjstHealthcheck
 from ..util import AFCEngineException, require_default_uls, \
     getQueueDirectory, als_log_afc_config_change
+from .. import static_assets
 
-from afcmodels.aaa import User, AccessPointDeny, AFCConfig, MTLS
+from afcmodels.aaa import User, AccessPointDeny, AFCConfig, MTLS, \
+    CacheGeneration
 from afcmodels.base import db
 from afcmodels.hardcoded_relations import RulesetVsRegion
 from .auth import auth
@@ -62,9 +64,13 @@ def build_task(
         request_str=None,
         original_request_str=None,
         config_str=None,
-        timeout_sec=600):
+        timeout_sec=600,
+        stage_timing=None):
     """
     Shared logic between PAWS and All other analysis for constructing and async call to run task
+
+    stage_timing is None or wire form of afc_traffic_metrics.StageTimer to pass to worker
+    (passed only if set, so that Workers that don't know it still accept the task)
     """
 
     prot, host, port = dataif.getProtocol()
@@ -85,6 +91,8 @@ def build_task(
         "config_str": config_str,
         "deadline": time.time() + timeout_sec
     }
+    if stage_timing is not None:
+        kwargs["stage_timing"] = stage_timing
     LOGGER.debug(f"build_task({kwargs})")
     run.apply_async(kwargs=kwargs)
 
@@ -100,6 +108,13 @@ class GuiConfig(MethodView):
                      f" {self.__class__.__name__}::{inspect.stack()[0][3]}()"
                      f" {flask.request.cookies}")
 
+        # Content only depends on URL prefix and process-wide configuration
+        return static_assets.json_cache.response(
+            ('GuiConfig', flask.request.script_root), self._gui_config)
+
+    def _gui_config(self):
+        ''' GUI config dictionary
+        '''
         # Figure out the current server version
         try:
             if sys.version_info.major != 3:
@@ -130,7 +145,7 @@ class GuiConfig(MethodView):
             about_login_url = None
 
         # TODO: temporary support python2
-        resp = flask.jsonify(
+        return dict(
             uls_url=flask.url_for('ratapi-v1.UlsFiles'),
             antenna_url=flask.url_for('ratapi-v1.AntennaFiles'),
             history_url=flask.url_for("ratapi-v1.History0"),
@@ -158,7 +173,6 @@ class GuiConfig(MethodView):
             app_name=flask.current_app.config['USER_APP_NAME'],
             version=serververs,
         )
-        return resp
 
 
 class HealthCheck(MethodView):
@@ -363,15 +377,16 @@ class AfcConfigFile(MethodView):
         # ensure that webdav is populated with default files
         require_default_uls()
 
-        resp = flask.make_response()
-        config = AFCConfig.query.filter(
-            AFCConfig.config['regionStr'].astext == filename).first()
-        if config:
-            resp.data = json.dumps(config.config)
-            resp.content_type = 'application/json'
-            return resp
-        else:
-            raise werkzeug.exceptions.NotFound()
+        def load():
+            config = AFCConfig.query.filter(
+                AFCConfig.config['regionStr'].astext == filename).first()
+            if not config:
+                raise werkzeug.exceptions.NotFound()
+            return config.config
+
+        # Every AFC Config modification bumps cache generation
+        return static_assets.json_cache.response(
+            ('AfcConfigFile', filename, CacheGeneration.get()), load)
 
     def put(self, filename):
         ''' PUT method for afc config
@@ -407,6 +422,7 @@ class AfcConfigFile(MethodView):
             else:
                 config.config = rcrd
                 config.created = datetime.datetime.now()
+            CacheGeneration.bump()
             db.session.commit()
 
         except BaseException as ex:
@@ -506,23 +522,6 @@ class LiDAR_Bounds(MethodView):
     ''' Allow the web UI to manipulate configuration directly.
     '''
 
-    def _open(self, abs_path, mode, user=None):
-        ''' Open a file.
-
-        :param abs_path: The specific config name to open.
-        :param mode: The file open mode.
-        :return: The opened file.
-        :rtype: file-like
-        '''
-
-        LOGGER.debug('Opening file "%s"', abs_path)
-        if not os.path.exists(abs_path) and mode != 'wb':
-            raise werkzeug.exceptions.NotFound()
-
-        handle = open(abs_path, mode)
-
-        return handle
-
     def get(self):
         ''' GET method for LiDAR_Bounds
         '''
@@ -532,18 +531,14 @@ class LiDAR_Bounds(MethodView):
         import xdg.BaseDirectory
 
         try:
-            resp = flask.make_response()
             datapath = next(xdg.BaseDirectory.load_data_paths(
                 'fbrat', 'rat_transfer', 'proc_lidar_2019'))
             full_path = os.path.join(datapath, 'LiDAR_Bounds.json.gz')
             if not os.path.exists(full_path):
                 raise werkzeug.exceptions.NotFound(
                     'LiDAR bounds file not found')
-            with self._open(full_path, 'rb', user_id) as data_file:
-                resp.data = data_file.read()
-            resp.content_type = 'application/json'
-            resp.content_encoding = 'gzip'
-            return resp
+            return static_assets.serve_file(
+                full_path, 'application/json', source_encoding='gzip')
         except StopIteration:
             raise werkzeug.exceptions.NotFound('Path not found to file')
 
@@ -552,23 +547,6 @@ class RAS_Bounds(MethodView):
     ''' Allow the web UI to manipulate configuration directly.
     '''
 
-    def _open(self, abs_path, mode, user=None):
-        ''' Open a file.
-
-        :param abs_path: The specific config name to open.
-        :param mode: The file open mode.
-        :return: The opened file.
-        :rtype: file-like
-        '''
-
-        LOGGER.debug('Opening file "%s"', abs_path)
-        if not os.path.exists(abs_path) and mode != 'wb':
-            raise werkzeug.exceptions.NotFound()
-
-        handle = open(abs_path, mode)
-
-        return handle
-
     def get(self):
         ''' GET method for RAS_Bounds
         '''
@@ -579,18 +557,13 @@ class RAS_Bounds(MethodView):
         import xdg.BaseDirectory
 
         try:
-            resp = flask.make_response()
             datapath = next(xdg.BaseDirectory.load_data_paths(
                 'fbrat', 'rat_transfer', 'proc_lidar_2019'))
             full_path = os.path.join(datapath, 'RAS_ExclusionZone.json')
             if not os.path.exists(full_path):
                 raise werkzeug.exceptions.NotFound(
                     'RAS exclusion zone file not found')
-            with self._open(full_path, 'rb', user_id) as data_file:
-                resp.data = data_file.read()
-            resp.content_type = 'application/json'
-            # resp.content_encoding = 'gzip'
-            return resp
+            return static_assets.serve_file(full_path, 'application/json')
         except StopIteration:
             raise werkzeug.exceptions.NotFound('Path not found to file')
 
@@ -1117,6 +1090,16 @@ class AfcRulesetIds(MethodView):
 
 
 class History(MethodView):
+    # Request headers, forwarded to history server
+    FWD_REQ_HEADERS = ('Accept', 'Range', 'If-None-Match',
+                       'If-Modified-Since')
+    # Response headers, forwarded from history server
+    FWD_RESP_HEADERS = ('Content-Type', 'Content-Length', 'Content-Encoding',
+                        'Content-Disposition', 'Content-Range',
+                        'Accept-Ranges', 'ETag', 'Last-Modified')
+    # Size of chunks in which history server response is forwarded
+    CHUNK_SIZE = 1024 * 1024
+
     def get(self, path=None):
         LOGGER.debug(f"History::get({path})")
         auth(roles=['Analysis', 'Trial', 'Admin'])
@@ -1129,26 +1112,35 @@ class History(MethodView):
             if path is not None:
                 path_len = len(path)
                 rurl = flask.request.base_url[:-path_len]
+            headers = {'X-Forwarded-Proto': fwd_proto}
+            for header in self.FWD_REQ_HEADERS:
+                if header in flask.request.headers:
+                    headers[header] = flask.request.headers[header]
+            # Listing pagination/sort/filter arguments are passed through
+            params = dict(flask.request.args.items())
+            params['url'] = rurl
             response = requests.request(
                 method=flask.request.method,
                 url=urllib.parse.urlunparse(
                     (conf.AFC_OBJST_SCHEME,
                      f'{conf.AFC_OBJST_HOST}:{conf.AFC_OBJST_HIST_PORT}',
                      f'/{path or ""}', '', '', '')),
-                params={'url': rurl},
-                headers={'X-Forwarded-Proto': fwd_proto}, stream=True,
+                params=params, headers=headers, stream=True,
                 allow_redirects=False)
-            if response.headers['Content-Type'].startswith("application/octet-stream") \
-                    and "Content-Encoding" not in response.headers:
-                # results.kmz case. Apache can't decompress it.
-                resp = flask.make_response()
-                resp.data = response.raw.read()
-                return resp
-            else:
-                return flask.render_template_string(response.text)
         except Exception as exc:
             LOGGER.error(f"Unreachable history host. {exc}")
             return f"Unreachable history host. {exc}"
+        # Content is streamed as is (without decompression - e.g. for
+        # results.kmz case, Apache can't decompress it)
+        resp = flask.Response(
+            response.raw.stream(self.CHUNK_SIZE, decode_content=False),
+            status=response.status_code,
+            headers={header: response.headers[header]
+                     for header in self.FWD_RESP_HEADERS
+                     if header in response.headers},
+            direct_passthrough=True)
+        resp.call_on_close(response.close)
+        return resp
 
 
 class History0(History):
@@ -16,7 +16,9 @@ need to make acquisition and create new database as following.
 """
 
 import argparse
+import asyncio
 import certifi
+import concurrent.futures
 import csv
 import datetime
 import hashlib
@@ -32,7 +34,9 @@ import shutil
 import sqlite3
 import subprocess
 import sys
+import threading
 import time
+import xml.etree.ElementTree as ET
 
 import smtplib
 import ssl
@@ -486,6 +490,8 @@ def _send_recv(cfg, req_data, ssn=None):
 
     new_req_json = json.loads(req_data.encode('utf-8'))
     new_req = json.dumps(new_req_json, sort_keys=True)
+    # per-request copy, as requests may be sent from several threads
+    req_headers = dict(headers)
     if (cfg['webui'] is False):
         params_data = {
             'conn_type': cfg['conn_type'],
@@ -502,12 +508,12 @@ def _send_recv(cfg, req_data, ssn=None):
             'debug': 'True',
             'gui': 'True'
         }
-        headers['Accept-Encoding'] = 'gzip, defalte'
-        headers['Referer'] = cfg['base_url'] + 'fbrat/www/index.html'
+        req_headers['Accept-Encoding'] = 'gzip, defalte'
+        req_headers['Referer'] = cfg['base_url'] + 'fbrat/www/index.html'
 
         csrf_token = ssn.cookies.get('csrf_token', default='')
         if csrf_token:
-            headers['X-Csrf-Token'] = csrf_token
+            req_headers['X-Csrf-Token'] = csrf_token
 
         app_log.debug(
             f"({os.getpid()}) {inspect.stack()[0][3]}()\n"
@@ -545,7 +551,7 @@ def _send_recv(cfg, req_data, ssn=None):
             cfg['url_path'],
             params=params_data,
             data=new_req,
-            headers=headers,
+            headers=req_headers,
             timeout=600,  # 10 min
             cert=cli_certs,
             allow_redirects=False,
@@ -1900,6 +1906,247 @@ def stress_run(cfg):
     return run_test(cfg)
 
 
+def parse_shard(opt):
+    """Parse '--shard i/N' value into (i, N) tuple, 1 <= i <= N"""
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', opt)
+    if (match is None) or \
+            (not (1 <= int(match.group(1)) <= int(match.group(2)))):
+        raise argparse.ArgumentTypeError(
+            f"'{opt}' is not in i/N form with 1 <= i <= N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def _in_shard(test_id, shard):
+    """
+    True if test vector with given test case id belongs to given (i, N)
+    shard. Assignment only depends on test case id, so it is the same on all
+    machines, regardless of the set of test vectors being run
+    """
+    if shard is None:
+        return True
+    shard_idx, shard_count = shard
+    digest = hashlib.sha256(str(test_id).encode('utf-8')).digest()
+    return (int.from_bytes(digest[:8], 'big') % shard_count) == \
+        (shard_idx - 1)
+
+
+def _load_failed_vectors(filename):
+    """
+    Test case ids of test vectors that did not pass in previous run
+    filename: JSON or JUnit XML (.xml) report of previous run
+    """
+    if filename.endswith('.xml'):
+        root = ET.parse(filename).getroot()
+        return {tc.get('name') for tc in root.iter('testcase')
+                if (tc.find('failure') is not None) or
+                (tc.find('error') is not None)}
+    with open(filename, encoding='utf-8') as f:
+        report = json.load(f)
+    return {vector['test_id'] for vector in report['vectors']
+            if vector['status'] != 'pass'}
+
+
+def _run_vector(cfg, comparator, test_case, test_id, request_data, ref,
+                ssn):
+    """
+    Run single test vector and compare its response with reference as soon
+    as it arrives. Called on engine's worker thread
+    ref: [response_json_str, response_hash] or None
+    Returns (result record dictionary, normalized response string or None)
+    """
+    record = {'index': test_case, 'test_id': test_id, 'status': 'error',
+              'latency_sec': None, 'message': None, 'diffs': []}
+    resp = None
+    before_ts = time.monotonic()
+    try:
+        resp = _send_recv(cfg, json.dumps(request_data), ssn)
+    except Exception as err:
+        record['message'] = f"Request failed: {err!r}"
+    record['latency_sec'] = round(time.monotonic() - before_ts, 3)
+    if resp is None:
+        record['message'] = record['message'] or "No response"
+        return record, None
+    if 'error' in resp:
+        record['message'] = f"Error response: {resp['error']}"
+        return record, None
+    if cfg['webui'] is True:
+        # remove the mapping info from the response
+        # to make sure the base data matches - not checking map results
+        resp['availableSpectrumInquiryResponses'][0].\
+            pop('vendorExtensions', None)
+    json_lookup('availabilityExpireTime', resp, '0')
+    upd_data = json.dumps(resp, sort_keys=True)
+    if ref is None:
+        record['message'] = "No reference response in the database"
+        return record, upd_data
+    if cfg['precision'] is None:
+        passed = \
+            hashlib.sha256(upd_data.encode('utf-8')).hexdigest() == ref[1]
+        if not passed:
+            record['message'] = "Response hash mismatch"
+            record['diffs'] = \
+                comparator.compare_results(ref_str=ref[0],
+                                           result_str=upd_data)
+    else:
+        record['diffs'] = \
+            comparator.compare_results(ref_str=ref[0], result_str=upd_data)
+        passed = not record['diffs']
+        if not passed:
+            record['message'] = "Response mismatch"
+    record['status'] = 'pass' if passed else 'fail'
+    return record, upd_data
+
+
+async def _run_tests_async(cfg, reqs, resps, ids, test_cases):
+    """
+    Run tests with at most cfg['concurrency'] requests in flight, comparing
+    each response as soon as it arrives
+    reqs: {testcaseid: [request_json_str]}
+    resps: {testcaseid: [response_json_str, response_hash]}
+    test_cases: [testcaseids]
+    Returns list of result records in test_cases order
+    """
+    comparator = TestResultComparator(precision=cfg['precision'] or 0)
+    concurrency = max(1, cfg['concurrency'])
+    window = asyncio.Semaphore(concurrency)
+    # WebUI requests need logged in session, one per worker thread
+    sessions = threading.local()
+    loop = asyncio.get_running_loop()
+    records = {}
+
+    def worker(test_case):
+        ssn = None
+        if cfg['webui'] is True:
+            ssn = getattr(sessions, 'ssn', None)
+            if ssn is None:
+                ssn = requests.Session()
+                _login(cfg, ssn)
+                sessions.ssn = ssn
+        return _run_vector(cfg, comparator, test_case, ids[test_case][0],
+                           reqs[test_case][0], resps.get(test_case), ssn)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency) as executor:
+
+        async def run(test_case):
+            async with window:
+                return await loop.run_in_executor(executor, worker,
+                                                  test_case)
+
+        for completed in asyncio.as_completed(
+                [run(test_case) for test_case in test_cases]):
+            record, upd_data = await completed
+            records[record['index']] = record
+            res = f"id {record['index']} name {record['test_id']} " \
+                f"status {record['status']} " \
+                f"time {record['latency_sec']:.1f}"
+            if record['status'] == 'pass':
+                app_log.info(res)
+            else:
+                app_log.error(f"{res} {record['message']}")
+                for line in record['diffs']:
+                    app_log.error(f"  Difference: {line}")
+            # For saving test results option
+            if not isinstance(cfg['outfile'], type(None)):
+                test_report(cfg['outfile'][0], record['latency_sec'],
+                            record['index'], record['test_id'],
+                            record['status'].upper(), upd_data)
+    return [records[test_case] for test_case in test_cases]
+
+
+def _write_json_report(filename, summary, records):
+    """Write JSON report of test run"""
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump({'summary': summary, 'vectors': records}, f, indent=2)
+
+
+def _write_junit_report(filename, summary, records):
+    """Write JUnit XML report of test run"""
+    testsuites = ET.Element('testsuites')
+    testsuite = ET.SubElement(
+        testsuites, 'testsuite', name='afc_tests',
+        tests=str(summary['total']), failures=str(summary['failed']),
+        errors=str(summary['errors']), skipped='0',
+        time=f"{summary['duration_sec']:.3f}",
+        timestamp=summary['started'])
+    for record in records:
+        testcase = ET.SubElement(
+            testsuite, 'testcase', classname='afc_tests',
+            name=str(record['test_id']),
+            time=f"{record['latency_sec'] or 0:.3f}")
+        if record['status'] == 'fail':
+            ET.SubElement(testcase, 'failure',
+                          message=record['message']).text = \
+                '\n'.join(record['diffs'])
+        elif record['status'] == 'error':
+            ET.SubElement(testcase, 'error', message=record['message'])
+    ET.indent(testsuites)
+    ET.ElementTree(testsuites).write(filename, encoding='utf-8',
+                                     xml_declaration=True)
+
+
+def run_async_test(cfg):
+    """
+    Fetch test vectors from the DB and run tests with asyncio engine:
+    concurrency window, sharding, replay of failed vectors, JUnit XML and
+    JSON reports
+    """
+    app_log.debug(f"({os.getpid()}) {inspect.stack()[0][3]}() "
+                  f"{cfg['url_path']}")
+
+    converted = _convert_reqs_n_resps_to_dict(cfg)
+    if converted == AFC_ERR:
+        return AFC_ERR
+    reqs_dict, resp_dict, ids, test_cases = converted
+    if not len(resp_dict):
+        app_log.info(f"Unable to compare response data."
+                     f"Suggest to make acquisition of responses.")
+        return AFC_ERR
+
+    if cfg['replay_from']:
+        failed = _load_failed_vectors(cfg['replay_from'])
+        test_cases = [tc for tc in test_cases if ids[tc][0] in failed]
+        app_log.info(f"Replaying {len(test_cases)} test vectors failed in "
+                     f"{cfg['replay_from']}")
+    test_cases = [tc for tc in test_cases
+                  if _in_shard(ids[tc][0], cfg['shard'])]
+
+    started = datetime.datetime.now(datetime.timezone.utc)
+    before_ts = time.monotonic()
+    records = asyncio.run(
+        _run_tests_async(cfg, reqs_dict, resp_dict, ids, test_cases))
+    latencies = sorted(r['latency_sec'] for r in records
+                       if r['latency_sec'] is not None)
+    summary = {
+        'started': started.isoformat(),
+        'duration_sec': round(time.monotonic() - before_ts, 3),
+        'url': cfg['url_path'],
+        'shard': '/'.join(map(str, cfg['shard'])) if cfg['shard'] else None,
+        'concurrency': cfg['concurrency'],
+        'total': len(records),
+        'passed': sum(r['status'] == 'pass' for r in records),
+        'failed': sum(r['status'] == 'fail' for r in records),
+        'errors': sum(r['status'] == 'error' for r in records),
+        'latency_sec': {
+            'max': latencies[-1],
+            'median': latencies[len(latencies) // 2],
+            'p95': latencies[int(len(latencies) * 0.95)]
+        } if latencies else None
+    }
+    app_log.info(f"Total {summary['total']}, passed {summary['passed']}, "
+                 f"failed {summary['failed']}, errors {summary['errors']} "
+                 f"in {summary['duration_sec']:.1f} secs")
+
+    if cfg['report_json']:
+        _write_json_report(cfg['report_json'], summary, records)
+    if cfg['report_junit']:
+        _write_junit_report(cfg['report_junit'], summary, records)
+    if not isinstance(cfg['outfile'], type(None)):
+        send_email(cfg)
+
+    return AFC_OK if summary['passed'] == summary['total'] else AFC_ERR
+
+
 def _run_cert_tests(cfg):
     """
     Run tests
@@ -2034,6 +2281,7 @@ execution_map = {
     'parse_tests': [parse_tests, parse_run_test_args],
     'reacq': [start_acquisition, parse_run_test_args],
     'run': [run_test, parse_run_test_args],
+    'run_async': [run_async_test, parse_run_test_args],
     'run_cert': [run_cert_tests, parse_run_cert_args],
     'stress': [stress_run, parse_run_test_args],
     'ver': [get_version, parse_run_test_args],
@@ -2151,6 +2399,32 @@ def make_arg_parser():
         type=str,
         help="hook to call currently provided command before "
         "main command specified by --cmd option.\n")
+    args_parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help="<nbr> - maximum number of requests in flight for "
+        "run_async command (default=8).\n")
+    args_parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        help="<i/N> - run_async only i-th of N deterministic shards of "
+        "test vectors (1 <= i <= N), e.g. to split run across "
+        "machines.\n")
+    args_parser.add_argument(
+        '--replay_from', '--replay-from',
+        type=str,
+        help="<filename> - run_async only test vectors that failed in "
+        "given previous JSON or JUnit XML (.xml) report.\n")
+    args_parser.add_argument(
+        '--report_json',
+        type=str,
+        help="<filename> - write run_async JSON report with per-vector "
+        "latency.\n")
+    args_parser.add_argument(
+        '--report_junit',
+        type=str,
+        help="<filename> - write run_async JUnit XML report.\n")
     args_parser.add_argument('--email_from', type=str,
                              help="<email address> - set sender email.\n")
     args_parser.add_argument('--email_to', type=str,
@@ -2167,6 +2441,8 @@ def make_arg_parser():
         choices=execution_map.keys(),
         nargs='?',
         help="run - run test from DB and compare.\n"
+        "run_async - run test from DB and compare with concurrent asyncio "
+        "engine.\n"
         "dry_run - run test from file and show response.\n"
         "exp_adm_cfg - export admin config into a file.\n"
         "add_reqs - run test from provided file and insert with response into "
@@ -25,8 +25,10 @@ import queue
 import re
 import signal
 import sys
+import tempfile
 import threading
-from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple, \
+    Union
 
 from geoutils import *
 
@@ -48,6 +50,14 @@ FILESET_MASKS_KEY = "files"
 # Key of MD5 list witin dataset
 FILESET_MD5_KEY = "md5"
 
+# Manifest file format version
+MANIFEST_VERSION = 1
+
+# Digest definitions: MD5 over concatenated file contents (one that is stored
+# in ..._version_info.json files) and MD5 over list of per-file MD5s
+DIGEST_CONCAT = "concat"
+DIGEST_FILES = "files"
+
 _EPILOG = """ This script benefits from `jsonschema` Python module installed,
 but may leave without it. Hence it may easily be used outside of container.
 Some examples:
@@ -62,6 +72,13 @@ Some examples:
     $ dir_md5.py compute --mask '*.hgt'  srtm3arcsecondv003
 - Update MD5 for USA geoids, per by usa_ge_prd/usa_ge_prd_version_info.json
     $ dir_md5.py update --json usa_ge_prd/usa_ge_prd_version_info.json
+- Compute MD5 over LiDAR files, not rehashing files unchanged since previous
+  run:
+    $ dir_md5.py compute --manifest lidar.manifest.json --recursive \
+      proc_lidar_2019
+- Report LiDAR files that changed since manifest was made:
+    $ dir_md5.py verify --manifest lidar.manifest.json --recursive \
+      proc_lidar_2019
 """
 
 
@@ -74,20 +91,27 @@ class FileInfo:
                  recursive
     basename  -- Basename to use as sort key if computation is nonrecursive
     size      -- File size in bytes
+    mtime_ns  -- File modification time in nanoseconds
+    inode     -- File inode number
     """
 
-    def __init__(self, filename: str, root: str, size: int) -> None:
+    def __init__(self, filename: str, root: str, size: int, mtime_ns: int = 0,
+                 inode: int = 0) -> None:
         """ Constructor
 
         Arguments:
         filename -- File name
         root     -- Root relative to which relative path should be computed
         size     -- File size in bytes
+        mtime_ns -- File modification time in nanoseconds
+        inode    -- File inode number
         """
         self.full_path = os.path.abspath(filename)
         self.rel_path = os.path.relpath(filename, root)
         self.basename = os.path.basename(filename)
         self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
 
     def sort_key(self, with_path: bool) -> Union[str, Tuple[str, str]]:
         """ Sort key
@@ -156,15 +180,21 @@ class Md5Computer:
         self._progress = progress
         self._stats = stats
 
-    def calculate(self, fileinfos: List[FileInfo]) -> str:
+    def calculate(self, fileinfos: List[FileInfo],
+                  file_md5s: Optional[Dict[str, str]] = None) -> str:
         """ Calculate MD5
 
         Arguments:
         fileinfos -- List of FileInfo objects on files to use
+        file_md5s -- Optional dictionary to fill with per-file MD5s (in
+                     lowercase hex representation), indexed by full file paths
         Return MD5 in string representation
         """
         start_time = datetime.datetime.now()
         md5 = hashlib.md5()
+        # Per-file MD5 of file being hashed
+        file_md5: Optional[Any] = None
+        file_md5_info: Optional[FileInfo] = None
         # Worker threads that read chunks' data
         threads: List[threading.Thread] = []
         try:
@@ -204,6 +234,14 @@ class Md5Computer:
                     data = chunk_map[next_md5_seq].data
                     assert data is not None
                     md5.update(data)
+                    if file_md5s is not None:
+                        fi = chunk_map[next_md5_seq].fileinfo
+                        if fi is not file_md5_info:
+                            file_md5 = hashlib.md5()
+                            file_md5_info = fi
+                        assert file_md5 is not None
+                        file_md5.update(data)
+                        file_md5s[fi.full_path] = file_md5.hexdigest()
                     chunk_map[next_md5_seq].data = None
                     del chunk_map[next_md5_seq]
                     next_md5_seq += 1
@@ -249,6 +287,11 @@ class Md5Computer:
         if self._progress:
             print(len(last_name) * " ", end="\r")
 
+        if file_md5s is not None:
+            # Empty files have no chunks
+            for fi in fileinfos:
+                file_md5s.setdefault(fi.full_path, hashlib.md5().hexdigest())
+
         if self._stats:
             seconds = (datetime.datetime.now() - start_time).total_seconds()
             total_size = sum(fi.size for fi in fileinfos)
@@ -300,6 +343,318 @@ class Md5Computer:
                 result_queue.put(chunk)
 
 
+def file_md5_worker(task: Tuple[str, int]) -> Tuple[str, Optional[str]]:
+    """ Worker process function that computes MD5 of single file
+
+    Arguments:
+    task -- (full_file_path, chunk_size) tuple
+    Returns (full_file_path, lowercase_hex_md5) tuple. MD5 is None on file
+    reading error
+    """
+    full_path, chunk_size = task
+    md5 = hashlib.md5()
+    try:
+        with open(full_path, mode="rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                md5.update(data)
+    except OSError:
+        return (full_path, None)
+    return (full_path, md5.hexdigest())
+
+
+class FileMd5Computer:
+    """ Computes per-file MD5s in parallel worker processes
+
+    Private attributes:
+    _num_procs  -- Number of worker processes
+    _chunk_size -- Size of file reading chunk in bytes
+    _progress   -- Print progress information
+    _stats      -- Print performance statistics
+    """
+
+    def __init__(self, num_procs: int, chunk_size: int, progress: bool,
+                 stats: bool) -> None:
+        """ Constructor
+
+        Arguments:
+        num_procs  -- Number of worker processes
+        chunk_size -- Size of file reading chunk in bytes
+        progress   -- Print progress information
+        stats      -- Print performance statistics
+        """
+        self._num_procs = num_procs
+        self._chunk_size = chunk_size
+        self._progress = progress
+        self._stats = stats
+
+    def calculate(self, fileinfos: List[FileInfo]) -> Dict[str, str]:
+        """ Calculate per-file MD5s
+
+        Arguments:
+        fileinfos -- List of FileInfo objects on files to hash
+        Returns dictionary of lowercase hex MD5s, indexed by full file paths
+        """
+        ret: Dict[str, str] = {}
+        if not fileinfos:
+            return ret
+        start_time = datetime.datetime.now()
+        original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pool = multiprocessing.Pool(
+            processes=min(self._num_procs, len(fileinfos)))
+        signal.signal(signal.SIGINT, original_sigint_handler)
+        try:
+            # Biggest files first - to not end up waiting for the last one
+            tasks = [(fi.full_path, self._chunk_size)
+                     for fi in sorted(fileinfos, key=lambda fi: -fi.size)]
+            for full_path, md5 in \
+                    pool.imap_unordered(file_md5_worker, tasks):
+                error_if(md5 is None, f"Error reading '{full_path}'")
+                assert md5 is not None
+                ret[full_path] = md5
+                if self._progress:
+                    print(f"{len(ret)} of {len(fileinfos)} files hashed",
+                          end="\r", flush=True)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+        if self._progress:
+            print("")
+        if self._stats:
+            seconds = (datetime.datetime.now() - start_time).total_seconds()
+            total_size = sum(fi.size for fi in fileinfos)
+            print(f"Files hashed: {len(fileinfos)}")
+            print(f"Data length: {total_size / GIGA:.3f} GB")
+            print(f"Performance: {total_size / (seconds or 1) / GIGA:.2f} "
+                  f"GB/s")
+        return ret
+
+
+class Manifest:
+    """ Manifest file - cache of per-file MD5s and of fileset digests.
+
+    Per-file MD5 is considered valid if file size, modification time and inode
+    number are the same as when it was computed. Fileset digest is considered
+    valid if the list of files with their sizes, modification times and inode
+    numbers is the same as when it was computed.
+    Manifest file is JSON with 'version', 'files' (per-file information
+    indexed by full file paths) and 'filesets' (digests indexed by fileset
+    signatures) fields
+
+    Private attributes:
+    _filename -- Manifest file name
+    _files    -- Per-file information (FileEntry objects), indexed by full
+                 file paths
+    _filesets -- Fileset digests, indexed by fileset signatures
+    _changed  -- True if manifest should be written back
+    """
+    # Manifest information about file
+    FileEntry = \
+        NamedTuple(
+            "FileEntry", [
+                # File size in bytes
+                ("size", int),
+                # File modification time in nanoseconds
+                ("mtime_ns", int),
+                # File inode number
+                ("inode", int),
+                # MD5 in lowercase hex representation
+                ("md5", str)])
+
+    def __init__(self, filename: str) -> None:
+        """ Constructor
+
+        Arguments:
+        filename -- Manifest file name. Need not exist
+        """
+        self._filename = filename
+        self._files: Dict[str, "Manifest.FileEntry"] = {}
+        self._filesets: Dict[str, str] = {}
+        self._changed = False
+        if not os.path.isfile(self._filename):
+            return
+        try:
+            with open(self._filename, mode="rb") as f:
+                manifest_dict = json.load(f)
+            error_if(manifest_dict.get("version") != MANIFEST_VERSION,
+                     f"Unsupported version of manifest file "
+                     f"'{self._filename}'")
+            for full_path, entry in manifest_dict["files"].items():
+                self._files[full_path] = self.__class__.FileEntry(**entry)
+            self._filesets = dict(manifest_dict["filesets"])
+        except (OSError, json.JSONDecodeError, AttributeError, KeyError,
+                TypeError) as ex:
+            error(f"Invalid manifest file '{self._filename}': {ex}")
+
+    def get_md5(self, fi: FileInfo) -> Optional[str]:
+        """ Returns MD5 of given file if it is in manifest and file was not
+        changed since, None otherwise """
+        entry = self._files.get(fi.full_path)
+        if (entry is None) or \
+                ((entry.size, entry.mtime_ns, entry.inode) !=
+                 (fi.size, fi.mtime_ns, fi.inode)):
+            return None
+        return entry.md5
+
+    def get_entry(self, full_path: str) -> Optional["Manifest.FileEntry"]:
+        """ Returns manifest information about file with given full path, None
+        if there is none """
+        return self._files.get(full_path)
+
+    def full_paths(self) -> List[str]:
+        """ Full paths of files in manifest """
+        return list(self._files.keys())
+
+    def set_md5(self, fi: FileInfo, md5: str) -> None:
+        """ Stores MD5 of given file """
+        entry = self.__class__.FileEntry(size=fi.size, mtime_ns=fi.mtime_ns,
+                                         inode=fi.inode, md5=md5)
+        if self._files.get(fi.full_path) != entry:
+            self._files[fi.full_path] = entry
+            self._changed = True
+
+    def get_fileset_digest(self, signature: str) -> Optional[str]:
+        """ Returns digest for fileset of given signature, None if unknown """
+        return self._filesets.get(signature)
+
+    def set_fileset_digest(self, signature: str, digest: str) -> None:
+        """ Stores digest of fileset of given signature """
+        if self._filesets.get(signature) != digest:
+            self._filesets[signature] = digest
+            self._changed = True
+
+    @classmethod
+    def fileset_signature(cls, fileinfos: List[FileInfo], digest_kind: str) \
+            -> str:
+        """ Signature of fileset (sorted list of files) for given digest
+        definition """
+        return hashlib.sha256(
+            json.dumps(
+                [digest_kind] +
+                [[fi.full_path, fi.size, fi.mtime_ns, fi.inode]
+                 for fi in fileinfos]).encode("utf-8")).hexdigest()
+
+    def save(self) -> None:
+        """ Writes manifest file (if it was changed). Entries of files that no
+        longer exist are dropped """
+        for full_path in list(self._files.keys()):
+            if not os.path.isfile(full_path):
+                del self._files[full_path]
+                self._changed = True
+        if not self._changed:
+            return
+        manifest_dict = {
+            "version": MANIFEST_VERSION,
+            "files": {full_path: entry._asdict()
+                      for full_path, entry in sorted(self._files.items())},
+            "filesets": self._filesets}
+        fd, temp_filename = \
+            tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self._filename)),
+                prefix=os.path.basename(self._filename) + ".incomplete.")
+        try:
+            with os.fdopen(fd, mode="w", encoding="utf-8") as f:
+                json.dump(manifest_dict, f, indent=1)
+            os.replace(temp_filename, self._filename)
+        except OSError as ex:
+            error(f"Error writing '{self._filename}': {ex}")
+        finally:
+            if os.path.isfile(temp_filename):
+                os.unlink(temp_filename)
+        self._changed = False
+
+
+def files_digest(fileinfos: List[FileInfo], file_md5s: Dict[str, str]) -> str:
+    """ Computes digest over per-file MD5s.
+
+    It is MD5 of md5sum-style lines ('<lowercase MD5>  <relative name>') in
+    file order
+
+    Arguments:
+    fileinfos -- List of FileInfo objects in digest order
+    file_md5s -- Per-file lowercase hex MD5s, indexed by full file paths
+    Returns MD5 in string representation
+    """
+    md5 = hashlib.md5()
+    for fi in fileinfos:
+        md5.update(f"{file_md5s[fi.full_path]}  {fi.rel_path}\n".
+                   encode("utf-8"))
+    return "".join(f"{b:02X}" for b in md5.digest())
+
+
+def compute_digest(args: Any, fileinfos: List[FileInfo],
+                   manifest: Optional[Manifest],
+                   need_file_md5s: bool = False) \
+        -> Tuple[str, Optional[Dict[str, str]]]:
+    """ Computes digest of fileset according to command line arguments
+
+    Arguments:
+    args           -- Parsed command line arguments
+    fileinfos      -- List of FileInfo objects in digest order
+    manifest       -- Optional manifest to take unchanged files' MD5s from and
+                      to store computed ones to
+    need_file_md5s -- True to compute per-file MD5s even if there is no
+                      manifest
+    Returns (digest, per_file_md5s) tuple. Per-file MD5s are indexed by full
+    file paths, they are None if not computed (in 'concat' mode without
+    manifest, unless explicitly requested)
+    """
+    signature = Manifest.fileset_signature(fileinfos, args.digest)
+    file_md5s: Optional[Dict[str, str]] = None
+    if args.digest == DIGEST_CONCAT:
+        digest = manifest.get_fileset_digest(signature) if manifest else None
+        if digest is not None:
+            file_md5s = {}
+            for fi in fileinfos:
+                md5 = manifest.get_md5(fi) if manifest else None
+                if md5 is None:
+                    # Fileset digest is there, but file digests are not
+                    file_md5s = None
+                    digest = None
+                    break
+                file_md5s[fi.full_path] = md5
+        if digest is None:
+            file_md5s = {} if (manifest or need_file_md5s) else None
+            digest = \
+                Md5Computer(
+                    num_threads=threads_arg(args.threads),
+                    chunk_size=args.chunk, max_in_flight=args.max_in_flight,
+                    progress=args.progress,
+                    stats=args.stats).calculate(fileinfos,
+                                                file_md5s=file_md5s)
+        elif args.stats:
+            print("Digest taken from manifest")
+    else:
+        assert args.digest == DIGEST_FILES
+        file_md5s = {}
+        to_compute: List[FileInfo] = []
+        for fi in fileinfos:
+            md5 = manifest.get_md5(fi) if manifest else None
+            if md5 is None:
+                to_compute.append(fi)
+            else:
+                file_md5s[fi.full_path] = md5
+        if args.stats:
+            print(f"MD5s of {len(fileinfos) - len(to_compute)} files taken "
+                  f"from manifest")
+        file_md5s.update(
+            FileMd5Computer(
+                num_procs=threads_arg(args.threads), chunk_size=args.chunk,
+                progress=args.progress,
+                stats=args.stats).calculate(to_compute))
+        digest = files_digest(fileinfos, file_md5s)
+    if manifest:
+        assert file_md5s is not None
+        for fi in fileinfos:
+            manifest.set_md5(fi, file_md5s[fi.full_path])
+        manifest.set_fileset_digest(signature, digest)
+        manifest.save()
+    return (digest, file_md5s)
+
+
 class VersionJson:
     """ Handler of version information JSON
 
@@ -424,8 +779,9 @@ def get_files(file_dir_name: str, masks: Optional[List[str]],
                     break
             else:
                 return
-        ret.append(FileInfo(filename=filename, root=root,
-                            size=os.path.getsize(filename)))
+        st = os.stat(filename)
+        ret.append(FileInfo(filename=filename, root=root, size=st.st_size,
+                            mtime_ns=st.st_mtime_ns, inode=st.st_ino))
     if os.path.isfile(file_dir_name):
         process_file(file_dir_name, os.path.dirname(file_dir_name))
     elif os.path.isdir(file_dir_name):
@@ -538,14 +894,11 @@ def do_compute(args: Any) -> None:
         get_filelists(
             json_filename=args.json, files_and_dirs=args.FILES_AND_DIRS,
             recursive=args.recursive, masks=args.mask)
+    manifest = Manifest(args.manifest) if args.manifest else None
     for fs_type, fileinfos in filelists:
         if len(filelists) != 1:
             print(f"Fileset: {fs_type}")
-        md5_computer = Md5Computer(num_threads=threads_arg(args.threads),
-                                   chunk_size=args.chunk,
-                                   max_in_flight=args.max_in_flight,
-                                   progress=args.progress, stats=args.stats)
-        print(md5_computer.calculate(fileinfos))
+        print(compute_digest(args, fileinfos, manifest)[0])
         if len(filelists) != 1:
             print("")
 
@@ -558,26 +911,53 @@ def do_verify(args: Any) -> None:
     """
     if args.nice:
         nice()
+    error_if((args.json is None) and (args.manifest is None),
+             "At least one of --json and --manifest should be specified")
     version_json, filelists = \
-        get_filelists(json_filename=args.json, json_required=True)
-    assert version_json is not None
+        get_filelists(
+            json_filename=args.json, files_and_dirs=args.FILES_AND_DIRS,
+            recursive=args.recursive, masks=args.mask)
+    # Manifest is used as reference here, so it is neither trusted nor updated
+    manifest = Manifest(args.manifest) if args.manifest else None
     mismatches: List[str] = []
+    differing_files: List[str] = []
+    verified_paths: Set[str] = set()
     for fs_type, fileinfos in filelists:
-        assert fs_type is not None
         if len(filelists) != 1:
             print(f"Fileset: {fs_type}")
-        md5_computer = Md5Computer(num_threads=threads_arg(args.threads),
-                                   chunk_size=args.chunk,
-                                   max_in_flight=args.max_in_flight,
-                                   progress=args.progress, stats=args.stats)
-        computed_md5 = md5_computer.calculate(fileinfos)
-        json_md5 = version_json.get_md5(fs_type)
-        if computed_md5 != json_md5:
-            print(f"MD5 mismatch. Computed: {computed_md5}, in '{args.json}': "
-                  f"{json_md5}'")
-            print("")
-            mismatches.append(fs_type)
+        computed_md5, file_md5s = \
+            compute_digest(args, fileinfos, manifest=None,
+                           need_file_md5s=manifest is not None)
+        if version_json is not None:
+            assert fs_type is not None
+            json_md5 = version_json.get_md5(fs_type)
+            if computed_md5 != json_md5:
+                print(f"MD5 mismatch. Computed: {computed_md5}, in "
+                      f"'{args.json}': {json_md5}'")
+                print("")
+                mismatches.append(fs_type)
+        if manifest is not None:
+            assert file_md5s is not None
+            for fi in fileinfos:
+                verified_paths.add(fi.full_path)
+                entry = manifest.get_entry(fi.full_path)
+                if entry is None:
+                    print(f"New: {fi.full_path}")
+                elif entry.md5 != file_md5s[fi.full_path]:
+                    print(f"Changed: {fi.full_path}")
+                else:
+                    continue
+                differing_files.append(fi.full_path)
+    if manifest is not None:
+        for full_path in sorted(manifest.full_paths()):
+            if (full_path not in verified_paths) and \
+                    (not os.path.isfile(full_path)):
+                print(f"Missing: {full_path}")
+                differing_files.append(full_path)
     error_if(mismatches, f"MD5 mismatches found in: {', '.join(mismatches)}")
+    error_if(differing_files,
+             f"{len(differing_files)} files differ from ones in "
+             f"'{args.manifest}'")
 
 
 def do_update(args: Any) -> None:
@@ -591,15 +971,12 @@ def do_update(args: Any) -> None:
     version_json, filelists = \
         get_filelists(json_filename=args.json, json_required=True)
     assert version_json is not None
+    manifest = Manifest(args.manifest) if args.manifest else None
     for fs_type, fileinfos in filelists:
         assert fs_type is not None
         if len(filelists) != 1:
             print(f"Fileset: {fs_type}")
-        md5_computer = Md5Computer(num_threads=threads_arg(args.threads),
-                                   chunk_size=args.chunk,
-                                   max_in_flight=args.max_in_flight,
-                                   progress=args.progress, stats=args.stats)
-        computed_md5 = md5_computer.calculate(fileinfos)
+        computed_md5 = compute_digest(args, fileinfos, manifest)[0]
         json_md5 = version_json.get_md5(fs_type)
         if computed_md5 != json_md5:
             version_json.update_md5(fs_type, computed_md5)
@@ -654,6 +1031,22 @@ def main(argv: List[str]) -> None:
     switches_computation.add_argument(
         "--nice", action="store_true",
         help="Lower priority of this process and its subprocesses")
+    switches_computation.add_argument(
+        "--manifest", metavar="MANIFEST_FILE",
+        help="Manifest file that stores size, modification time, inode and "
+        "MD5 of every hashed file. In 'verify' subcommand it is a reference "
+        "against which changed, new and missing files are reported, in other "
+        "subcommands - a cache that allows to not rehash unchanged files (it "
+        "is created if absent and updated)")
+    switches_computation.add_argument(
+        "--digest", choices=[DIGEST_CONCAT, DIGEST_FILES],
+        default=DIGEST_CONCAT,
+        help=f"Digest definition. '{DIGEST_CONCAT}' - MD5 over concatenated "
+        f"file contents (one used in ..._version_info.json files), computed "
+        f"in one stream, manifest only helps if no file changed. "
+        f"'{DIGEST_FILES}' - MD5 over md5sum-style list of per-file MD5s, "
+        f"files are hashed in parallel processes, only changed files are "
+        f"rehashed if manifest is used. Default is '{DIGEST_CONCAT}'")
     switches_computation.add_argument(
         "--chunk", type=int, default=16 * 1024 * 1024, help=argparse.SUPPRESS)
     switches_computation.add_argument(
@@ -704,9 +1097,11 @@ def main(argv: List[str]) -> None:
     # Subparser for "verify" subcommand
     parser_verify = subparsers.add_parser(
         "verify",
-        parents=[switches_required_json, switches_computation, switches_stats],
+        parents=[switches_explicit, switches_optional_json,
+                 switches_computation, switches_stats],
         help="Computes MD5 and checks if it matches one in "
-        "...version_info.json file")
+        "...version_info.json file (if --json specified) and/or reports files "
+        "that differ from ones in manifest (if --manifest specified)")
     parser_verify.set_defaults(func=do_verify)
 
     # Subparser for "update" subcommand
@@ -15,17 +15,33 @@ import argparse
 import csv
 import datetime
 import enum
+import hashlib
+import json
+import multiprocessing
 import multiprocessing.pool
 import os
 import shlex
 import sys
-from typing import List, Optional, Set, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from geoutils import *
 
+try:
+    from osgeo import gdal
+    HAS_GDAL = True
+except ImportError:
+    HAS_GDAL = False
+
 # Pattern for .csv name that corresponds to locality name
 CSV_PATTERN = "%s_info.csv"
 
+# Names of .csv columns with source file boundaries
+CSV_BOUNDARY_COLUMNS = \
+    ("MIN_LAT_DEG", "MAX_LAT_DEG", "MIN_LON_DEG", "MAX_LON_DEG")
+
+# Number of bits per coordinate in Z-order (Morton) key of locality position
+Z_ORDER_BITS = 16
+
 # Default resampling to use in gdalbuildvrt
 DEFAULT_RESAMPLING = "cubic"
 
@@ -44,6 +60,11 @@ Some usage examples:
    $ lidar_merge.py --threads 8 --nice --proj_param BIGTIFF=YES \\
      --proj_param COMPRESS=ZSTD proj_lidar_2019 MERGED_LIDARS
   On 8 CPUs this takes ~5 hours.
+- Same, but merging with GDAL Python bindings in worker processes and keeping
+  progress journal, so that restarted merge skips verified results:
+   $ lidar_merge.py --threads 8 --nice --in_process \
+     --journal MERGED_LIDARS/journal.jsonl --proj_param BIGTIFF=YES \
+     --proj_param COMPRESS=ZSTD proj_lidar_2019 MERGED_LIDARS
 """
 
 
@@ -65,6 +86,163 @@ class ConvResult(NamedTuple):
     # gdal_merge command line used
     command_line: Optional[str] = None
 
+    # Name of created file
+    dst_filename: Optional[str] = None
+
+    # Total size of source files
+    bytes_read: int = 0
+
+
+class LocalityInfo(NamedTuple):
+    """ Information about locality from its .csv file """
+
+    # Source files in .csv order
+    srcs: List[str]
+
+    # (lat, lon) of locality center or None if .csv has no boundaries
+    center: Optional[Tuple[float, float]]
+
+
+def read_locality_csv(src_dir: str, locality: str) -> LocalityInfo:
+    """ Reads locality .csv file
+
+    Arguments:
+    src_dir  -- Source directory
+    locality -- Locality (subdirectory with .tif files)
+    Returns LocalityInfo object. Raises ValueError on error
+    """
+    srcs: List[str] = []
+    boundaries: Optional[List[float]] = None
+    csv_file_name = os.path.join(src_dir, CSV_PATTERN % locality)
+    with open(csv_file_name, newline='', encoding="utf-8") as csv_f:
+        for row in csv.DictReader(csv_f):
+            if "FILE" not in row:
+                raise ValueError(f"Invalid '{csv_file_name}' file structure")
+            src_filename = os.path.join(src_dir, locality, row["FILE"])
+            if not os.path.isfile(src_filename):
+                raise ValueError(f"Source file '{src_filename}' of locality "
+                                 f"'{locality}' not found")
+            srcs.append(src_filename)
+            try:
+                row_boundaries = \
+                    [float(row[column]) for column in CSV_BOUNDARY_COLUMNS]
+                boundaries = row_boundaries if boundaries is None else \
+                    [min(boundaries[0], row_boundaries[0]),
+                     max(boundaries[1], row_boundaries[1]),
+                     min(boundaries[2], row_boundaries[2]),
+                     max(boundaries[3], row_boundaries[3])]
+            except (KeyError, TypeError, ValueError):
+                pass
+    if not srcs:
+        raise ValueError(f"Locality '{locality}' have no source files")
+    return \
+        LocalityInfo(
+            srcs=srcs,
+            center=None if boundaries is None
+            else ((boundaries[0] + boundaries[1]) / 2,
+                  (boundaries[2] + boundaries[3]) / 2))
+
+
+def z_order_key(center: Optional[Tuple[float, float]]) -> int:
+    """ Z-order (Morton) key of given position, used to process nearby
+    localities one after another. Localities without position go last """
+    if center is None:
+        return 1 << (2 * Z_ORDER_BITS)
+    scale = (1 << Z_ORDER_BITS) - 1
+    y = int(min(max((center[0] + 90) / 180, 0), 1) * scale)
+    x = int(min(max((center[1] + 180) / 360, 0), 1) * scale)
+    ret = 0
+    for bit in range(Z_ORDER_BITS):
+        ret |= (((x >> bit) & 1) << (2 * bit)) | \
+            (((y >> bit) & 1) << (2 * bit + 1))
+    return ret
+
+
+class MergeJournal:
+    """ Persistent progress journal.
+
+    JSON Lines file, each line describes a successfully merged locality: its
+    signature (digest of source files' names, sizes, modification times and of
+    merge parameters) and size and modification time of resulting file.
+    Lines are appended (and synced) on completion of every locality, so the
+    journal survives crashes (possibly truncated last line is ignored)
+
+    Private attributes:
+    _filename -- Journal file name
+    _records  -- Journal records (dictionaries), indexed by locality names
+    """
+
+    def __init__(self, filename: str) -> None:
+        """ Constructor
+
+        Arguments:
+        filename -- Journal file name. Need not exist
+        """
+        self._filename = filename
+        self._records: Dict[str, Dict[str, Any]] = {}
+        if not os.path.isfile(self._filename):
+            return
+        with open(self._filename, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self._records[record["locality"]] = record
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    pass
+
+    @classmethod
+    def signature(cls, srcs: List[str], params: List[Any]) -> str:
+        """ Signature of locality merge
+
+        Arguments:
+        srcs   -- Source file names
+        params -- JSON-serializable merge parameters
+        Returns signature string
+        """
+        files: List[Any] = []
+        for src in srcs:
+            st = os.stat(src)
+            files.append([os.path.basename(src), st.st_size, st.st_mtime_ns])
+        return hashlib.sha256(
+            json.dumps([params, files]).encode("utf-8")).hexdigest()
+
+    def is_complete(self, locality: str, signature: str) -> bool:
+        """ True if locality was merged with given signature and resulting
+        file is still there, intact """
+        record = self._records.get(locality)
+        if (record is None) or (record.get("signature") != signature):
+            return False
+        try:
+            st = os.stat(record["dst_filename"])
+        except (OSError, KeyError):
+            return False
+        return (st.st_size, st.st_mtime_ns) == \
+            (record.get("size"), record.get("mtime_ns"))
+
+    def add(self, locality: str, signature: str, dst_filename: str,
+            duration: datetime.timedelta, bytes_read: int) -> None:
+        """ Appends record on successfully merged locality
+
+        Arguments:
+        locality     -- Locality name
+        signature    -- Locality merge signature
+        dst_filename -- Resulting file name
+        duration     -- Merge duration
+        bytes_read   -- Total size of source files
+        """
+        st = os.stat(dst_filename)
+        record = {"locality": locality, "signature": signature,
+                  "dst_filename": dst_filename, "size": st.st_size,
+                  "mtime_ns": st.st_mtime_ns,
+                  "duration_sec": duration.total_seconds(),
+                  "bytes_read": bytes_read,
+                  "timestamp": datetime.datetime.now().isoformat()}
+        self._records[locality] = record
+        with open(self._filename, mode="a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
 
 def merge_worker(
         src_dir: str, dst_dir: str, locality: str, out_ext: Optional[str],
@@ -90,43 +268,26 @@ def merge_worker(
     try:
         start_time = datetime.datetime.now()
         warn_msg: str = ""
-        srcs: List[str] = []
         src_extensions: Set[str] = set()
         src_pixel_sizes: Set[Tuple[Optional[float], Optional[float]]] = set()
-        csv_file_nmame = os.path.join(src_dir, CSV_PATTERN % locality)
-        with open(csv_file_nmame, newline='', encoding="utf-8") as csv_f:
-            for row in csv.DictReader(csv_f):
-                if "FILE" not in row:
-                    return \
-                        ConvResult(
-                            locality=locality, status=ConvStatus.Error,
-                            duration=datetime.datetime.now() - start_time,
-                            msg=f"Invalid '{csv_file_nmame}' file structure")
-                src_filename = os.path.join(src_dir, locality, row["FILE"])
-                if not os.path.isfile(src_filename):
-                    return \
-                        ConvResult(
-                            locality=locality, status=ConvStatus.Error,
-                            duration=datetime.datetime.now() - start_time,
-                            msg=f"Source file '{src_filename}' of locality "
-                            f"'{locality}' not found")
-                gi = GdalInfo(src_filename, fail_on_error=False)
-                if not gi:
-                    return \
-                        ConvResult(
-                            locality=locality, status=ConvStatus.Error,
-                            duration=datetime.datetime.now() - start_time,
-                            msg=f"Unable to inspect '{src_filename}' of "
-                            f"locality '{locality}' with gdalinfo")
-                src_extensions.add(os.path.splitext(src_filename)[1])
-                src_pixel_sizes.add((gi.pixel_size_lat, gi.pixel_size_lon))
-                srcs.append(src_filename)
-        if not srcs:
-            return \
-                ConvResult(
-                    locality=locality, status=ConvStatus.Error,
-                    duration=datetime.datetime.now() - start_time,
-                    msg=f"Locality '{locality}' have no source files")
+        try:
+            srcs = read_locality_csv(src_dir, locality).srcs
+        except ValueError as ex:
+            return ConvResult(locality=locality, status=ConvStatus.Error,
+                              duration=datetime.datetime.now() - start_time,
+                              msg=str(ex))
+        bytes_read = sum(os.path.getsize(src) for src in srcs)
+        for src_filename in srcs:
+            gi = GdalInfo(src_filename, fail_on_error=False)
+            if not gi:
+                return \
+                    ConvResult(
+                        locality=locality, status=ConvStatus.Error,
+                        duration=datetime.datetime.now() - start_time,
+                        msg=f"Unable to inspect '{src_filename}' of "
+                        f"locality '{locality}' with gdalinfo")
+            src_extensions.add(os.path.splitext(src_filename)[1])
+            src_pixel_sizes.add((gi.pixel_size_lat, gi.pixel_size_lon))
         srcs.reverse()
         if len(src_pixel_sizes) != 1:
             if warn_msg:
@@ -201,7 +362,8 @@ def merge_worker(
         os.rename(temp_filename, dst_filename)
         return ConvResult(locality=locality, status=ConvStatus.Success,
                           duration=datetime.datetime.now() - start_time,
-                          msg=warn_msg, command_line=command_line)
+                          msg=warn_msg, command_line=command_line,
+                          dst_filename=dst_filename, bytes_read=bytes_read)
     except (Exception, KeyboardInterrupt, SystemExit) as ex:
         return ConvResult(locality=locality, status=ConvStatus.Error,
                           duration=datetime.datetime.now() - start_time,
@@ -215,6 +377,106 @@ def merge_worker(
                 pass
 
 
+def in_process_merge_init() -> None:
+    """ Initializer of in-process merge worker process """
+    gdal.UseExceptions()
+
+
+def in_process_merge_worker(
+        src_dir: str, dst_dir: str, locality: str, out_ext: Optional[str],
+        out_format: Optional[str], resampling: str, format_params: List[str],
+        overwrite: bool) -> ConvResult:
+    """ Merge worker that uses GDAL Python bindings.
+
+    Source files are opened once - datasets are used both for inspection and
+    for building VRT (in /vsimem/). Worker processes are long-lived, so GDAL
+    block cache persists between localities
+
+    Arguments:
+    src_dir       -- Source directory
+    dst_dir       -- Destination directory
+    locality      -- Locality (subdirectory with .tif files)
+    out_ext       -- Optional output file extension
+    out_format    -- Optional output format (GDAL driver name)
+    resampling    -- Resampling for VRT
+    format_params -- Optional output format parameters
+    overwrite     -- True to overwrite existing files
+    Return Conversion result
+    """
+    start_time = datetime.datetime.now()
+    mem_filename_vrt = f"/vsimem/{locality}_{os.getpid()}.vrt"
+    temp_filename: Optional[str] = None
+    datasets: List[Any] = []
+    try:
+        warn_msg: str = ""
+        try:
+            srcs = read_locality_csv(src_dir, locality).srcs
+        except ValueError as ex:
+            return ConvResult(locality=locality, status=ConvStatus.Error,
+                              duration=datetime.datetime.now() - start_time,
+                              msg=str(ex))
+        bytes_read = sum(os.path.getsize(src) for src in srcs)
+        src_extensions = {os.path.splitext(src)[1] for src in srcs}
+        if out_ext is None:
+            if len(src_extensions) != 1:
+                return \
+                    ConvResult(
+                        locality=locality, status=ConvStatus.Error,
+                        duration=datetime.datetime.now() - start_time,
+                        msg=f"Source files for locality '{locality}' have "
+                        f"have different extensions. Extension for output "
+                        f"file must be explicitly specified")
+            out_ext = list(src_extensions)[0]
+        dst_filename = os.path.join(dst_dir, locality) + out_ext
+        temp_filename = \
+            os.path.join(dst_dir, locality) + ".incomplete" + out_ext
+        if os.path.isfile(dst_filename) and (not overwrite):
+            return ConvResult(locality=locality, status=ConvStatus.Exists,
+                              duration=datetime.datetime.now() - start_time)
+        src_pixel_sizes: Set[Tuple[float, float]] = set()
+        for src in reversed(srcs):
+            datasets.append(gdal.Open(src, gdal.GA_ReadOnly))
+            geo_transform = datasets[-1].GetGeoTransform()
+            src_pixel_sizes.add((abs(geo_transform[5]),
+                                 abs(geo_transform[1])))
+        if len(src_pixel_sizes) != 1:
+            warn_msg = f"Locality '{locality}' has different pixel sizes " \
+                f"in different source files. Pixel sizes of the last file " \
+                f"({srcs[-1]}) will be used"
+        vrt = gdal.BuildVRT(
+            mem_filename_vrt, datasets,
+            options=gdal.BuildVRTOptions(
+                resampleAlg=resampling or None,
+                options=["-ignore_srcmaskband"]))
+        # Resulting dataset is not retained, hence closed immediately
+        gdal.Translate(
+            temp_filename, vrt,
+            options=gdal.TranslateOptions(format=out_format,
+                                          creationOptions=format_params,
+                                          strict=True))
+        vrt = None
+        os.replace(temp_filename, dst_filename)
+        return ConvResult(locality=locality, status=ConvStatus.Success,
+                          duration=datetime.datetime.now() - start_time,
+                          msg=warn_msg, dst_filename=dst_filename,
+                          bytes_read=bytes_read)
+    except (Exception, KeyboardInterrupt, SystemExit) as ex:
+        return ConvResult(locality=locality, status=ConvStatus.Error,
+                          duration=datetime.datetime.now() - start_time,
+                          msg=repr(ex))
+    finally:
+        datasets = []
+        if gdal.VSIStatL(mem_filename_vrt) is not None:
+            gdal.Unlink(mem_filename_vrt)
+        for filename in (temp_filename,
+                         temp_filename and (temp_filename + ".aux.xml")):
+            try:
+                if filename and os.path.isfile(filename):
+                    os.unlink(filename)
+            except OSError:
+                pass
+
+
 def main(argv: List[str]) -> None:
     """Do the job.
 
@@ -261,6 +523,16 @@ def main(argv: List[str]) -> None:
         "--out_ext", metavar=".EXT",
         help="Extension for output files. Default is to keep original "
         "extension")
+    argument_parser.add_argument(
+        "--in_process", action="store_true",
+        help="Merge with GDAL Python bindings in worker processes instead of "
+        "running GDAL utilities. Requires GDAL Python bindings")
+    argument_parser.add_argument(
+        "--journal", metavar="JOURNAL_FILE",
+        help="Progress journal file (created if absent). Localities recorded "
+        "in it as merged are skipped if their source files, merge parameters "
+        "and resulting file did not change since. Resulting files not "
+        "recorded in journal are redone")
     argument_parser.add_argument(
         "--verbose", action="store_true",
         help="Process localities sequentially, print verbose gdal_translate "
@@ -284,6 +556,8 @@ def main(argv: List[str]) -> None:
 
     error_if(not os.path.isdir(args.SRC_DIR),
              f"Source directory '{args.SRC_DIR}' not found")
+    error_if(args.in_process and (not HAS_GDAL),
+             "--in_process requires GDAL Python bindings to be installed")
 
     start_time = datetime.datetime.now()
 
@@ -308,10 +582,41 @@ def main(argv: List[str]) -> None:
         error_if(not localities,
                  f"No LiDAR localities found in '{args.SRC_DIR}'")
 
+    # Ordering localities so that nearby ones are processed one after another
+    centers: Dict[str, Optional[Tuple[float, float]]] = {}
+    for locality in localities:
+        try:
+            centers[locality] = \
+                read_locality_csv(args.SRC_DIR, locality).center
+        except (OSError, ValueError):
+            centers[locality] = None
+    localities.sort(key=lambda locality: z_order_key(centers[locality]))
+
+    journal = MergeJournal(args.journal) if args.journal else None
+    # Merge signatures of localities, indexed by locality names
+    signatures: Dict[str, str] = {}
+    # Localities already merged according to journal
+    journaled_localities: List[str] = []
+    if journal is not None:
+        params = [args.out_ext, args.format, args.resampling,
+                  args.format_param]
+        for locality in localities:
+            try:
+                signatures[locality] = \
+                    MergeJournal.signature(
+                        read_locality_csv(args.SRC_DIR, locality).srcs,
+                        params)
+            except (OSError, ValueError):
+                continue
+            if (not args.overwrite) and \
+                    journal.is_complete(locality, signatures[locality]):
+                journaled_localities.append(locality)
+
     completed_count = [0]  # List to facilitate closure in completer()
     total_count = len(localities)
     skipped_localities: List[str] = []
     failed_localities: List[str] = []
+    total_bytes_read = [0]  # List to facilitate closure in completer()
 
     def completer(cr: ConvResult) -> None:
         """ Processes completion of a single file """
@@ -330,9 +635,19 @@ def main(argv: List[str]) -> None:
             failed_localities.append(cr.locality)
         else:
             assert cr.status == ConvStatus.Success
-            if cr.msg is not None:
-                msg += "\n" + cr.msg
-            msg += f"Converted in {Durator.duration_to_hms(cr.duration)}"
+            if cr.msg:
+                msg += "\n" + cr.msg + "\n"
+            seconds = cr.duration.total_seconds()
+            msg += f"Converted in {Durator.duration_to_hms(cr.duration)}, " \
+                f"{cr.bytes_read / 1024 / 1024:.1f}MB read " \
+                f"({cr.bytes_read / 1024 / 1024 / (seconds or 1):.1f}MB/s)"
+            total_bytes_read[0] += cr.bytes_read
+            if (journal is not None) and (cr.locality in signatures):
+                assert cr.dst_filename is not None
+                journal.add(locality=cr.locality,
+                            signature=signatures[cr.locality],
+                            dst_filename=cr.dst_filename,
+                            duration=cr.duration, bytes_read=cr.bytes_read)
         print(msg)
 
     common_kwargs = {
@@ -342,25 +657,48 @@ def main(argv: List[str]) -> None:
         "out_format": args.format,
         "resampling": args.resampling,
         "format_params": args.format_param,
-        "overwrite": args.overwrite,
-        "verbose": args.verbose}
+        "overwrite": args.overwrite}
+    if not args.in_process:
+        common_kwargs["verbose"] = args.verbose
+    worker = in_process_merge_worker if args.in_process else merge_worker
+
+    def locality_kwargs(locality: str) -> Dict[str, Any]:
+        """ Worker arguments for given locality """
+        ret = common_kwargs.copy()
+        ret["locality"] = locality
+        if journal is not None:
+            # Results not verified by journal are redone
+            ret["overwrite"] = True
+        return ret
+
     try:
+        for locality in journaled_localities:
+            completer(
+                ConvResult(locality=locality, status=ConvStatus.Exists,
+                           duration=datetime.timedelta()))
+        localities = [locality for locality in localities
+                      if locality not in journaled_localities]
         if args.verbose:
+            if args.in_process:
+                in_process_merge_init()
             for locality in localities:
-                completer(merge_worker(locality=locality, **common_kwargs))
+                completer(worker(**locality_kwargs(locality)))
         else:
             original_sigint_handler = \
                 signal.signal(signal.SIGINT, signal.SIG_IGN)
-            with multiprocessing.pool.ThreadPool(
-                    processes=threads_arg(args.threads)) as pool:
+            with (multiprocessing.Pool(processes=threads_arg(args.threads),
+                                       initializer=in_process_merge_init)
+                  if args.in_process else
+                  multiprocessing.pool.ThreadPool(
+                      processes=threads_arg(args.threads))) as pool:
                 signal.signal(signal.SIGINT, original_sigint_handler)
                 for locality in localities:
-                    kwds = common_kwargs.copy()
-                    kwds["locality"] = locality
-                    pool.apply_async(merge_worker, kwds=kwds,
+                    pool.apply_async(worker, kwds=locality_kwargs(locality),
                                      callback=completer)
                 pool.close()
                 pool.join()
+        print(f"{total_bytes_read[0] / 1024 / 1024 / 1024:.2f}GB of source "
+              f"data read")
         if skipped_localities:
             print(f"{len(skipped_localities)} previously processed localities "
                   "skipped")
@@ -11,15 +11,13 @@
 # pylint: disable=too-many-branches, too-many-statements, wrong-import-order
 
 import argparse
-import datetime
-import math
+import numpy as np
 import os
 from osgeo import gdal
 import sqlite3
-import struct
 import sys
 import tempfile
-from typing import Dict, List, Optional
+from typing import Iterator, List, Optional, Tuple
 
 from geoutils import error, error_if, setup_logging, warp
 
@@ -37,8 +35,41 @@ MAX_LAT_FIELD = "max_lat"
 MIN_LON_FIELD = "min_lon"
 MAX_LON_FIELD = "max_lon"
 
-# Database bulk write saize (in number of records)
-BULK_WRITE_THRESHOLD = 1000
+# Approximate number of pixels in raster block read at once
+BLOCK_PIXELS = 4 * 1024 * 1024
+
+# PRAGMAs for bulk load of (freshly created) database. Database is deleted on
+# failure anyway, so there is no point in journaling and syncing
+BULK_LOAD_PRAGMAS = ["journal_mode = OFF", "synchronous = OFF",
+                     "locking_mode = EXCLUSIVE", "temp_store = MEMORY",
+                     "cache_size = -262144"]
+
+
+def raster_blocks(band: gdal.Band, nodata: Optional[float]) \
+        -> Iterator[Tuple[int, Tuple[np.ndarray, np.ndarray], np.ndarray]]:
+    """ Reads raster by blocks of lines, yields nonzero valid pixels
+
+    Arguments:
+    band   -- Raster band to read
+    nodata -- NoData value or None
+    Yields (first_line_idx, (line_indices, column_indices), values) tuples.
+    Line indices are relative to block, pixel order is row-major
+    """
+    line_len = band.XSize
+    num_lines = band.YSize
+    block_lines = max(1, BLOCK_PIXELS // max(line_len, 1))
+    for yoff in range(0, num_lines, block_lines):
+        print(f"Line {yoff} of {num_lines} ({yoff * 100 / num_lines:.1f}%)",
+              end="\r", flush=True)
+        block = \
+            band.ReadAsArray(xoff=0, yoff=yoff, win_xsize=line_len,
+                             win_ysize=min(block_lines, num_lines - yoff)).\
+            astype(np.float64, copy=False)
+        valid = (block != 0) & ~np.isnan(block)
+        if nodata is not None:
+            valid &= block != nodata
+        yield (yoff, np.nonzero(valid), block[valid])
+    print("")
 
 
 def main(argv: List[str]) -> None:
@@ -111,78 +142,66 @@ def main(argv: List[str]) -> None:
              overwrite=True, quiet=False)
         db_conn = sqlite3.connect(args.TO)
         db_cur = db_conn.cursor()
+        for pragma in BULK_LOAD_PRAGMAS:
+            db_cur.execute(f"PRAGMA {pragma}")
         db_cur.execute(
             f"CREATE TABLE {TABLE_NAME}({CUMULATIVE_DENSITY_FIELD} real, "
             f"{MIN_LAT_FIELD} real, {MAX_LAT_FIELD} real, "
             f"{MIN_LON_FIELD} real, {MAX_LON_FIELD} real)")
-        db_cur.execute(
-            f"CREATE INDEX {CUMULATIVE_DENSITY_FIELD}_idx ON {TABLE_NAME}"
-            f"({CUMULATIVE_DENSITY_FIELD} ASC)")
         gdal_dataset = gdal.Open(scaled_file, gdal.GA_ReadOnly)
-        line_len = gdal_dataset.RasterXSize
-        num_lines = gdal_dataset.RasterYSize
         lon0, lon_res, _, lat0, _, lat_res = gdal_dataset.GetGeoTransform()
-        unpack_format = "d" * line_len
-
         gdal_band = gdal_dataset.GetRasterBand(1)
         nodata = gdal_band.GetNoDataValue()
 
+        print("Computing total population")
         total_population: float = 0
-        bulk: List[Dict[str, float]] = []
-        start_time = datetime.datetime.now()
-        print("Fetching density data from file")
-        for lat_idx in range(num_lines):
-            print(f"Line {lat_idx} of {num_lines} "
-                  f"({lat_idx * 100 / num_lines:.1f}%)",
-                  end="\r", flush=True)
-            raster_bytes = gdal_band.ReadRaster(xoff=0, yoff=lat_idx,
-                                                xsize=line_len, ysize=1)
-            raster_values = struct.unpack(unpack_format, raster_bytes)
-            for lon_idx in range(line_len):
-                v = raster_values[lon_idx]
-                if math.isnan(v) or (v in (0, nodata)):
-                    continue
-                total_population += v
-                lat1 = lat0 + lat_idx * lat_res
-                lat2 = lat0 + (lat_idx + 1) * lat_res
-                lon1 = lon0 + lon_idx * lon_res
-                lon2 = lon0 + (lon_idx + 1) * lon_res
-                min_lon = min(lon1, lon2)
-                max_lon = max(lon1, lon2)
-                while min_lon < -180:
-                    min_lon += 360
-                    max_lon += 360
-                while max_lon > 180:
-                    min_lon -= 360
-                    max_lon -= 360
-                bulk.append({CUMULATIVE_DENSITY_FIELD: total_population,
-                             MIN_LAT_FIELD: min(lat1, lat2),
-                             MAX_LAT_FIELD: max(lat1, lat2),
-                             MIN_LON_FIELD: min_lon,
-                             MAX_LON_FIELD: max_lon})
-                if len(bulk) < BULK_WRITE_THRESHOLD:
-                    continue
-                db_cur.executemany(
-                    f"INSERT INTO {TABLE_NAME} VALUES("
-                    f":{CUMULATIVE_DENSITY_FIELD}, "
-                    f":{MIN_LAT_FIELD}, :{MAX_LAT_FIELD},"
-                    f":{MIN_LON_FIELD}, :{MAX_LON_FIELD})",
-                    bulk)
-                db_conn.commit()
-                bulk = []
-        if bulk:
+        for _, _, values in raster_blocks(gdal_band, nodata):
+            if len(values):
+                # Summation order is the same as in cumulative sum below, so
+                # last cumulative density will be exactly 1
+                values[0] += total_population
+                total_population = float(np.cumsum(values)[-1])
+        print(f"Population total: {total_population}")
+        error_if(total_population == 0, "No population in source file")
+
+        print("Writing density data to database")
+        cumulative_population: float = 0
+        for yoff, (line_indices, lon_indices), values in \
+                raster_blocks(gdal_band, nodata):
+            if not len(values):
+                continue
+            values[0] += cumulative_population
+            cumulative = np.cumsum(values)
+            cumulative_population = float(cumulative[-1])
+            lat_indices = line_indices + yoff
+            lat1 = lat0 + lat_indices * lat_res
+            lat2 = lat0 + (lat_indices + 1) * lat_res
+            lon1 = lon0 + lon_indices * lon_res
+            lon2 = lon0 + (lon_indices + 1) * lon_res
+            min_lon = np.minimum(lon1, lon2)
+            max_lon = np.maximum(lon1, lon2)
+            while True:
+                below = min_lon < -180
+                if not below.any():
+                    break
+                min_lon[below] += 360
+                max_lon[below] += 360
+            while True:
+                above = max_lon > 180
+                if not above.any():
+                    break
+                min_lon[above] -= 360
+                max_lon[above] -= 360
             db_cur.executemany(
-                f"INSERT INTO {TABLE_NAME} VALUES("
-                f":{CUMULATIVE_DENSITY_FIELD}, "
-                f":{MIN_LAT_FIELD}, :{MAX_LAT_FIELD},"
-                f":{MIN_LON_FIELD}, :{MAX_LON_FIELD})",
-                bulk)
-            db_conn.commit()
-            bulk = []
-        print(f"\nPopulation total: {total_population}")
-        print("Normalizing density")
-        db_cur.execute(f"UPDATE {TABLE_NAME} SET {CUMULATIVE_DENSITY_FIELD} = "
-                       f"{CUMULATIVE_DENSITY_FIELD} / {total_population}")
+                f"INSERT INTO {TABLE_NAME} VALUES(?, ?, ?, ?, ?)",
+                zip((cumulative / total_population).tolist(),
+                    np.minimum(lat1, lat2).tolist(),
+                    np.maximum(lat1, lat2).tolist(),
+                    min_lon.tolist(), max_lon.tolist()))
+        print("Building index")
+        db_cur.execute(
+            f"CREATE INDEX {CUMULATIVE_DENSITY_FIELD}_idx ON {TABLE_NAME}"
+            f"({CUMULATIVE_DENSITY_FIELD} ASC)")
         db_conn.commit()
         success = True
     except KeyboardInterrupt:
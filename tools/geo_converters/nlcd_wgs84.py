@@ -13,15 +13,15 @@
 import argparse
 from collections.abc import Iterable
 import os
-import struct
 import sys
 import tempfile
-from typing import Dict, List, NamedTuple, Set, Tuple
+from typing import Any, Dict, List, NamedTuple, Set, Tuple
 import yaml
 
 from geoutils import *
 
 try:
+    import numpy as np
     from osgeo import gdal
     HAS_GDAL = True
 except ImportError:
@@ -33,6 +33,16 @@ PARAM_FILE_NAME = os.path.splitext(__file__)[0] + ".yaml"
 # Length of color table in translated file
 TARGET_COLOR_TABLE_LENGTH = 256
 
+# Minimum length of source to target code lookup table (covers all Byte
+# codes)
+LUT_LENGTH = 256
+
+# Maximum length of source to target code lookup table
+MAX_LUT_LENGTH = 65536
+
+# Approximate number of pixels in translation window
+WINDOW_PIXELS = 4 * 1024 * 1024
+
 DEFAULT_RESAMPLING = "near"
 
 
@@ -192,117 +202,90 @@ class YamlParams:
         return {k: i.target_code for k, i in self.encodings[name].items()}
 
 
-class TranslationContexts:
-    """ Collection of translation contexts.
-
-    Private attributes:
-    self._contexts -- Contexts, ordered by row length and data type
-    """
-    # Translation context: preallocated buffers and constants used in
-    # translation
-    TranslationContext = \
-        NamedTuple("TranslationContext",
-                   [
-                       # Format of input data for estruct.unpack()
-                       ("input_format", str),
-                       # Format of output data for struct.pack()
-                       ("output_format", str),
-                       # Buffer for output data
-                       ("buffer", List[int])])
-
-    # Translation of GDAL raster data types to struct data types
-    _DATA_SIZES: Dict[int, str] = \
-        {gdal.GDT_Byte: "B",
-         gdal.GDT_Int8: "b",
-         gdal.GDT_Int16: "h",
-         gdal.GDT_Int32: "i",
-         gdal.GDT_UInt16: "H",
-         gdal.GDT_UInt32: "I"} if HAS_GDAL else {}
-
-    def __init__(self) -> None:
-        """ Constructor """
-        self._contexts: \
-            Dict[Tuple[int, int],
-                 "TranslationContexts.TranslationContext"] = {}
-
-    def get_context(self, input_size: int, data_type_code: int) \
-            -> "TranslationContexts.TranslationContext":
-        """ Context for given data length and type
-
-        Arguments:
-        input_size     -- Input data size in bytes
-        data_type_code -- GDAL input data type code
-        Returns Context for given size and data type
-        """
-        key = (input_size, data_type_code)
-        ret = self._contexts.get(key)
-        if ret is None:
-            struct_data_type = self._DATA_SIZES.get(data_type_code)
-            error_if(struct_data_type is None,
-                     f"Unsupported data type code of {data_type_code} in "
-                     f"source file")
-            assert struct_data_type is not None
-            length = input_size // struct.calcsize(struct_data_type)
-            ret = \
-                self.TranslationContext(
-                    input_format=length * struct_data_type,
-                    output_format=length * "B", buffer=length * [0])
-            self._contexts[key] = ret
-        return ret
-
-
 class Translation:
-    """ Pixel row translator to NLCD encoding.
-    This class intended to be used as context manager (with 'with`)
+    """ Translator of source raster windows to NLCD encoding
+
+    Translation is made by means of lookup table, applied to whole windows
+    (block-aligned full-width strips of source raster). Windows are read in
+    worker processes, each opening source file once. Lookup table starts at
+    the minimum of 0 and the minimum source code (hence negative codes of
+    signed data types are supported)
 
     Private attributes:
-    _translation_dict     -- Dictionary from source to target (NLCD as of time
-                             of this writing) encoding
-    _default_code         -- Code to use when source code missing in
-                             translation dictionary
-    _data_type_code       -- GDAL pixel data type code
-    _translation_contexts -- Translation context factory
+    _src          -- Source file name
+    _lut_base     -- Source code of the first lookup table entry
+    _lut          -- Lookup table from source to target (NLCD as of time of
+                     this writing) codes
+    _known        -- Lookup table of source codes present in translation
+                     dictionary
+    _default_code -- Code to use when source code missing in translation
+                     dictionary
+    _band         -- Source raster band (opened in worker process on first
+                     use)
     """
+    # Window of source raster (full-width strip)
+    Window = \
+        NamedTuple("Window",
+                   [
+                       # Top row of window
+                       ("yoff", int),
+                       # Number of rows in window
+                       ("ysize", int)])
 
-    def __init__(self, translation_dict: Dict[int, int], default_code: int,
-                 data_type_code: int) -> None:
+    def __init__(self, src: str, translation_dict: Dict[int, int],
+                 default_code: int) -> None:
         """ Constructor
 
         Arguments:
+        src               -- Source file name
         translation _dict -- Translation dictionary to target encoding
         default_code      -- Default code in target encoding
-        data_type_code    -- GDAL pixel data type code
         """
-        self._translation_dict = translation_dict
+        self._src = src
         self._default_code = default_code
-        self._data_type_code = data_type_code
-        self._translation_contexts = TranslationContexts()
-
-    def translate(self, input_bytes: bytes) -> Tuple[bytes, Set[int]]:
-        """ Translate pixel row
+        self._lut_base = min([0] + list(translation_dict.keys()))
+        lut_length = \
+            max([LUT_LENGTH - 1] + list(translation_dict.keys())) - \
+            self._lut_base + 1
+        error_if(lut_length > MAX_LUT_LENGTH,
+                 f"Source codes span range of {lut_length} values, which "
+                 f"exceeds maximum of {MAX_LUT_LENGTH}")
+        self._lut = np.full(lut_length, default_code, dtype=np.uint8)
+        self._known = np.zeros(lut_length, dtype=bool)
+        for src_code, dst_code in translation_dict.items():
+            self._lut[src_code - self._lut_base] = dst_code
+            self._known[src_code - self._lut_base] = True
+        self._band: Any = None
+
+    def translate(self, window: "Translation.Window") \
+            -> Tuple["Translation.Window", Any, Set[int]]:
+        """ Reads and translates raster window
 
         Arguments:
-        input_bytes -- Input raster line byte string
-        Returns tuple with translated raster line and set of codes that were
-        not in translation dictionary
+        window -- Window to translate
+        Returns tuple with window, translated window data (NumPy array) and
+        set of codes that were not in translation dictionary
         """
-        tc = \
-            self._translation_contexts.get_context(
-                input_size=len(input_bytes),
-                data_type_code=self._data_type_code)
-        input_values = struct.unpack(tc.input_format, input_bytes)
-        unknown_codes: Set[int] = set()
-        end_idx = len(input_values)
-        idx = 0
-        while idx < end_idx:
-            try:
-                while idx < end_idx:
-                    tc.buffer[idx] = self._translation_dict[input_values[idx]]
-                    idx += 1
-            except KeyError:
-                unknown_codes.add(input_values[idx])
-                self._translation_dict[input_values[idx]] = self._default_code
-        return (struct.pack(tc.output_format, *tc.buffer), unknown_codes)
+        if self._band is None:
+            self._band = gdal.Open(self._src, gdal.GA_ReadOnly).\
+                GetRasterBand(1)
+        data = self._band.ReadAsArray(xoff=0, yoff=window.yoff,
+                                      win_xsize=self._band.XSize,
+                                      win_ysize=window.ysize)
+        if (data.dtype == np.uint8) and (self._lut_base == 0):
+            ret = self._lut[data]
+            known = self._known[data]
+        else:
+            indices = data.astype(np.int64) - self._lut_base
+            in_range = (indices >= 0) & (indices < len(self._lut))
+            indices = np.where(in_range, indices, 0)
+            ret = np.where(in_range, self._lut[indices],
+                           np.uint8(self._default_code))
+            known = in_range & self._known[indices]
+        unknown_codes: Set[int] = \
+            set() if known.all() \
+            else {int(code) for code in np.unique(data[~known])}
+        return (window, ret, unknown_codes)
 
 
 def translate(src: str, dst: str, yaml_params: YamlParams,
@@ -332,30 +315,41 @@ def translate(src: str, dst: str, yaml_params: YamlParams,
     band_dst.SetRasterColorTable(color_table_dst)
     band_dst.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
     band_dst.SetNoDataValue(yaml_params.default_code)
+    error_if(band_src.DataType not in
+             (gdal.GDT_Byte, gdal.GDT_Int8, gdal.GDT_Int16, gdal.GDT_Int32,
+              gdal.GDT_UInt16, gdal.GDT_UInt32),
+             f"Unsupported data type code of {band_src.DataType} in source "
+             f"file")
     translation = \
         Translation(
+            src=src,
             translation_dict=yaml_params.get_translation_dict(
                 translation_name),
-            default_code=yaml_params.default_code,
-            data_type_code=band_src.DataType)
+            default_code=yaml_params.default_code)
     progressor = GdalProgressor(filename=src, total_lines=band_src.YSize)
-
-    def scan_line_producer() -> Iterable[bytes]:
-        """ Produces scan lines from the source file """
-        for y in range(band_src.YSize):
-            yield band_src.ReadRaster(xoff=0, yoff=y,
-                                      xsize=band_src.XSize, ysize=1)
+    # Windows are full-width strips, whose height is a multiple of native
+    # block height
+    block_height = band_src.GetBlockSize()[1]
+    window_height = \
+        block_height * \
+        max(WINDOW_PIXELS // (band_src.XSize * block_height), 1)
+
+    def window_producer() -> Iterable[Translation.Window]:
+        """ Produces windows of the source file """
+        for yoff in range(0, band_src.YSize, window_height):
+            yield Translation.Window(
+                yoff=yoff, ysize=min(window_height, band_src.YSize - yoff))
 
     unknown_codes: Set[int] = set()
-    with WindowedProcessPool(producer=scan_line_producer(),
+    # Windows are read and translated by workers while translated ones are
+    # written here
+    with WindowedProcessPool(producer=window_producer(),
                              processor=translation.translate,
-                             max_in_flight=100, threads=threads) as wpp:
-        y = 0
-        for scanline_dst, uc in wpp:
-            band_dst.WriteRaster(xoff=0, yoff=y, xsize=band_src.XSize, ysize=1,
-                                 buf_string=scanline_dst)
-            progressor.progress(y)
-            y += 1
+                             max_in_flight=2 * threads,
+                             threads=threads) as wpp:
+        for window, data_dst, uc in wpp:
+            band_dst.WriteArray(data_dst, xoff=0, yoff=window.yoff)
+            progressor.progress(window.yoff + window.ysize - 1)
             unknown_codes |= uc
     ds_dst.FlushCache()
     ds_dst = None
@@ -448,8 +442,8 @@ def main(argv: List[str]) -> None:
              f"'{args.DST}' already exists. Specify --overwrite to overwrite")
     error_if(
         (args.encoding is not None) and (not HAS_GDAL),
-        "Python GDAL support was not installed. Try to  'pip install gdal' or "
-        "run containerized version of this script")
+        "Python GDAL (and NumPy) support was not installed. Try to  'pip "
+        "install numpy gdal' or run containerized version of this script")
     os.makedirs(
         os.path.dirname(os.path.abspath(
             os.path.expanduser(os.path.expandvars(args.DST)))),
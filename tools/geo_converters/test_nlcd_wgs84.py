@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+""" Tests of nlcd_wgs84.py land cover translation: lookup table translation
+is compared with per-pixel dictionary translation (previously used by
+nlcd_wgs84.py) on synthetic rasters
+
+Run tests:        python3 -m unittest test_nlcd_wgs84
+Run benchmark:    AFC_BENCHMARK=1 python3 -m unittest \
+                      test_nlcd_wgs84.TestBenchmark
+"""
+
+# Copyright (C) 2022 Broadcom. All rights reserved.
+# The term "Broadcom" refers solely to the Broadcom Inc. corporate affiliate
+# that owns the software below.
+# This work is licensed under the OpenAFC Project License, a copy of which is
+# included with this software program.
+
+# pylint: disable=invalid-name, protected-access
+
+import os
+import time
+from typing import Any, Dict, Set, Tuple
+import unittest
+
+import nlcd_wgs84
+
+np: Any = getattr(nlcd_wgs84, "np", None)
+
+# Synthetic raster dimensions
+WIDTH = 300
+HEIGHT = 200
+
+# Benchmark raster dimension
+BENCHMARK_SIZE = 2000
+
+
+class FakeBand:
+    """ Raster band, that returns windows of given array """
+
+    def __init__(self, data: Any) -> None:
+        self.XSize = data.shape[1]
+        self._data = data
+
+    def ReadAsArray(self, xoff: int, yoff: int, win_xsize: int,
+                    win_ysize: int) -> Any:
+        """ Window of raster data """
+        return self._data[yoff: yoff + win_ysize, xoff: xoff + win_xsize]
+
+
+def dict_translate(data: Any, translation_dict: Dict[int, int],
+                   default_code: int) -> Tuple[Any, Set[int]]:
+    """ Per-pixel dictionary translation (reference implementation).
+    Returns translated data and set of unknown codes """
+    translation_dict = dict(translation_dict)
+    unknown_codes: Set[int] = set()
+    ret = []
+    for value in data.flatten().tolist():
+        if value not in translation_dict:
+            unknown_codes.add(value)
+            translation_dict[value] = default_code
+        ret.append(translation_dict[value])
+    return (np.array(ret, dtype=np.uint8).reshape(data.shape), unknown_codes)
+
+
+def lut_translate(data: Any, translation_dict: Dict[int, int],
+                  default_code: int, window_height: int = HEIGHT) \
+        -> Tuple[Any, Set[int]]:
+    """ Lookup table translation by windows (implementation under test).
+    Returns translated data and set of unknown codes """
+    translation = nlcd_wgs84.Translation(src="",
+                                         translation_dict=translation_dict,
+                                         default_code=default_code)
+    translation._band = FakeBand(data)
+    ret = np.zeros(data.shape, dtype=np.uint8)
+    unknown_codes: Set[int] = set()
+    for yoff in range(0, data.shape[0], window_height):
+        window, window_data, window_unknown = \
+            translation.translate(
+                nlcd_wgs84.Translation.Window(
+                    yoff=yoff,
+                    ysize=min(window_height, data.shape[0] - yoff)))
+        ret[window.yoff: window.yoff + window.ysize, :] = window_data
+        unknown_codes |= window_unknown
+    return (ret, unknown_codes)
+
+
+def random_raster(dtype: Any, codes: Any,
+                  shape: Tuple[int, int] = (HEIGHT, WIDTH)) -> Any:
+    """ Raster of given type, made of given codes and random values """
+    rng = np.random.default_rng(seed=1)
+    info = np.iinfo(dtype)
+    ret = rng.choice(np.array(list(codes), dtype=np.int64), size=shape)
+    noise = rng.integers(info.min, info.max, size=shape, endpoint=True)
+    ret = np.where(rng.random(size=shape) < 0.1, noise, ret)
+    return ret.astype(dtype)
+
+
+@unittest.skipIf(np is None, "NumPy not installed")
+class TestTranslation(unittest.TestCase):
+    """ Lookup table translation """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._yaml_params = nlcd_wgs84.YamlParams()
+
+    def _check(self, data: Any, translation_dict: Dict[int, int],
+               window_height: int = HEIGHT) -> None:
+        """ Checks that both translations give the same result """
+        expected, expected_unknown = \
+            dict_translate(data, translation_dict,
+                           self._yaml_params.default_code)
+        actual, actual_unknown = \
+            lut_translate(data, translation_dict,
+                          self._yaml_params.default_code,
+                          window_height=window_height)
+        self.assertTrue(np.array_equal(actual, expected))
+        self.assertEqual(actual_unknown, expected_unknown)
+
+    def test_encodings(self) -> None:
+        """ All encodings on rasters of all supported types """
+        for name in self._yaml_params.encodings:
+            translation_dict = self._yaml_params.get_translation_dict(name)
+            for dtype in (np.uint8, np.int8, np.int16, np.uint16, np.int32,
+                          np.uint32):
+                info = np.iinfo(dtype)
+                codes = [code for code in translation_dict
+                         if info.min <= code <= info.max] or [0]
+                with self.subTest(encoding=name, dtype=dtype.__name__):
+                    self._check(random_raster(dtype, codes),
+                                translation_dict)
+
+    def test_negative_codes(self) -> None:
+        """ Negative codes (like -128 'No data' of CORINE) are translated """
+        translation_dict = self._yaml_params.get_translation_dict("corine")
+        self.assertIn(-128, translation_dict)
+        data = np.full((4, 5), -128, dtype=np.int8)
+        data[0, 0] = 44
+        data[1, 1] = -1
+        actual, unknown = \
+            lut_translate(data, translation_dict,
+                          self._yaml_params.default_code)
+        self.assertEqual(actual[0, 0], translation_dict[44])
+        self.assertEqual(actual[2, 2], translation_dict[-128])
+        self.assertEqual(actual[1, 1], self._yaml_params.default_code)
+        self.assertEqual(unknown, {-1})
+        self._check(data, translation_dict)
+
+    def test_windows(self) -> None:
+        """ Translation by windows """
+        translation_dict = self._yaml_params.get_translation_dict("noaa")
+        self._check(random_raster(np.uint8, translation_dict.keys()),
+                    translation_dict, window_height=HEIGHT // 3)
+
+
+@unittest.skipIf(np is None, "NumPy not installed")
+@unittest.skipUnless(os.environ.get("AFC_BENCHMARK"),
+                     "Benchmark. Set AFC_BENCHMARK=1 to run")
+class TestBenchmark(unittest.TestCase):
+    """ Translation throughput benchmark """
+
+    def test_throughput(self) -> None:
+        """ Prints throughput of both translations on CORINE-like raster """
+        yaml_params = nlcd_wgs84.YamlParams()
+        translation_dict = yaml_params.get_translation_dict("corine")
+        for dtype in (np.uint8, np.int8, np.int16):
+            info = np.iinfo(dtype)
+            data = random_raster(
+                dtype, [code for code in translation_dict
+                        if info.min <= code <= info.max],
+                shape=(BENCHMARK_SIZE, BENCHMARK_SIZE))
+            for name, func in [("dict", dict_translate),
+                               ("lut", lut_translate)]:
+                start = time.perf_counter()
+                func(data, translation_dict, yaml_params.default_code)
+                elapsed = time.perf_counter() - start
+                print(f"{dtype.__name__:>6} {name:>4}: "
+                      f"{data.size / elapsed / 1e6:8.1f} Mpixel/s")
+
+
+if __name__ == "__main__":
+    unittest.main()
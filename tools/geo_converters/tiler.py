@@ -22,10 +22,21 @@ import os
 import shlex
 import signal
 import sys
-from typing import List, NamedTuple, Optional, Set
+import tempfile
+from typing import Any, List, NamedTuple, Optional, Set, Tuple
 
 from geoutils import *
 
+try:
+    import numpy as np
+    from osgeo import gdal
+    HAS_GDAL = True
+except ImportError:
+    HAS_GDAL = False
+
+# Approximate number of pixels read at once when inspecting in-process tile
+INSPECT_WINDOW_PIXELS = 4 * 1024 * 1024
+
 _EPILOG = """This script expects that GDAL utilities are installed and in PATH.
 Also it expects that as part of this installation proj/proj.db is somehow
 installed as well (if it is, but gdalwarp still complains - set PROJ_LIB
@@ -37,6 +48,11 @@ Some examples:
    $ tiler.py --threads 8 --tile_pattern \
      TILED_NLCD_PROD/usa_lc_prd_{lat_hem}{lat_u:02}{lon_hem}{lon_l03}.tif \\
      nlcd/production/*.tif
+- Same, but without spawning GDAL utilities for every tile (requires GDAL
+  Python bindings and numpy):
+   $ tiler.py --threads 8 --in_process --tile_pattern \
+     TILED_NLCD_PROD/usa_lc_prd_{lat_hem}{lat_u:02}{lon_hem}{lon_l03}.tif \
+     nlcd/production/*.tif
 """
 
 # Conversion result status
@@ -62,6 +78,23 @@ class ConvResult(NamedTuple):
     msg: Optional[str] = None
 
 
+def make_tile_filename(tile_pattern: str, top: int, left: int) -> str:
+    """ Tile file name for given tile
+
+    Arguments:
+    tile_pattern -- Tile file name pattern
+    top          -- Top latitude
+    left         -- Left longitude (normalized to [-180, 180[ range)
+    Returns tile file name
+    """
+    return tile_pattern.format(lat_u=abs(top), lat_d=abs(top - 1),
+                               lon_l=abs(left), lon_r=abs(left + 1),
+                               lat_hem='n' if top > 0 else 's',
+                               LAT_HEM='N' if top > 0 else 'S',
+                               lon_hem='e' if left >= 0 else 'w',
+                               LON_HEM='E' if left >= 0 else 'W')
+
+
 def tile_creator(tile_pattern: str, sources: List[str], top: int, left: int,
                  margin: int, pixel_size_lat: float, pixel_size_lon: float,
                  scale: Optional[List[float]], no_data: Optional[str],
@@ -102,13 +135,7 @@ def tile_creator(tile_pattern: str, sources: List[str], top: int, left: int,
     temp_filename_vrt: Optional[str] = None
     temp_filename_xml: Optional[str] = None
     try:
-        tile_filename = \
-            tile_pattern.format(lat_u=abs(top), lat_d=abs(top - 1),
-                                lon_l=abs(left), lon_r=abs(left + 1),
-                                lat_hem='n' if top > 0 else 's',
-                                LAT_HEM='N' if top > 0 else 'S',
-                                lon_hem='e' if left >= 0 else 'w',
-                                LON_HEM='E' if left >= 0 else 'W')
+        tile_filename = make_tile_filename(tile_pattern, top, left)
         temp_filename = os.path.splitext(tile_filename)[0] + ".incomplete" + \
             os.path.splitext(tile_filename)[1]
         temp_filename_vrt = \
@@ -216,6 +243,179 @@ def tile_creator(tile_pattern: str, sources: List[str], top: int, left: int,
                 pass
 
 
+class TileSource:
+    """ Per-process cache of source dataset for in-process tiling.
+
+    Source (single file or VRT of all source files) is opened once per worker
+    process - on first tile cut in this process
+
+    Private attributes:
+    _filename -- Source file name
+    _dataset  -- Opened source dataset or None
+    """
+    _filename: Optional[str] = None
+    _dataset: Any = None
+
+    @classmethod
+    def init(cls, filename: str) -> None:
+        """ Worker process initializer
+
+        Arguments:
+        filename -- Source file name
+        """
+        gdal.UseExceptions()
+        cls._filename = filename
+        cls._dataset = None
+
+    @classmethod
+    def dataset(cls) -> Any:
+        """ Source dataset (opened on first call) """
+        if cls._dataset is None:
+            assert cls._filename is not None
+            cls._dataset = gdal.Open(cls._filename, gdal.GA_ReadOnly)
+        return cls._dataset
+
+
+def inspect_tile(ds: Any) -> Tuple[bool, Optional[float], Optional[float]]:
+    """ Computes empty tile criteria from tile pixels
+
+    Arguments:
+    ds -- Tile dataset
+    Returns (has_valid_pixels, min_valid_value, max_valid_value) tuple. Values
+    are over all bands, None if there are no valid pixels
+    """
+    min_value: Optional[float] = None
+    max_value: Optional[float] = None
+    rows = max(1, INSPECT_WINDOW_PIXELS // max(ds.RasterXSize, 1))
+    for band_idx in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(band_idx)
+        no_data = band.GetNoDataValue()
+        for yoff in range(0, ds.RasterYSize, rows):
+            data = band.ReadAsArray(0, yoff, ds.RasterXSize,
+                                    min(rows, ds.RasterYSize - yoff))
+            valid = np.ones(data.shape, dtype=bool)
+            if np.issubdtype(data.dtype, np.floating):
+                valid &= ~np.isnan(data)
+            if (no_data is not None) and (not np.isnan(no_data)):
+                valid &= data != no_data
+            if not valid.any():
+                continue
+            values = data[valid]
+            window_min = float(values.min())
+            window_max = float(values.max())
+            min_value = window_min if min_value is None \
+                else min(min_value, window_min)
+            max_value = window_max if max_value is None \
+                else max(max_value, window_max)
+    return (min_value is not None, min_value, max_value)
+
+
+def in_process_tile_creator(
+        tile_pattern: str, top: int, left: int, margin: int,
+        pixel_size_lat: float, pixel_size_lon: float,
+        scale: Optional[List[float]], no_data: Optional[str],
+        data_type: Optional[str], resampling: str, overwrite: bool,
+        remove_values: Optional[List[float]], out_format: Optional[str],
+        format_params: List[str]) -> ConvResult:
+    """ Worker function that creates tile with GDAL Python bindings.
+
+    Tile is cut from source dataset, cached in TileSource, to /vsimem/, checked
+    for emptiness, then copied to temporary file that is renamed to tile file
+
+    Arguments:
+    tile_pattern   -- Tile file name pattern
+    top            -- Top latitude
+    left           -- Left longitude
+    margin         -- Number of margin pixels
+    pixel_size_lat -- Pixel size in latitudinal direction
+    pixel_size_lon -- Pixel size in longitudinal direction
+    scale          -- Optional scale as [src_min,src_max,dst_min, dst_max]
+    no_data        -- Optional NoData value
+    data_type      -- Optional pixel data type
+    resampling     -- Resampling method
+    overwrite      -- True to overwrite existing files, False to skip
+    remove_values  -- Optional list of values values in monochrome tiles to
+                      drop
+    out_format     -- Optional output format
+    format_params  -- Optional output format parameters
+    Returns ConvResult object
+    """
+    while left < -180:
+        left += 360
+    while left >= 180:
+        left -= 360
+
+    start_time = datetime.datetime.now()
+    tile_filename = make_tile_filename(tile_pattern, top, left)
+    mem_filename = \
+        f"/vsimem/tiler_{os.getpid()}_{top}_{left}" + \
+        os.path.splitext(tile_filename)[1]
+    temp_filename: Optional[str] = None
+    try:
+        if os.path.isfile(tile_filename) and (not overwrite):
+            return ConvResult(tilename=tile_filename, status=ConvStatus.Exists,
+                              duration=datetime.datetime.now() - start_time)
+        options = \
+            gdal.TranslateOptions(
+                format=out_format, creationOptions=format_params,
+                strict=True, resampleAlg=resampling,
+                projWin=[left - pixel_size_lon * margin,
+                         top + pixel_size_lat * margin,
+                         left + 1 + pixel_size_lon * margin,
+                         top - 1 - pixel_size_lat * margin],
+                scaleParams=[scale] if scale else None,
+                noData=no_data,
+                outputType=gdal.GetDataTypeByName(data_type) if data_type
+                else gdal.GDT_Unknown)
+        ds = gdal.Translate(mem_filename, TileSource.dataset(),
+                            options=options)
+        has_valid, min_value, max_value = inspect_tile(ds)
+        ds = None
+        if os.path.isfile(tile_filename):
+            os.unlink(tile_filename)
+        if not has_valid:
+            return \
+                ConvResult(tilename=tile_filename, status=ConvStatus.Dropped,
+                           duration=datetime.datetime.now() - start_time,
+                           msg="All pixels are NoData")
+        if (min_value == max_value) and (min_value in (remove_values or [])):
+            return \
+                ConvResult(
+                    tilename=tile_filename, status=ConvStatus.Dropped,
+                    duration=datetime.datetime.now() - start_time,
+                    msg=f"All valid pixels are equal to {min_value}")
+        f = gdal.VSIFOpenL(mem_filename, "rb")
+        try:
+            content = gdal.VSIFReadL(1, gdal.VSIStatL(mem_filename).size, f)
+        finally:
+            gdal.VSIFCloseL(f)
+        fd, temp_filename = \
+            tempfile.mkstemp(
+                dir=os.path.dirname(tile_filename) or ".",
+                prefix=os.path.splitext(os.path.basename(tile_filename))[0] +
+                ".incomplete.",
+                suffix=os.path.splitext(tile_filename)[1])
+        with os.fdopen(fd, "wb") as tf:
+            tf.write(content)
+        os.replace(temp_filename, tile_filename)
+        temp_filename = None
+        return ConvResult(tilename=tile_filename, status=ConvStatus.Success,
+                          duration=datetime.datetime.now() - start_time)
+    except (Exception, KeyboardInterrupt, SystemExit) as ex:
+        return ConvResult(tilename=tile_filename, status=ConvStatus.Error,
+                          duration=datetime.datetime.now() - start_time,
+                          msg=repr(ex))
+    finally:
+        for filename in (mem_filename, mem_filename + ".aux.xml"):
+            if gdal.VSIStatL(filename) is not None:
+                gdal.Unlink(filename)
+        try:
+            if temp_filename and os.path.isfile(temp_filename):
+                os.unlink(temp_filename)
+        except OSError:
+            pass
+
+
 def main(argv: List[str]) -> None:
     """Do the job.
 
@@ -314,6 +514,11 @@ def main(argv: List[str]) -> None:
         help="Remove tiles all valid points of which consists only of given "
         "value (e.g. artificial NLCD in far sea. This parameter may be "
         "specified more than once")
+    argument_parser.add_argument(
+        "--in_process", action="store_true",
+        help="Cut tiles with GDAL Python bindings in worker processes (each "
+        "opens source data once) instead of running GDAL utilities for every "
+        "tile. Requires GDAL Python bindings and numpy")
     argument_parser.add_argument(
         "--verbose", action="store_true",
         help="Create tiles sequentially, printing gdal_translate output in "
@@ -334,6 +539,9 @@ def main(argv: List[str]) -> None:
 
     start_time = datetime.datetime.now()
 
+    error_if(args.in_process and (not HAS_GDAL),
+             "--in_process requires GDAL Python bindings and numpy to be "
+             "installed")
     error_if((args.left is None) != (args.right is None),
              "--left and --right should be specified together or not at all")
     try:
@@ -464,16 +672,52 @@ def main(argv: List[str]) -> None:
 
     print(f"{len(tiles)} tiles in {global_boundaries}")
 
+    # Source for in-process tiling: the only source file or VRT of all of them
+    in_process_src: Optional[str] = None
+    temp_vrt: Optional[str] = None
+    if args.in_process:
+        gdal.UseExceptions()
+        all_sources: List[str] = []
+        for sb in source_boundaries:
+            filename = os.path.abspath(sb.filename)
+            if filename not in all_sources:
+                all_sources.append(filename)
+        if len(all_sources) == 1:
+            in_process_src = all_sources[0]
+        else:
+            fd, temp_vrt = \
+                tempfile.mkstemp(
+                    dir=os.path.dirname(args.tile_pattern) or ".",
+                    prefix="tiler_sources.incomplete.", suffix=".vrt")
+            os.close(fd)
+            vrt = gdal.BuildVRT(
+                temp_vrt, all_sources[::-1],
+                options=gdal.BuildVRTOptions(
+                    resampleAlg=resampling,
+                    options=["-ignore_srcmaskband"]))
+            error_if(vrt is None, "Source VRT creation failed")
+            vrt = None
+            in_process_src = temp_vrt
+
     original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    pool = None if args.verbose else \
-        multiprocessing.pool.ThreadPool(
+    pool: Optional[multiprocessing.pool.Pool] = None
+    if args.verbose:
+        if args.in_process:
+            assert in_process_src is not None
+            TileSource.init(in_process_src)
+    elif args.in_process:
+        pool = multiprocessing.Pool(processes=threads_arg(args.threads),
+                                    initializer=TileSource.init,
+                                    initargs=(in_process_src,))
+    else:
+        pool = multiprocessing.pool.ThreadPool(
             processes=threads_arg(args.threads))
     signal.signal(signal.SIGINT, original_sigint_handler)
+    worker = in_process_tile_creator if args.in_process else tile_creator
     try:
         for tile in tiles:
             kwargs = {
                 "tile_pattern": args.tile_pattern,
-                "sources": tile.sources,
                 "top": tile.top,
                 "left": tile.left,
                 "margin": args.margin,
@@ -486,14 +730,15 @@ def main(argv: List[str]) -> None:
                 "overwrite": args.overwrite,
                 "remove_values": args.remove_value,
                 "out_format": args.format,
-                "format_params": args.format_param,
-                "verbose": args.verbose}
+                "format_params": args.format_param}
+            if not args.in_process:
+                kwargs["sources"] = tile.sources
+                kwargs["verbose"] = args.verbose
             if args.verbose:
-                completer(tile_creator(**kwargs))
+                completer(worker(**kwargs))
             else:
                 assert pool is not None
-                pool.apply_async(tile_creator, kwds=kwargs,
-                                 callback=completer)
+                pool.apply_async(worker, kwds=kwargs, callback=completer)
         if pool:
             pool.close()
             pool.join()
@@ -525,6 +770,8 @@ def main(argv: List[str]) -> None:
     finally:
         if pool is not None:
             pool.terminate()
+        if temp_vrt and os.path.isfile(temp_vrt):
+            os.unlink(temp_vrt)
 
 
 if __name__ == "__main__":
@@ -31,7 +31,8 @@ import urllib.parse
 import db_utils
 from log_utils import dp, error, error_if
 from rcache_models import AfcReqRespKey, ApDbRecord, ApDbRespState, \
-    Beam, LatLonRect, RcacheDirectionalInvalidateReq, RcacheInvalidateReq, \
+    Beam, CertificationKey, LatLonRect, RcacheCertIdInvalidateReq, \
+    RcacheDirectionalInvalidateReq, RcacheInvalidateReq, \
     RcacheSpatialInvalidateReq, RcacheStatus, RcacheUpdateReq
 
 # Environment variable with connection string to Postgres DB
@@ -611,6 +612,17 @@ async def do_invalidate(args: Any) -> None:
                               azimuth_to_tx=tx1 if tx2 is None else None))
             invalidate_req = RcacheDirectionalInvalidateReq(beams=beams).dict()
             path = "directional_invalidate"
+    elif args.cert_id:
+        certifications: List[CertificationKey] = []
+        for s in args.cert_id:
+            ruleset_id, sep, cert_id = s.partition(",")
+            error_if(not (ruleset_id and sep and cert_id),
+                     f"Certification specification '{s}' has invalid format")
+            certifications.append(
+                CertificationKey(ruleset_id=ruleset_id, cert_id=cert_id))
+        invalidate_req = \
+            RcacheCertIdInvalidateReq(certifications=certifications).dict()
+        path = "cert_id_invalidate"
     else:
         error("No invalidation type parameters specified")
     async with aiohttp.ClientSession() as session:
@@ -806,6 +818,10 @@ def main(argv: List[str]) -> None:
         "--ruleset", metavar="RULESET_ID", action="append",
         help="Config ruleset ID for entries to invalidate. This parameter may "
         "be specified several times")
+    parser_invalidate.add_argument(
+        "--cert_id", metavar="RULESET_ID,CERT_ID", action="append",
+        help="Certification for entries to invalidate (entries of APs having "
+        "this certification). This parameter may be specified several times")
     parser_invalidate.set_defaults(func=do_invalidate)
     parser_invalidate.set_defaults(is_async=True)
 
@@ -0,0 +1,38 @@
+"""Pipeline stages added
+
+Revision ID: 5d2e7f1a9c34
+Revises: 6926c125ef61
+Create Date: 2026-10-18 10:12:41.417093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import enum
+
+# revision identifiers, used by Alembic.
+revision = '5d2e7f1a9c34'
+down_revision = '6926c125ef61'
+branch_labels = None
+depends_on = None
+
+PipelineStage = \
+    enum.Enum("PipelineStage",
+              ["Download", "FsidEmbed", "DbDiff", "Validation", "Install"])
+
+
+def upgrade() -> None:
+    """ Create table of pipeline stage completion records """
+    op.create_table(
+        "stages",
+        sa.Column("stage", sa.Enum(PipelineStage), primary_key=True,
+                  index=True),
+        sa.Column("input_digest", sa.String(), nullable=False),
+        sa.Column("output_digest", sa.String(), nullable=False),
+        sa.Column("details", sa.String(), nullable=True),
+        sa.Column("timestamp", sa.DateTime(timezone=True), nullable=False))
+
+
+def downgrade() -> None:
+    """ Drop table of pipeline stage completion records """
+    op.drop_table("stages")
+    op.execute(sa.text("DROP TYPE pipelinestage"))
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+""" Tests of staged FS (ULS) download pipeline: stage ordering, skipping of
+unchanged stages, resume and failure propagation.
+
+Download script, FSID tool and database comparison script are replaced with
+small scripts that operate on canned FCC/ISED files in temporary download
+directory. State database is replaced with in-memory one
+
+Run tests:        python3 -m unittest test_uls_service
+"""
+
+# Copyright (C) 2022 Broadcom. All rights reserved.
+# The term "Broadcom" refers solely to the Broadcom Inc. corporate affiliate
+# that owns the software below.
+# This work is licensed under the OpenAFC Project License, a copy of which is
+# included with this software program.
+
+# pylint: disable=invalid-name, too-many-instance-attributes
+
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+import unittest
+from unittest import mock
+
+import pydantic
+
+import uls_service
+from uls_service_state_db import LogType, PipelineStage, StageInfo
+
+# Download script. Makes FS database of canned FCC/ISED files, counts its runs
+DOWNLOAD_SCRIPT = """
+import argparse, hashlib, os, shutil, sqlite3, sys
+parser = argparse.ArgumentParser()
+for arg in ("--region", "--save_dir", "--download_dir", "--result_dir",
+            "--temp_dir"):
+    parser.add_argument(arg)
+args = parser.parse_args()
+with open(os.path.join(args.download_dir, "runs.log"), "a") as f:
+    f.write("run\\n")
+with open(os.path.join(args.download_dir, "runs.log")) as f:
+    run = len(f.readlines())
+if os.path.exists(os.path.join(args.download_dir, "FAIL")):
+    sys.exit("FCC server is down")
+os.makedirs(args.result_dir, exist_ok=True)
+db = sqlite3.connect(os.path.join(args.result_dir, f"FS_{run}.sqlite3"))
+db.execute("CREATE TABLE data_ids (region TEXT, identity TEXT)")
+db.execute("CREATE TABLE uls (region TEXT, line TEXT)")
+for region, name in [("US", "fcc.dat"), ("CA", "ised.dat")]:
+    src = os.path.join(args.download_dir, name)
+    with open(src, "rb") as f:
+        content = f.read()
+    db.execute("INSERT INTO data_ids VALUES (?, ?)",
+               (region, hashlib.sha256(content).hexdigest()))
+    for line in content.decode().splitlines():
+        db.execute("INSERT INTO uls VALUES (?, ?)", (region, line))
+    os.makedirs(os.path.join(args.temp_dir, region), exist_ok=True)
+    shutil.copyfile(src, os.path.join(args.temp_dir, region, name))
+db.commit()
+db.close()
+"""
+
+# FSID tool. Logs its commands, fails embedding if FAIL_EMBED file present
+FSID_TOOL = """
+import os, sqlite3, sys
+tool_dir = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(tool_dir, "fsid_tool.log"), "a") as f:
+    f.write(sys.argv[1] + "\\n")
+db = sqlite3.connect(sys.argv[2])
+has_table = db.execute("SELECT name FROM sqlite_master "
+                       "WHERE name = 'fsid'").fetchone() is not None
+if sys.argv[1] == "check":
+    sys.exit(0 if has_table else 1)
+if sys.argv[1] == "extract":
+    with open(sys.argv[3], "w") as f:
+        f.writelines(row[0] + "\\n" for row in db.execute("SELECT * FROM fsid"))
+    sys.exit(0)
+if os.path.exists(os.path.join(tool_dir, "FAIL_EMBED")):
+    sys.exit("Embedding failed")
+db.execute("DROP TABLE IF EXISTS fsid")
+db.execute("CREATE TABLE fsid (line TEXT)")
+if os.path.isfile(sys.argv[3]):
+    with open(sys.argv[3]) as f:
+        db.executemany("INSERT INTO fsid VALUES (?)",
+                       [(line.strip(),) for line in f])
+db.commit()
+"""
+
+# Database comparison script
+FS_DB_DIFF = """
+import json, sys
+with open(sys.argv[2], "w") as f:
+    json.dump({"beams": [], "rectangles": [
+        {"min_lat_deg": 40, "max_lat_deg": 41, "min_lon_deg": -100,
+         "max_lon_deg": -99}]}, f)
+print("Paths in DB1: 2\\nPaths in DB2: 2\\nDifferent paths: 1\\n"
+      "Different RAS entries: 0\\n")
+"""
+
+# Healthcheck script
+HEALTHCHECK_SCRIPT = "import sys\nsys.exit(0)\n"
+
+# Name of FS database symlink
+SYMLINK = "FS_LATEST.sqlite3"
+
+
+class FakeStateDb:
+    """ In-memory state database
+
+    Public attributes:
+    stages  -- StageInfo objects, indexed by stages
+    written -- Stages in order of completion record writes
+    logs    -- Logs, indexed by log types
+    """
+
+    def __init__(self) -> None:
+        self.stages: Dict[PipelineStage, StageInfo] = {}
+        self.written: List[PipelineStage] = []
+        self.logs: Dict[LogType, str] = {}
+
+    def create_db(self, **kwargs: Any) -> bool:
+        """ Database creation """
+        return True
+
+    def read_milestone(self, milestone: Any) -> Dict[str, Any]:
+        """ Milestone retrieval """
+        return {}
+
+    def write_log(self, log_type: LogType, log: str) -> None:
+        """ Log write """
+        self.logs[log_type] = log
+
+    def write_stage(self, stage: PipelineStage, input_digest: str,
+                    output_digest: str,
+                    details: Optional[Dict[str, Any]] = None) -> None:
+        """ Stage completion record write """
+        self.written.append(stage)
+        self.stages[stage] = \
+            StageInfo(stage=stage, input_digest=input_digest,
+                      output_digest=output_digest,
+                      details=json.loads(json.dumps(details or {})),
+                      timestamp=datetime.datetime.now(datetime.timezone.utc))
+
+    def read_stages(self) -> Dict[PipelineStage, StageInfo]:
+        """ Stage completion records retrieval """
+        return dict(self.stages)
+
+
+class TestPipeline(unittest.TestCase):
+    """ Download pipeline runs """
+
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self._testdir = tempfile.mkdtemp()
+        self._download_dir = self._dir("download")
+        self._tool_dir = self._dir("tools")
+        self._ext_db_dir = self._dir("ext_db")
+        self._result_dir = os.path.join(self._testdir, "result")
+        self._temp_dir = os.path.join(self._testdir, "temp")
+        self._write(self._download_dir, "fcc.dat", "US path 1\nUS path 2\n")
+        self._write(self._download_dir, "ised.dat", "CA path 1\n")
+        self._write(self._testdir, "ras.sqlite3", "RAS")
+        self._state_db = FakeStateDb()
+        self._status_updater = mock.Mock()
+        self._checker = mock.Mock()
+        self._checker.valid.return_value = True
+        self._patchers = \
+            [mock.patch.object(uls_service, name, value) for name, value in
+             [("StateDb", lambda **kwargs: self._state_db),
+              ("StatusUpdater",
+               mock.Mock(return_value=self._status_updater)),
+              ("UlsFileChecker", mock.Mock(return_value=self._checker)),
+              ("ExtParamFilesChecker", mock.Mock()),
+              ("als", mock.Mock()),
+              ("setup_logging", mock.Mock()),
+              # Saves are named by time with second resolution
+              ("save_recent_download", mock.Mock()),
+              ("FSID_TOOL", self._script("fsid_tool.py", FSID_TOOL)),
+              ("FS_DB_DIFF", self._script("fs_db_diff.py", FS_DB_DIFF)),
+              ("HEALTHCHECK_SCRIPT",
+               self._script("healthcheck.py", HEALTHCHECK_SCRIPT))]]
+        for patcher in self._patchers:
+            patcher.start()
+
+    def tearDown(self) -> None:
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+        shutil.rmtree(self._testdir)
+        unittest.TestCase.tearDown(self)
+
+    def _dir(self, name: str) -> str:
+        """ Creates subdirectory of test directory, returns its path """
+        ret = os.path.join(self._testdir, name)
+        os.makedirs(ret)
+        return ret
+
+    def _write(self, directory: str, name: str, content: str) -> str:
+        """ Writes file, returns its path """
+        ret = os.path.join(directory, name)
+        with open(ret, "w", encoding="utf-8") as f:
+            f.write(content)
+        return ret
+
+    def _script(self, name: str, content: str) -> str:
+        """ Writes executable Python script to tool directory, returns its
+        path """
+        ret = self._write(self._tool_dir, name,
+                          f"#!{sys.executable}\n{content}")
+        os.chmod(ret, 0o755)
+        return ret
+
+    def _log_lines(self, directory: str, name: str) -> List[str]:
+        """ Lines of log file written by tool script """
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            return []
+        with open(path, encoding="utf-8") as f:
+            return [line.strip() for line in f]
+
+    def _download_runs(self) -> int:
+        """ Number of download script runs so far """
+        return len(self._log_lines(self._download_dir, "runs.log"))
+
+    def _embeds(self) -> int:
+        """ Number of FSID embeddings so far """
+        return self._log_lines(self._tool_dir, "fsid_tool.log").count("embed")
+
+    def _current_db(self) -> Optional[str]:
+        """ Name of database current symlink points to """
+        symlink = os.path.join(self._ext_db_dir, SYMLINK)
+        return os.readlink(symlink) if os.path.islink(symlink) else None
+
+    def _run(self, *args: str) -> List[PipelineStage]:
+        """ Runs download once, returns stages completed during the run """
+        prev_written = len(self._state_db.written)
+        uls_service.main(
+            ["--download_script",
+             self._script("download.py", DOWNLOAD_SCRIPT),
+             "--download_script_args",
+             f"--download_dir {self._download_dir} "
+             f"--result_dir {self._result_dir} --temp_dir {self._temp_dir}",
+             "--result_dir", self._result_dir, "--temp_dir", self._temp_dir,
+             "--save_dir", os.path.join(self._testdir, "save"),
+             "--ext_db_dir", self._ext_db_dir, "--ext_db_symlink", SYMLINK,
+             "--ext_ras_database", os.path.join(self._testdir, "ras.sqlite3"),
+             "--ras_database", os.path.join(self._testdir, "ras_copy.sqlite3"),
+             "--fsid_file", os.path.join(self._testdir, "fsid.csv"),
+             "--stage_dir", os.path.join(self._testdir, "stages"),
+             "--service_state_db_dsn", "postgresql://localhost/state",
+             "--run_once"] + list(args))
+        return self._state_db.written[prev_written:]
+
+    def test_stage_order(self) -> None:
+        """ Stages executed in order, DbDiff only if there is previous
+        database, unchanged data not installed """
+        self.assertEqual(
+            self._run(),
+            [PipelineStage.Download, PipelineStage.FsidEmbed,
+             PipelineStage.Validation, PipelineStage.Install])
+        self.assertEqual(self._current_db(), "FS_1.sqlite3")
+        self._status_updater.milestone.assert_any_call(
+            uls_service.DownloaderMilestone.DbUpdated)
+
+        self._write(self._download_dir, "fcc.dat", "US path 1\nUS path 3\n")
+        self.assertEqual(
+            self._run(),
+            [PipelineStage.Download, PipelineStage.FsidEmbed,
+             PipelineStage.DbDiff, PipelineStage.Validation,
+             PipelineStage.Install])
+        self.assertEqual(self._current_db(), "FS_2.sqlite3")
+        # Previous database passed to validity check along with difference
+        db_diff = self._checker.valid.call_args[1]["db_diff"]
+        self.assertEqual(len(db_diff.diff_tiles), 1)
+
+        # Nothing changed - nothing installed
+        self.assertEqual(self._run(), [PipelineStage.Download])
+        self.assertEqual(self._current_db(), "FS_2.sqlite3")
+        self.assertEqual(self._download_runs(), 3)
+
+    def test_resume(self) -> None:
+        """ Stages, completed by failed run, skipped on resume """
+        self._checker.valid.return_value = False
+        self.assertEqual(self._run(),
+                         [PipelineStage.Download, PipelineStage.FsidEmbed])
+        self.assertIsNone(self._current_db())
+
+        # Without resume download is repeated, but FSID embedding of the same
+        # data is skipped
+        self.assertEqual(self._run(), [PipelineStage.Download])
+        self.assertEqual((self._download_runs(), self._embeds()), (2, 1))
+
+        # Resume skips download
+        self._checker.valid.return_value = True
+        self.assertEqual(self._run("--resume"),
+                         [PipelineStage.Validation, PipelineStage.Install])
+        self.assertEqual((self._download_runs(), self._embeds()), (2, 1))
+        self.assertEqual(self._current_db(), "FS_2.sqlite3")
+
+        # Stages from given one are rerun (forced, as data is not changed)
+        self.assertEqual(
+            self._run("--from_stage", "FsidEmbed", "--force"),
+            [PipelineStage.FsidEmbed, PipelineStage.DbDiff,
+             PipelineStage.Validation, PipelineStage.Install])
+        self.assertEqual((self._download_runs(), self._embeds()), (2, 2))
+
+    def test_failures(self) -> None:
+        """ Failed stage stops pipeline, is reported and rerun next time """
+        self._write(self._download_dir, "FAIL", "")
+        self.assertEqual(self._run(), [])
+        self.assertIn("FCC server is down",
+                      self._state_db.logs[LogType.LastFailed])
+        self.assertIsNone(self._current_db())
+        os.unlink(os.path.join(self._download_dir, "FAIL"))
+
+        self._write(self._tool_dir, "FAIL_EMBED", "")
+        self.assertEqual(self._run(), [PipelineStage.Download])
+        self.assertIn("Embedding failed",
+                      self._state_db.logs[LogType.LastFailed])
+        self.assertIsNone(self._current_db())
+        self.assertEqual(os.listdir(self._ext_db_dir), [])
+        os.unlink(os.path.join(self._tool_dir, "FAIL_EMBED"))
+
+        self.assertEqual(
+            self._run("--resume"),
+            [PipelineStage.FsidEmbed, PipelineStage.Validation,
+             PipelineStage.Install])
+        self.assertEqual(self._download_runs(), 2)
+        self.assertEqual(self._current_db(), "FS_2.sqlite3")
+        self.assertNotIn("Embedding failed",
+                         self._state_db.logs[LogType.Last])
+        self.assertIn(LogType.LastCompleted, self._state_db.logs)
+
+    def test_invalid_from_stage(self) -> None:
+        """ Invalid stage name reported with list of valid ones """
+        required = {"ext_db_dir": self._ext_db_dir, "ext_db_symlink": SYMLINK,
+                    "ext_ras_database": "ras.sqlite3",
+                    "service_state_db_dsn": "postgresql://localhost/state"}
+        self.assertEqual(
+            uls_service.Settings(from_stage="FsidEmbed", **required).
+            from_stage, "FsidEmbed")
+        with self.assertRaises(pydantic.ValidationError) as ctx:
+            uls_service.Settings(from_stage="bogus", **required)
+        self.assertIn("FsidEmbed", str(ctx.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
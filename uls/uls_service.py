@@ -44,12 +44,20 @@ from rcache_client import RcacheClient
 from rcache_models import Beam, LatLonRect, RcacheClientSettings
 from pydantic_utils import env_help, merge_args
 from uls_service_common import *
+from uls_service_stages import ArtifactStore, combine_digests, file_digest, \
+    StageTracker
 from uls_service_state_db import CheckType, DownloaderMilestone, LogType, \
-    StateDb
+    PipelineStage, StageInfo, StateDb
 
 # Filemask for ULS databases
 ULS_FILEMASK = "*.sqlite3"
 
+# Extension of ULS database stage artifacts
+ULS_EXT = ".sqlite3"
+
+# Extension of FSID table stage artifacts
+FSID_EXT = ".csv"
+
 # ULS database identity table
 DATA_IDS_TABLE = "data_ids"
 
@@ -223,6 +231,30 @@ class Settings(pydantic.BaseSettings):
         pydantic.Field(False,
                        description="Force FS database update (even if not "
                        "changed or found invalid)")
+    stage_dir: str = \
+        pydantic.Field(
+            "/mnt/nfs/rat_transfer/daily_uls_parse/stages/",
+            env="ULS_STAGE_DIR",
+            description="Directory for intermediate artifacts of download "
+            "pipeline stages")
+    resume: bool = \
+        pydantic.Field(False, env="ULS_RESUME",
+                       description="First download resumed from previously "
+                       "completed stages")
+    from_stage: Optional[str] = \
+        pydantic.Field(None, env="ULS_FROM_STAGE",
+                       description="First pipeline stage to rerun on first "
+                       "download", no="First changed")
+
+    @pydantic.validator("from_stage", pre=False)
+    @classmethod
+    def check_from_stage(cls, v: Any) -> Any:
+        """ Checks that stage name is valid """
+        if (v is not None) and (v not in PipelineStage.__members__):
+            raise ValueError(
+                f"Invalid pipeline stage '{v}'. Valid stages are: "
+                f"{', '.join(PipelineStage.__members__)}")
+        return v
 
     @pydantic.validator("check_ext_files", pre=True)
     @classmethod
@@ -636,6 +668,11 @@ def save_recent_download(regions, num_of_saves, recent_download_dir: str, saved_
 
     for region in regions:
         regionDataDir = os.path.join(recent_download_dir, region)
+        if not os.path.isdir(regionDataDir):
+            # E.g. download stage was taken from previous run
+            logging.warning(f"Downloaded data for region '{region}' not "
+                            f"found in '{recent_download_dir}', not saved")
+            continue
         regionSaveParentDir = os.path.join(saved_download_dir, region)
         saveDir = os.path.join(regionSaveParentDir, newSaveName)
         shutil.copytree(regionDataDir, saveDir)
@@ -753,6 +790,31 @@ class DbDiff:
         self.valid = True
         logging.info(str(self))
 
+    def to_dict(self) -> Dict[str, Any]:
+        """ JSON-serializable representation (for stage artifact) """
+        assert self.valid
+        return {"prev_filename": self.prev_filename,
+                "new_filename": self.new_filename,
+                "prev_len": self.prev_len, "new_len": self.new_len,
+                "diff_len": self.diff_len, "ras_diff_len": self.ras_diff_len,
+                "diff_tiles": [tile.dict() for tile in self.diff_tiles],
+                "diff_beams": [beam.dict() for beam in self.diff_beams]}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "DbDiff":
+        """ Creates valid object from result of to_dict() """
+        ret = cls.__new__(cls)
+        ret.valid = True
+        ret.prev_filename = d["prev_filename"]
+        ret.new_filename = d["new_filename"]
+        ret.prev_len = d["prev_len"]
+        ret.new_len = d["new_len"]
+        ret.diff_len = d["diff_len"]
+        ret.ras_diff_len = d["ras_diff_len"]
+        ret.diff_tiles = [LatLonRect(**tile) for tile in d["diff_tiles"]]
+        ret.diff_beams = [Beam(**beam) for beam in d["diff_beams"]]
+        return ret
+
     def __str__(self) -> str:
         """ String representation (for log and ALS) """
         return \
@@ -1166,6 +1228,22 @@ def main(argv: List[str]) -> None:
         "--force", action="store_true",
         help=f"Force database update even if it is not noticeably changed or "
         f"not passed validity check{env_help(Settings, 'force')}")
+    argument_parser.add_argument(
+        "--stage_dir", metavar="STAGE_DIR",
+        help=f"Directory for content-addressed intermediate artifacts of "
+        f"download pipeline stages{env_help(Settings, 'stage_dir')}")
+    argument_parser.add_argument(
+        "--resume", action="store_true",
+        help=f"On first download take results of previously completed "
+        f"pipeline stages (including download script run) instead of "
+        f"rerunning them{env_help(Settings, 'resume')}")
+    argument_parser.add_argument(
+        "--from_stage", metavar="STAGE",
+        choices=StageTracker.stage_names(),
+        help=f"On first download take results of previously completed "
+        f"pipeline stages preceding given one, rerun given and subsequent "
+        f"stages. Stages are: {', '.join(StageTracker.stage_names())}"
+        f"{env_help(Settings, 'from_stage')}")
 
     settings: Settings = \
         cast(Settings, merge_args(settings_class=Settings,
@@ -1243,6 +1321,14 @@ def main(argv: List[str]) -> None:
         rcache: Optional[RcacheClient] = \
             RcacheClient(rcache_settings) if rcache_settings.enabled else None
 
+        stage_tracker = \
+            StageTracker(
+                state_db=state_db,
+                store=ArtifactStore(settings.stage_dir),
+                resume=settings.resume,
+                from_stage=None if settings.from_stage is None
+                else PipelineStage[settings.from_stage])
+
         status_updater.milestone(DownloaderMilestone.ServiceStart)
 
         if settings.delay_hr and (not settings.run_once):
@@ -1272,66 +1358,111 @@ def main(argv: List[str]) -> None:
                     logging.info(
                         f"Current database: '{os.readlink(current_uls_file)}'")
 
-                extract_fsid_table(uls_file=current_uls_file,
-                                   fsid_file=settings.fsid_file,
-                                   executor=executor)
-
-                # Clear some directories from stuff left from previous
-                # downloads
-                for dir_to_clean in [settings.result_dir, settings.temp_dir]:
-                    if dir_to_clean and os.path.isdir(dir_to_clean):
-                        executor.execute(f"rm -rf {dir_to_clean}/*",
-                                         timeout_sec=100, fail_on_error=True)
-
-                logging.info("Copying RAS database")
-                shutil.copyfile(settings.ext_ras_database,
-                                settings.ras_database)
-
                 logging.info("Checking if external parameter files changed")
                 ext_params_file_checker.check()
                 als_record.now(field_name="externals_checked_time")
 
-                # Issue download script
-                cmdline_args: List[str] = []
-                if settings.nice and (os.name == "posix"):
-                    cmdline_args.append("nice")
-                cmdline_args.append(settings.download_script)
-                if settings.region:
-                    cmdline_args += ["--region", settings.region]
-                cmdline_args += ["--save_dir", settings.save_dir]
-                if settings.download_script_args:
-                    cmdline_args.append(settings.download_script_args)
-                if settings.ext_wif_files_dir is not None:
-                    cmdline_args += ["--ext_wif_files_dir", settings.ext_wif_files_dir]
-                logging.info(f"Starting {' '.join(cmdline_args)}")
-                executor.execute(
-                    " ".join(cmdline_args) if settings.download_script_args
-                    else cmdline_args,
-                    cwd=os.path.dirname(settings.download_script),
-                    timeout_sec=settings.timeout_hr * 3600,
-                    fail_on_error=True)
-
-                # Find out name of new ULS file
-                uls_files = glob.glob(os.path.join(settings.result_dir,
-                                                   ULS_FILEMASK))
-                if len(uls_files) < 1:
-                    raise ProcessingException(
-                        "ULS file not generated by ULS downloader")
-                if len(uls_files) > 1:
-                    raise ProcessingException(
-                        f"More than one {ULS_FILEMASK} file generated by ULS "
-                        f"downloader. What gives?")
+                # Download stage
+                download_input = \
+                    combine_digests(
+                        settings.download_script, settings.region,
+                        settings.download_script_args,
+                        settings.ext_wif_files_dir,
+                        file_digest(settings.ext_ras_database))
+                download_record: Optional[StageInfo] = \
+                    stage_tracker.completed(
+                        PipelineStage.Download, download_input,
+                        ext=ULS_EXT, resume_only=True)
+                if download_record is None:
+                    extract_fsid_table(uls_file=current_uls_file,
+                                       fsid_file=settings.fsid_file,
+                                       executor=executor)
+
+                    # Clear some directories from stuff left from previous
+                    # downloads
+                    for dir_to_clean in [settings.result_dir,
+                                         settings.temp_dir]:
+                        if dir_to_clean and os.path.isdir(dir_to_clean):
+                            executor.execute(f"rm -rf {dir_to_clean}/*",
+                                             timeout_sec=100,
+                                             fail_on_error=True)
+
+                    logging.info("Copying RAS database")
+                    shutil.copyfile(settings.ext_ras_database,
+                                    settings.ras_database)
+
+                    # Issue download script
+                    cmdline_args: List[str] = []
+                    if settings.nice and (os.name == "posix"):
+                        cmdline_args.append("nice")
+                    cmdline_args.append(settings.download_script)
+                    if settings.region:
+                        cmdline_args += ["--region", settings.region]
+                    cmdline_args += ["--save_dir", settings.save_dir]
+                    if settings.download_script_args:
+                        cmdline_args.append(settings.download_script_args)
+                    if settings.ext_wif_files_dir is not None:
+                        cmdline_args += ["--ext_wif_files_dir",
+                                         settings.ext_wif_files_dir]
+                    logging.info(f"Starting {' '.join(cmdline_args)}")
+                    executor.execute(
+                        " ".join(cmdline_args) if settings.download_script_args
+                        else cmdline_args,
+                        cwd=os.path.dirname(settings.download_script),
+                        timeout_sec=settings.timeout_hr * 3600,
+                        fail_on_error=True)
+
+                    # Find out name of new ULS file
+                    uls_files = glob.glob(os.path.join(settings.result_dir,
+                                                       ULS_FILEMASK))
+                    if len(uls_files) < 1:
+                        raise ProcessingException(
+                            "ULS file not generated by ULS downloader")
+                    if len(uls_files) > 1:
+                        raise ProcessingException(
+                            f"More than one {ULS_FILEMASK} file generated by "
+                            f"ULS downloader. What gives?")
+                    if get_uls_identity(uls_files[0]) is None:
+                        raise ProcessingException(
+                            "Generated ULS file does not contain identity "
+                            "information")
+                    # FSID table, updated by download script, is stored
+                    # alongside, as it is input for FSID embedding stage
+                    fsid_digest: Optional[str] = \
+                        stage_tracker.store.put_file(settings.fsid_file,
+                                                     ext=FSID_EXT) \
+                        if os.path.isfile(settings.fsid_file) else None
+                    download_record = \
+                        stage_tracker.complete(
+                            PipelineStage.Download, download_input,
+                            stage_tracker.store.put_file(uls_files[0],
+                                                         ext=ULS_EXT),
+                            details={"name": os.path.basename(uls_files[0]),
+                                     "fsid": fsid_digest,
+                                     "artifacts": [fsid_digest]
+                                     if fsid_digest else []})
+                    status_updater.milestone(
+                        DownloaderMilestone.DownloadSuccess)
+                else:
+                    # Restoring FSID table, produced by skipped download
+                    if download_record.details.get("fsid"):
+                        shutil.copyfile(
+                            stage_tracker.store.path(
+                                download_record.details["fsid"], FSID_EXT),
+                            settings.fsid_file)
 
                 # Check what regions were updated
-                new_uls_file = uls_files[0]
-                logging.info(f"ULS file '{new_uls_file}' created. It will "
+                new_uls_file = \
+                    stage_tracker.store.path(download_record.output_digest,
+                                             ULS_EXT)
+                uls_file_name = download_record.details["name"]
+                logging.info(f"ULS file '{uls_file_name}' created. It will "
                              f"undergo some inspection")
                 new_uls_identity = get_uls_identity(new_uls_file)
                 if new_uls_identity is None:
                     raise ProcessingException(
                         "Generated ULS file does not contain identity "
                         "information")
-                status_updater.milestone(DownloaderMilestone.DownloadSuccess)
                 als_record.now(field_name="downloaded_time")
 
                 updated_regions = set(new_uls_identity.keys())
@@ -1349,51 +1480,120 @@ def main(argv: List[str]) -> None:
 
                 # If anything was updated - do the update routine
                 if updated_regions or settings.force:
-                    # Embed updated FSID table to the new database
-                    logging.info("Embedding FSID table")
-                    executor.execute(
-                        [FSID_TOOL, "embed", new_uls_file, settings.fsid_file],
-                        fail_on_error=True)
+                    # FSID embedding stage
+                    embed_input = \
+                        combine_digests(
+                            download_record.output_digest,
+                            file_digest(settings.fsid_file)
+                            if os.path.isfile(settings.fsid_file) else None)
+                    embed_record: Optional[StageInfo] = \
+                        stage_tracker.completed(PipelineStage.FsidEmbed,
+                                                embed_input, ext=ULS_EXT)
+                    if embed_record is None:
+                        logging.info("Embedding FSID table")
+                        embedded_file = \
+                            stage_tracker.store.temp_file(ext=ULS_EXT)
+                        try:
+                            shutil.copyfile(new_uls_file, embedded_file)
+                            executor.execute(
+                                [FSID_TOOL, "embed", embedded_file,
+                                 settings.fsid_file],
+                                fail_on_error=True)
+                            embed_record = \
+                                stage_tracker.complete(
+                                    PipelineStage.FsidEmbed, embed_input,
+                                    stage_tracker.store.put_file(
+                                        embedded_file, ext=ULS_EXT,
+                                        move=True))
+                        finally:
+                            if os.path.isfile(embedded_file):
+                                os.unlink(embedded_file)
 
                     temp_uls_file_name = \
-                        os.path.join(full_ext_db_dir,
-                                     "temp_" + os.path.basename(new_uls_file))
+                        os.path.join(full_ext_db_dir, "temp_" + uls_file_name)
                     # Copy new ULS file to external directory
                     logging.debug(
-                        f"Copying '{new_uls_file}' to '{temp_uls_file_name}'")
-                    shutil.copy2(new_uls_file, temp_uls_file_name)
-
-                    db_diff = DbDiff(prev_filename=current_uls_file,
-                                     new_filename=temp_uls_file_name,
-                                     executor=executor,
-                                     allow_directional_invalidate=settings.
-                                     rcache_directional_invalidate) \
-                        if has_previous else None
+                        f"Copying '{uls_file_name}' to '{temp_uls_file_name}'")
+                    shutil.copy2(
+                        stage_tracker.store.path(embed_record.output_digest,
+                                                 ULS_EXT),
+                        temp_uls_file_name)
+
+                    # Database difference stage
+                    db_diff: Optional[DbDiff] = None
+                    diff_record: Optional[StageInfo] = None
+                    if has_previous:
+                        diff_input = \
+                            combine_digests(
+                                embed_record.output_digest,
+                                file_digest(current_uls_file),
+                                settings.rcache_directional_invalidate)
+                        diff_record = \
+                            stage_tracker.completed(PipelineStage.DbDiff,
+                                                    diff_input, ext=".json")
+                        if diff_record is None:
+                            db_diff = \
+                                DbDiff(prev_filename=current_uls_file,
+                                       new_filename=temp_uls_file_name,
+                                       executor=executor,
+                                       allow_directional_invalidate=settings.
+                                       rcache_directional_invalidate)
+                            if db_diff.valid:
+                                diff_record = \
+                                    stage_tracker.complete(
+                                        PipelineStage.DbDiff, diff_input,
+                                        stage_tracker.store.put_json(
+                                            db_diff.to_dict()))
+                        else:
+                            db_diff = \
+                                DbDiff.from_dict(
+                                    stage_tracker.store.get_json(
+                                        diff_record.output_digest))
                     if db_diff:
                         als_record.db_difference = str(db_diff)
-                    if uls_file_checker.valid(
-                            base_dir=settings.ext_db_dir,
-                            new_filename=os.path.join(
-                                os.path.dirname(settings.ext_db_symlink),
-                                os.path.basename(temp_uls_file_name)),
-                            db_diff=db_diff) or settings.force:
+
+                    # Validation stage. Invalid difference is never skipped
+                    validation_input = \
+                        combine_digests(
+                            embed_record.output_digest,
+                            diff_record.output_digest if diff_record
+                            else None,
+                            settings.max_change_percent, settings.afc_url,
+                            settings.afc_parallel, settings.region)
+                    validated = \
+                        ((db_diff is None) or db_diff.valid) and \
+                        (stage_tracker.completed(
+                            PipelineStage.Validation, validation_input,
+                            ext=ULS_EXT) is not None)
+                    if (not validated) and \
+                            uls_file_checker.valid(
+                                base_dir=settings.ext_db_dir,
+                                new_filename=os.path.join(
+                                    os.path.dirname(settings.ext_db_symlink),
+                                    os.path.basename(temp_uls_file_name)),
+                                db_diff=db_diff):
+                        stage_tracker.complete(
+                            PipelineStage.Validation, validation_input,
+                            embed_record.output_digest)
+                        validated = True
+                    if validated or settings.force:
                         if not settings.force:
                             als_record.now(field_name="validated_time")
                         if settings.force:
                             status_updater.status_check(CheckType.FsDatabase,
                                                         None)
+                        # Installation stage
                         # Renaming database
                         permanent_uls_file_name = \
-                            os.path.join(full_ext_db_dir,
-                                         os.path.basename(new_uls_file))
+                            os.path.join(full_ext_db_dir, uls_file_name)
                         os.rename(temp_uls_file_name, permanent_uls_file_name)
                         # Retargeting symlink
                         update_uls_file(
                             uls_dir=full_ext_db_dir,
-                            uls_file=os.path.basename(new_uls_file),
+                            uls_file=uls_file_name,
                             symlink=os.path.basename(settings.ext_db_symlink),
                             executor=executor)
-                        als_record.fs_db_name = os.path.basename(new_uls_file)
+                        als_record.fs_db_name = uls_file_name
                         als_record.now(field_name="updated_time")
                         if rcache and (db_diff is not None):
                             if db_diff.diff_beams:
@@ -1439,6 +1639,14 @@ def main(argv: List[str]) -> None:
                             all_regions=list(new_uls_identity.keys()))
 
                         status_updater.milestone(DownloaderMilestone.DbUpdated)
+                        stage_tracker.complete(
+                            PipelineStage.Install,
+                            combine_digests(
+                                embed_record.output_digest,
+                                diff_record.output_digest if diff_record
+                                else None),
+                            embed_record.output_digest,
+                            details={"name": uls_file_name})
                         completed = True
                 else:
                     logging.info("FS data is identical to previous. No update "
@@ -1448,6 +1656,10 @@ def main(argv: List[str]) -> None:
                 err_msg = str(ex)
                 logging.error(f"Download failed: {ex}")
             finally:
+                try:
+                    stage_tracker.pipeline_finished()
+                except OSError as ex:
+                    logging.warning(f"Stage artifacts cleanup failed: {ex}")
                 als.als_json_log(topic="fs_download", record=als_record.dict())
                 if settings.run_once:
                     flushed = als.als_flush()
@@ -0,0 +1,268 @@
+""" Checkpointing of FS download pipeline stages """
+
+# Copyright (C) 2022 Broadcom. All rights reserved.
+# The term "Broadcom" refers solely to the Broadcom Inc. corporate affiliate
+# that owns the software below.
+# This work is licensed under the OpenAFC Project License, a copy of which is
+# included with this software program.
+
+# pylint: disable=wrong-import-order, invalid-name, wildcard-import
+# pylint: disable=unused-wildcard-import, logging-fstring-interpolation
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from uls_service_common import *
+from uls_service_state_db import PipelineStage, StageInfo, StateDb
+
+# Size of chunk used in file digest computation
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(filename: str) -> str:
+    """ Returns SHA256 digest of given file's content """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(DIGEST_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def combine_digests(*parts: Any) -> str:
+    """ Returns digest of given sequence of digests and JSON-serializable
+    parameters. None parts are allowed (and distinguished) """
+    return \
+        hashlib.sha256(
+            json.dumps(list(parts), sort_keys=True).encode("utf-8")).\
+        hexdigest()
+
+
+class ArtifactStore:
+    """ Directory of content-addressed stage artifacts
+
+    Artifact file name is its SHA256 digest plus extension, so the same content
+    is never stored twice and file presence means artifact is complete (files
+    are put in place by atomic rename)
+
+    Private attributes:
+    _directory -- Artifact directory
+    """
+
+    def __init__(self, directory: str) -> None:
+        """ Constructor
+
+        Arguments:
+        directory -- Artifact directory. Created if absent
+        """
+        self._directory = directory
+        os.makedirs(self._directory, exist_ok=True)
+
+    def path(self, digest: str, ext: str = "") -> str:
+        """ Path to artifact with given digest and extension """
+        return os.path.join(self._directory, digest + ext)
+
+    def has(self, digest: str, ext: str = "") -> bool:
+        """ True if artifact with given digest and extension present """
+        return os.path.isfile(self.path(digest, ext))
+
+    def put_file(self, filename: str, ext: str = "",
+                 move: bool = False) -> str:
+        """ Puts given file to the store
+
+        Arguments:
+        filename -- File to put
+        ext      -- Artifact file extension
+        move     -- True to move file (must be on the same filesystem as
+                    store), False to copy it
+        Returns artifact digest
+        """
+        digest = file_digest(filename)
+        if self.has(digest, ext):
+            if move:
+                os.unlink(filename)
+        elif move:
+            os.replace(filename, self.path(digest, ext))
+        else:
+            self._put(lambda temp: shutil.copyfile(filename, temp),
+                      self.path(digest, ext))
+        return digest
+
+    def temp_file(self, ext: str = "") -> str:
+        """ Creates temporary file in store directory (for subsequent
+        put_file(move=True)). Returns its name """
+        fd, ret = tempfile.mkstemp(dir=self._directory, prefix=".incomplete_",
+                                   suffix=ext)
+        os.close(fd)
+        return ret
+
+    def put_json(self, obj: Any) -> str:
+        """ Stores given JSON-serializable object
+
+        Arguments:
+        obj -- Object to store
+        Returns artifact digest
+        """
+        content = json.dumps(obj, sort_keys=True, indent=2)
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if not self.has(digest, ".json"):
+
+            def writer(temp: str) -> None:
+                """ Writes content to given file """
+                with open(temp, "w", encoding="utf-8") as f:
+                    f.write(content)
+
+            self._put(writer, self.path(digest, ".json"))
+        return digest
+
+    def get_json(self, digest: str) -> Any:
+        """ Retrieves JSON artifact with given digest """
+        with open(self.path(digest, ".json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def prune(self, keep: Iterable[str]) -> None:
+        """ Removes artifacts other than given ones
+
+        Arguments:
+        keep -- Digests of artifacts to keep
+        """
+        keep_set: Set[str] = set(keep)
+        for filename in os.listdir(self._directory):
+            if os.path.splitext(filename)[0] in keep_set:
+                continue
+            try:
+                os.unlink(os.path.join(self._directory, filename))
+                logging.debug(f"Stale artifact '{filename}' removed")
+            except OSError as ex:
+                logging.warning(
+                    f"Failed to remove stale artifact '{filename}': {ex}")
+
+    def _put(self, writer: Any, dst: str) -> None:
+        """ Writes artifact via temporary file and renames it into place
+
+        Arguments:
+        writer -- Callable that writes artifact to file with given name
+        dst    -- Artifact file name
+        """
+        temp = self.temp_file()
+        try:
+            writer(temp)
+            os.replace(temp, dst)
+            temp = ""
+        finally:
+            if temp:
+                os.unlink(temp)
+
+
+class StageTracker:
+    """ Decides which pipeline stages should be executed and records stage
+    completions
+
+    Stage is considered clean (and skipped) if its completion record has the
+    same input digest as now computed, its artifact is present and it is not
+    forced to rerun by --from_stage. Download stage input (FCC/ISED data on the
+    internet) can't be digested, so it is only skipped on resume.
+
+    Private attributes:
+    _state_db   -- StateDb object
+    _store      -- ArtifactStore object
+    _records    -- Completion records, indexed by stage
+    _resume     -- True to resume from previously completed stages (reset
+                   after first pipeline run)
+    _from_stage -- None or first stage to force execution of (reset after
+                   first pipeline run)
+    """
+
+    def __init__(self, state_db: StateDb, store: ArtifactStore,
+                 resume: bool = False,
+                 from_stage: Optional[PipelineStage] = None) -> None:
+        """ Constructor
+
+        Arguments:
+        state_db   -- StateDb object
+        store      -- ArtifactStore object
+        resume     -- True to resume from previously completed stages on first
+                      pipeline run
+        from_stage -- None or first stage to rerun on first pipeline run
+                      (previous stages are taken from completion records).
+                      Implies resume
+        """
+        self._state_db = state_db
+        self._store = store
+        self._records: Dict[PipelineStage, StageInfo] = state_db.read_stages()
+        self._resume = resume or (from_stage is not None)
+        self._from_stage = from_stage
+
+    @property
+    def store(self) -> ArtifactStore:
+        """ Artifact store """
+        return self._store
+
+    def completed(self, stage: PipelineStage, input_digest: str,
+                  ext: str = "", resume_only: bool = False) \
+            -> Optional[StageInfo]:
+        """ Checks if stage may be skipped
+
+        Arguments:
+        stage        -- Stage in question
+        input_digest -- Digest of stage inputs
+        ext          -- Extension of stage artifact
+        resume_only  -- True if stage inputs are not fully covered by digest
+                        (e.g. internet data), so stage only may be skipped on
+                        resume
+        Returns completion record if stage may be skipped, None if it should
+        be executed
+        """
+        if (self._from_stage is not None) and \
+                (stage.value >= self._from_stage.value):
+            return None
+        if resume_only and (not self._resume):
+            return None
+        record = self._records.get(stage)
+        if (record is None) or (record.input_digest != input_digest) or \
+                (not self._store.has(record.output_digest, ext)):
+            return None
+        logging.info(f"Stage {stage.name} skipped: its inputs not changed "
+                     f"since {record.timestamp.isoformat()}")
+        return record
+
+    def complete(self, stage: PipelineStage, input_digest: str,
+                 output_digest: str,
+                 details: Optional[Dict[str, Any]] = None) -> StageInfo:
+        """ Records stage completion
+
+        Arguments:
+        stage         -- Completed stage
+        input_digest  -- Digest of stage inputs
+        output_digest -- Digest of stage artifact
+        details       -- Optional stage-specific details
+        Returns completion record
+        """
+        self._state_db.write_stage(stage=stage, input_digest=input_digest,
+                                   output_digest=output_digest,
+                                   details=details)
+        self._records = self._state_db.read_stages()
+        return self._records[stage]
+
+    def pipeline_finished(self) -> None:
+        """ Called at the end of pipeline run. Resets resume mode and removes
+        artifacts not referenced by completion records (as output or in
+        'artifacts' list of details) """
+        self._resume = False
+        self._from_stage = None
+        keep: List[str] = []
+        for record in self._records.values():
+            keep.append(record.output_digest)
+            keep += record.details.get("artifacts", [])
+        self._store.prune(keep)
+
+    @staticmethod
+    def stage_names() -> List[str]:
+        """ List of stage names (for command line help) """
+        return [stage.name for stage in PipelineStage]
@@ -13,6 +13,7 @@
 
 import datetime
 import enum
+import json
 import requests
 import shlex
 import sqlalchemy as sa
@@ -87,6 +88,38 @@ CheckInfo = \
             ("timestamp", datetime.datetime)])
 
 
+# Stages of FS download pipeline, in order of execution. Names used in
+# database - please change judiciously
+PipelineStage = \
+    enum.Enum("PipelineStage",
+              [
+                  # Download script run (download, parse, antenna processing)
+                  "Download",
+                  # FSID table embedding
+                  "FsidEmbed",
+                  # Computation of difference with current database
+                  "DbDiff",
+                  # Validity check (difference size, trial AFC Requests)
+                  "Validation",
+                  # New database installation and Rcache invalidation
+                  "Install"])
+
+# Information about completed pipeline stage
+StageInfo = \
+    NamedTuple(
+        "StageInfo",
+        [
+            # Stage
+            ("stage", PipelineStage),
+            # Digest of stage inputs
+            ("input_digest", str),
+            # Digest of stage output artifact
+            ("output_digest", str),
+            # Stage-specific details (e.g. original artifact file name)
+            ("details", Dict[str, Any]),
+            # Stage completion timestamp
+            ("timestamp", datetime.datetime)])
+
 # Alarm types
 AlarmType = enum.Enum("AlarmType", ["MissingMilestone", "FailedCheck"])
 
@@ -130,9 +163,12 @@ class StateDb:
     # Name of table with check results
     CHECKS_TABLE = "checks"
 
+    # Name of table with pipeline stage completion records
+    STAGES_TABLE = "stages"
+
     # All known table names (not including Alembic, etc.)
     ALL_TABLE_NAMES = [MILESTONE_TABLE_NAME, ALARM_TABLE_NAME, LOG_TABLE_NAME,
-                       CHECKS_TABLE]
+                       CHECKS_TABLE, STAGES_TABLE]
 
     def __init__(self, db_dsn: str, db_password_file: Optional[str]) -> None:
         """ Constructor
@@ -180,6 +216,15 @@ class StateDb:
             sa.Column("check_item", sa.String(), primary_key=True, index=True),
             sa.Column("errmsg", sa.String(), nullable=True),
             sa.Column("timestamp", sa.DateTime(timezone=True), nullable=False))
+        sa.Table(
+            self.STAGES_TABLE,
+            self.metadata,
+            sa.Column("stage", sa.Enum(PipelineStage), primary_key=True,
+                      index=True),
+            sa.Column("input_digest", sa.String(), nullable=False),
+            sa.Column("output_digest", sa.String(), nullable=False),
+            sa.Column("details", sa.String(), nullable=True),
+            sa.Column("timestamp", sa.DateTime(timezone=True), nullable=False))
         self._engine: Any = None
 
     def create_db(self, db_creator_url: Optional[str],
@@ -500,3 +545,62 @@ class StateDb:
                     timestamp=rec.timestamp)
             ret.setdefault(check_info.check_type, []).append(check_info)
         return ret
+
+    def write_stage(self, stage: PipelineStage, input_digest: str,
+                    output_digest: str,
+                    details: Optional[Dict[str, Any]] = None) -> None:
+        """ Write pipeline stage completion record
+
+        Arguments:
+        stage         -- Completed stage
+        input_digest  -- Digest of stage inputs
+        output_digest -- Digest of stage output artifact
+        details       -- Optional stage-specific details
+        """
+        table = self.metadata.tables[self.STAGES_TABLE]
+        ins = sa_pg.insert(table).\
+            values(stage=stage.name, input_digest=input_digest,
+                   output_digest=output_digest,
+                   details=json.dumps(details or {}),
+                   timestamp=datetime.datetime.now(datetime.timezone.utc))
+        ins = \
+            ins.on_conflict_do_update(
+                index_elements=["stage"],
+                set_={c.name: ins.excluded[c.name]
+                      for c in table.c if not c.primary_key})
+        self._execute([ins])
+
+    def read_stages(self) -> Dict[PipelineStage, StageInfo]:
+        """ Read pipeline stage completion records
+
+        Returns dictionary of StageInfo objects, indexed by stage
+        """
+        table = self.metadata.tables[self.STAGES_TABLE]
+        sel = sa.select([table.c.stage, table.c.input_digest,
+                         table.c.output_digest, table.c.details,
+                         table.c.timestamp])
+        rp = self._execute([sel])
+        ret: Dict[PipelineStage, StageInfo] = {}
+        for rec in rp:
+            stage_info = \
+                StageInfo(
+                    stage=PipelineStage[rec.stage],
+                    input_digest=rec.input_digest,
+                    output_digest=rec.output_digest,
+                    details=json.loads(rec.details) if rec.details else {},
+                    timestamp=rec.timestamp)
+            ret[stage_info.stage] = stage_info
+        return ret
+
+    def clear_stages(self, stages: Iterable[PipelineStage]) -> None:
+        """ Remove completion records of given pipeline stages
+
+        Arguments:
+        stages -- Stages to remove records of
+        """
+        stage_names = [stage.name for stage in stages]
+        if not stage_names:
+            return
+        table = self.metadata.tables[self.STAGES_TABLE]
+        self._execute(
+            [sa.delete(table).where(table.c.stage.in_(stage_names))])